@@ -3,15 +3,20 @@ __author__ = 'frank'
 import os
 import os.path
 import pprint
+import subprocess
+import threading
 import traceback
-import urllib2
 import urlparse
 import tempfile
 
 import zstacklib.utils.daemon as daemon
 import zstacklib.utils.http as http
 import zstacklib.utils.jsonobject as jsonobject
-from zstacklib.utils import lock
+from zstacklib.utils import ceph
+from zstacklib.utils import cephclient
+from zstacklib.utils import downloader
+from zstacklib.utils import imagecatalog
+from zstacklib.utils import taskregistry
 from zstacklib.utils import thread
 from zstacklib.utils.bash import *
 from zstacklib.utils.report import Report
@@ -148,68 +153,167 @@ class UploadTask(object):
     def is_running(self):
         return not(self.completed or self.is_started())
 
-class UploadTasks(object):
-    MAX_RECORDS = 80
-
-    def __init__(self):
-        self.tasks = {}
-
-    def _expunge_oldest_task(self):
-        key, ts = '',  linux.get_current_timestamp()
-        for k in self.tasks:
-            task = self.tasks[k]
-
-            if task.is_running():
-                continue
+    def to_dict(self):
+        return dict(self.__dict__)
 
-            if task.lastOpTime < ts:
-                key, ts = k, task.lastOpTime
+    @staticmethod
+    def from_dict(d):
+        task = UploadTask(d['imageUuid'], d['installPath'], d['dstPath'], d['tmpPath'])
+        task.__dict__.update(d)
+        if not task.completed:
+            # the upload connection is gone with the agent restarted
+            task.fail('upload interrupted by restarting the ceph backup storage agent')
+        return task
 
-        if key != '': del(self.tasks[key])
+class UploadTasks(object):
+    SNAPSHOT_PATH = '/var/lib/zstack/ceph-backupstorage/upload-tasks.json'
 
+    def __init__(self, snapshot_path=None):
+        self.tasks = taskregistry.TaskRegistry(lambda t: t.completed, lambda t: t.lastOpTime,
+                                               snapshot_path=snapshot_path, to_dict=UploadTask.to_dict,
+                                               from_dict=UploadTask.from_dict)
 
-    @lock.lock('ceph-upload-task')
     def add_task(self, t):
-        if len(self.tasks) > self.MAX_RECORDS:
-            self._expunge_oldest_task()
-        self.tasks[t.imageUuid] = t
+        self.tasks.add(t.imageUuid, t)
 
-    @lock.lock('ceph-upload-task')
     def get_task(self, imageUuid):
         return self.tasks.get(imageUuid)
 
+    def lock_of(self, imageUuid):
+        return self.tasks.lock_of(imageUuid)
+
 # ------------------------------------------------------------------ #
 
-class ProgressedFileWriter(object):
-    def __init__(self, wfd, pfunc):
-        self.wfd = wfd
-        self.pfunc = pfunc
-        self.bytesWritten = 0
+import cherrypy
 
-    def write(self, s):
-        self.wfd.write(s)
-        self.bytesWritten += len(s)
-        self.pfunc(self.bytesWritten)
+IMPORT_IMAGE_CMD = 'rbd import --image-format 2 - %s'
+# data is piped to the importer in multiples of the rbd object size
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+IMAGE_HEADER_LENGTH = 0x9007
+# each upload holds up to WRITE_BUFFER_SIZE + 2 * READ_BLOCK_SIZE bytes of memory
+MAX_CONCURRENT_UPLOADS = 8
+upload_slots = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
+
+class ImageImporter(object):
+    '''
+    pipes an uploaded image into the stdin of an importer command. The format of the image
+    is sniffed from the first buffer, the upload progress is updated once per buffer.
+    '''
+    def __init__(self, task, import_cmd, lock=None):
+        self.task = task
+        self.lock = lock or threading.RLock()
+        self.import_cmd = import_cmd
+        self.err = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(import_cmd, shell=True, stdin=subprocess.PIPE, stdout=self.err,
+                                        stderr=self.err, close_fds=True, executable='/bin/bash')
+        self.buf = []
+        self.buffered = 0
+        self.written = 0
+        self.header = None
+
+    @property
+    def image_format(self):
+        return get_image_format_from_buf(self.header or '')
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buffered += len(data)
+        if self.buffered >= WRITE_BUFFER_SIZE:
+            self._flush(aligned=True)
+
+    def _flush(self, aligned=False):
+        data = ''.join(self.buf)
+        if aligned:
+            size = len(data) - len(data) % WRITE_BUFFER_SIZE
+            self.buf = [data[size:]] if size < len(data) else []
+            self.buffered = len(data) - size
+            if size < len(data):
+                data = data[:size]
+        else:
+            self.buf = []
+            self.buffered = 0
 
-    def seek(self, offset, whence=None):
-        pass
+        if self.header is None:
+            self.header = data[:IMAGE_HEADER_LENGTH]
 
-import cherrypy
-class CustomPart(cherrypy._cpreqbody.Part):
-    """A customized multipart"""
-    maxrambytes = 0
-
-    def __init__(self, fp, headers, boundary, fifopath, pfunc):
-        cherrypy._cpreqbody.Part.__init__(self, fp, headers, boundary)
-        self.wfd = None
-        self.file = None
-        self.value = None
-        self.fifopath = fifopath
-        self.pfunc = pfunc
-
-    def make_file(self):
-        self.wfd = open(self.fifopath, 'w')
-        return ProgressedFileWriter(self.wfd, self.pfunc)
+        try:
+            self.process.stdin.write(data)
+        except IOError as e:
+            raise Exception('failed to write image to [%s], %s, %s' % (self.import_cmd, e, self._read_error()))
+        self.written += len(data)
+        if self.task:
+            with self.lock:
+                self.task.downloadedSize = self.written
+                self.task.lastOpTime = linux.get_current_timestamp()
+
+    def _read_error(self):
+        self.err.seek(0)
+        return self.err.read()
+
+    def close(self):
+        self._flush()
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise Exception('failed to import image by [%s], return code: %s, error: %s' %
+                            (self.import_cmd, self.process.returncode, self._read_error()))
+        self.err.close()
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.err.close()
+
+def _find_part_end(data, delimiter):
+    # the delimiter is only a boundary if followed by '--', a line break or padding
+    start = 0
+    while True:
+        idx = data.find(delimiter, start)
+        if idx < 0:
+            return None
+
+        follow = data[idx + len(delimiter):idx + len(delimiter) + 2]
+        if len(follow) < 2:
+            return None
+        if follow == '--' or follow[0] in ' \t\r\n':
+            return idx - 1 if idx > 0 and data[idx - 1] == '\r' else idx
+        start = idx + 1
+
+def read_part_body(fp, boundary, out):
+    '''
+    copies the body of the current multipart part from fp to out in large blocks,
+    then drains the rest of the request body
+    '''
+    delimiter = '\n' + boundary
+    # '\r' before and two bytes after the delimiter are needed to find the end
+    keep = len(delimiter) + 3
+    # the line break before the first boundary is part of the delimiter, fake one
+    # for an empty body and skip it when writing
+    pending = '\n'
+    skip = 1
+    while True:
+        block = fp.read(READ_BLOCK_SIZE)
+        if not block:
+            raise EOFError("Illegal end of multipart body.")
+
+        data = pending + block
+        end = _find_part_end(data, delimiter)
+        if end is not None:
+            if end > skip:
+                out.write(data[skip:end])
+            break
+
+        cut = len(data) - keep
+        if cut > skip:
+            out.write(data[skip:cut])
+            pending = data[cut:]
+            skip = 0
+        else:
+            pending = data
+
+    while fp.read(READ_BLOCK_SIZE):
+        pass
 
 def get_boundary(entity):
     ib = ""
@@ -254,59 +358,50 @@ def get_image_format_from_buf(qhdr):
         return 'iso'
     return "raw"
 
-def stream_body(task, fpath, entity, boundary):
-    def _progress_consumer(total):
-        task.downloadedSize = total
-
-    @thread.AsyncThread
-    def _do_import(task, fpath):
-        shell.check_run("cat %s | rbd import --image-format 2 - %s" % (fpath, task.tmpPath))
+def receive_image(task, entity, boundary, import_cmd, lock=None):
+    '''
+    pipes the file of a multipart upload into import_cmd
 
+    @return: the image format sniffed from its header
+    '''
     while True:
         headers = cherrypy._cpreqbody.Part.read_headers(entity.fp)
-        p = CustomPart(entity.fp, headers, boundary, fpath, _progress_consumer)
-        if not p.filename:
-            continue
-
-        # start consumer
-        _do_import(task, fpath)
-        try:
-            p.process()
-        except Exception as e:
-            logger.warn('process image %s failed: %s' % (task.imageUuid, str(e)))
-            pass
-        finally:
-            if p.wfd is not None:
-                p.wfd.close()
-        break
+        p = cherrypy._cpreqbody.Part(entity.fp, headers, boundary)
+        if p.filename:
+            break
+        p.read_lines_to_boundary()
 
-    if task.downloadedSize != task.expectedSize:
-        task.fail('incomplete upload, got %d, expect %d' % (task.downloadedSize, task.expectedSize))
+    importer = ImageImporter(task, import_cmd, lock)
+    try:
+        read_part_body(entity.fp, boundary, importer)
+        importer.close()
+    except:
+        importer.abort()
+        raise
+
+    return importer.image_format
+
+def stream_body(task, entity, boundary, lock):
+    '''lock is the one of the task, the state of the task is only changed with it held'''
+    def fail(reason):
+        with lock:
+            task.fail(reason)
         shell.run('rbd rm %s' % task.tmpPath)
-        return
-
-    file_format = None
-    qcow2_length = 0x9007
-    image_format = "raw"
-    image_header_file = "tmp/%s_header" % task.imageUuid
-    shell.check_run("rbd export %s - | head -%d > %s" % (task.tmpPath, qcow2_length, image_header_file))
-    fd = open(image_header_file)
-    qhdr = fd.read(qcow2_length)
-    fd.close()
-    linux.rm_file_force(image_header_file)
-    if len(qhdr) >= qcow2_length:
-        image_format = get_image_format_from_buf(qhdr)
 
     try:
-        file_format = linux.get_img_fmt('rbd:'+task.tmpPath)
+        image_format = receive_image(task, entity, boundary, IMPORT_IMAGE_CMD % task.tmpPath, lock)
     except Exception as e:
-        task.fail('upload image %s failed: %s' % (task.imageUuid, str(e)))
+        logger.warn('process image %s failed: %s' % (task.imageUuid, str(e)))
+        fail('upload image %s failed: %s' % (task.imageUuid, str(e)))
+        return
+
+    if task.downloadedSize != task.expectedSize:
+        fail('incomplete upload, got %d, expect %d' % (task.downloadedSize, task.expectedSize))
         return
 
-    if file_format == 'qcow2':
-        if linux.qcow2_get_backing_file('rbd:'+task.tmpPath):
-            task.fail('Qcow2 image %s has backing file' % task.imageUuid)
-            shell.run('rbd rm %s' % task.tmpPath)
+    if image_format in ('qcow2', 'derivedQcow2'):
+        if image_format == 'derivedQcow2' or linux.qcow2_get_backing_file('rbd:'+task.tmpPath):
+            fail('Qcow2 image %s has backing file' % task.imageUuid)
             return
 
         conf_path = None
@@ -326,8 +421,9 @@ def stream_body(task, fpath, entity, boundary):
     else:
         shell.check_run('rbd mv %s %s' % (task.tmpPath, task.dstPath))
 
-    task.image_format = image_format
-    task.success()
+    with lock:
+        task.image_format = image_format
+        task.success()
 
 # ------------------------------------------------------------------ #
 
@@ -355,15 +451,15 @@ class CephAgent(object):
 
     http_server = http.HttpServer(port=7761)
     http_server.logfile_path = log.get_logfile_path()
-    upload_tasks = UploadTasks()
+    upload_tasks = UploadTasks(UploadTasks.SNAPSHOT_PATH)
 
     def __init__(self):
         self.http_server.register_async_uri(self.INIT_PATH, self.init)
-        self.http_server.register_async_uri(self.DOWNLOAD_IMAGE_PATH, self.download)
+        self.http_server.register_async_uri(self.DOWNLOAD_IMAGE_PATH, self.download, lane=thread.BULK_LANE)
         self.http_server.register_raw_uri(self.UPLOAD_IMAGE_PATH, self.upload)
         self.http_server.register_async_uri(self.UPLOAD_PROGRESS_PATH, self.get_upload_progress)
         self.http_server.register_async_uri(self.DELETE_IMAGE_PATH, self.delete)
-        self.http_server.register_async_uri(self.PING_PATH, self.ping)
+        self.http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
         self.http_server.register_async_uri(self.GET_IMAGE_SIZE_PATH, self.get_image_size)
         self.http_server.register_async_uri(self.GET_FACTS, self.get_facts)
         self.http_server.register_sync_uri(self.ECHO_PATH, self.echo)
@@ -373,42 +469,16 @@ class CephAgent(object):
         self.http_server.register_async_uri(self.DELETE_IMAGES_METADATA, self.delete_image_metadata_from_file)
         self.http_server.register_async_uri(self.CHECK_POOL_PATH, self.check_pool)
         self.http_server.register_async_uri(self.GET_LOCAL_FILE_SIZE, self.get_local_file_size)
-        self.http_server.register_async_uri(self.MIGRATE_IMAGE_PATH, self.migrate_image)
+        self.http_server.register_async_uri(self.MIGRATE_IMAGE_PATH, self.migrate_image, lane=thread.BULK_LANE)
+        self.catalogs = {}
 
-    def _get_capacity(self):
-        o = shell.call('ceph df -f json')
-        df = jsonobject.loads(o)
+    def _get_capacity(self, force=False):
+        capacity = ceph.capacity.get(force)
+        poolCapacities = [CephPoolCapacity(p.name, p.available, p.replicated_size, p.used) for p in capacity.pools]
+        return capacity.total, capacity.available, poolCapacities
 
-        if df.stats.total_bytes__ is not None :
-            total = long(df.stats.total_bytes_)
-        elif df.stats.total_space__ is not None:
-            total = long(df.stats.total_space__) * 1024
-        else:
-            raise Exception('unknown ceph df output: %s' % o)
-
-        if df.stats.total_avail_bytes__ is not None:
-            avail = long(df.stats.total_avail_bytes_)
-        elif df.stats.total_avail__ is not None:
-            avail = long(df.stats.total_avail_) * 1024
-        else:
-            raise Exception('unknown ceph df output: %s' % o)
-
-        poolCapacities = []
-
-        if not df.pools:
-            return total, avail, poolCapacities
-
-        for pool in df.pools:
-            poolAvailable = pool.stats.max_avail_
-            poolUsed = pool.stats.bytes_used_
-            poolSize = jsonobject.loads(shell.call('ceph osd pool get %s size -f json' % pool.name)).size
-            poolCapacity = CephPoolCapacity(pool.name, poolAvailable, poolSize, poolUsed)
-            poolCapacities.append(poolCapacity)
-
-        return total, avail, poolCapacities
-
-    def _set_capacity_to_response(self, rsp):
-        total, avail, poolCapacities = self._get_capacity()
+    def _set_capacity_to_response(self, rsp, force=False):
+        total, avail, poolCapacities = self._get_capacity(force)
 
         rsp.totalCapacity = total
         rsp.availableCapacity = avail
@@ -423,7 +493,7 @@ class CephAgent(object):
         return path.lstrip('ceph:').lstrip('//')
 
     def _get_file_size(self, path):
-        o = shell.call('rbd --format json info %s' % path)
+        o = cephclient.get_client().image_info(path)
         o = jsonobject.loads(o)
         return long(o.size_)
 
@@ -439,136 +509,76 @@ class CephAgent(object):
         with open(path) as f:
             return f.read()
 
-    @in_bash
+    def _get_catalog(self, pool_name):
+        bs_uuid = pool_name.split("-")[-1]
+        pool = "bak-t-%s" % bs_uuid
+        catalog = self.catalogs.get(pool)
+        if catalog is None:
+            catalog = self.catalogs[pool] = imagecatalog.ImageCatalog(imagecatalog.RadosStore(pool, self.CEPH_METADATA_FILE))
+        return catalog
+
     @replyerror
     def get_images_metadata(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
-        valid_images_info = ""
-        self.get_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
-        last_image_install_path = ""
-        bs_ceph_info_file = "/tmp/%s" % self.CEPH_METADATA_FILE
-        with open(bs_ceph_info_file) as fd:
-            images_info = fd.read()
-            for image_info in images_info.split('\n'):
-                if image_info != '':
-                    image_json = jsonobject.loads(image_info)
-                    # todo support multiple bs
-                    image_uuid = image_json['uuid']
-                    image_install_path = image_json["backupStorageRefs"][0]["installPath"]
-                    ret = bash_r("rbd info %s" % image_install_path.split("//")[1])
-                    if ret == 0 :
-                        logger.info("Check image %s install path %s successfully!" % (image_uuid, image_install_path))
-                        if image_install_path != last_image_install_path:
-                            valid_images_info = image_info + '\n' + valid_images_info
-                            last_image_install_path = image_install_path
-                    else:
-                        logger.warn("Image %s install path %s is invalid!" % (image_uuid, image_install_path))
-
-        self.put_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
+        catalog = self._get_catalog(cmd.poolName)
+        valid_images_info = []
+        install_paths = set()
+        for image_info in catalog.export(newest_first=True):
+            image_install_path = imagecatalog.get_install_path(image_info)
+            if image_install_path in install_paths:
+                continue
+            if cephclient.get_client().image_exists(image_install_path.split("//")[1]):
+                valid_images_info.append(image_info + '\n')
+                install_paths.add(image_install_path)
+            else:
+                logger.warn("Image install path %s is invalid! %s" % (image_install_path, image_info))
+        catalog.compact()
+
         rsp = GetImageMetaDataResponse()
-        rsp.imagesMetadata= valid_images_info
+        rsp.imagesMetadata = ''.join(valid_images_info)
         return jsonobject.dumps(rsp)
 
-    @in_bash
     @replyerror
     def check_image_metadata_file_exist(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
         rsp = CheckImageMetaDataFileExistResponse()
         rsp.backupStorageMetaFileName = self.CEPH_METADATA_FILE
-        ret, output = bash_ro("rados -p bak-t-%s stat %s" % (bs_uuid,self.CEPH_METADATA_FILE))
-        if ret == 0:
-            rsp.exist = True
-        else:
-            rsp.exist = False
+        rsp.exist = self._get_catalog(cmd.poolName).exists()
         return jsonobject.dumps(rsp)
 
-    def get_metadata_file(self, bs_uuid, file_name):
-        local_file_name = "/tmp/%s" % file_name
-        bash_ro("rm -rf %s" % local_file_name)
-        bash_ro("rados -p bak-t-%s get %s %s" % (bs_uuid, file_name, local_file_name))
-
-    def put_metadata_file(self, bs_uuid, file_name):
-        local_file_name = "/tmp/%s" % file_name
-        ret, output = bash_ro("rados -p bak-t-%s put %s %s" % (bs_uuid, file_name, local_file_name))
-        if ret == 0:
-            bash_ro("rm -rf %s" % local_file_name)
-
-    @in_bash
     @replyerror
     def dump_image_metadata_to_file(self, req):
-
-        def _write_info_to_metadata_file(fd):
-            strip_list_content = content[1:-1]
-            data_list = strip_list_content.split('},')
-            for item in data_list:
-                if item.endswith("}") is not True:
-                    item = item + "}"
-                    fd.write(item + '\n')
-
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
-        content = cmd.imageMetaData
-        dump_all_metadata = cmd.dumpAllMetaData
-        if dump_all_metadata is True:
-            # this means no metadata exist in ceph
-            bash_r("touch /tmp/%s" % self.CEPH_METADATA_FILE)
+        catalog = self._get_catalog(cmd.poolName)
+        images = imagecatalog.parse_images(cmd.imageMetaData or '')
+        if cmd.dumpAllMetaData is True:
+            catalog.replace(images)
         else:
-            self.get_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
-        bs_ceph_info_file = "/tmp/%s" % self.CEPH_METADATA_FILE
-        if content is not None:
-            if '[' == content[0] and ']' == content[-1]:
-                if dump_all_metadata is True:
-                    with open(bs_ceph_info_file, 'w') as fd:
-                        _write_info_to_metadata_file(fd)
-                else:
-                    with open(bs_ceph_info_file, 'a') as fd:
-                        _write_info_to_metadata_file(fd)
-            else:
-                # one image info
-                if dump_all_metadata is True:
-                    with open(bs_ceph_info_file, 'w') as fd:
-                        fd.write(content + '\n')
-                else:
-                    with open(bs_ceph_info_file, 'a') as fd:
-                        fd.write(content + '\n')
-
-        self.put_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
+            catalog.put(images)
+
         rsp = DumpImageMetaDataToFileResponse()
         return jsonobject.dumps(rsp)
 
-    @in_bash
     @replyerror
     def delete_image_metadata_from_file(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        image_uuid = cmd.imageUuid
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
-        self.get_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
-        bs_ceph_info_file = "/tmp/%s" % self.CEPH_METADATA_FILE
-        ret, output = bash_ro("sed -i.bak '/%s/d' %s" % (image_uuid, bs_ceph_info_file))
-        self.put_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
+        self._get_catalog(cmd.poolName).delete(cmd.imageUuid)
         rsp = DeleteImageMetaDataResponse()
-        rsp.ret = ret
+        rsp.ret = 0
         return jsonobject.dumps(rsp)
 
-
-
     @replyerror
     @in_bash
     def get_facts(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        o = bash_o('ceph mon_status')
+        client = cephclient.get_client()
+        o = client.mon_command('mon_status')
         mon_status = jsonobject.loads(o)
         fsid = mon_status.monmap.fsid_
 
         rsp = GetFactsRsp()
 
-        facts = bash_o('ceph -s -f json')
+        facts = client.mon_command('status')
         mon_facts = jsonobject.loads(facts)
         for mon in mon_facts.monmap.mons:
             ADDR = mon.addr.split(':')[0]
@@ -599,7 +609,7 @@ class CephAgent(object):
 
         rsp = InitRsp()
         rsp.fsid = fsid
-        self._set_capacity_to_response(rsp)
+        self._set_capacity_to_response(rsp, force=True)
 
         return jsonobject.dumps(rsp)
 
@@ -607,14 +617,10 @@ class CephAgent(object):
         return path.lstrip('ceph:').lstrip('//').split('/')
 
     def _fail_task(self, task, reason):
-        task.fail(reason)
+        with self.upload_tasks.lock_of(task.imageUuid):
+            task.fail(reason)
         raise Exception(reason)
 
-    def _get_fifopath(self, uu):
-        import tempfile
-        d = tempfile.gettempdir()
-        return os.path.join(d, uu)
-
     # handler for multipart upload, requires:
     # - header X-IMAGE-UUID
     # - header X-IMAGE-SIZE
@@ -626,7 +632,8 @@ class CephAgent(object):
         if task is None:
             raise Exception('image not found %s' % imageUuid)
 
-        task.expectedSize = long(imageSize)
+        with self.upload_tasks.lock_of(imageUuid):
+            task.expectedSize = long(imageSize)
         total, avail, poolCapacities = self._get_capacity()
         if avail <= task.expectedSize:
             self._fail_task(task, 'capacity not enough for size: ' + imageSize)
@@ -637,15 +644,10 @@ class CephAgent(object):
             self._fail_task(task, 'unexpected post form')
 
         try:
-            # prepare the fifo to save image upload
-            fpath = self._get_fifopath(imageUuid)
-            linux.rm_file_force(fpath)
-            os.mkfifo(fpath)
-            stream_body(task, fpath, entity, boundary)
+            with upload_slots:
+                stream_body(task, entity, boundary, self.upload_tasks.lock_of(imageUuid))
         except Exception as e:
             self._fail_task(task, str(e))
-        finally:
-            linux.rm_file_force(fpath)
 
     def _prepare_upload(self, cmd):
         start = len(self.UPLOAD_PROTO)
@@ -670,6 +672,10 @@ class CephAgent(object):
         if task is None:
             raise Exception('image not found %s' % cmd.imageUuid)
 
+        with self.upload_tasks.lock_of(cmd.imageUuid):
+            return self._get_upload_progress_rsp(task)
+
+    def _get_upload_progress_rsp(self, task):
         rsp = UploadProgressRsp()
         rsp.completed = task.completed
         rsp.installPath = task.installPath
@@ -698,9 +704,7 @@ class CephAgent(object):
         def _get_origin_format(path):
             qcow2_length = 0x9007
             if path.startswith('http://') or path.startswith('https://') or path.startswith('ftp://'):
-                resp = urllib2.urlopen(path)
-                qhdr = resp.read(qcow2_length)
-                resp.close()
+                qhdr = image_downloader.sniff(qcow2_length)
             elif path.startswith('sftp://'):
                 fd, tmp_file = tempfile.mkstemp()
                 get_header_from_pipe_cmd = "timeout 60 head --bytes=%d %s > %s" % (qcow2_length, pipe_path, tmp_file)
@@ -732,24 +736,6 @@ class CephAgent(object):
         def _1():
             shell.check_run('rbd rm %s/%s' % (pool, tmp_image_name))
 
-        def _getRealSize(length):
-            '''length looks like: 10245K'''
-            logger.debug(length)
-            if not length[-1].isalpha():
-                return length
-            units = {
-                "g": lambda x: x * 1024 * 1024 * 1024,
-                "m": lambda x: x * 1024 * 1024,
-                "k": lambda x: x * 1024,
-            }
-            try:
-                if not length[-1].isalpha():
-                    return length
-                return units[length[-1].lower()](int(length[:-1]))
-            except:
-                logger.warn(linux.get_exception_stacktrace())
-                return length
-
         # whether we have an upload request
         if cmd.url.startswith(self.UPLOAD_PROTO):
             self._prepare_upload(cmd)
@@ -768,44 +754,34 @@ class CephAgent(object):
 
         url = urlparse.urlparse(cmd.url)
         if url.scheme in ('http', 'https', 'ftp'):
+            image_downloader = downloader.Downloader(cmd.url)
             image_format = get_origin_format(cmd.url, True)
-            cmd.url = linux.shellquote(cmd.url)
             # roll back tmp ceph file after import it
             _1()
 
-            _, PFILE = tempfile.mkstemp()
-            content_length = shell.call('curl -sI %s|grep Content-Length' % cmd.url).strip().split()[1]
-            total = _getRealSize(content_length)
-
-            def _getProgress(synced):
-                logger.debug("getProgress in ceph-bs-agent, synced: %s, total: %s" % (synced, total))
-                last = shell.call('tail -1 %s' % PFILE).strip()
-                if not last or len(last.split()) < 1:
-                    return synced
-                logger.debug("last synced: %s" % last)
-                written = _getRealSize(last.split()[0])
-                if total > 0 and synced < written:
-                    synced = written
-                    if synced < total:
-                        percent = int(round(float(synced) / float(total) * 90))
-                        report.progress_report(percent, "report")
-                return synced
-
+            total = image_downloader.remote.size
             logger.debug("content-length is: %s" % total)
+            last_percent = [0]
 
-            _, _, err = bash_progress_1('set -o pipefail;wget --no-check-certificate -O - %s 2>%s| rbd import --image-format 2 - %s/%s'
-                       % (cmd.url, PFILE, pool, tmp_image_name), _getProgress)
-            if err:
-                raise err
-            actual_size = linux.get_file_size_by_http_head(cmd.url)
+            def _progress(downloaded, total):
+                if not total:
+                    return
+                percent = int(round(float(downloaded) / float(total) * 90))
+                if percent > last_percent[0]:
+                    last_percent[0] = percent
+                    report.progress_report(percent, "report")
 
-            if os.path.exists(PFILE):
-                os.remove(PFILE)
+            importer = ImageImporter(None, IMPORT_IMAGE_CMD % ('%s/%s' % (pool, tmp_image_name)))
+            try:
+                actual_size = image_downloader.download(importer, progress=_progress)
+                importer.close()
+            except:
+                importer.abort()
+                raise
 
         elif url.scheme == 'sftp':
             port = (url.port, 22)[url.port is None]
-            _, PFILE = tempfile.mkstemp()
-            pipe_path = PFILE + "fifo"
+            pipe_path = tempfile.mktemp(suffix='.fifo')
             scp_to_pipe_cmd = "scp -P %d -o StrictHostKeyChecking=no %s@%s:%s %s" % (port, url.username, url.hostname, url.path, pipe_path)
             sftp_command = "sftp -o StrictHostKeyChecking=no -o BatchMode=no -P %s -b /dev/stdin %s@%s" % (port, url.username, url.hostname) + " <<EOF\n%s\nEOF\n"
             if url.password is not None:
@@ -819,29 +795,17 @@ class CephAgent(object):
             # roll back tmp ceph file after import it
             _1()
 
-            def _get_progress(synced):
-                logger.debug("getProgress in add image")
-                if not os.path.exists(PFILE):
-                    return synced
-                last = shell.call('tail -1 %s' % PFILE).strip()
-                if not last or not last.isdigit():
-                    return synced
-                report.progress_report(int(last)*90/100, "report")
-                return synced
-
-            get_content_from_pipe_cmd = "pv -s %s -n %s 2>%s" % (actual_size, pipe_path, PFILE)
-            import_from_pipe_cmd = "rbd import --image-format 2 - %s/%s" % (pool, tmp_image_name)
-            _, _, err = bash_progress_1('set -o pipefail; %s & %s | %s' %
-                                        (scp_to_pipe_cmd, get_content_from_pipe_cmd, import_from_pipe_cmd), _get_progress)
-
-            if os.path.exists(PFILE):
-                os.remove(PFILE)
+            def _get_progress(progress):
+                report.progress_report(int(progress.percent)*90/100, "report")
 
-            if os.path.exists(pipe_path):
-                os.remove(pipe_path)
-
-            if err:
-                raise err
+            get_content_from_pipe_cmd = "pv -s %s -n %s" % (actual_size, pipe_path)
+            import_from_pipe_cmd = "rbd import --image-format 2 - %s/%s" % (pool, tmp_image_name)
+            try:
+                bash_progress('%s & %s | %s' % (scp_to_pipe_cmd, get_content_from_pipe_cmd, import_from_pipe_cmd),
+                              'pv', _get_progress, errorout=True, pipe_fail=True)
+            finally:
+                if os.path.exists(pipe_path):
+                    os.remove(pipe_path)
 
         elif url.scheme == 'file':
             src_path = cmd.url.lstrip('file:')
@@ -886,7 +850,7 @@ class CephAgent(object):
         _2()
 
 
-        o = shell.call('rbd --format json info %s/%s' % (pool, image_name))
+        o = cephclient.get_client().image_info('%s/%s' % (pool, image_name))
         image_stats = jsonobject.loads(o)
 
         rsp.size = long(image_stats.size_)
@@ -903,8 +867,9 @@ class CephAgent(object):
     def ping(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = PingRsp()
+        client = cephclient.get_client()
 
-        facts = bash_o('ceph -s -f json')
+        facts = client.mon_command('status')
         mon_facts = jsonobject.loads(facts)
         found = False
         for mon in mon_facts.monmap.mons:
@@ -922,14 +887,17 @@ class CephAgent(object):
 
         pool, objname = cmd.testImagePath.split('/')
 
-        create_img = shell.ShellCmd("echo zstack | rados -p '%s' put '%s' -" % (pool, objname))
-        create_img(False)
-        if create_img.return_code != 0:
+        try:
+            client.object_put(pool, objname, 'zstack\n')
+        except cephclient.CephError as e:
             rsp.success = False
             rsp.failure = 'UnableToCreateFile'
-            rsp.error = "%s %s" % (create_img.stderr, create_img.stdout)
+            rsp.error = str(e)
         else:
-            shell.run("rados -p '%s' rm '%s'" % (pool, objname))
+            try:
+                client.object_remove(pool, objname)
+            except cephclient.CephError as e:
+                logger.debug('failed to remove the heartbeat object %s: %s' % (cmd.testImagePath, e))
 
         return jsonobject.dumps(rsp)
 
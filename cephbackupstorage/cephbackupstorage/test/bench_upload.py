@@ -0,0 +1,73 @@
+'''
+benchmark of the multipart upload path with a file-backed stand-in for 'rbd import'.
+Run: python -m cephbackupstorage.test.bench_upload [size in MB]
+
+@author: frank
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cherrypy
+from cephbackupstorage.test import upload_harness
+from zstacklib.utils import shell
+
+def fifo_upload(body_path, dst_path):
+    # the way uploads were received before: line by line into a fifo read by 'cat | import'
+    class Writer(object):
+        def __init__(self, wfd):
+            self.wfd = wfd
+
+        def write(self, s):
+            self.wfd.write(s)
+
+        def seek(self, offset, whence=None):
+            pass
+
+    entity = upload_harness.FakeEntity(body_path)
+    fifo = dst_path + '.fifo'
+    os.mkfifo(fifo)
+    try:
+        boundary = upload_harness.cephagent.get_boundary(entity)
+        while True:
+            headers = cherrypy._cpreqbody.Part.read_headers(entity.fp)
+            p = cherrypy._cpreqbody.Part(entity.fp, headers, boundary)
+            if p.filename:
+                break
+            p.read_lines_to_boundary()
+
+        importer = shell.ShellCmd('cat %s | cat > %s' % (fifo, dst_path), pipe=False)
+        with open(fifo, 'w') as wfd:
+            p.read_into_file(Writer(wfd))
+        importer(True)
+    finally:
+        os.remove(fifo)
+        entity.close()
+
+def _measure(name, func, size):
+    start = time.time()
+    func()
+    cost = time.time() - start
+    print '%-44s %8.3f s %8.1f MB/s' % (name, cost, size / cost)
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    shell.logcmd = False
+    folder = tempfile.mkdtemp()
+    try:
+        image = os.path.join(folder, 'image')
+        body = os.path.join(folder, 'body')
+        shell.call('head -c %dM /dev/urandom > %s' % (size, image))
+        upload_harness.make_body(body, image)
+
+        _measure('fifo, line by line (before)', lambda: fifo_upload(body, os.path.join(folder, 'fifo-out')), size)
+        _measure('in-process, buffered', lambda: upload_harness.upload(body, image, os.path.join(folder, 'out')), size)
+        _measure('in-process, 4 concurrent uploads', lambda: upload_harness.upload_concurrently(
+            body, image, [os.path.join(folder, 'out%s' % i) for i in range(4)]), size * 4)
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+'''
+
+@author: frank
+'''
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+from cephbackupstorage import cephagent
+from cephbackupstorage.test import upload_harness
+
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.image = os.path.join(self.folder, 'image')
+        self.body = os.path.join(self.folder, 'body')
+        self.dst = os.path.join(self.folder, 'dst')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _upload(self, content, extra_fields=True):
+        with open(self.image, 'wb') as fd:
+            fd.write(content)
+        upload_harness.make_body(self.body, self.image, extra_fields)
+        return upload_harness.upload(self.body, self.image, self.dst)
+
+    def test_upload_raw(self):
+        # line breaks and boundary-like bytes across the read blocks
+        content = ('\r\n--%s-x\n' % upload_harness.BOUNDARY) * 100000 + os.urandom(cephagent.WRITE_BUFFER_SIZE + 3)
+        task, image_format = self._upload(content)
+        self.assertTrue(filecmp.cmp(self.image, self.dst, shallow=False))
+        self.assertEqual(len(content), task.downloadedSize)
+        self.assertEqual('raw', image_format)
+
+    def test_upload_qcow2(self):
+        task, image_format = self._upload('QFI\xfb' + '\0' * 100, extra_fields=False)
+        self.assertEqual('qcow2', image_format)
+        self.assertEqual(104, task.downloadedSize)
+
+    def test_upload_empty(self):
+        task, image_format = self._upload('')
+        self.assertEqual(0, os.path.getsize(self.dst))
+        self.assertEqual('raw', image_format)
+
+    def test_importer_failure(self):
+        task = upload_harness.new_task(__file__)
+        importer = cephagent.ImageImporter(task, 'exit 3')
+        importer.write('x')
+        self.assertRaises(Exception, importer.close)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+local harness of the multipart upload path of the ceph backup storage agent, the importer
+is a file-backed stand-in for 'rbd import', so no ceph cluster is needed
+
+@author: frank
+'''
+import os
+import threading
+
+from cephbackupstorage import cephagent
+
+BOUNDARY = '----zstackUploadBoundary'
+
+class FakeContentType(object):
+    def __init__(self):
+        self.params = {'boundary': BOUNDARY}
+
+class FakeReader(object):
+    # the part of cherrypy's SizedReader the upload path uses
+    def __init__(self, path):
+        self.fd = open(path, 'rb')
+
+    def read(self, size=None):
+        return self.fd.read(size) if size else self.fd.read()
+
+    def readline(self, size=None):
+        return self.fd.readline(size) if size else self.fd.readline()
+
+    def finish(self):
+        pass
+
+    def close(self):
+        self.fd.close()
+
+class FakeEntity(object):
+    def __init__(self, path):
+        self.fp = FakeReader(path)
+        self.content_type = FakeContentType()
+
+    def readline(self, size=None):
+        return self.fp.readline(size) if size else self.fp.readline()
+
+    def close(self):
+        self.fp.close()
+
+def make_body(path, image_path, extra_fields=True):
+    with open(path, 'wb') as out:
+        if extra_fields:
+            out.write('--%s\r\nContent-Disposition: form-data; name="name"\r\n\r\nimage\r\n' % BOUNDARY)
+        out.write('--%s\r\nContent-Disposition: form-data; name="file"; filename="image"\r\n'
+                  'Content-Type: application/octet-stream\r\n\r\n' % BOUNDARY)
+        with open(image_path, 'rb') as fd:
+            while True:
+                data = fd.read(1024 * 1024)
+                if not data:
+                    break
+                out.write(data)
+        out.write('\r\n--%s--\r\n' % BOUNDARY)
+
+def new_task(image_path):
+    task = cephagent.UploadTask('uuid', 'ceph://pool/image', 'pool/image', 'pool/tmp-image')
+    task.expectedSize = os.path.getsize(image_path)
+    return task
+
+def upload(body_path, image_path, dst_path):
+    '''
+    @return: the task and the sniffed image format
+    '''
+    entity = FakeEntity(body_path)
+    try:
+        task = new_task(image_path)
+        boundary = cephagent.get_boundary(entity)
+        with cephagent.upload_slots:
+            image_format = cephagent.receive_image(task, entity, boundary, 'cat > %s' % dst_path)
+        return task, image_format
+    finally:
+        entity.close()
+
+def upload_concurrently(body_path, image_path, dst_paths):
+    errors = []
+    def run(dst):
+        try:
+            upload(body_path, image_path, dst)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(d,)) for d in dst_paths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
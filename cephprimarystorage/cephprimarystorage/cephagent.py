@@ -1,5 +1,3 @@
-import tempfile
-
 __author__ = 'frank'
 
 import pprint
@@ -10,10 +8,13 @@ import zstacklib.utils.http as http
 import zstacklib.utils.jsonobject as jsonobject
 import zstacklib.utils.lock as lock
 import zstacklib.utils.sizeunit as sizeunit
+import zstacklib.utils.thread as thread
 from zstacklib.utils.report import *
 from zstacklib.utils.bash import *
 from zstacklib.utils.rollback import rollback, rollbackable
 import os
+from zstacklib.utils import ceph
+from zstacklib.utils import cephclient
 from zstacklib.utils import shell
 from imagestore import ImageStoreClient
 
@@ -173,59 +174,37 @@ class CephAgent(object):
         self.http_server.register_async_uri(self.UNPROTECT_SNAPSHOT_PATH, self.unprotect_snapshot)
         self.http_server.register_async_uri(self.ROLLBACK_SNAPSHOT_PATH, self.rollback_snapshot)
         self.http_server.register_async_uri(self.FLATTEN_PATH, self.flatten)
-        self.http_server.register_async_uri(self.SFTP_DOWNLOAD_PATH, self.sftp_download)
-        self.http_server.register_async_uri(self.SFTP_UPLOAD_PATH, self.sftp_upload)
-        self.http_server.register_async_uri(self.CP_PATH, self.cp)
-        self.http_server.register_async_uri(self.UPLOAD_IMAGESTORE_PATH, self.upload_imagestore)
-        self.http_server.register_async_uri(self.DOWNLOAD_IMAGESTORE_PATH, self.download_imagestore)
+        self.http_server.register_async_uri(self.SFTP_DOWNLOAD_PATH, self.sftp_download, lane=thread.BULK_LANE)
+        self.http_server.register_async_uri(self.SFTP_UPLOAD_PATH, self.sftp_upload, lane=thread.BULK_LANE)
+        self.http_server.register_async_uri(self.CP_PATH, self.cp, lane=thread.BULK_LANE)
+        self.http_server.register_async_uri(self.UPLOAD_IMAGESTORE_PATH, self.upload_imagestore, lane=thread.BULK_LANE)
+        self.http_server.register_async_uri(self.DOWNLOAD_IMAGESTORE_PATH, self.download_imagestore, lane=thread.BULK_LANE)
         self.http_server.register_async_uri(self.DELETE_POOL_PATH, self.delete_pool)
         self.http_server.register_async_uri(self.GET_VOLUME_SIZE_PATH, self.get_volume_size)
-        self.http_server.register_async_uri(self.PING_PATH, self.ping)
+        self.http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
         self.http_server.register_async_uri(self.GET_FACTS, self.get_facts)
         self.http_server.register_async_uri(self.DELETE_IMAGE_CACHE, self.delete_image_cache)
         self.http_server.register_async_uri(self.CHECK_BITS_PATH, self.check_bits)
         self.http_server.register_async_uri(self.RESIZE_VOLUME_PATH, self.resize_volume)
         self.http_server.register_sync_uri(self.ECHO_PATH, self.echo)
-        self.http_server.register_async_uri(self.MIGRATE_VOLUME_PATH, self.migrate_volume)
-        self.http_server.register_async_uri(self.MIGRATE_VOLUME_SNAPSHOT_PATH, self.migrate_volume_snapshot)
+        self.http_server.register_async_uri(self.MIGRATE_VOLUME_PATH, self.migrate_volume, lane=thread.BULK_LANE)
+        self.http_server.register_async_uri(self.MIGRATE_VOLUME_SNAPSHOT_PATH, self.migrate_volume_snapshot, lane=thread.BULK_LANE)
         self.http_server.register_async_uri(self.GET_VOLUME_SNAPINFOS_PATH, self.get_volume_snapinfos)
 
         self.imagestore_client = ImageStoreClient()
 
-    def _set_capacity_to_response(self, rsp):
-        o = shell.call('ceph df -f json')
-        df = jsonobject.loads(o)
-
-        if df.stats.total_bytes__ is not None:
-            total = long(df.stats.total_bytes_)
-        elif df.stats.total_space__ is not None:
-            total = long(df.stats.total_space__) * 1024
-        else:
-            raise Exception('unknown ceph df output: %s' % o)
-
-        if df.stats.total_avail_bytes__ is not None:
-            avail = long(df.stats.total_avail_bytes_)
-        elif df.stats.total_avail__ is not None:
-            avail = long(df.stats.total_avail_) * 1024
-        else:
-            raise Exception('unknown ceph df output: %s' % o)
-
-        rsp.totalCapacity = total
-        rsp.availableCapacity = avail
+    def _set_capacity_to_response(self, rsp, force=False):
+        capacity = ceph.capacity.get(force)
+        rsp.totalCapacity = capacity.total
+        rsp.availableCapacity = capacity.available
 
-        if not df.pools:
+        if not capacity.pools:
             return
 
-        rsp.poolCapacities = []
-        for pool in df.pools:
-            poolAvailable = pool.stats.max_avail_
-            poolUsed = pool.stats.bytes_used_
-            poolSize = jsonobject.loads(shell.call('ceph osd pool get %s size -f json' % pool.name)).size
-            poolCapacity = CephPoolCapacity(pool.name, poolAvailable, poolSize, poolUsed)
-            rsp.poolCapacities.append(poolCapacity)
+        rsp.poolCapacities = [CephPoolCapacity(p.name, p.available, p.replicated_size, p.used) for p in capacity.pools]
 
     def _get_file_size(self, path):
-        o = shell.call('rbd --format json info %s' % path)
+        o = cephclient.get_client().image_info(path)
         o = jsonobject.loads(o)
         return long(o.size_)
 
@@ -257,17 +236,16 @@ class CephAgent(object):
         SP_PATH = self._normalize_install_path(cmd.snapshotPath)
         IMAGE_PATH = self._normalize_install_path(cmd.imagePath)
 
-        if bash_r('rbd info {{IMAGE_PATH}}') != 0:
+        client = cephclient.get_client()
+        if not client.image_exists(IMAGE_PATH):
             return jsonobject.dumps(rsp)
 
-        o = bash_o('rbd children {{SP_PATH}}')
-        o = o.strip(' \t\r\n')
-        if o:
+        if client.image_children(SP_PATH):
             raise Exception('the image cache[%s] is still in used' % cmd.imagePath)
 
-        bash_errorout('rbd snap unprotect {{SP_PATH}}')
-        bash_errorout('rbd snap rm {{SP_PATH}}')
-        bash_errorout('rbd rm {{IMAGE_PATH}}')
+        client.snap_unprotect(SP_PATH)
+        client.snap_remove(SP_PATH)
+        client.image_remove(IMAGE_PATH)
         self._set_capacity_to_response(rsp)
         return jsonobject.dumps(rsp)
 
@@ -275,13 +253,14 @@ class CephAgent(object):
     @in_bash
     def get_facts(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        o = bash_o('ceph mon_status')
+        client = cephclient.get_client()
+        o = client.mon_command('mon_status')
         mon_status = jsonobject.loads(o)
         fsid = mon_status.monmap.fsid_
 
         rsp = GetFactsRsp()
 
-        facts = bash_o('ceph -s -f json')
+        facts = client.mon_command('status')
         mon_facts = jsonobject.loads(facts)
         for mon in mon_facts.monmap.mons:
             ADDR = mon.addr.split(':')[0]
@@ -299,8 +278,9 @@ class CephAgent(object):
     @in_bash
     def ping(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
+        client = cephclient.get_client()
 
-        facts = bash_o('ceph -s -f json')
+        facts = client.mon_command('status')
         mon_facts = jsonobject.loads(facts)
         found = False
         for mon in mon_facts.monmap.mons:
@@ -338,17 +318,22 @@ class CephAgent(object):
         def doPing():
             # try to delete test file, ignore the result
             pool, objname = cmd.testImagePath.split('/')
-            bash_r("rados -p '%s' rm '%s'" % (pool, objname))
-            r, o, e = bash_roe("timeout 60 echo zstack | rados -p '%s' put '%s' -" % (pool, objname))
-            if r != 0:
+            try:
+                client.object_remove(pool, objname)
+            except cephclient.CephError:
+                pass
+
+            try:
+                client.object_put(pool, objname, 'zstack\n', timeout=60)
+            except cephclient.CephTimeout as e:
                 rsp.success = False
                 rsp.failure = "UnableToCreateFile"
-                if r == 124:
-                    # timeout happened
-                    rsp.error = 'failed to create heartbeat object on ceph, timeout after 60s, %s %s' % (e, o)
-                    raise Exception(rsp.error)
-                else:
-                    rsp.error = "%s %s" % (e, o)
+                rsp.error = 'failed to create heartbeat object on ceph, timeout after 60s, %s' % e
+                raise Exception(rsp.error)
+            except cephclient.CephError as e:
+                rsp.success = False
+                rsp.failure = "UnableToCreateFile"
+                rsp.error = str(e)
 
         doPing()
 
@@ -375,7 +360,7 @@ class CephAgent(object):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         spath = self._normalize_install_path(cmd.snapshotPath)
 
-        shell.call('rbd snap rollback %s' % spath)
+        cephclient.get_client().snap_rollback(spath)
         rsp = RollbackSnapshotRsp()
         rsp.size = self._get_file_size(spath)
         self._set_capacity_to_response(rsp)
@@ -392,23 +377,13 @@ class CephAgent(object):
 
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "CephCpVolume"
-        _, PFILE = tempfile.mkstemp()
         stage = (cmd.threadContext['task-stage'], "10-90")[cmd.threadContext['task-stage'] is None]
 
-        def _get_progress(synced):
-            if not Report.url:
-                return synced
-
-            logger.debug("getProgress in ceph-agent")
-            percent = shell.call("tail -1 %s | grep -o '1\?[0-9]\{1,2\}%%' | tail -1" % PFILE).strip(' \t\n\r%')
-            if percent and Report.url:
-                report.progress_report(get_exact_percent(percent, stage), "report")
-            return synced
+        def _get_progress(progress):
+            if Report.url:
+                report.progress_report(get_exact_percent(progress.percent, stage), "report")
 
-        bash_progress_1('rbd cp %s %s 2> %s' % (src_path, dst_path, PFILE), _get_progress)
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
+        bash_progress('rbd cp %s %s' % (src_path, dst_path), 'percent', _get_progress)
 
         rsp = CpRsp()
         rsp.size = self._get_file_size(dst_path)
@@ -447,18 +422,21 @@ class CephAgent(object):
         do_create = True
         if cmd.skipOnExisting:
             image_name, sp_name = spath.split('@')
-            o = shell.call('rbd --format json snap ls %s' % image_name)
+            o = cephclient.get_client().snap_list(image_name)
             o = jsonobject.loads(o)
             for s in o:
                 if s.name_ == sp_name:
                     do_create = False
 
         if do_create:
-            o = shell.ShellCmd('rbd snap create %s' % spath)
-            o(False)
-            if o.return_code != 0:
-                shell.run("rbd snap rm %s" % spath)
-                o.raise_error()
+            try:
+                cephclient.get_client().snap_create(spath)
+            except cephclient.CephError as e:
+                try:
+                    cephclient.get_client().snap_remove(spath)
+                except cephclient.CephError as e1:
+                    logger.debug('failed to clean up snapshot %s: %s' % (spath, e1))
+                raise e
 
 
         rsp = CreateSnapshotRsp()
@@ -472,7 +450,7 @@ class CephAgent(object):
 
         spath = self._normalize_install_path(cmd.snapshotPath)
 
-        shell.call('rbd snap rm %s' % spath)
+        cephclient.get_client().snap_remove(spath)
 
         rsp = AgentResponse()
         self._set_capacity_to_response(rsp)
@@ -483,7 +461,7 @@ class CephAgent(object):
     def purge_snapshots(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         vpath = self._normalize_install_path(cmd.volumePath)
-        shell.call('rbd snap purge %s' % vpath)
+        cephclient.get_client().snap_purge(vpath)
         rsp = AgentResponse()
         self._set_capacity_to_response(rsp)
         return jsonobject.dumps(rsp)
@@ -493,7 +471,7 @@ class CephAgent(object):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         spath = self._normalize_install_path(cmd.snapshotPath)
 
-        shell.call('rbd snap unprotect %s' % spath)
+        cephclient.get_client().snap_unprotect(spath)
 
         return jsonobject.dumps(AgentResponse())
 
@@ -502,7 +480,11 @@ class CephAgent(object):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         spath = self._normalize_install_path(cmd.snapshotPath)
 
-        shell.call('rbd snap protect %s' % spath, exception=not cmd.ignoreError)
+        try:
+            cephclient.get_client().snap_protect(spath)
+        except cephclient.CephError:
+            if not cmd.ignoreError:
+                raise
 
         rsp = AgentResponse()
         return jsonobject.dumps(rsp)
@@ -512,15 +494,7 @@ class CephAgent(object):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         path = self._normalize_install_path(cmd.installPath)
         rsp = CheckIsBitsExistingRsp()
-        try:
-            shell.call('rbd info %s' % path)
-        except Exception as e:
-            if 'No such file or directory' in str(e):
-                rsp.existing = False
-                return jsonobject.dumps(rsp)
-            else:
-                raise e
-        rsp.existing = True
+        rsp.existing = cephclient.get_client().image_exists(path)
         return jsonobject.dumps(rsp)
 
     @replyerror
@@ -569,7 +543,7 @@ class CephAgent(object):
             shell.call('ceph osd pool create %s 128' % realname)
 
         rsp = AgentResponse()
-        self._set_capacity_to_response(rsp)
+        self._set_capacity_to_response(rsp, force=True)
 
         return jsonobject.dumps(rsp)
 
@@ -608,7 +582,7 @@ class CephAgent(object):
             rsp.userKey = o[0].key_
 
         rsp.fsid = fsid
-        self._set_capacity_to_response(rsp)
+        self._set_capacity_to_response(rsp, force=True)
 
         return jsonobject.dumps(rsp)
 
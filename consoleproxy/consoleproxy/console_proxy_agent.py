@@ -5,6 +5,7 @@ from zstacklib.utils import log
 from zstacklib.utils import jsonobject
 from zstacklib.utils import daemon
 from zstacklib.utils import linux
+from zstacklib.utils import procfs
 from zstacklib.utils import filedb
 from zstacklib.utils import lock
 from zstacklib.utils.bash import *
@@ -267,14 +268,7 @@ class ConsoleProxyAgent(object):
         rsp.proxyPort = cmd.proxyPort
         logger.debug('successfully add new proxy token file %s' % info_str)
         ##if process exists,return
-        out = shell.call("ps aux | grep websockify")
-        alive = False
-        for o in out.split('\n'):
-            if o.find(cmd.proxyHostname) != -1:
-                alive = True
-                break
-                
-        if alive:
+        if procfs.get_process_table(force=True).find('websockify', cmd.proxyHostname):
             return jsonobject.dumps(rsp)    
         
         ##start a new websockify process
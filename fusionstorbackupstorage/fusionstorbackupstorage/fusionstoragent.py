@@ -10,6 +10,7 @@ import zstacklib.utils.jsonobject as jsonobject
 import zstacklib.utils.lock as lock
 import zstacklib.utils.linux as linux
 import zstacklib.utils.sizeunit as sizeunit
+import zstacklib.utils.thread as thread
 import zstacklib.utils.lichbd_factory as lichbdfactory
 from zstacklib.utils import plugin
 from zstacklib.utils.rollback import rollback, rollbackable
@@ -93,9 +94,9 @@ class FusionstorAgent(object):
 
     def __init__(self):
         self.http_server.register_async_uri(self.INIT_PATH, self.init)
-        self.http_server.register_async_uri(self.DOWNLOAD_IMAGE_PATH, self.download)
+        self.http_server.register_async_uri(self.DOWNLOAD_IMAGE_PATH, self.download, lane=thread.BULK_LANE)
         self.http_server.register_async_uri(self.DELETE_IMAGE_PATH, self.delete)
-        self.http_server.register_async_uri(self.PING_PATH, self.ping)
+        self.http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
         self.http_server.register_async_uri(self.GET_IMAGE_SIZE_PATH, self.get_image_size)
         self.http_server.register_async_uri(self.GET_FACTS, self.get_facts)
         self.http_server.register_sync_uri(self.ECHO_PATH, self.echo)
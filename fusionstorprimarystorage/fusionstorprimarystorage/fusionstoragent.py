@@ -10,6 +10,7 @@ import zstacklib.utils.jsonobject as jsonobject
 import zstacklib.utils.lock as lock
 import zstacklib.utils.linux as linux
 import zstacklib.utils.sizeunit as sizeunit
+import zstacklib.utils.thread as thread
 from zstacklib.utils import plugin
 from zstacklib.utils.rollback import rollback, rollbackable
 import os
@@ -125,12 +126,12 @@ class FusionstorAgent(object):
         self.http_server.register_async_uri(self.UNPROTECT_SNAPSHOT_PATH, self.unprotect_snapshot)
         self.http_server.register_async_uri(self.ROLLBACK_SNAPSHOT_PATH, self.rollback_snapshot)
         self.http_server.register_async_uri(self.FLATTEN_PATH, self.flatten)
-        self.http_server.register_async_uri(self.SFTP_DOWNLOAD_PATH, self.sftp_download)
-        self.http_server.register_async_uri(self.SFTP_UPLOAD_PATH, self.sftp_upload)
-        self.http_server.register_async_uri(self.CP_PATH, self.cp)
+        self.http_server.register_async_uri(self.SFTP_DOWNLOAD_PATH, self.sftp_download, lane=thread.BULK_LANE)
+        self.http_server.register_async_uri(self.SFTP_UPLOAD_PATH, self.sftp_upload, lane=thread.BULK_LANE)
+        self.http_server.register_async_uri(self.CP_PATH, self.cp, lane=thread.BULK_LANE)
         self.http_server.register_async_uri(self.DELETE_POOL_PATH, self.delete_pool)
         self.http_server.register_async_uri(self.GET_VOLUME_SIZE_PATH, self.get_volume_size)
-        self.http_server.register_async_uri(self.PING_PATH, self.ping)
+        self.http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
         self.http_server.register_async_uri(self.GET_FACTS, self.get_facts)
         self.http_server.register_sync_uri(self.ECHO_PATH, self.echo)
 
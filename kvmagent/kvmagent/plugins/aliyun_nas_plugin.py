@@ -8,6 +8,7 @@ from zstacklib.utils.bash import *
 from kvmagent import kvmagent
 from zstacklib.utils import jsonobject
 from zstacklib.utils import http
+from zstacklib.utils import thread
 from zstacklib.utils import shell
 import zstacklib.utils.uuidhelper as uuidhelper
 from kvmagent.plugins.imagestore import ImageStoreClient
@@ -123,7 +124,7 @@ class AliyunNasStoragePlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.IS_MOUNT_PATH, self.ismount)
         http_server.register_async_uri(self.MOUNT_DATA_PATH, self.mountdata)
         http_server.register_async_uri(self.INIT_PATH, self.init)
-        http_server.register_async_uri(self.PING_PATH, self.ping)
+        http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
         http_server.register_async_uri(self.LIST_PATH, self.list)
         http_server.register_async_uri(self.UPDATE_MOUNT_POINT_PATH, self.updateMount)
         http_server.register_async_uri(self.REMOUNT_PATH, self.remount)
@@ -135,13 +136,13 @@ class AliyunNasStoragePlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.GET_VOLUME_SIZE_PATH, self.getvolumesize)
         http_server.register_async_uri(self.REVERT_VOLUME_FROM_SNAPSHOT_PATH, self.revertvolume)
         http_server.register_async_uri(self.REINIT_VOLUME_PATH, self.reinit)
-        http_server.register_async_uri(self.UPLOAD_BIT_TO_IMAGESTORE__PATH, self.uploadtoimagestore)
-        http_server.register_async_uri(self.DOWNLOAD_BIT_TO_IMAGESTORE_PATH, self.downloadfromimagestore)
+        http_server.register_async_uri(self.UPLOAD_BIT_TO_IMAGESTORE__PATH, self.uploadtoimagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.DOWNLOAD_BIT_TO_IMAGESTORE_PATH, self.downloadfromimagestore, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.RESIZE_VOLUME_PATH, self.resize)
-        http_server.register_async_uri(self.COMMIT_PATH, self.commit_to_imagestore)
-        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME_PATH, self.createtemplate)
-        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.mergesnapshot)
-        http_server.register_async_uri(self.OFFLINE_MERGE_SNAPSHOT_PATH, self.offlinemerge)
+        http_server.register_async_uri(self.COMMIT_PATH, self.commit_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME_PATH, self.createtemplate, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.mergesnapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.OFFLINE_MERGE_SNAPSHOT_PATH, self.offlinemerge, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.GET_CAPACITY_PATH, self.getcapacity)
         http_server.register_async_uri(self.CHECK_MOUNT_PATH, self.checkmountpath)
         self.mount_path = {}
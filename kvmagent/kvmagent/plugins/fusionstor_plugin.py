@@ -12,6 +12,7 @@ from zstacklib.utils import shell
 from zstacklib.utils import lichbd
 from zstacklib.utils import sizeunit
 from zstacklib.utils import linux
+from zstacklib.utils import procfs
 from zstacklib.utils import thread
 import zstacklib.utils.lichbd_factory as lichbdfactory
 import os.path
@@ -39,8 +40,8 @@ def kill_vm(maxAttempts):
         if not vm_uuid:
             continue
 
-        vm_pid = shell.call("ps aux | grep '/opt/fusionstack/qemu/bin/qemu-system-x86_64' | grep -v 'grep' | awk '/%s/{print $2}'" % vm_uuid)
-        vm_pid = vm_pid.strip(' \t\n\r')
+        vm_pid = ' '.join(p.pid for p in procfs.get_process_table(force=True).find(
+            '/opt/fusionstack/qemu/bin/qemu-system-x86_64', vm_uuid))
         kill = shell.ShellCmd('kill -9 %s' % vm_pid)
         kill(False)
         if kill.return_code == 0:
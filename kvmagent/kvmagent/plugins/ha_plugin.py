@@ -4,11 +4,17 @@ from zstacklib.utils import http
 from zstacklib.utils import log
 from zstacklib.utils import shell
 from zstacklib.utils import linux
+from zstacklib.utils import procfs
 from zstacklib.utils import thread
+import math
+import os
 import os.path
+import Queue
+import signal
 import time
 import traceback
 import threading
+import xml.etree.ElementTree as etree
 
 logger = log.get_logger(__name__)
 
@@ -33,40 +39,114 @@ class ReportPsStatusCmd(object):
         self.psStatus = None
 
 
-def kill_vm(maxAttempts, mountPaths=None, isFileSystem=None):
-    zstack_uuid_pattern = "'[0-9a-f]{8}[0-9a-f]{4}[1-5][0-9a-f]{3}[89ab][0-9a-f]{3}[0-9a-f]{12}'"
+LIBVIRT_QEMU_STATUS_DIR = '/var/run/libvirt/qemu'
+
+def find_qemu_pids(proc_dir='/proc'):
+    '''vm uuid -> pids of its qemu processes, by one scan of /proc'''
+    return procfs.scan(proc_dir).get_qemu_vm_pids()
+
+class VmStorage(object):
+    def __init__(self, has_file_disk, file_path, volume_name):
+        # has a disk other than cdrom on file system storages
+        self.has_file_disk = has_file_disk
+        # the first file source of the disks
+        self.file_path = file_path
+        # the first network volume of the disks, e.g. pool/image of rbd
+        self.volume_name = volume_name
+
+    @staticmethod
+    def from_xml(xml):
+        root = etree.fromstring(xml)
+        domain = root if root.tag == 'domain' else root.find('domain')
+        has_file_disk = False
+        file_path = volume_name = ''
+        for disk in domain.findall('devices/disk'):
+            if disk.get('type') == 'file' and disk.get('device') != 'cdrom':
+                has_file_disk = True
+            source = disk.find('source')
+            if source is None:
+                continue
+            if not file_path and source.get('file'):
+                file_path = source.get('file')
+            if not volume_name and source.get('protocol'):
+                volume_name = source.get('name', '')
+        return VmStorage(has_file_disk, file_path, volume_name)
+
+class VmStorageMap(object):
+    '''
+    the storages of vms parsed from their domain xml, the live xml libvirt keeps
+    in LIBVIRT_QEMU_STATUS_DIR is cached until it's changed
+    '''
+    def __init__(self, status_dir=LIBVIRT_QEMU_STATUS_DIR):
+        self.status_dir = status_dir
+        self.storages = {}
+        self.lock = threading.Lock()
+
+    def _read_status_xml(self, vm_uuid):
+        path = os.path.join(self.status_dir, '%s.xml' % vm_uuid)
+        try:
+            mtime = os.path.getmtime(path)
+            with self.lock:
+                cached = self.storages.get(vm_uuid)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+            with open(path) as fd:
+                storage = VmStorage.from_xml(fd.read())
+        except (IOError, OSError, etree.ParseError):
+            return None
+
+        with self.lock:
+            self.storages[vm_uuid] = (mtime, storage)
+        return storage
+
+    # @return: VmStorage, or None if the domain xml is unavailable
+    def get(self, vm_uuid):
+        storage = self._read_status_xml(vm_uuid)
+        if storage:
+            return storage
+
+        o = shell.ShellCmd('virsh dumpxml %s' % vm_uuid)
+        o(False)
+        if o.return_code != 0:
+            return None
+        try:
+            return VmStorage.from_xml(o.stdout)
+        except etree.ParseError:
+            return None
 
-    virsh_list = shell.call("virsh list --all")
-    logger.debug("virsh_list:\n" + virsh_list)
+    def prune(self, vm_uuids):
+        with self.lock:
+            for vm_uuid in set(self.storages) - set(vm_uuids):
+                del self.storages[vm_uuid]
 
-    vm_in_process_uuid_list = shell.call("virsh list | egrep -o " + zstack_uuid_pattern + " | sort | uniq")
-    logger.debug('vm_in_process_uuid_list:\n' + vm_in_process_uuid_list)
+vm_storages = VmStorageMap()
+
+def kill_vm(maxAttempts, mountPaths=None, isFileSystem=None):
+    vm_pids = find_qemu_pids()
+    vm_storages.prune(vm_pids.keys())
+    logger.debug('vm qemu processes: %s' % vm_pids)
 
     # kill vm's qemu process
     vm_pids_dict = {}
-    for vm_uuid in vm_in_process_uuid_list.split('\n'):
-        vm_uuid = vm_uuid.strip(' \t\n\r')
-        if not vm_uuid:
-            continue
-
+    for vm_uuid, pids in vm_pids.items():
         if mountPaths and isFileSystem is not None \
                 and not is_need_kill(vm_uuid, mountPaths, isFileSystem):
             continue
+        vm_pids_dict[vm_uuid] = pids
 
-        vm_pid = shell.call("ps aux | grep qemu-kvm | grep -v grep | awk '/%s/{print $2}'" % vm_uuid)
-        vm_pid = vm_pid.strip(' \t\n\r')
-        vm_pids_dict[vm_uuid] = vm_pid
-
-    for vm_uuid, vm_pid in vm_pids_dict.items():
-        kill = shell.ShellCmd('kill -9 %s' % vm_pid)
-        kill(False)
-        if kill.return_code == 0:
-            logger.warn('kill the vm[uuid:%s, pid:%s] because we lost connection to the storage.'
-                        'failed to read the heartbeat file %s times' % (vm_uuid, vm_pid, maxAttempts))
-        else:
-            logger.warn('failed to kill the vm[uuid:%s, pid:%s] %s' % (vm_uuid, vm_pid, kill.stderr))
+    killed = []
+    for vm_uuid, pids in vm_pids_dict.items():
+        for vm_pid in pids:
+            try:
+                os.kill(int(vm_pid), signal.SIGKILL)
+                killed.append(vm_pid)
+                logger.warn('kill the vm[uuid:%s, pid:%s] because we lost connection to the storage.'
+                            'failed to read the heartbeat file %s times' % (vm_uuid, vm_pid, maxAttempts))
+            except OSError as e:
+                logger.warn('failed to kill the vm[uuid:%s, pid:%s] %s' % (vm_uuid, vm_pid, e))
 
-    return vm_pids_dict.values()
+    return killed
 
 
 def mount_path_is_nfs(mount_path):
@@ -101,41 +181,238 @@ def kill_progresses_using_mount_path(mount_path):
 
 
 def is_need_kill(vmUuid, mountPaths, isFileSystem):
-    def vm_match_storage_type(vmUuid, isFileSystem):
-        o = shell.ShellCmd("virsh dumpxml %s | grep \"disk type='file'\" | grep -v \"device='cdrom'\"" % vmUuid)
-        o(False)
-        if (o.return_code == 0 and isFileSystem) or (o.return_code != 0 and not isFileSystem):
+    def vm_in_storage_list(vm_path, storage_paths):
+        if vm_path == "" or any([vm_path.startswith(ps_path) for ps_path in storage_paths]):
             return True
         return False
 
-    def vm_in_this_file_system_storage(vm_uuid, ps_paths):
-        cmd = shell.ShellCmd("virsh dumpxml %s | grep \"source file=\" | head -1 |awk -F \"'\" '{print $2}'" % vm_uuid)
-        cmd(False)
-        vm_path = cmd.stdout.strip()
-        if cmd.return_code != 0 or vm_in_storage_list(vm_path, ps_paths):
-            return True
-        return False
+    storage = vm_storages.get(vmUuid)
+    if storage is None:
+        # the vm can't be told apart, it's only killed for a distributed storage
+        return not isFileSystem
 
-    def vm_in_this_distributed_storage(vm_uuid, ps_paths):
-        cmd = shell.ShellCmd("virsh dumpxml %s | grep \"source protocol\" | head -1 | awk -F \"'\" '{print $4}'" % vm_uuid)
-        cmd(False)
-        vm_path = cmd.stdout.strip()
-        if cmd.return_code != 0 or vm_in_storage_list(vm_path, ps_paths):
-            return True
+    if storage.has_file_disk != bool(isFileSystem):
         return False
+    if isFileSystem:
+        return vm_in_storage_list(storage.file_path, mountPaths)
+    return vm_in_storage_list(storage.volume_name, mountPaths)
 
-    def vm_in_storage_list(vm_path, storage_paths):
-        if vm_path == "" or any([vm_path.startswith(ps_path) for ps_path in storage_paths]):
-            return True
-        return False
+HEARTBEAT_TICK = 0.1
+HEARTBEAT_WHEEL_SLOTS = 1024
+HEARTBEAT_WORKER_IDLE_TIMEOUT = 60
 
-    if vm_match_storage_type(vmUuid, isFileSystem):
-        if isFileSystem and vm_in_this_file_system_storage(vmUuid, mountPaths):
-            return True
-        elif not isFileSystem and vm_in_this_distributed_storage(vmUuid, mountPaths):
-            return True
+class HeartbeatTimeout(Exception):
+    pass
+
+class TimerWheel(object):
+    '''
+    a hashed timer wheel run by one thread, callbacks must not block as they are
+    called in the thread
+    '''
+    def __init__(self, tick=HEARTBEAT_TICK, slots=HEARTBEAT_WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, delay, func, *args):
+        # rounded first, 0.8 / 0.1 is a bit more than 8 ticks
+        ticks = max(1, int(math.ceil(round(float(delay) / self.tick, 6))))
+        # a delay of whole rounds lands on the current slot and fires after its last round
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        offset += 1
+        with self.lock:
+            self.slots[(self.current + offset) % len(self.slots)].append([rounds, func, args])
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, name='heartbeat-timer-wheel')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _advance(self):
+        with self.lock:
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            due = [e for e in slot if e[0] == 0]
+            pending = [e for e in slot if e[0] > 0]
+            for e in pending:
+                e[0] -= 1
+            self.slots[self.current] = pending
+        return due
+
+    def _run(self):
+        next_tick = time.time()
+        while True:
+            next_tick += self.tick
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1:
+                # the clock jumped, don't fire the ticks missed in a burst
+                next_tick = time.time()
+
+            for _, func, args in self._advance():
+                try:
+                    func(*args)
+                except Exception:
+                    logger.warn(traceback.format_exc())
+
+class HeartbeatWorkers(object):
+    '''
+    threads doing heartbeat writes, a new thread is started if none is idle as
+    a write to an unreachable storage may never return
+    '''
+    def __init__(self, idle_timeout=HEARTBEAT_WORKER_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.jobs = Queue.Queue()
+        self.idle = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        with self.lock:
+            self.pending += 1
+            self.jobs.put((func, args))
+            if self.pending <= self.idle:
+                return
+            self.idle += 1
+
+        t = threading.Thread(target=self._work, name='heartbeat-worker')
+        t.daemon = True
+        t.start()
+
+    def _work(self):
+        while True:
+            try:
+                func, args = self.jobs.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                with self.lock:
+                    if self.pending >= self.idle:
+                        continue
+                    self.idle -= 1
+                    return
 
-    return False
+            with self.lock:
+                self.idle -= 1
+                self.pending -= 1
+            try:
+                func(*args)
+            except Exception:
+                logger.warn(traceback.format_exc())
+            with self.lock:
+                self.idle += 1
+
+    def call(self, timeout, func, *args):
+        '''runs func in a worker, raises HeartbeatTimeout if it doesn't return in timeout seconds'''
+        done = threading.Event()
+        ret = {}
+
+        def run():
+            try:
+                ret['value'] = func(*args)
+            except Exception as e:
+                ret['error'] = e
+            done.set()
+
+        self.submit(run)
+        if not done.wait(timeout):
+            raise HeartbeatTimeout('%s%s does not return in %s seconds' % (func.__name__, args, timeout))
+        if 'error' in ret:
+            raise ret['error']
+        return ret.get('value')
+
+timer_wheel = TimerWheel()
+heartbeat_workers = HeartbeatWorkers()
+
+def touch_heartbeat_file(path):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_NONBLOCK, 0644)
+    try:
+        os.utime(path, None)
+    finally:
+        os.close(fd)
+
+class FileSystemHeartbeat(object):
+    '''
+    touches the heartbeat file every interval seconds, a touch not returned in timeout
+    seconds fails. on_max_failures() is called in a new thread after max_attempts failures
+    in a row, the heartbeat is paused till it returns. is_running() stops the heartbeat
+    when returning False
+    '''
+    def __init__(self, path, interval, timeout, max_attempts, on_max_failures, is_running,
+                 wheel=None, workers=None):
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.on_max_failures = on_max_failures
+        self.is_running = is_running
+        self.wheel = wheel or timer_wheel
+        self.workers = workers or heartbeat_workers
+        self.failure = 0
+        self.attempt = 0
+        self.judged = True
+        # a touch not returned yet, maybe stuck on the storage
+        self.touching = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.wheel.schedule(self.interval, self._beat)
+
+    def _beat(self):
+        if not self.is_running():
+            logger.debug('stop heartbeat[%s] for filesystem self-fencer' % self.path)
+            return
+
+        with self.lock:
+            self.attempt += 1
+            self.judged = False
+            attempt = self.attempt
+            # don't pile up writes on a storage a touch is stuck on
+            touch = not self.touching
+            self.touching = True
+
+        if touch:
+            self.workers.submit(self._touch, attempt)
+        self.wheel.schedule(self.timeout, self._judge, attempt, False, 'timeout after %s seconds' % self.timeout)
+
+    def _touch(self, attempt):
+        try:
+            touch_heartbeat_file(self.path)
+            ok, err = True, None
+        except (IOError, OSError) as e:
+            ok, err = False, str(e)
+
+        with self.lock:
+            self.touching = False
+        self._judge(attempt, ok, err)
+
+    def _judge(self, attempt, ok, err):
+        with self.lock:
+            if attempt != self.attempt or self.judged:
+                return
+            self.judged = True
+            if ok:
+                self.failure = 0
+            else:
+                self.failure += 1
+            failure = self.failure
+
+        if not ok:
+            logger.warn('unable to touch %s, %s' % (self.path, err))
+
+        if failure == self.max_attempts:
+            self._fence()
+        else:
+            self.wheel.schedule(self.interval, self._beat)
+
+    @thread.AsyncThread
+    def _fence(self):
+        try:
+            self.on_max_failures()
+        except Exception:
+            logger.warn(traceback.format_exc())
+        finally:
+            self.wheel.schedule(self.interval, self._beat)
 
 class HaPlugin(kvmagent.KvmAgent):
     SCAN_HOST_PATH = "/ha/scanhost"
@@ -272,14 +549,13 @@ class HaPlugin(kvmagent.KvmAgent):
     def setup_self_fencer(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
 
-        @thread.AsyncThread
         def heartbeat_file_fencer(mount_path, ps_uuid, mounted_by_zstack):
             def try_remount_fs():
                 if mount_path_is_nfs(mount_path):
                     shell.run("systemctl start nfs-client.target")
 
                 while self.run_filesystem_fencer(ps_uuid, created_time):
-                    if linux.is_mounted(path=mount_path) and touch_heartbeat_file():
+                    if linux.is_mounted(path=mount_path) and touch_heartbeat_file_with_timeout():
                         self.report_storage_status([ps_uuid], 'Connected')
                         logger.debug("fs[uuid:%s] is reachable again, report to management" % ps_uuid)
                         break
@@ -298,14 +574,14 @@ class HaPlugin(kvmagent.KvmAgent):
 
                 logger.debug('stop remount fs[uuid:%s]' % ps_uuid)
 
-            def after_kill_vm():
+            def after_kill_vm(killed_vm_pids):
                 if not killed_vm_pids or not mounted_by_zstack:
                     return
 
                 try:
                     kill_and_umount(mount_path, mount_path_is_nfs(mount_path))
                 except UmountException:
-                    if shell.run('ps -p %s' % ' '.join(killed_vm_pids)) == 0:
+                    if any(linux.process_exists(pid) for pid in killed_vm_pids):
                         virsh_list = shell.call("timeout 10 virsh list --all || echo 'cannot obtain virsh list'")
                         logger.debug("virsh_list:\n" + virsh_list)
                         logger.error('kill vm[pids:%s] failed because of unavailable fs[mountPath:%s].'
@@ -314,42 +590,29 @@ class HaPlugin(kvmagent.KvmAgent):
 
                 try_remount_fs()
 
-
-            def touch_heartbeat_file():
-                touch = shell.ShellCmd('timeout %s touch %s' % (cmd.storageCheckerTimeout, heartbeat_file_path))
-                touch(False)
-                if touch.return_code != 0:
-                    logger.warn('unable to touch %s, %s %s' % (heartbeat_file_path, touch.stderr, touch.stdout))
-                return touch.return_code == 0
+            def touch_heartbeat_file_with_timeout():
+                try:
+                    heartbeat_workers.call(cmd.storageCheckerTimeout, touch_heartbeat_file, heartbeat_file_path)
+                    return True
+                except Exception as e:
+                    logger.warn('unable to touch %s, %s' % (heartbeat_file_path, e))
+                    return False
+
+            def fence():
+                logger.warn('failed to touch the heartbeat file[%s] %s times, we lost the connection to the storage,'
+                            'shutdown ourselves' % (heartbeat_file_path, cmd.maxAttempts))
+                self.report_storage_status([ps_uuid], 'Disconnected')
+                after_kill_vm(kill_vm(cmd.maxAttempts, [mount_path], True))
 
             heartbeat_file_path = os.path.join(mount_path, 'heartbeat-file-kvm-host-%s.hb' % cmd.hostUuid)
             created_time = time.time()
             with self.fencer_lock:
                 self.run_filesystem_fencer_timestamp[ps_uuid] = created_time
-            try:
-                failure = 0
-                url = shell.call("mount | grep -e '%s' | awk '{print $1}'" % mount_path).strip()
-                options = shell.call("mount | grep -e '%s' | awk -F '[()]' '{print $2}'" % mount_path).strip()
 
-                while self.run_filesystem_fencer(ps_uuid, created_time):
-                    time.sleep(cmd.interval)
-                    if touch_heartbeat_file():
-                        failure = 0
-                        continue
-
-                    failure += 1
-                    if failure == cmd.maxAttempts:
-                        logger.warn('failed to touch the heartbeat file[%s] %s times, we lost the connection to the storage,'
-                                    'shutdown ourselves' % (heartbeat_file_path, cmd.maxAttempts))
-                        self.report_storage_status([ps_uuid], 'Disconnected')
-                        killed_vm_pids = kill_vm(cmd.maxAttempts, [mount_path], True)
-                        after_kill_vm()
-
-                logger.debug('stop heartbeat[%s] for filesystem self-fencer' % heartbeat_file_path)
-
-            except:
-                content = traceback.format_exc()
-                logger.warn(content)
+            url = shell.call("mount | grep -e '%s' | awk '{print $1}'" % mount_path).strip()
+            options = shell.call("mount | grep -e '%s' | awk -F '[()]' '{print $2}'" % mount_path).strip()
+            FileSystemHeartbeat(heartbeat_file_path, cmd.interval, cmd.storageCheckerTimeout, cmd.maxAttempts,
+                                fence, lambda: self.run_filesystem_fencer(ps_uuid, created_time)).start()
 
         for mount_path, uuid, mounted_by_zstack in zip(cmd.mountPaths, cmd.uuids, cmd.mountedByZStack):
             if not linux.timeout_isdir(mount_path):
@@ -444,7 +707,7 @@ class HaPlugin(kvmagent.KvmAgent):
 
     def run_filesystem_fencer(self, ps_uuid, created_time):
         with self.fencer_lock:
-            if not self.run_filesystem_fencer_timestamp[ps_uuid] or self.run_filesystem_fencer_timestamp[ps_uuid] > created_time:
+            if not self.run_filesystem_fencer_timestamp.get(ps_uuid) or self.run_filesystem_fencer_timestamp[ps_uuid] > created_time:
                 return False
 
             self.run_filesystem_fencer_timestamp[ps_uuid] = created_time
@@ -1,13 +1,19 @@
 __author__ = 'frank'
 
+import hashlib
 import os.path
+import pipes
+import subprocess
+import tempfile
 import traceback
 
 import zstacklib.utils.uuidhelper as uuidhelper
 from kvmagent import kvmagent
 from kvmagent.plugins.imagestore import ImageStoreClient
+from zstacklib.utils import checksum
 from zstacklib.utils import jsonobject
 from zstacklib.utils import shell
+from zstacklib.utils import thread
 from zstacklib.utils.bash import *
 from zstacklib.utils.report import *
 
@@ -87,6 +93,83 @@ class ListResponse(AgentResponse):
         self.paths = []
 
 
+MIGRATE_CHUNK_SIZE = 1024 * 1024
+MIGRATE_PARALLELISM = 4
+
+def md5sum_file(path, progress=None, use_cache=True):
+    return checksum.md5sum(path, progress.add if progress else None, use_cache)
+
+class RemoteFileSender(object):
+    '''
+    sends files to the same path on a remote host through ssh, each file is read once and its md5
+    is computed while sending. Like the quick check of rsync, a file is skipped if the remote one
+    has the same size and modification time.
+    '''
+    def __init__(self, ip, port, user, password):
+        self.password_file = linux.write_to_temp_file(password)
+        self.ssh_args = ['/usr/bin/sshpass', '-f%s' % self.password_file, 'ssh', '-o', 'StrictHostKeyChecking=no',
+                         '-p', str(port), '-l', user, ip]
+
+    def close(self):
+        if os.path.exists(self.password_file):
+            os.remove(self.password_file)
+
+    def stat_remote_files(self, paths):
+        '''
+        @return: path -> (size, mtime) of the existing remote files
+        '''
+        remote_cmd = "stat -c '%%s %%Y %%n' -- %s 2>/dev/null; true" % ' '.join([pipes.quote(p) for p in paths])
+        o = shell.call(' '.join([pipes.quote(a) for a in self.ssh_args + [remote_cmd]]))
+        ret = {}
+        for l in o.splitlines():
+            tokens = l.split(' ', 2)
+            if len(tokens) == 3 and tokens[0].isdigit() and tokens[1].isdigit():
+                ret[tokens[2]] = (long(tokens[0]), long(tokens[1]))
+        return ret
+
+    def send(self, path, progress=None):
+        '''
+        @return: md5 of the sent file
+        '''
+        st = os.stat(path)
+        tmp = pipes.quote('%s.migrating' % path)
+        dst = pipes.quote(path)
+        remote_cmd = ' && '.join([
+            'mkdir -p %s' % pipes.quote(os.path.dirname(path)),
+            'cat > %s' % tmp,
+            'chown %d:%d %s' % (st.st_uid, st.st_gid, tmp),
+            'chmod %o %s' % (st.st_mode & 07777, tmp),
+            'touch -m -d @%d %s' % (int(st.st_mtime), tmp),
+            'mv -f %s %s' % (tmp, dst),
+            '/bin/sync %s' % dst
+        ])
+
+        digest = hashlib.md5()
+        with tempfile.TemporaryFile() as err:
+            p = subprocess.Popen(self.ssh_args + [remote_cmd], stdin=subprocess.PIPE, stdout=err, stderr=err, close_fds=True)
+            try:
+                with open(path, 'rb') as fd:
+                    while True:
+                        data = fd.read(MIGRATE_CHUNK_SIZE)
+                        if not data:
+                            break
+                        digest.update(data)
+                        p.stdin.write(data)
+                        if progress:
+                            progress.add(len(data))
+                p.stdin.close()
+            except IOError as e:
+                # the remote command failed, the error is in its output
+                logger.warn('failed to send %s to %s, %s' % (path, self.ssh_args[-1], e))
+            finally:
+                rc = p.wait()
+
+            if rc != 0:
+                err.seek(0)
+                raise Exception('failed to send %s to %s, return code: %s, error: %s' % (path, self.ssh_args[-1], rc, err.read()))
+
+        return digest.hexdigest()
+
 class LocalStoragePlugin(kvmagent.KvmAgent):
     INIT_PATH = "/localstorage/init"
     GET_PHYSICAL_CAPACITY_PATH = "/localstorage/getphysicalcapacity"
@@ -131,29 +214,29 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.DELETE_BITS_PATH, self.delete)
         http_server.register_async_uri(self.DELETE_DIR_PATH, self.deletedir)
         http_server.register_async_uri(self.GET_LIST_PATH, self.list)
-        http_server.register_async_uri(self.DOWNLOAD_BIT_PATH, self.download_from_sftp)
-        http_server.register_async_uri(self.UPLOAD_BIT_PATH, self.upload_to_sftp)
-        http_server.register_async_uri(self.UPLOAD_TO_IMAGESTORE_PATH, self.upload_to_imagestore)
-        http_server.register_async_uri(self.COMMIT_TO_IMAGESTORE_PATH, self.commit_to_imagestore)
-        http_server.register_async_uri(self.DOWNLOAD_FROM_IMAGESTORE_PATH, self.download_from_imagestore)
+        http_server.register_async_uri(self.DOWNLOAD_BIT_PATH, self.download_from_sftp, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.UPLOAD_BIT_PATH, self.upload_to_sftp, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.UPLOAD_TO_IMAGESTORE_PATH, self.upload_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.COMMIT_TO_IMAGESTORE_PATH, self.commit_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.DOWNLOAD_FROM_IMAGESTORE_PATH, self.download_from_imagestore, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.REVERT_SNAPSHOT_PATH, self.revert_snapshot)
         http_server.register_async_uri(self.REINIT_IMAGE_PATH, self.reinit_image)
-        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot)
-        http_server.register_async_uri(self.MERGE_AND_REBASE_SNAPSHOT_PATH, self.merge_and_rebase_snapshot)
-        http_server.register_async_uri(self.OFFLINE_MERGE_PATH, self.offline_merge_snapshot)
-        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME, self.create_template_from_volume)
+        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.MERGE_AND_REBASE_SNAPSHOT_PATH, self.merge_and_rebase_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.OFFLINE_MERGE_PATH, self.offline_merge_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME, self.create_template_from_volume, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.CHECK_BITS_PATH, self.check_bits)
         http_server.register_async_uri(self.REBASE_ROOT_VOLUME_TO_BACKING_FILE_PATH, self.rebase_root_volume_to_backing_file)
         http_server.register_async_uri(self.VERIFY_SNAPSHOT_CHAIN_PATH, self.verify_backing_file_chain)
         http_server.register_async_uri(self.REBASE_SNAPSHOT_BACKING_FILES_PATH, self.rebase_backing_files)
-        http_server.register_async_uri(self.COPY_TO_REMOTE_BITS_PATH, self.copy_bits_to_remote)
-        http_server.register_async_uri(self.GET_MD5_PATH, self.get_md5)
-        http_server.register_async_uri(self.CHECK_MD5_PATH, self.check_md5)
+        http_server.register_async_uri(self.COPY_TO_REMOTE_BITS_PATH, self.copy_bits_to_remote, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.GET_MD5_PATH, self.get_md5, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.CHECK_MD5_PATH, self.check_md5, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.GET_BACKING_FILE_PATH, self.get_backing_file_path)
         http_server.register_async_uri(self.GET_VOLUME_SIZE, self.get_volume_size)
         http_server.register_async_uri(self.GET_BASE_IMAGE_PATH, self.get_volume_base_image_path)
         http_server.register_async_uri(self.GET_QCOW2_REFERENCE, self.get_qcow2_reference)
-        http_server.register_async_uri(self.CONVERT_QCOW2_TO_RAW, self.convert_qcow2_to_raw)
+        http_server.register_async_uri(self.CONVERT_QCOW2_TO_RAW, self.convert_qcow2_to_raw, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.RESIZE_VOLUME_PATH, self.resize_volume)
 
         self.imagestore_client = ImageStoreClient()
@@ -236,10 +319,8 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
             Report.url = cmd.sendCommandUrl
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
 
         total = 0
-        written = 0
         for to in cmd.md5s:
             total = total + os.path.getsize(to.path)
 
@@ -248,37 +329,20 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
         if cmd.stage:
             start, end = get_scale(cmd.stage)
 
-
-        def _get_progress(synced):
-            logger.debug("getProgress in get_md5")
-            if not os.path.exists(PFILE):
-                return synced
-            last = shell.call('tail -1 %s' % PFILE).strip()
-            if not last or not last.isdigit():
-                return synced
-            percent = int(round((float(written) * 100 + os.path.getsize(to.path) * float(last)) / total * (end - start) / 100) + start)
-            report.progress_report(str(percent), "report")
-            return synced
-
         report.resourceUuid = cmd.volumeUuid
         if start == 0:
             report.progress_report("0", "start")
         else:
             report.progress_report(str(start), "report")
 
+        progress = MigrationProgress(report, start, end, total)
         for to in cmd.md5s:
-            _, md5, _ = bash_progress_1("pv -n %s 2>%s | md5sum | cut -d ' ' -f 1" % (to.path, PFILE), _get_progress)
             rsp.md5s.append({
                 'resourceUuid': to.resourceUuid,
                 'path': to.path,
-                'md5': md5
+                # ends with a newline like the md5sum output, agents not upgraded compare it as is
+                'md5': md5sum_file(to.path, progress) + '\n'
             })
-            written += os.path.getsize(to.path)
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
 
         return jsonobject.dumps(rsp)
 
@@ -290,9 +354,7 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
 
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
         total = 0
-        written = 0
 
         start = 90
         end = 100
@@ -301,30 +363,16 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
         for to in cmd.md5s:
             total = total + os.path.getsize(to.path)
 
-        def _get_progress(synced):
-            logger.debug("getProgress in check_md5")
-            if not os.path.exists(PFILE):
-                return synced
-            last = shell.call('tail -1 %s' % PFILE).strip()
-            if not last or not last.isdigit():
-                return synced
-            percent = int(round((float(written) * 100 + os.path.getsize(to.path) * float(last)) / total * (end - start) / 100) + start)
-            report.progress_report(percent, "report")
-            return synced
-
         report.resourceUuid = cmd.volumeUuid
+        progress = MigrationProgress(report, start, end, total)
         for to in cmd.md5s:
-            _, dst_md5, _ = bash_progress_1("pv -n %s 2>%s | md5sum | cut -d ' ' -f 1" % (to.path, PFILE), _get_progress)
+            # verify what is on the disk, not a cached checksum
+            dst_md5 = md5sum_file(to.path, progress, use_cache=False)
 
-            if dst_md5 != to.md5:
+            # the md5 from get_md5 ends with a newline
+            if dst_md5 != to.md5.strip():
                 raise Exception("MD5 unmatch. The file[uuid:%s, path:%s]'s md5 (src host:%s, dst host:%s)" %
                                 (to.resourceUuid, to.path, to.md5, dst_md5))
-            written += os.path.getsize(to.path)
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
 
         rsp = AgentResponse()
         if end == 100:
@@ -340,17 +388,22 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
         return linux.get_disk_capacity_by_df(path)
 
     @kvmagent.replyerror
-    @in_bash
     def copy_bits_to_remote(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        chain = sum([linux.qcow2_get_file_chain(p) for p in cmd.paths], [])
+        if cmd.dstUsername != 'root':
+            raise Exception("cannot support migrate to non-root user host")
+
+        chain = []
+        for p in sum([linux.qcow2_get_file_chain(p) for p in cmd.paths], []):
+            if p not in chain:
+                chain.append(p)
+
         if cmd.sendCommandUrl:
             Report.url = cmd.sendCommandUrl
 
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
         report.resourceUuid = cmd.uuid
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
 
         start = 10
         end = 90
@@ -358,60 +411,37 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
             start, end = get_scale(cmd.stage)
 
         total = 0
-        for path in set(chain):
+        for path in chain:
             total = total + os.path.getsize(path)
 
-        written = 0
-
-        def _get_progress(synced):
-            logger.debug("getProgress in localstorage-agent, synced: %s, total: %s" % (synced, total))
-            if not os.path.exists(PFILE):
-                return synced
-            fpread = open(PFILE, 'r')
-            lines = fpread.readlines()
-            if not lines:
-                fpread.close()
-                return synced
-            last = str(lines[-1]).strip().split('\r')[-1]
-            if not last or len(last.split()) < 1:
-                fpread.close()
-                return synced
-            line = last.split()[0]
-            if not line.isdigit():
-                return synced
-            if total > 0:
-                synced = long(line)
-                if synced < total:
-                    percent = int(round(float(written + synced) / float(total) * (end - start) + start))
-                    report.progress_report(percent, "report")
-                    synced = written
-            fpread.close()
-            return synced
-
-        for path in set(chain):
-            PATH = path
-            PASSWORD = cmd.dstPassword
-            USER = cmd.dstUsername
-            IP = cmd.dstIp
-            PORT = (cmd.dstPort and cmd.dstPort or "22")
-            DIR = os.path.dirname(path)
-
-            if cmd.dstUsername == 'root':
-                _, _, err = bash_progress_1(
-                    # Fixes ZSTAC-13430: handle extremely complex password like ~ ` !@#$%^&*()_+-=[]{}|?<>;:'"/ .
-                    'echo \'{{PASSWORD}}\' > /tmp/tmp_passwd && rsync -av --progress --relative {{PATH}} --rsh="/usr/bin/sshpass -f/tmp/tmp_passwd ssh -o StrictHostKeyChecking=no -p {{PORT}} -l {{USER}}" {{IP}}:/ 1>{{PFILE}}', _get_progress, False)
-
-                if err:
-                    raise Exception('fail to migrate vm to host, because %s' % str(err))
-            else:
-                raise Exception("cannot support migrate to non-root user host")
-            written += os.path.getsize(path)
-            bash_errorout('/usr/bin/sshpass -f/tmp/tmp_passwd ssh -o StrictHostKeyChecking=no -p {{PORT}} {{USER}}@{{IP}} "/bin/sync {{PATH}}"')
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
+        progress = MigrationProgress(report, start, end, total)
+        sender = RemoteFileSender(cmd.dstIp, cmd.dstPort and cmd.dstPort or "22", cmd.dstUsername, cmd.dstPassword)
+
+        def send(path):
+            key = checksum.get_file_key(path)
+            if remote_files.get(path) == (key[2], long(key[1])):
+                logger.debug('skip sending %s to %s, the remote file has the same size and mtime' % (path, cmd.dstIp))
+                progress.add(key[2])
+                return
+
+            md5 = sender.send(path, progress)
+            if key != checksum.get_file_key(path):
+                raise Exception('the file[%s] changed when migrating it to host[%s]' % (path, cmd.dstIp))
+
+            cached = checksum.get_cached(path, key=key)
+            if cached and cached != md5:
+                raise Exception('the md5 of file[%s] changed from %s to %s when migrating it to host[%s]' %
+                                (path, cached, md5, cmd.dstIp))
+            checksum.remember(path, md5, key=key)
+
+        try:
+            remote_files = sender.stat_remote_files(chain)
+            thread.run_parallel(send, chain, cmd.parallelism or MIGRATE_PARALLELISM)
+        except Exception as e:
+            raise Exception('fail to migrate vm to host, because %s' % str(e))
+        finally:
+            sender.close()
+
         rsp = AgentResponse()
         rsp.totalCapacity, rsp.availableCapacity = self._get_disk_capacity(cmd.storagePath)
         return jsonobject.dumps(rsp)
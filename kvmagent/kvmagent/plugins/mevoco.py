@@ -8,6 +8,7 @@ from zstacklib.utils import log
 from zstacklib.utils import shell
 from zstacklib.utils import sizeunit
 from zstacklib.utils import linux
+from zstacklib.utils import procfs
 from zstacklib.utils import thread
 from zstacklib.utils import iptables
 from zstacklib.utils import ebtables
@@ -17,6 +18,7 @@ from zstacklib.utils import ip
 import os.path
 import re
 import threading
+import collections
 import time
 import email
 import cStringIO as c
@@ -240,6 +242,195 @@ class DhcpEnv(object):
         if ret != 0:
             bash_errorout('iptables -w -t mangle -A POSTROUTING -p udp -m udp --dport 68 -j CHECKSUM --checksum-fill')
 
+class DnsmasqHostsFile(object):
+    '''
+    lines of a dnsmasq hosts/options file indexed by the keys get_keys() returns for each line.
+    Changes are kept in memory until flush() replaces the file atomically, the file is read
+    again if something else changed it.
+    '''
+    def __init__(self, path, get_keys):
+        self.path = path
+        self.get_keys = get_keys
+        self.lines = collections.OrderedDict()
+        self.index = {}
+        self.seq = 0
+        self.dirty = False
+        self.signature = None
+        self.load()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_ino, st.st_mtime, st.st_size
+        except OSError:
+            return None
+
+    def load(self):
+        self.lines.clear()
+        self.index.clear()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as fd:
+                for l in fd:
+                    self.add(l)
+        self.signature = self._stat()
+        self.dirty = False
+
+    def load_if_changed(self):
+        if self._stat() != self.signature:
+            logger.debug('%s is changed by others, reload it' % self.path)
+            self.load()
+
+    def add(self, line):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            return
+
+        self.seq += 1
+        self.lines[self.seq] = line
+        for k in self.get_keys(line):
+            self.index.setdefault(k, set()).add(self.seq)
+        self.dirty = True
+
+    def _remove_seq(self, seq):
+        line = self.lines.pop(seq, None)
+        if line is None:
+            return
+        for k in self.get_keys(line):
+            seqs = self.index.get(k)
+            if seqs is not None:
+                seqs.discard(seq)
+                if not seqs:
+                    del self.index[k]
+        self.dirty = True
+
+    def remove(self, key):
+        for seq in list(self.index.get(key, ())):
+            self._remove_seq(seq)
+
+    def remove_if(self, is_line_to_delete):
+        for seq, line in self.lines.items():
+            if is_line_to_delete(line):
+                self._remove_seq(seq)
+
+    def clear(self):
+        self.lines.clear()
+        self.index.clear()
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            return
+
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as fd:
+            for l in self.lines.itervalues():
+                fd.write(l)
+                fd.write('\n')
+        os.rename(tmp, self.path)
+        self.signature = self._stat()
+        self.dirty = False
+
+def _get_dhcp_line_keys(line):
+    # mac,set:tag,ip[,hostname],infinite
+    fields = line.split(',')
+    keys = [('mac', fields[0])]
+    if len(fields) > 2:
+        keys.append(('ip', fields[2]))
+    return keys
+
+def _get_option_line_keys(line):
+    # tag:tag,option...
+    if not line.startswith('tag:'):
+        return []
+    return [line[4:].split(',', 1)[0]]
+
+def _get_dns_line_keys(line):
+    # ip hostname
+    return [line.split(None, 1)[0]]
+
+class DhcpEntryStore(object):
+    '''
+    dhcp entries of a namespace in the dnsmasq hosts.dhcp, hosts.option and hosts.dns files
+    '''
+    def __init__(self, dhcp_path, dns_path, option_path):
+        self.dhcp = DnsmasqHostsFile(dhcp_path, _get_dhcp_line_keys)
+        self.dns = DnsmasqHostsFile(dns_path, _get_dns_line_keys)
+        self.option = DnsmasqHostsFile(option_path, _get_option_line_keys)
+
+    def load_if_changed(self):
+        for f in (self.dhcp, self.dns, self.option):
+            f.load_if_changed()
+
+    def erase(self, mac, ip):
+        self.dhcp.remove(('mac', mac))
+        self.dhcp.remove(('ip', ip))
+        self.option.remove(mac.replace(':', ''))
+        self.dns.remove(ip)
+
+    def clear(self):
+        for f in (self.dhcp, self.dns, self.option):
+            f.clear()
+
+    def flush(self):
+        for f in (self.dhcp, self.dns, self.option):
+            f.flush()
+
+class _DnsmasqReload(object):
+    def __init__(self, conf_file_path):
+        self.conf_file_path = conf_file_path
+        self.restart = False
+        self.done = threading.Event()
+        self.error = None
+
+class DnsmasqReloader(object):
+    '''
+    coalesces the restarts and SIGHUPs of the dnsmasq of a namespace requested in DEBOUNCE
+    seconds into one. Must be called without holding the 'dnsmasq' lock.
+    '''
+    DEBOUNCE = 0.2
+
+    def __init__(self, restart, refresh):
+        self._restart = restart
+        self._refresh = refresh
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def reload(self, ns_name, conf_file_path, restart=False):
+        with self.lock:
+            r = self.pending.get(ns_name)
+            leader = r is None
+            if leader:
+                r = self.pending[ns_name] = _DnsmasqReload(conf_file_path)
+            r.restart = r.restart or restart
+
+        if leader:
+            time.sleep(self.DEBOUNCE)
+            with self.lock:
+                del self.pending[ns_name]
+
+            try:
+                with lock.NamedLock('dnsmasq'):
+                    if r.restart:
+                        self._restart(ns_name, r.conf_file_path)
+                    else:
+                        self._refresh(ns_name, r.conf_file_path)
+            except Exception as e:
+                r.error = e
+            finally:
+                r.done.set()
+        else:
+            r.done.wait()
+
+        if r.error:
+            raise r.error
+
+    # reloads: list of (ns_name, conf_file_path, restart)
+    def reload_all(self, reloads):
+        if len(reloads) == 1:
+            self.reload(*reloads[0])
+        elif reloads:
+            thread.run_parallel(lambda r: self.reload(*r), reloads, len(reloads))
+
 class Mevoco(kvmagent.KvmAgent):
     APPLY_DHCP_PATH = "/flatnetworkprovider/dhcp/apply"
     PREPARE_DHCP_PATH = "/flatnetworkprovider/dhcp/prepare"
@@ -261,6 +452,8 @@ class Mevoco(kvmagent.KvmAgent):
 
     def __init__(self):
         self.signal_count = 0
+        self.dhcp_stores = {}
+        self.dnsmasq_reloader = DnsmasqReloader(self._restart_dnsmasq, self._refresh_dnsmasq)
 
     def start(self):
         http_server = kvmagent.get_http_server()
@@ -281,64 +474,46 @@ class Mevoco(kvmagent.KvmAgent):
     def stop(self):
         pass
 
-    @lock.lock('dnsmasq')
     @kvmagent.replyerror
     def remove_dns_forward(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = RemoveForwardDnsRsp()
 
-        conf_file_path, dhcp_path, dns_path, option_path, _ = self._make_conf_path(cmd.nameSpace)
-        self._remove_dns_forward(cmd.mac, option_path)
-        self._restart_dnsmasq(cmd.nameSpace, conf_file_path)
+        with lock.NamedLock('dnsmasq'):
+            conf_file_path, dhcp_path, dns_path, option_path, _ = self._make_conf_path(cmd.nameSpace)
+            self._remove_dns_forward(cmd.nameSpace, cmd.mac)
 
+        self.dnsmasq_reloader.reload(cmd.nameSpace, conf_file_path, restart=True)
         return jsonobject.dumps(rsp)
 
-    def _remove_dns_forward(self, mac, option_path):
-        TAG = mac.replace(':', '')
-        OPTION = option_path
-
-        bash_errorout('''\
-sed -i '/{{TAG}},/d' {{OPTION}};
-sed -i '/^$/d' {{OPTION}};
-''')
+    def _remove_dns_forward(self, namespace_name, mac):
+        store = self._get_dhcp_store(namespace_name)
+        store.option.remove(mac.replace(':', ''))
+        store.flush()
 
-
-    @lock.lock('dnsmasq')
     @kvmagent.replyerror
     def setup_dns_forward(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = SetForwardDnsRsp()
 
-        self._apply_dns_forward(cmd)
+        with lock.NamedLock('dnsmasq'):
+            conf_file_path = self._apply_dns_forward(cmd)
 
+        self.dnsmasq_reloader.reload(cmd.nameSpace, conf_file_path, restart=True)
         return jsonobject.dumps(rsp)
 
     def _apply_dns_forward(self, cmd):
         conf_file_path, dhcp_path, dns_path, option_path, log_path = self._make_conf_path(cmd.nameSpace)
+        store = self._get_dhcp_store(cmd.nameSpace)
 
         TAG = cmd.mac.replace(':', '')
-        OPTION = option_path
-        DNS = cmd.wrongDns
-
         for dns in cmd.wrongDns:
-            DNS = dns
-            bash_errorout('''\
-            sed -i '/{{TAG}},option:dns-server,{{DNS}}/d' {{OPTION}};
-            sed -i '/^$/d' {{OPTION}};
-            ''')
+            wrong = 'tag:%s,option:dns-server,%s' % (TAG, dns)
+            store.option.remove_if(lambda l: wrong in l)
 
-        DNS = cmd.dns
-        option_conf = '''\
-tag:{{TAG}},option:dns-server,{{DNS}}
-
-'''
-        tmpt = Template(option_conf)
-        option_conf = tmpt.render({'TAG': TAG, 'DNS': DNS})
-        mode = 'a+'
-        with open(option_path, mode) as fd:
-            fd.write(option_conf)
-
-        self._restart_dnsmasq(cmd.nameSpace, conf_file_path)
+        store.option.add('tag:%s,option:dns-server,%s' % (TAG, cmd.dns))
+        store.flush()
+        return conf_file_path
 
 
     @kvmagent.replyerror
@@ -364,7 +539,10 @@ tag:{{TAG}},option:dns-server,{{DNS}}
             if ret != 0:
                 bash_errorout(EBTABLES_CMD + ' -A {{CHAIN_NAME}} -j RETURN')
 
-        bash_errorout("ps aux | grep -v grep | grep -w dnsmasq | grep -w %s | awk '{printf $2}' | xargs -r kill -9" % cmd.namespaceName)
+        with lock.NamedLock('dnsmasq'):
+            self.dhcp_stores.pop(cmd.namespaceName, None)
+        procfs.kill_processes([p for p in procfs.get_process_table(force=True).processes
+                               if p.has_words('dnsmasq', cmd.namespaceName)])
         bash_errorout("ip netns | grep -w %s | grep -v grep | awk '{print $1}' | xargs -r ip netns del %s" % (cmd.namespaceName, cmd.namespaceName))
 
         return jsonobject.dumps(DeleteNamespaceRsp())
@@ -400,7 +578,8 @@ tag:{{TAG}},option:dns-server,{{DNS}}
             cmds.append(EBTABLES_CMD + " -t nat -X %s" % CHAIN_NAME)
             bash_r("\n".join(cmds))
 
-        bash_errorout("ps aux | grep lighttpd | grep {{BR_NAME}} | grep -w userdata | awk '{print $2}' | xargs -r kill -9")
+        procfs.kill_processes([p for p in procfs.get_process_table(force=True).find('lighttpd', BR_NAME)
+                               if p.has_words('userdata')])
 
         return jsonobject.dumps(kvmagent.AgentResponse())
 
@@ -747,32 +926,44 @@ mimetype.assign = (
 
         return jsonobject.dumps(PrepareDhcpRsp())
 
-    @lock.lock('dnsmasq')
     @kvmagent.replyerror
     def reset_default_gateway(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
 
-        if cmd.namespaceNameOfGatewayToRemove and cmd.macOfGatewayToRemove and cmd.gatewayToRemove:
-            conf_file_path, _, _, option_path, _ = self._make_conf_path(cmd.namespaceNameOfGatewayToRemove)
-            mac_to_remove = cmd.macOfGatewayToRemove.replace(':', '')
+        reloads = []
+        with lock.NamedLock('dnsmasq'):
+            if cmd.namespaceNameOfGatewayToRemove and cmd.macOfGatewayToRemove and cmd.gatewayToRemove:
+                conf_file_path, _, _, option_path, _ = self._make_conf_path(cmd.namespaceNameOfGatewayToRemove)
+                mac_to_remove = cmd.macOfGatewayToRemove.replace(':', '')
 
-            def is_line_to_delete(line):
-                return cmd.gatewayToRemove in line and mac_to_remove in line and 'router' in line
+                def is_line_to_delete(line):
+                    return cmd.gatewayToRemove in line and mac_to_remove in line and 'router' in line
 
-            linux.delete_lines_from_file(option_path, is_line_to_delete)
-            self._refresh_dnsmasq(cmd.namespaceNameOfGatewayToRemove, conf_file_path)
+                store = self._get_dhcp_store(cmd.namespaceNameOfGatewayToRemove)
+                store.option.remove_if(is_line_to_delete)
+                store.flush()
+                reloads.append((cmd.namespaceNameOfGatewayToRemove, conf_file_path, False))
 
-        if cmd.namespaceNameOfGatewayToAdd and cmd.macOfGatewayToAdd and cmd.gatewayToAdd:
-            conf_file_path, _, _, option_path, _ = self._make_conf_path(cmd.namespaceNameOfGatewayToAdd)
-            option = 'tag:%s,option:router,%s\n' % (cmd.macOfGatewayToAdd.replace(':', ''), cmd.gatewayToAdd)
-            with open(option_path, 'a+') as fd:
-                fd.write(option)
+            if cmd.namespaceNameOfGatewayToAdd and cmd.macOfGatewayToAdd and cmd.gatewayToAdd:
+                conf_file_path, _, _, option_path, _ = self._make_conf_path(cmd.namespaceNameOfGatewayToAdd)
+                store = self._get_dhcp_store(cmd.namespaceNameOfGatewayToAdd)
+                store.option.add('tag:%s,option:router,%s' % (cmd.macOfGatewayToAdd.replace(':', ''), cmd.gatewayToAdd))
+                store.flush()
+                reloads.append((cmd.namespaceNameOfGatewayToAdd, conf_file_path, False))
 
-            self._refresh_dnsmasq(cmd.namespaceNameOfGatewayToAdd, conf_file_path)
+        self.dnsmasq_reloader.reload_all(reloads)
 
         return jsonobject.dumps(ResetGatewayRsp())
 
-    @lock.lock('dnsmasq')
+    def _get_dhcp_store(self, namespace_name):
+        _, dhcp_path, dns_path, option_path, _ = self._make_conf_path(namespace_name)
+        store = self.dhcp_stores.get(namespace_name)
+        if not store:
+            store = self.dhcp_stores[namespace_name] = DhcpEntryStore(dhcp_path, dns_path, option_path)
+        else:
+            store.load_if_changed()
+        return store
+
     @kvmagent.replyerror
     def apply_dhcp(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
@@ -790,6 +981,9 @@ mimetype.assign = (
             bridge_name = dhcp[0].bridgeName
             namespace_name = dhcp[0].namespaceName
             conf_file_path, dhcp_path, dns_path, option_path, log_path = self._make_conf_path(namespace_name)
+            store = self._get_dhcp_store(namespace_name)
+            if cmd.rebuild:
+                store.clear()
 
             conf_file = '''\
 domain-needed
@@ -856,7 +1050,7 @@ dhcp-range={{g}},static
                 info.append(dhcp_info)
 
                 if not cmd.rebuild:
-                    self._erase_configurations(d.mac, d.ip, dhcp_path, dns_path, option_path)
+                    store.erase(d.mac, d.ip)
 
             dhcp_conf = '''\
 {% for d in dhcp -%}
@@ -870,12 +1064,8 @@ dhcp-range={{g}},static
 
             tmpt = Template(dhcp_conf)
             dhcp_conf = tmpt.render({'dhcp': info})
-            mode = 'a+'
-            if cmd.rebuild:
-                mode = 'w'
-
-            with open(dhcp_path, mode) as fd:
-                fd.write(dhcp_conf)
+            for l in dhcp_conf.splitlines():
+                store.dhcp.add(l)
 
             option_conf = '''\
 {% for o in options -%}
@@ -904,9 +1094,8 @@ tag:{{o.tag}},option:mtu,{{o.mtu}}
     '''
             tmpt = Template(option_conf)
             option_conf = tmpt.render({'options': info})
-
-            with open(option_path, mode) as fd:
-                fd.write(option_conf)
+            for l in option_conf.splitlines():
+                store.option.add(l)
 
             hostname_conf = '''\
 {% for h in hostnames -%}
@@ -917,17 +1106,16 @@ tag:{{o.tag}},option:mtu,{{o.mtu}}
     '''
             tmpt = Template(hostname_conf)
             hostname_conf = tmpt.render({'hostnames': info})
+            for l in hostname_conf.splitlines():
+                store.dns.add(l)
 
-            with open(dns_path, mode) as fd:
-                fd.write(hostname_conf)
+            store.flush()
+            return namespace_name, conf_file_path, restart_dnsmasq
 
-            if restart_dnsmasq:
-                self._restart_dnsmasq(namespace_name, conf_file_path)
-            else:
-                self._refresh_dnsmasq(namespace_name, conf_file_path)
+        with lock.NamedLock('dnsmasq'):
+            reloads = [apply(v) for v in namespace_dhcp.values()]
 
-        for k, v in namespace_dhcp.iteritems():
-            apply(v)
+        self.dnsmasq_reloader.reload_all(reloads)
 
         rsp = ApplyDhcpRsp()
         return jsonobject.dumps(rsp)
@@ -963,26 +1151,6 @@ tag:{{o.tag}},option:mtu,{{o.mtu}}
         shell.call('kill -1 %s' % pid)
         self.signal_count += 1
 
-    def _erase_configurations(self, mac, ip, dhcp_path, dns_path, option_path):
-        MAC = mac
-        TAG = mac.replace(':', '')
-        DHCP = dhcp_path
-        OPTION = option_path
-        IP = ip
-        DNS = dns_path
-
-        bash_errorout('''\
-sed -i '/{{MAC}},/d' {{DHCP}};
-sed -i '/,{{IP}},/d' {{DHCP}};
-sed -i '/^$/d' {{DHCP}};
-sed -i '/{{TAG}},/d' {{OPTION}};
-sed -i '/^$/d' {{OPTION}};
-sed -i '/^{{IP}} /d' {{DNS}};
-sed -i '/^$/d' {{DNS}}
-''')
-
-
-    @lock.lock('dnsmasq')
     @kvmagent.replyerror
     def release_dhcp(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
@@ -995,15 +1163,18 @@ sed -i '/^$/d' {{DNS}}
                 namespace_dhcp[d.namespaceName] = lst
             lst.append(d)
 
-        @in_bash
-        def release(dhcp):
+        def release(namespace_name, dhcp):
+            conf_file_path = self._make_conf_path(namespace_name)[0]
+            store = self._get_dhcp_store(namespace_name)
             for d in dhcp:
-                conf_file_path, dhcp_path, dns_path, option_path, _ = self._make_conf_path(d.namespaceName)
-                self._erase_configurations(d.mac, d.ip, dhcp_path, dns_path, option_path)
-                self._restart_dnsmasq(d.namespaceName, conf_file_path)
+                store.erase(d.mac, d.ip)
+            store.flush()
+            return namespace_name, conf_file_path, True
+
+        with lock.NamedLock('dnsmasq'):
+            reloads = [release(k, v) for k, v in namespace_dhcp.iteritems()]
 
-        for k, v in namespace_dhcp.iteritems():
-            release(v)
+        self.dnsmasq_reloader.reload_all(reloads)
 
         rsp = ReleaseDhcpRsp()
         return jsonobject.dumps(rsp)
@@ -8,7 +8,9 @@ import traceback
 import zstacklib.utils.uuidhelper as uuidhelper
 from kvmagent import kvmagent
 from kvmagent.plugins.imagestore import ImageStoreClient
+from zstacklib.utils import checksum
 from zstacklib.utils import http
+from zstacklib.utils import thread
 from zstacklib.utils import jsonobject
 from zstacklib.utils import linux
 from zstacklib.utils import log
@@ -195,29 +197,29 @@ class NfsPrimaryStoragePlugin(kvmagent.KvmAgent):
         http_server.register_sync_uri(self.UNMOUNT_PATH, self.umount)
         http_server.register_async_uri(self.CREATE_VOLUME_FROM_TEMPLATE_PATH, self.create_root_volume_from_template)
         http_server.register_async_uri(self.CREATE_EMPTY_VOLUME_PATH, self.create_empty_volume)
-        http_server.register_async_uri(self.DOWNLOAD_FROM_SFTP_PATH, self.download_from_sftp)
+        http_server.register_async_uri(self.DOWNLOAD_FROM_SFTP_PATH, self.download_from_sftp, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.GET_CAPACITY_PATH, self.get_capacity)
         http_server.register_async_uri(self.DELETE_PATH, self.delete)
         http_server.register_async_uri(self.LIST_PATH, self.list)
-        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME_PATH, self.create_template_from_root_volume)
+        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME_PATH, self.create_template_from_root_volume, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.CHECK_BITS_PATH, self.check_bits)
         http_server.register_async_uri(self.REVERT_VOLUME_FROM_SNAPSHOT_PATH, self.revert_volume_from_snapshot)
         http_server.register_async_uri(self.REINIT_IMAGE_PATH, self.reinit_image)
-        http_server.register_async_uri(self.UPLOAD_TO_SFTP_PATH, self.upload_to_sftp)
-        http_server.register_async_uri(self.UPLOAD_TO_IMAGESTORE_PATH, self.upload_to_imagestore)
-        http_server.register_async_uri(self.COMMIT_TO_IMAGESTORE_PATH, self.commit_to_imagestore)
-        http_server.register_async_uri(self.DOWNLOAD_FROM_IMAGESTORE_PATH, self.download_from_imagestore)
-        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot)
-        http_server.register_async_uri(self.REBASE_MERGE_SNAPSHOT_PATH, self.rebase_and_merge_snapshot)
+        http_server.register_async_uri(self.UPLOAD_TO_SFTP_PATH, self.upload_to_sftp, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.UPLOAD_TO_IMAGESTORE_PATH, self.upload_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.COMMIT_TO_IMAGESTORE_PATH, self.commit_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.DOWNLOAD_FROM_IMAGESTORE_PATH, self.download_from_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.REBASE_MERGE_SNAPSHOT_PATH, self.rebase_and_merge_snapshot, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.MOVE_BITS_PATH, self.move_bits)
-        http_server.register_async_uri(self.OFFLINE_SNAPSHOT_MERGE, self.merge_snapshot_to_volume)
+        http_server.register_async_uri(self.OFFLINE_SNAPSHOT_MERGE, self.merge_snapshot_to_volume, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.REMOUNT_PATH, self.remount)
         http_server.register_async_uri(self.GET_VOLUME_SIZE_PATH, self.get_volume_size)
-        http_server.register_async_uri(self.PING_PATH, self.ping)
+        http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
         http_server.register_async_uri(self.GET_VOLUME_BASE_IMAGE_PATH, self.get_volume_base_image_path)
         http_server.register_async_uri(self.UPDATE_MOUNT_POINT_PATH, self.update_mount_point)
         http_server.register_async_uri(self.RESIZE_VOLUME_PATH, self.resize_volume)
-        http_server.register_async_uri(self.NFS_TO_NFS_MIGRATE_VOLUME_PATH, self.migrate_volume)
+        http_server.register_async_uri(self.NFS_TO_NFS_MIGRATE_VOLUME_PATH, self.migrate_volume, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.NFS_REBASE_VOLUME_BACKING_FILE_PATH, self.rebase_volume_backing_file)
         self.mount_path = {}
         self.image_cache = None
@@ -236,8 +238,9 @@ class NfsPrimaryStoragePlugin(kvmagent.KvmAgent):
 
         # begin volume migration, then check md5 sums
         shell.call("mkdir -p %s; cp -r %s/* %s" % (cmd.dstVolumeFolderPath, cmd.srcVolumeFolderPath, cmd.dstVolumeFolderPath))
-        src_md5 = shell.call("find %s -type f -exec md5sum {} \; | awk '{ print $1 }' | sort | md5sum" % cmd.srcVolumeFolderPath)
-        dst_md5 = shell.call("find %s -type f -exec md5sum {} \; | awk '{ print $1 }' | sort | md5sum" % cmd.dstVolumeFolderPath)
+        # both folders are on this host, the files are hashed by chunks in parallel
+        src_md5 = checksum.folder_digest(cmd.srcVolumeFolderPath)
+        dst_md5 = checksum.folder_digest(cmd.dstVolumeFolderPath)
         if src_md5 != dst_md5:
             rsp.error = "failed to copy files from %s to %s, md5sum not match" % (cmd.srcVolumeFolderPath, cmd.dstVolumeFolderPath)
             rsp.success = False
@@ -13,6 +13,7 @@ from zstacklib.utils import shell
 from zstacklib.utils import lock
 from zstacklib.utils import linux
 from zstacklib.utils import iptables
+from zstacklib.utils import ordered_set
 import os.path
 import re
 
@@ -66,6 +67,14 @@ class CheckDefaultSecurityGroupResponse(kvmagent.AgentResponse):
     def __init__(self):
         super(CheckDefaultSecurityGroupResponse, self).__init__()
 
+class SecurityGroupRuleCache(object):
+    def __init__(self):
+        # fingerprint of the zstack chains in iptables after our last change,
+        # someone else changed them if the fingerprint doesn't match
+        self.fingerprint = None
+        # vnic name -> rules generated for it last time
+        self.vnic_rules = {}
+
 class SecurityGroupPlugin(kvmagent.KvmAgent):
     
     SECURITY_GROUP_APPLY_RULE_PATH = "/securitygroup/applyrules"
@@ -300,6 +309,7 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
 
         for r in rules:
             ipt.add_rule(r)
+        return rules
             
     def _delete_vnic_in_chain(self, ipt, nic_name):
         in_chain_name = self._make_in_chain_name(nic_name)
@@ -348,12 +358,14 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
             ips_mn = ipset_mn
 
         self._create_default_rules(ipt)
-        
+
+        vnic_rules = {}
         for rto in cmd.ruleTOs:
             if rto.actionCode == self.ACTION_CODE_DELETE_CHAIN:
                 self._delete_vnic_chain(ipt, rto.vmNicInternalName)
+                vnic_rules.pop(rto.vmNicInternalName, None)
             elif rto.actionCode == self.ACTION_CODE_APPLY_RULE:
-                self._apply_rules_on_vnic_chain(ipt, ips_mn, rto)
+                vnic_rules[rto.vmNicInternalName] = self._apply_rules_on_vnic_chain(ipt, ips_mn, rto)
             else:
                 raise Exception('unknown action code: %s' % rto.actionCode)
 
@@ -369,11 +381,124 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         def match_set_name(name):
             return name.startswith(self.ZSTACK_IPSET_NAME_FORMAT)
         ips_mn.cleanup_other_ipset(match_set_name, used_ipset)
+        return vnic_rules
         
     def _refresh_rules_on_host_using_iprange_match(self, cmd):
         ipt = iptables.from_iptables_save()
         self._delete_all_chains(ipt)
-        self._apply_rules_using_iprange_match(cmd, ipt)
+        return self._apply_rules_using_iprange_match(cmd, ipt)
+
+    def _is_zstack_chain(self, chain_name):
+        return chain_name == self.ZSTACK_DEFAULT_CHAIN or chain_name.startswith('vnic')
+
+    def _load_zstack_chains(self):
+        return iptables.ChainSnapshot(iptables.IPTables.FILTER_TABLE_NAME, self._is_zstack_chain).load()
+
+    def _update_rule_cache(self, vnic_rules):
+        cache = SecurityGroupRuleCache()
+        cache.fingerprint = self._load_zstack_chains().fingerprint
+        cache.vnic_rules = vnic_rules
+        self.rule_cache = cache
+
+    def _apply_rules_incrementally(self, cmd):
+        # only rewrite the chains of vnics whose rules changed, with
+        # iptables-restore --noflush. Return False if a full resync is needed
+        if not self.rule_cache:
+            return False
+
+        snapshot = self._load_zstack_chains()
+        if snapshot.fingerprint != self.rule_cache.fingerprint:
+            logger.debug('security group chains are changed outside the agent, do a full resync')
+            return False
+        if self.ZSTACK_DEFAULT_CHAIN not in snapshot.chains or not snapshot.references:
+            return False
+
+        ips_mn = ipset.IPSetManager()
+        vnic_rules = dict(self.rule_cache.vnic_rules)
+        chains = {}
+        deleted_chains = ordered_set.OrderedSet()
+        # rules jumping from the default chain to the vnic chains
+        new_jump_rules = []
+
+        def rules_of_chain(rules, chain_name):
+            return list(ordered_set.OrderedSet([r for r in rules if r.split()[1] == chain_name]))
+
+        for rto in cmd.ruleTOs:
+            vif_name = rto.vmNicInternalName
+            in_chain_name = self._make_in_chain_name(vif_name)
+            out_chain_name = self._make_out_chain_name(vif_name)
+            if rto.actionCode == self.ACTION_CODE_DELETE_CHAIN:
+                vnic_rules.pop(vif_name, None)
+                for c in (in_chain_name, out_chain_name):
+                    chains.pop(c, None)
+                    if c in snapshot.chains:
+                        deleted_chains.add(c)
+            elif rto.actionCode == self.ACTION_CODE_APPLY_RULE:
+                rules = self._create_rule_from_setting(rto, ips_mn)
+                deleted_chains.discard(in_chain_name)
+                deleted_chains.discard(out_chain_name)
+                if vnic_rules.get(vif_name) == rules and in_chain_name in snapshot.chains and \
+                        out_chain_name in snapshot.chains:
+                    continue
+
+                vnic_rules[vif_name] = rules
+                chains[in_chain_name] = rules_of_chain(rules, in_chain_name)
+                chains[out_chain_name] = rules_of_chain(rules, out_chain_name)
+                new_jump_rules.extend(rules_of_chain(rules, self.ZSTACK_DEFAULT_CHAIN))
+            else:
+                raise Exception('unknown action code: %s' % rto.actionCode)
+
+        all_nics = linux.get_all_ethernet_device_names()
+        for c in snapshot.chains.keys():
+            if c.startswith('vnic') and c.split('-')[0] not in all_nics and c not in chains:
+                logger.debug('clean up defunct vnic chain[%s]' % c)
+                deleted_chains.add(c)
+                vnic_rules.pop(c.split('-')[0], None)
+
+        # the default chain only needs rewriting when vnic chains are created or deleted
+        default_rules = snapshot.chains[self.ZSTACK_DEFAULT_CHAIN]
+        jump_targets = set([iptables.IPTables.find_target_in_rule(r) for r in default_rules])
+        new_chains = [c for c in chains.keys() if c not in jump_targets]
+        if deleted_chains or new_chains:
+            default_accept_rule = "-A %s -j ACCEPT" % self.ZSTACK_DEFAULT_CHAIN
+            affected = set(deleted_chains) | set(chains.keys())
+            rules = [r for r in default_rules if r != default_accept_rule and
+                     iptables.IPTables.find_target_in_rule(r) not in affected]
+            rules.extend(new_jump_rules)
+            rules.append(default_accept_rule)
+            chains[self.ZSTACK_DEFAULT_CHAIN] = rules
+
+        ips_mn.refresh_my_ipsets()
+        if chains or deleted_chains:
+            iptables.restore_chains_noflush(chains, deleted_chains)
+
+        used_ipset = set()
+        for name, rules in snapshot.chains.items() + chains.items():
+            if name in deleted_chains:
+                continue
+            for r in rules:
+                set_name = iptables.IPTables.find_ipset_in_rule(r)
+                if set_name:
+                    used_ipset.add(set_name)
+
+        def match_set_name(name):
+            return name.startswith(self.ZSTACK_IPSET_NAME_FORMAT)
+        ips_mn.cleanup_other_ipset(match_set_name, list(used_ipset))
+
+        self._update_rule_cache(vnic_rules)
+        return True
+
+    def _apply_rules(self, cmd):
+        try:
+            if self._apply_rules_incrementally(cmd):
+                return
+        except iptables.IPTablesError:
+            logger.warn('failed to apply security group rules incrementally, do a full resync\n%s' %
+                        linux.get_exception_stacktrace())
+
+        self.rule_cache = None
+        vnic_rules = self._apply_rules_using_iprange_match(cmd)
+        self._update_rule_cache(vnic_rules)
     
     @lock.file_lock('/run/xtables.lock')
     @kvmagent.replyerror
@@ -381,7 +506,7 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = ApplySecurityGroupRuleResponse()
         try:
-            self._apply_rules_using_iprange_match(cmd)
+            self._apply_rules(cmd)
         except iptables.IPTablesError as e:
             err_log = linux.get_exception_stacktrace()
             logger.warn(err_log)
@@ -395,7 +520,9 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = RefreshAllRulesOnHostResponse()
         try:
-            self._refresh_rules_on_host_using_iprange_match(cmd)
+            self.rule_cache = None
+            vnic_rules = self._refresh_rules_on_host_using_iprange_match(cmd)
+            self._update_rule_cache(vnic_rules)
         except iptables.IPTablesError as e:
             err_log = linux.get_exception_stacktrace()
             logger.warn(err_log)
@@ -412,6 +539,7 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
     def cleanup_unused_rules_on_host(self, req):
         rsp = CleanupUnusedRulesOnHostResponse()
 
+        self.rule_cache = None
         ipt = iptables.from_iptables_save()
         ips_mn = ipset.IPSetManager()
         self._cleanup_stale_chains(ipt)
@@ -431,6 +559,7 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = UpdateGroupMemberResponse()
 
+        self.rule_cache = None
         ips_mn = ipset.IPSetManager()
         ipt = iptables.from_iptables_save()
         to_del_ipset_names = []
@@ -456,6 +585,7 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
     def check_default_sg_rules(self, req):
         rsp = CheckDefaultSecurityGroupResponse()
 
+        self.rule_cache = None
         ipt = iptables.from_iptables_save()
         default_chain = ipt.get_chain(self.ZSTACK_DEFAULT_CHAIN)
         if not default_chain:
@@ -465,6 +595,11 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         return jsonobject.dumps(rsp)
 
 
+    def __init__(self):
+        super(SecurityGroupPlugin, self).__init__()
+        # protected by /run/xtables.lock like the chains it describes
+        self.rule_cache = None
+
     def start(self):
         http_server = kvmagent.get_http_server()
         http_server.register_async_uri(self.SECURITY_GROUP_CLEANUP_UNUSED_RULE_ON_HOST_PATH, self.cleanup_unused_rules_on_host)
@@ -1,6 +1,13 @@
+import errno
+import fcntl
+import hashlib
+import io
+import mmap
 import os.path
 import re
 import random
+import stat
+import struct
 import time
 
 from zstacklib.utils import lock
@@ -14,6 +21,8 @@ from zstacklib.utils import shell
 from zstacklib.utils import linux
 from zstacklib.utils import lvm
 from zstacklib.utils import bash
+from zstacklib.utils import thread
+from zstacklib.utils.report import Report, MigrationProgress, get_scale
 import zstacklib.utils.uuidhelper as uuidhelper
 
 logger = log.get_logger(__name__)
@@ -24,6 +33,10 @@ VOLUME_TAG = "zs::sharedblock::volume"
 IMAGE_TAG = "zs::sharedblock::image"
 DEFAULT_VG_METADATA_SIZE = "2g"
 DEFAULT_SANLOCK_LV_SIZE = "1024"
+MIGRATE_BLOCK_SIZE = 4 * 1024 * 1024
+MIGRATE_PARALLELISM = 4
+DIRECT_IO_ALIGNMENT = 4096
+BLKZEROOUT = 0x127f
 
 
 class AgentRsp(object):
@@ -111,6 +124,126 @@ class SharedBlockMigrateVolumeStruct:
         pass
 
 
+def _open_direct(path, flags):
+    # a copy much larger than the page cache bypasses it, not every file system supports that
+    try:
+        return os.open(path, flags | os.O_DIRECT)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return os.open(path, flags)
+
+
+def _clear_direct(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+
+
+class VolumeCopier(object):
+    '''
+    copies a volume with large direct io. Zero blocks of the source are zeroed out by
+    BLKZEROOUT on a block device and skipped on a file; the md5 of the source is computed
+    while copying, so verify() reads the destination only
+    '''
+    def __init__(self, src, dst, progress=None, block_size=MIGRATE_BLOCK_SIZE):
+        self.src = src
+        self.dst = dst
+        self.progress = progress
+        self.block_size = block_size
+        self.size = 0
+        self.md5 = None
+        self.zeroout = True
+
+    def _write_zeros(self, dst, dst_fd, buf, n, dst_is_block):
+        if not dst_is_block:
+            os.lseek(dst_fd, n, os.SEEK_CUR)
+            return
+
+        if self.zeroout:
+            try:
+                fcntl.ioctl(dst_fd, BLKZEROOUT, struct.pack('QQ', self.size, n))
+                os.lseek(dst_fd, n, os.SEEK_CUR)
+                return
+            except IOError as e:
+                logger.debug("BLKZEROOUT is not supported on %s, write zeros: %s" % (self.dst, e))
+                self.zeroout = False
+        self._write(dst, dst_fd, buf, n)
+
+    def _write(self, dst, dst_fd, buf, n):
+        if n % DIRECT_IO_ALIGNMENT != 0:
+            _clear_direct(dst_fd)
+        written = 0
+        while written < n:
+            written += dst.write(buffer(buf, written, n - written))
+
+    def copy(self):
+        digest = hashlib.md5()
+        # anonymous mmap is page aligned as O_DIRECT requires
+        buf = mmap.mmap(-1, self.block_size)
+        zeros = buffer('\0' * self.block_size)
+        src_fd = _open_direct(self.src, os.O_RDONLY)
+        dst_fd = None
+        try:
+            dst_fd = _open_direct(self.dst, os.O_WRONLY | os.O_CREAT)
+            dst_is_block = stat.S_ISBLK(os.fstat(dst_fd).st_mode)
+            if not dst_is_block:
+                os.ftruncate(dst_fd, 0)
+            src = io.FileIO(src_fd, 'r', closefd=False)
+            dst = io.FileIO(dst_fd, 'w', closefd=False)
+
+            self.size = 0
+            while True:
+                n = src.readinto(buf)
+                if not n:
+                    break
+
+                data = buffer(buf, 0, n)
+                digest.update(data)
+                if data == buffer(zeros, 0, n):
+                    self._write_zeros(dst, dst_fd, buf, n, dst_is_block)
+                else:
+                    self._write(dst, dst_fd, buf, n)
+                self.size += n
+                if self.progress:
+                    self.progress.add(n)
+
+            if not dst_is_block:
+                os.ftruncate(dst_fd, self.size)
+            os.fsync(dst_fd)
+        finally:
+            os.close(src_fd)
+            if dst_fd is not None:
+                os.close(dst_fd)
+            buf.close()
+
+        self.md5 = digest.hexdigest()
+        return self.md5
+
+    def verify(self):
+        # the destination may be larger than the source, only the copied bytes count
+        digest = hashlib.md5()
+        buf = mmap.mmap(-1, self.block_size)
+        fd = _open_direct(self.dst, os.O_RDONLY)
+        try:
+            f = io.FileIO(fd, 'r', closefd=False)
+            left = self.size
+            while left > 0:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                n = min(n, left)
+                digest.update(buffer(buf, 0, n))
+                left -= n
+                if self.progress:
+                    self.progress.add(n)
+        finally:
+            os.close(fd)
+            buf.close()
+
+        if left != 0 or digest.hexdigest() != self.md5:
+            raise Exception("the data of %s copied from %s is corrupted, md5 of source: %s, destination: %s" %
+                            (self.dst, self.src, self.md5, digest.hexdigest()))
+
+
 def translate_absolute_path_from_install_path(path):
     if path is None:
         raise Exception("install path can not be null")
@@ -224,24 +357,24 @@ class SharedBlockPlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.DISCONNECT_PATH, self.disconnect)
         http_server.register_async_uri(self.CREATE_VOLUME_FROM_CACHE_PATH, self.create_root_volume)
         http_server.register_async_uri(self.DELETE_BITS_PATH, self.delete_bits)
-        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME_PATH, self.create_template_from_volume)
-        http_server.register_async_uri(self.UPLOAD_BITS_TO_SFTP_BACKUPSTORAGE_PATH, self.upload_to_sftp)
-        http_server.register_async_uri(self.DOWNLOAD_BITS_FROM_SFTP_BACKUPSTORAGE_PATH, self.download_from_sftp)
-        http_server.register_async_uri(self.UPLOAD_BITS_TO_IMAGESTORE_PATH, self.upload_to_imagestore)
-        http_server.register_async_uri(self.COMMIT_BITS_TO_IMAGESTORE_PATH, self.commit_to_imagestore)
-        http_server.register_async_uri(self.DOWNLOAD_BITS_FROM_IMAGESTORE_PATH, self.download_from_imagestore)
+        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME_PATH, self.create_template_from_volume, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.UPLOAD_BITS_TO_SFTP_BACKUPSTORAGE_PATH, self.upload_to_sftp, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.DOWNLOAD_BITS_FROM_SFTP_BACKUPSTORAGE_PATH, self.download_from_sftp, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.UPLOAD_BITS_TO_IMAGESTORE_PATH, self.upload_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.COMMIT_BITS_TO_IMAGESTORE_PATH, self.commit_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.DOWNLOAD_BITS_FROM_IMAGESTORE_PATH, self.download_from_imagestore, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.REVERT_VOLUME_FROM_SNAPSHOT_PATH, self.revert_volume_from_snapshot)
-        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot)
-        http_server.register_async_uri(self.OFFLINE_MERGE_SNAPSHOT_PATH, self.offline_merge_snapshots)
+        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.OFFLINE_MERGE_SNAPSHOT_PATH, self.offline_merge_snapshots, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.CREATE_EMPTY_VOLUME_PATH, self.create_empty_volume)
-        http_server.register_async_uri(self.CONVERT_IMAGE_TO_VOLUME, self.convert_image_to_volume)
+        http_server.register_async_uri(self.CONVERT_IMAGE_TO_VOLUME, self.convert_image_to_volume, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.CHECK_BITS_PATH, self.check_bits)
         http_server.register_async_uri(self.RESIZE_VOLUME_PATH, self.resize_volume)
         http_server.register_async_uri(self.CHANGE_VOLUME_ACTIVE_PATH, self.active_lv)
         http_server.register_async_uri(self.GET_VOLUME_SIZE_PATH, self.get_volume_size)
         http_server.register_async_uri(self.CHECK_DISKS_PATH, self.check_disks)
         http_server.register_async_uri(self.ADD_SHARED_BLOCK, self.add_disk)
-        http_server.register_async_uri(self.MIGRATE_DATA_PATH, self.migrate_volumes)
+        http_server.register_async_uri(self.MIGRATE_DATA_PATH, self.migrate_volumes, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.GET_BLOCK_DEVICES_PATH, self.get_block_devices)
 
         self.imagestore_client = ImageStoreClient()
@@ -370,7 +503,7 @@ class SharedBlockPlugin(kvmagent.KvmAgent):
             if len(active_lvs) == 0:
                 return
             logger.warn("active lvs %s will be deactivate" % active_lvs)
-            lvm.deactive_lv(vgUuid)
+            lvm.deactive_lvs(active_lvs)
             active_lvs = lvm.list_local_active_lvs(vgUuid)
             if len(active_lvs) != 0:
                 raise RetryException("lvs [%s] still active, retry deactive again" % active_lvs)
@@ -713,13 +846,35 @@ class SharedBlockPlugin(kvmagent.KvmAgent):
                                                      "%s::%s::%s" % (VOLUME_TAG, cmd.hostUuid, time.time()))
                 lvm.active_lv(target_abs_path, lvm.LvmlockdLockType.SHARE)
 
-        try:
-            for struct in cmd.migrateVolumeStructs:
-                target_abs_path = translate_absolute_path_from_install_path(struct.targetInstallPath)
-                current_abs_path = translate_absolute_path_from_install_path(struct.currentInstallPath)
+        if cmd.sendCommandUrl:
+            Report.url = cmd.sendCommandUrl
+        report = Report(cmd.threadContext, cmd.threadContextStack)
+        report.processType = "SharedBlockMigrateVolume"
+        stage = "10-90"
+        if cmd.threadContext and cmd.threadContext['task-stage']:
+            stage = cmd.threadContext['task-stage']
+        start, end = get_scale(stage)
+
+        total = 0
+        for struct in cmd.migrateVolumeStructs:
+            size = long(lvm.get_lv_size(translate_absolute_path_from_install_path(struct.currentInstallPath)))
+            # the data is read once more to verify the copy
+            total += size * 2 if struct.compareQcow2 else size
+        progress = MigrationProgress(report, start, end, total) if Report.url else None
+
+        def copy_volume(struct):
+            target_abs_path = translate_absolute_path_from_install_path(struct.targetInstallPath)
+            current_abs_path = translate_absolute_path_from_install_path(struct.currentInstallPath)
+
+            with lvm.OperateLv(current_abs_path, shared=True):
+                copier = VolumeCopier(current_abs_path, target_abs_path, progress)
+                copier.copy()
+                # replaces qemu-img compare, a rebase below only changes the header of target
+                if struct.compareQcow2:
+                    copier.verify()
 
-                with lvm.OperateLv(current_abs_path, shared=True):
-                    bash.bash_errorout("cp %s %s" % (current_abs_path, target_abs_path))
+        try:
+            thread.run_parallel(copy_volume, cmd.migrateVolumeStructs, MIGRATE_PARALLELISM)
 
             for struct in cmd.migrateVolumeStructs:
                 target_abs_path = translate_absolute_path_from_install_path(struct.targetInstallPath)
@@ -735,8 +890,6 @@ class SharedBlockPlugin(kvmagent.KvmAgent):
                         lvm.do_active_lv(target_backing_file, lvm.LvmlockdLockType.SHARE, False)
                         logger.debug("rebase %s to %s" % (target_abs_path, target_backing_file))
                         linux.qcow2_rebase_no_check(target_backing_file, target_abs_path)
-                    if struct.compareQcow2:
-                        bash.bash_errorout("time qemu-img compare %s %s" % (current_abs_path, target_abs_path))
         except Exception as e:
             for struct in cmd.migrateVolumeStructs:
                 target_abs_path = translate_absolute_path_from_install_path(struct.targetInstallPath)
@@ -748,9 +901,8 @@ class SharedBlockPlugin(kvmagent.KvmAgent):
                     lvm.delete_lv(target_abs_path, False)
             raise e
         finally:
-            for struct in cmd.migrateVolumeStructs:
-                target_abs_path = translate_absolute_path_from_install_path(struct.targetInstallPath)
-                lvm.deactive_lv(target_abs_path)
+            lvm.deactive_lvs([translate_absolute_path_from_install_path(struct.targetInstallPath)
+                              for struct in cmd.migrateVolumeStructs])
 
         rsp.totalCapacity, rsp.availableCapacity = lvm.get_vg_size(cmd.vgUuid)
         return jsonobject.dumps(rsp)
@@ -2,8 +2,10 @@
 @author: Frank
 '''
 import Queue
+import collections
 import os.path
 import tempfile
+import threading
 import time
 import traceback
 import xml.etree.ElementTree as etree
@@ -25,6 +27,7 @@ from zstacklib.utils import lichbd
 import zstacklib.utils.lichbd_factory as lichbdfactory
 from zstacklib.utils import linux
 from zstacklib.utils import log
+from zstacklib.utils import procfs
 from zstacklib.utils import lvm
 from zstacklib.utils import shell
 from zstacklib.utils import thread
@@ -167,12 +170,19 @@ class DestroyVmResponse(kvmagent.AgentResponse):
 class VmSyncCmd(kvmagent.AgentCommand):
     def __init__(self):
         super(VmSyncCmd, self).__init__()
+        # if set, only return states changed since this version of the epoch
+        self.sinceVersion = None
+        self.sinceEpoch = None
 
 
 class VmSyncResponse(kvmagent.AgentResponse):
     def __init__(self):
         super(VmSyncResponse, self).__init__()
         self.states = None
+        self.epoch = None
+        self.version = None
+        # True if states only contains the changes since VmSyncCmd.sinceVersion
+        self.delta = False
 
 
 class AttachDataVolumeCmd(kvmagent.AgentCommand):
@@ -374,7 +384,7 @@ class VncPortIptableRule(object):
         ipt.add_rule('-A INPUT -p tcp -m tcp --dport %s -j %s' % (self.port, chain_name))
         ipt.add_rule('-A %s -d %s -j ACCEPT' % (chain_name, current_ip_with_netmask))
         ipt.add_rule('-A %s ! -d %s -j REJECT --reject-with icmp-host-prohibited' % (chain_name, current_ip_with_netmask))
-        ipt.iptable_restore()
+        ipt.iptable_restore_modified_chains()
 
     @lock.file_lock('/run/xtables.lock')
     def delete(self):
@@ -382,8 +392,13 @@ class VncPortIptableRule(object):
 
         ipt = iptables.from_iptables_save()
         chain_name = self._make_chain_name()
+        input_chain = ipt.get_chain('INPUT')
+        if input_chain:
+            for r in input_chain.children[:]:
+                if ipt.is_target_in_rule(r.identity, chain_name):
+                    r.delete()
         ipt.delete_chain(chain_name)
-        ipt.iptable_restore()
+        ipt.iptable_restore_modified_chains()
 
     @lock.file_lock('/run/xtables.lock')
     def delete_stale_chains(self):
@@ -518,6 +533,7 @@ class LibvirtAutoReconnect(object):
     evtMgr = LibvirtEventManager()
 
     libvirt_event_callbacks = {}
+    connection_broken_callbacks = []
 
     def __init__(self, func):
         self.func = func
@@ -531,6 +547,19 @@ class LibvirtAutoReconnect(object):
             LibvirtAutoReconnect.libvirt_event_callbacks[id] = cbs
         cbs.append(cb)
 
+    @staticmethod
+    def add_connection_broken_callback(cb):
+        LibvirtAutoReconnect.connection_broken_callbacks.append(cb)
+
+    @staticmethod
+    def _call_connection_broken_callbacks(*args):
+        for cb in LibvirtAutoReconnect.connection_broken_callbacks:
+            try:
+                cb(*args)
+            except:
+                content = traceback.format_exc()
+                logger.warn(content)
+
     @staticmethod
     def register_libvirt_callbacks():
         def reboot_callback(conn, dom, opaque):
@@ -563,6 +592,16 @@ class LibvirtAutoReconnect(object):
         LibvirtAutoReconnect.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
                                                          lifecycle_callback, None)
 
+        # events are lost while libvirtd restarts
+        def close_callback(conn, reason, opaque):
+            logger.warn('the libvirt connection is closed, reason: %s' % reason)
+            LibvirtAutoReconnect._call_connection_broken_callbacks()
+
+        try:
+            LibvirtAutoReconnect.conn.registerCloseCallback(close_callback, None)
+        except (libvirt.libvirtError, AttributeError) as e:
+            logger.warn('unable to register the libvirt close callback, %s' % str(e))
+
         # NOTE: the keepalive doesn't work on some libvirtd even the versions are the same
         # the error is like "the caller doesn't support keepalive protocol; perhaps it's missing event loop implementation"
 
@@ -593,6 +632,7 @@ class LibvirtAutoReconnect(object):
 
         logger.warn("the libvirt connection is broken, there is no safeway to auto-reconnect without fd leak, we"
                     " will ask the mgmt server to reconnect us after self quit")
+        LibvirtAutoReconnect._call_connection_broken_callbacks()
         VmPlugin.queue.put("exit")
 
         # old_conn = LibvirtAutoReconnect.conn
@@ -1063,81 +1103,145 @@ def get_vm_by_uuid_no_retry(uuid, exception_if_not_existing=True):
         err = 'error happened when looking up vm[uuid:%(uuid)s], libvirt error code: %(error_code)s, %(e)s' % locals()
         raise libvirt.libvirtError(err)
 
-def get_active_vm_uuids_states():
-    @LibvirtAutoReconnect
-    def call_libvirt(conn):
-        return conn.listDomainsID()
+class DomainInfo(object):
+    def __init__(self):
+        self.uuid = None
+        self.state = None
+        self.cpu_num = None
+        # in bytes
+        self.memory = None
 
-    ids = call_libvirt()
-    uuids_states = {}
 
-    @LibvirtAutoReconnect
-    def get_domain(conn):
-        # i is for..loop's control variable
-        # it's Python's local scope tricky
-        try:
-            return conn.lookupByID(i)
-        except libvirt.libvirtError as ex:
-            if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                return None
-            raise ex
+class DomainInventory(object):
+    '''
+    states, cpu and memory of all running domains fetched by one bulk libvirt
+    call, cached for CACHE_TTL seconds so concurrent vm sync, state check and
+    capacity requests share the same snapshot. Lifecycle events invalidate it.
+    '''
+    CACHE_TTL = 3
 
-    for i in ids:
-        domain = get_domain()
-        if domain == None:
-            continue
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.domains = None
+        self.load_time = 0
 
-        uuid = domain.name()
+    @staticmethod
+    def _load_with_domain_stats():
+        stats = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON
+
+        @LibvirtAutoReconnect
+        def call_libvirt(conn):
+            return conn.getAllDomainStats(stats, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+
+        domains = {}
+        for dom, record in call_libvirt():
+            d = DomainInfo()
+            d.uuid = dom.name()
+            d.state = Vm.power_state[record['state.state']]
+            d.cpu_num = record.get('vcpu.current', 0)
+            d.memory = long(record.get('balloon.current', 0)) * 1024
+            domains[d.uuid] = d
+        return domains
+
+    @staticmethod
+    def _load_with_domain_info():
+        @LibvirtAutoReconnect
+        def call_libvirt(conn):
+            return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+
+        domains = {}
+        for dom in call_libvirt():
+            try:
+                (state, _, memory, cpu_num, _) = dom.info()
+            except libvirt.libvirtError as ex:
+                # the domain stopped after being listed
+                if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                    continue
+                raise ex
+
+            d = DomainInfo()
+            d.uuid = dom.name()
+            d.state = Vm.power_state[state]
+            d.cpu_num = cpu_num
+            d.memory = long(memory) * 1024
+            domains[d.uuid] = d
+        return domains
+
+    def _load(self):
+        # virConnectGetAllDomainStats requires libvirt 1.2.8
+        if hasattr(libvirt.virConnect, 'getAllDomainStats'):
+            try:
+                return self._load_with_domain_stats()
+            except libvirt.libvirtError as ex:
+                if ex.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                    raise ex
+
+        return self._load_with_domain_info()
+
+    def get_domains(self, cached=True):
+        with self.lock:
+            if cached and self.domains is not None and time.time() - self.load_time < self.CACHE_TTL:
+                return self.domains
+
+            self.domains = self._load()
+            self.load_time = time.time()
+            return self.domains
+
+    def invalidate(self):
+        with self.lock:
+            self.domains = None
+
+    def on_lifecycle_event(self, conn, dom, event, detail, opaque):
+        self.invalidate()
+
+
+domain_inventory = DomainInventory()
+
+
+def get_qemu_process_vm_names():
+    return procfs.get_process_table().get_qemu_vm_names()
+
+
+def get_active_vm_uuids_states(cached=False):
+    uuids_states = {}
+    for uuid, d in domain_inventory.get_domains(cached).items():
         if uuid.startswith("guestfs-"):
             logger.debug("ignore the temp vm generate by guestfish.")
             continue
         if uuid == "ZStack Management Node VM":
             logger.debug("ignore the vm used for MN HA.")
             continue
-        (state, _, _, _, _) = domain.info()
-        state = Vm.power_state[state]
-        # or use
-        uuids_states[uuid] = state
+        uuids_states[uuid] = d.state
     return uuids_states
 
 
-def get_all_vm_states():
-    return get_active_vm_uuids_states()
+def get_all_vm_states(cached=False):
+    return get_active_vm_uuids_states(cached)
 
 
 def get_running_vms():
     @LibvirtAutoReconnect
-    def get_all_ids(conn):
-        return conn.listDomainsID()
+    def call_libvirt(conn):
+        return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
 
-    ids = get_all_ids()
     vms = []
-
-    @LibvirtAutoReconnect
-    def get_domain(conn):
+    for domain in call_libvirt():
         try:
-            return conn.lookupByID(i)
+            vm = Vm.from_virt_domain(domain)
         except libvirt.libvirtError as ex:
             if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                return None
+                continue
             raise ex
-
-    for i in ids:
-        domain = get_domain()
-        if domain == None:
-            continue
-        vm = Vm.from_virt_domain(domain)
         vms.append(vm)
     return vms
 
 
 def get_cpu_memory_used_by_running_vms():
-    runnings = get_running_vms()
     used_cpu = 0
     used_memory = 0
-    for vm in runnings:
-        used_cpu += vm.get_cpu_num()
-        used_memory += vm.get_memory()
+    for d in domain_inventory.get_domains().values():
+        used_cpu += d.cpu_num
+        used_memory += d.memory
 
     return (used_cpu, used_memory)
 
@@ -3175,6 +3279,142 @@ class Vm(object):
         return vm
 
 
+class VmStateTable(object):
+    '''
+    states of active vms kept in memory. It is updated by libvirt lifecycle
+    events and reconciled with a full libvirt scan periodically, every change
+    bumps the version so callers can fetch the changes since a version they
+    have seen.
+    '''
+    RECONCILE_INTERVAL = 60
+    MAX_CHANGES = 10000
+
+    event_states = {
+        libvirt.VIR_DOMAIN_EVENT_STARTED: Vm.VM_STATE_RUNNING,
+        libvirt.VIR_DOMAIN_EVENT_RESUMED: Vm.VM_STATE_RUNNING,
+        libvirt.VIR_DOMAIN_EVENT_SUSPENDED: Vm.VM_STATE_PAUSED,
+        libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: Vm.VM_STATE_SUSPENDED,
+        libvirt.VIR_DOMAIN_EVENT_CRASHED: Vm.VM_STATE_CRASHED,
+        # stopped vms are not active anymore, they are removed from the table
+        libvirt.VIR_DOMAIN_EVENT_STOPPED: None,
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = None
+        # events may have been missed, the next read reconciles first
+        self.stale = False
+        # versions of a previous agent process are meaningless, they are told apart by the epoch
+        self.epoch = uuidhelper.uuid()
+        self.version = 0
+        # vm uuid -> version of its last change, the oldest change first
+        self.changes = collections.OrderedDict()
+        # changes before this version have been dropped
+        self.oldest_version = 0
+
+    @staticmethod
+    def _is_ignored(uuid):
+        return uuid.startswith("guestfs-") or uuid == "ZStack Management Node VM"
+
+    def _set(self, uuid, state):
+        if self.states.get(uuid) == state:
+            return
+
+        if state is None:
+            del self.states[uuid]
+        else:
+            self.states[uuid] = state
+
+        self.version += 1
+        self.changes.pop(uuid, None)
+        self.changes[uuid] = self.version
+        if len(self.changes) > self.MAX_CHANGES:
+            _, v = self.changes.popitem(last=False)
+            self.oldest_version = v
+
+    def invalidate(self, *args):
+        '''called when the libvirt connection breaks'''
+        with self.lock:
+            self.stale = True
+
+    # @return: the states just read from libvirt
+    def reconcile(self):
+        with self.lock:
+            scan_version = self.version
+            self.stale = False
+
+        try:
+            states = get_active_vm_uuids_states()
+        except Exception as e:
+            with self.lock:
+                self.stale = True
+            raise e
+
+        with self.lock:
+            if self.states is None:
+                self.states = {}
+
+            current = self.states.keys()
+            for uuid in set(current + states.keys()):
+                if self.changes.get(uuid, 0) > scan_version:
+                    # an event arrived after the scan started, it's newer than the scan
+                    continue
+
+                state = states.get(uuid)
+                if self.states.get(uuid) != state and scan_version:
+                    logger.debug('vm state table drifted, vm[uuid:%s] state %s -> %s' %
+                                 (uuid, self.states.get(uuid), state))
+                self._set(uuid, state)
+
+        return states
+
+    def _ensure_loaded(self):
+        if self.states is None or self.stale:
+            self.reconcile()
+
+    def on_lifecycle_event(self, conn, dom, event, detail, opaque):
+        if event not in self.event_states:
+            return
+
+        uuid = dom.name()
+        if self._is_ignored(uuid):
+            return
+
+        with self.lock:
+            if self.states is None:
+                return
+            self._set(uuid, self.event_states[event])
+
+    def get_state(self, uuid):
+        self._ensure_loaded()
+        with self.lock:
+            return self.states.get(uuid)
+
+    def get_states(self):
+        self._ensure_loaded()
+        with self.lock:
+            return self.version, dict(self.states)
+
+    # @return: (version, states, is_full)
+    # vms stopped since the version are reported as Shutdown
+    def get_changes_since(self, version, epoch):
+        self._ensure_loaded()
+        with self.lock:
+            if version is None or epoch != self.epoch or version < self.oldest_version or version > self.version:
+                return self.version, dict(self.states), True
+
+            changes = {}
+            for uuid, v in reversed(self.changes.items()):
+                if v <= version:
+                    break
+                changes[uuid] = self.states.get(uuid, Vm.VM_STATE_SHUTDOWN)
+            return self.version, changes, False
+
+
+vm_state_table = VmStateTable()
+LibvirtAutoReconnect.add_connection_broken_callback(vm_state_table.invalidate)
+
+
 class VmPlugin(kvmagent.KvmAgent):
     KVM_START_VM_PATH = "/vm/start"
     KVM_STOP_VM_PATH = "/vm/stop"
@@ -3359,7 +3599,8 @@ class VmPlugin(kvmagent.KvmAgent):
     @kvmagent.replyerror
     def check_vm_state(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        states = get_all_vm_states()
+        # HA decisions must not use a state up to RECONCILE_INTERVAL old, ask libvirt
+        states = vm_state_table.reconcile()
         rsp = CheckVmStateRsp()
         for uuid in cmd.vmUuids:
             s = states.get(uuid)
@@ -3525,14 +3766,22 @@ class VmPlugin(kvmagent.KvmAgent):
         #             logger.warn(linux.get_exception_stacktrace())
         #
         # rsp.states = running_vms
-        rsp.states = get_all_vm_states()
+        since_version = since_epoch = None
+        if req[http.REQUEST_BODY]:
+            cmd = jsonobject.loads(req[http.REQUEST_BODY])
+            since_version = cmd.sinceVersion
+            since_epoch = cmd.sinceEpoch
+
+        rsp.epoch = vm_state_table.epoch
+        rsp.version, rsp.states, full = vm_state_table.get_changes_since(since_version, since_epoch)
+        rsp.delta = not full
+        all_states = rsp.states if full else vm_state_table.get_states()[1]
 
         # Occasionally, virsh might not be able to list all VM instances with
         # uri=qemu://system.  To prevend this situation, we double check the
         # 'rsp.states' agaist QEMU process lists.
-        output = bash.bash_o("ps x | grep -P -o 'qemu-kvm.*?-name[[:space:]]+\K.*?,' | sed 's/.$//'").splitlines()
-        for guest in output:
-            if guest in rsp.states or guest.lower() == "ZStack Management Node VM".lower():
+        for guest in get_qemu_process_vm_names():
+            if guest in all_states or guest.lower() == "ZStack Management Node VM".lower():
                 continue
             logger.warn('guest [%s] not found in virsh list' % guest)
             rsp.states[guest] = Vm.VM_STATE_RUNNING
@@ -4384,12 +4633,12 @@ class VmPlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.KVM_DETACH_VOLUME, self.detach_data_volume)
         http_server.register_async_uri(self.KVM_ATTACH_ISO_PATH, self.attach_iso)
         http_server.register_async_uri(self.KVM_DETACH_ISO_PATH, self.detach_iso)
-        http_server.register_async_uri(self.KVM_MIGRATE_VM_PATH, self.migrate_vm)
+        http_server.register_async_uri(self.KVM_MIGRATE_VM_PATH, self.migrate_vm, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.KVM_TAKE_VOLUME_SNAPSHOT_PATH, self.take_volume_snapshot)
-        http_server.register_async_uri(self.KVM_TAKE_VOLUME_BACKUP_PATH, self.take_volume_backup)
+        http_server.register_async_uri(self.KVM_TAKE_VOLUME_BACKUP_PATH, self.take_volume_backup, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.KVM_TAKE_VOLUMES_SNAPSHOT_PATH, self.take_volumes_snapshots)
         http_server.register_async_uri(self.KVM_BLOCK_STREAM_VOLUME_PATH, self.block_stream)
-        http_server.register_async_uri(self.KVM_MERGE_SNAPSHOT_PATH, self.merge_snapshot_to_volume)
+        http_server.register_async_uri(self.KVM_MERGE_SNAPSHOT_PATH, self.merge_snapshot_to_volume, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.KVM_LOGOUT_ISCSI_TARGET_PATH, self.logout_iscsi_target)
         http_server.register_async_uri(self.KVM_LOGIN_ISCSI_TARGET_PATH, self.login_iscsi_target)
         http_server.register_async_uri(self.KVM_ATTACH_NIC_PATH, self.attach_nic)
@@ -4470,6 +4719,19 @@ class VmPlugin(kvmagent.KvmAgent):
 
         clean_stale_vm_vnc_port_chain()
 
+        @thread.AsyncThread
+        def reconcile_vm_state_table():
+            while True:
+                try:
+                    vm_state_table.reconcile()
+                except:
+                    content = traceback.format_exc()
+                    logger.warn(content)
+
+                time.sleep(VmStateTable.RECONCILE_INTERVAL)
+
+        reconcile_vm_state_table()
+
     def _vm_lifecycle_event(self, conn, dom, event, detail, opaque):
         try:
             evstr = LibvirtEventManager.event_to_string(event)
@@ -4657,6 +4919,10 @@ class VmPlugin(kvmagent.KvmAgent):
                                                   self._set_vnc_port_iptable_rule)
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self._vm_reboot_event)
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._release_sharedblocks)
+        LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                                  domain_inventory.on_lifecycle_event)
+        LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                                  vm_state_table.on_lifecycle_event)
         LibvirtAutoReconnect.register_libvirt_callbacks()
 
     def stop(self):
@@ -3,8 +3,10 @@ import os.path
 import zstacklib.utils.uuidhelper as uuidhelper
 from kvmagent import kvmagent
 from kvmagent.plugins.imagestore import ImageStoreClient
+from zstacklib.utils import checksum
 from zstacklib.utils import jsonobject
 from zstacklib.utils import shell
+from zstacklib.utils import thread
 from zstacklib.utils.bash import *
 from zstacklib.utils.report import *
 
@@ -104,26 +106,26 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.CREATE_VOLUME_FROM_CACHE_PATH, self.create_root_volume_from_template)
         http_server.register_async_uri(self.DELETE_BITS_PATH, self.delete)
         http_server.register_async_uri(self.DELETE_DIR_PATH, self.deletedir)
-        http_server.register_async_uri(self.UPLOAD_TO_IMAGESTORE_PATH, self.upload_to_imagestore)
-        http_server.register_async_uri(self.COMMIT_TO_IMAGESTORE_PATH, self.commit_to_imagestore)
-        http_server.register_async_uri(self.DOWNLOAD_FROM_IMAGESTORE_PATH, self.download_from_imagestore)
+        http_server.register_async_uri(self.UPLOAD_TO_IMAGESTORE_PATH, self.upload_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.COMMIT_TO_IMAGESTORE_PATH, self.commit_to_imagestore, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.DOWNLOAD_FROM_IMAGESTORE_PATH, self.download_from_imagestore, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.REVERT_SNAPSHOT_PATH, self.revert_snapshot)
-        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot)
-        http_server.register_async_uri(self.MERGE_AND_REBASE_SNAPSHOT_PATH, self.merge_and_rebase_snapshot)
-        http_server.register_async_uri(self.OFFLINE_MERGE_PATH, self.offline_merge_snapshot)
-        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME, self.create_template_from_volume)
+        http_server.register_async_uri(self.MERGE_SNAPSHOT_PATH, self.merge_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.MERGE_AND_REBASE_SNAPSHOT_PATH, self.merge_and_rebase_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.OFFLINE_MERGE_PATH, self.offline_merge_snapshot, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.CREATE_TEMPLATE_FROM_VOLUME, self.create_template_from_volume, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.CHECK_BITS_PATH, self.check_bits)
         http_server.register_async_uri(self.REBASE_ROOT_VOLUME_TO_BACKING_FILE_PATH, self.rebase_root_volume_to_backing_file)
         http_server.register_async_uri(self.VERIFY_SNAPSHOT_CHAIN_PATH, self.verify_backing_file_chain)
         http_server.register_async_uri(self.REBASE_SNAPSHOT_BACKING_FILES_PATH, self.rebase_backing_files)
-        http_server.register_async_uri(self.COPY_TO_REMOTE_BITS_PATH, self.copy_bits_to_remote)
-        http_server.register_async_uri(self.GET_MD5_PATH, self.get_md5)
-        http_server.register_async_uri(self.CHECK_MD5_PATH, self.check_md5)
+        http_server.register_async_uri(self.COPY_TO_REMOTE_BITS_PATH, self.copy_bits_to_remote, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.GET_MD5_PATH, self.get_md5, lane=thread.BULK_LANE)
+        http_server.register_async_uri(self.CHECK_MD5_PATH, self.check_md5, lane=thread.BULK_LANE)
         http_server.register_async_uri(self.GET_BACKING_FILE_PATH, self.get_backing_file_path)
         http_server.register_async_uri(self.GET_VOLUME_SIZE, self.get_volume_size)
         http_server.register_async_uri(self.GET_BASE_IMAGE_PATH, self.get_volume_base_image_path)
         http_server.register_async_uri(self.GET_QCOW2_REFERENCE, self.get_qcow2_reference)
-        http_server.register_async_uri(self.CONVERT_QCOW2_TO_RAW, self.convert_qcow2_to_raw)
+        http_server.register_async_uri(self.CONVERT_QCOW2_TO_RAW, self.convert_qcow2_to_raw, lane=thread.BULK_LANE)
 
         self.imagestore_client = ImageStoreClient()
 
@@ -194,10 +196,8 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
             Report.url = cmd.sendCommandUrl
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
 
         total = 0
-        written = 0
         for to in cmd.md5s:
             total = total + os.path.getsize(to.path)
 
@@ -206,37 +206,20 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
         if cmd.stage:
             start, end = get_scale(cmd.stage)
 
-
-        def _get_progress(synced):
-            logger.debug("getProgress in get_md5")
-            if not os.path.exists(PFILE):
-                return synced
-            last = shell.call('tail -1 %s' % PFILE).strip()
-            if not last or not last.isdigit():
-                return synced
-            percent = int(round((float(written) * 100 + os.path.getsize(to.path) * float(last)) / total * (end - start) / 100) + start)
-            report.progress_report(str(percent), "report")
-            return synced
-
         report.resourceUuid = cmd.volumeUuid
         if start == 0:
             report.progress_report("0", "start")
         else:
             report.progress_report(str(start), "report")
 
+        progress = MigrationProgress(report, start, end, total)
         for to in cmd.md5s:
-            _, md5, _ = bash_progress_1("pv -n %s 2>%s | md5sum | cut -d ' ' -f 1" % (to.path, PFILE), _get_progress)
             rsp.md5s.append({
                 'resourceUuid': to.resourceUuid,
                 'path': to.path,
-                'md5': md5
+                # ends with a newline like the md5sum output, agents not upgraded compare it as is
+                'md5': checksum.md5sum(to.path, progress.add) + '\n'
             })
-            written += os.path.getsize(to.path)
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
 
         return jsonobject.dumps(rsp)
 
@@ -248,9 +231,7 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
 
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
         total = 0
-        written = 0
 
         start = 90
         end = 100
@@ -259,30 +240,16 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
         for to in cmd.md5s:
             total = total + os.path.getsize(to.path)
 
-        def _get_progress(synced):
-            logger.debug("getProgress in check_md5")
-            if not os.path.exists(PFILE):
-                return synced
-            last = shell.call('tail -1 %s' % PFILE).strip()
-            if not last or not last.isdigit():
-                return synced
-            percent = int(round((float(written) * 100 + os.path.getsize(to.path) * float(last)) / total * (end - start) / 100) + start)
-            report.progress_report(percent, "report")
-            return synced
-
         report.resourceUuid = cmd.volumeUuid
+        progress = MigrationProgress(report, start, end, total)
         for to in cmd.md5s:
-            _, dst_md5, _ = bash_progress_1("pv -n %s 2>%s | md5sum | cut -d ' ' -f 1" % (to.path, PFILE), _get_progress)
+            # verify what is on the disk, not a cached checksum
+            dst_md5 = checksum.md5sum(to.path, progress.add, use_cache=False)
 
-            if dst_md5 != to.md5:
+            # the md5 from get_md5 ends with a newline
+            if dst_md5 != to.md5.strip():
                 raise Exception("MD5 unmatch. The file[uuid:%s, path:%s]'s md5 (src host:%s, dst host:%s)" %
                                 (to.resourceUuid, to.path, to.md5, dst_md5))
-            written += os.path.getsize(to.path)
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
 
         rsp = AgentResponse()
         if end == 100:
@@ -308,7 +275,6 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
         report.resourceUuid = cmd.uuid
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
 
         start = 10
         end = 90
@@ -321,30 +287,10 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
 
         written = 0
 
-        def _get_progress(synced):
-            logger.debug("getProgress in localstorage-agent, synced: %s, total: %s" % (synced, total))
-            if not os.path.exists(PFILE):
-                return synced
-            fpread = open(PFILE, 'r')
-            lines = fpread.readlines()
-            if not lines:
-                fpread.close()
-                return synced
-            last = str(lines[-1]).strip().split('\r')[-1]
-            if not last or len(last.split()) < 1:
-                fpread.close()
-                return synced
-            line = last.split()[0]
-            if not line.isdigit():
-                return synced
-            if total > 0:
-                synced = long(line)
-                if synced < total:
-                    percent = int(round(float(written + synced) / float(total) * (end - start) + start))
-                    report.progress_report(percent, "report")
-                    synced = written
-            fpread.close()
-            return synced
+        def _get_progress(progress):
+            if total > 0 and progress.bytes < total:
+                percent = int(round(float(written + progress.bytes) / float(total) * (end - start) + start))
+                report.progress_report(percent, "report")
 
         for path in set(chain):
             PATH = path
@@ -355,8 +301,8 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
             DIR = os.path.dirname(path)
 
             if cmd.dstUsername == 'root':
-                _, _, err = bash_progress_1(
-                    'rsync -av --progress --relative {{PATH}} --rsh="/usr/bin/sshpass -p \'{{PASSWORD}}\' ssh -o StrictHostKeyChecking=no -p {{PORT}} -l {{USER}}" {{IP}}:/ 1>{{PFILE}}', _get_progress, False)
+                _, _, err = bash_progress(
+                    'rsync -av --progress --relative {{PATH}} --rsh="/usr/bin/sshpass -p \'{{PASSWORD}}\' ssh -o StrictHostKeyChecking=no -p {{PORT}} -l {{USER}}" {{IP}}:/', 'rsync', _get_progress, progress_stream='stdout')
 
                 if err:
                     raise Exception('fail to migrate vm to host, because %s' % str(err))
@@ -367,8 +313,6 @@ class ZsesStoragePlugin(kvmagent.KvmAgent):
             percent = int(round(float(written) / float(total) * (end - start) + start))
             report.progress_report(percent, "report")
 
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
         rsp = AgentResponse()
         rsp.totalCapacity, rsp.availableCapacity = self._get_disk_capacity(cmd.storagePath)
         return jsonobject.dumps(rsp)
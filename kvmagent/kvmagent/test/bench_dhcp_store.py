@@ -0,0 +1,69 @@
+'''
+benchmark of applying dhcp entries of 10k nics to the dnsmasq files of one namespace,
+comparing the indexed store with erasing each entry by sed. Run: python -m kvmagent.test.bench_dhcp_store
+
+@author: frank
+'''
+import os
+import shutil
+import tempfile
+import time
+from kvmagent.plugins import mevoco
+from zstacklib.utils import shell
+
+ENTRY_NUM = 10000
+SED_ENTRY_NUM = 200
+
+def make_entry(i):
+    mac = 'fa:16:3e:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+    ip = '10.%s.%s.%s' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+    tag = mac.replace(':', '')
+    return mac, ip, ['%s,set:%s,%s,vm-%s,infinite' % (mac, tag, ip, i)], \
+           ['tag:%s,option:router,10.0.0.1' % tag, 'tag:%s,option:netmask,255.0.0.0' % tag], ['%s vm-%s' % (ip, i)]
+
+def apply_with_store(folder, num):
+    paths = [os.path.join(folder, n) for n in ('hosts.dhcp', 'hosts.dns', 'hosts.option')]
+    store = mevoco.DhcpEntryStore(*paths)
+    for i in range(num):
+        mac, ip, dhcp, option, dns = make_entry(i)
+        store.erase(mac, ip)
+        for l in dhcp:
+            store.dhcp.add(l)
+        for l in option:
+            store.option.add(l)
+        for l in dns:
+            store.dns.add(l)
+    store.flush()
+
+def apply_with_sed(folder, num):
+    dhcp_path, dns_path, option_path = [os.path.join(folder, n) for n in ('hosts.dhcp', 'hosts.dns', 'hosts.option')]
+    for p in (dhcp_path, dns_path, option_path):
+        open(p, 'a').close()
+
+    for i in range(num):
+        mac, ip, dhcp, option, dns = make_entry(i)
+        shell.call("sed -i '/%s,/d' %s; sed -i '/,%s,/d' %s; sed -i '/%s,/d' %s; sed -i '/^%s /d' %s" %
+                   (mac, dhcp_path, ip, dhcp_path, mac.replace(':', ''), option_path, ip, dns_path))
+        for p, lines in ((dhcp_path, dhcp), (option_path, option), (dns_path, dns)):
+            with open(p, 'a') as fd:
+                fd.write('\n'.join(lines) + '\n')
+
+def _measure(name, func, num):
+    folder = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        func(folder, num)
+        # applying the same entries again erases all of them first
+        func(folder, num)
+        cost = time.time() - start
+        print '%-40s %6s entries %10.3f s, %8.3f ms/entry' % (name, num, cost, cost * 1000 / num / 2)
+    finally:
+        shutil.rmtree(folder)
+
+def main():
+    shell.logcmd = False
+    _measure('indexed store, one flush per batch', apply_with_store, ENTRY_NUM)
+    _measure('sed per entry', apply_with_sed, SED_ENTRY_NUM)
+
+if __name__ == '__main__':
+    main()
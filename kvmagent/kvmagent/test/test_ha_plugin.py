@@ -0,0 +1,196 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from kvmagent.plugins import ha_plugin
+
+VM_UUID = '8b1f4e3c5a2d4e6f9a0b1c2d3e4f5a6b'
+OTHER_UUID = '1c2d3e4f5a6b4c7d8e9f0a1b2c3d4e5f'
+
+STATUS_XML = '''<domstatus state='running' pid='1234'>
+  <domain type='kvm' id='1'>
+    <name>%s</name>
+    <devices>
+      <disk type='file' device='cdrom'>
+        <source file='/iso/cd.iso'/>
+      </disk>
+      <disk type='file' device='disk'>
+        <source file='/nfs/ps1/rootVolumes/root.qcow2'/>
+      </disk>
+    </devices>
+  </domain>
+</domstatus>'''
+
+RBD_XML = '''<domain type='kvm'>
+  <devices>
+    <disk type='network' device='disk'>
+      <source protocol='rbd' name='pool1/volume'/>
+    </disk>
+  </devices>
+</domain>'''
+
+class TestVmStorages(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_parse(self):
+        s = ha_plugin.VmStorage.from_xml(STATUS_XML % VM_UUID)
+        self.assertEqual((True, '/iso/cd.iso', ''), (s.has_file_disk, s.file_path, s.volume_name))
+        s = ha_plugin.VmStorage.from_xml(RBD_XML)
+        self.assertEqual((False, '', 'pool1/volume'), (s.has_file_disk, s.file_path, s.volume_name))
+
+    def test_map_and_need_kill(self):
+        path = os.path.join(self.workdir, '%s.xml' % VM_UUID)
+        with open(path, 'w') as fd:
+            fd.write(STATUS_XML % VM_UUID)
+
+        storages = ha_plugin.VmStorageMap(self.workdir)
+        s = storages.get(VM_UUID)
+        self.assertIs(s, storages.get(VM_UUID))
+
+        with open(path, 'w') as fd:
+            fd.write((STATUS_XML % VM_UUID).replace('/iso/cd.iso', '/nfs/ps1/cd.iso'))
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual('/nfs/ps1/cd.iso', storages.get(VM_UUID).file_path)
+
+        orig = ha_plugin.vm_storages
+        ha_plugin.vm_storages = storages
+        try:
+            self.assertTrue(ha_plugin.is_need_kill(VM_UUID, ['/nfs/ps1'], True))
+            self.assertFalse(ha_plugin.is_need_kill(VM_UUID, ['/nfs/ps2'], True))
+            self.assertFalse(ha_plugin.is_need_kill(VM_UUID, ['pool1'], False))
+        finally:
+            ha_plugin.vm_storages = orig
+
+        storages.prune([])
+        self.assertEqual({}, storages.storages)
+
+    def test_find_qemu_pids(self):
+        def proc(pid, args):
+            os.makedirs(os.path.join(self.workdir, pid))
+            with open(os.path.join(self.workdir, pid, 'cmdline'), 'w') as fd:
+                fd.write('\0'.join(args) + '\0')
+
+        proc('100', ['/usr/libexec/qemu-kvm', '-name', 'guest=%s,debug-threads=on' % VM_UUID, '-uuid', VM_UUID])
+        proc('101', ['/usr/bin/qemu-system-x86_64', '-name', OTHER_UUID])
+        proc('102', ['/usr/bin/python', 'grep', VM_UUID])
+        proc('103', [])
+        # tools working on the disks of a vm are not the vm
+        proc('104', ['/usr/bin/qemu-img', 'convert', '/pool/%s.qcow2' % VM_UUID, '/pool/x.qcow2'])
+        proc('105', ['/usr/bin/qemu-nbd', '--fork', '/pool/%s.qcow2' % OTHER_UUID])
+        proc('106', ['/usr/libexec/qemu-kvm', '-drive', 'file=/pool/%s.qcow2' % OTHER_UUID])
+        os.makedirs(os.path.join(self.workdir, 'self'))
+
+        self.assertEqual({VM_UUID: ['100'], OTHER_UUID: ['101']}, ha_plugin.find_qemu_pids(self.workdir))
+
+class TestHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'heartbeat-file-kvm-host-x.hb')
+        self.orig_touch = ha_plugin.touch_heartbeat_file
+        self.wheel = ha_plugin.TimerWheel(tick=0.01)
+        self.workers = ha_plugin.HeartbeatWorkers(idle_timeout=1)
+
+    def tearDown(self):
+        ha_plugin.touch_heartbeat_file = self.orig_touch
+        shutil.rmtree(self.workdir)
+
+    def _heartbeat(self, running, fenced, max_attempts=3):
+        return ha_plugin.FileSystemHeartbeat(self.path, 0.05, 0.1, max_attempts, lambda: fenced.append(time.time()),
+                                             lambda: running[0], self.wheel, self.workers)
+
+    def test_timer_wheel(self):
+        fired = []
+        start = time.time()
+        for delay in (0.05, 0.2, 0.1):
+            self.wheel.schedule(delay, fired.append, delay)
+        # a delay longer than a round of the wheel
+        rounds = []
+        wheel = ha_plugin.TimerWheel(tick=0.01, slots=4)
+        wheel.schedule(0.1, lambda: rounds.append(time.time() - start))
+        time.sleep(0.4)
+        self.assertEqual([0.05, 0.1, 0.2], fired)
+        self.assertTrue(0.1 <= rounds[0] < 0.2)
+
+    def test_timer_wheel_whole_rounds(self):
+        wheel = ha_plugin.TimerWheel(tick=0.1, slots=8)
+        # driven by hand
+        wheel.thread = threading.current_thread()
+        for delay in (0.1, 0.8, 1.6, 0.9):
+            wheel.schedule(delay, None, delay)
+        fired = {}
+        for tick in range(1, 20):
+            for _, _, args in wheel._advance():
+                fired[args[0]] = tick
+        self.assertEqual({0.1: 1, 0.8: 8, 1.6: 16, 0.9: 9}, fired)
+
+    def test_touch(self):
+        running = [True]
+        fenced = []
+        self._heartbeat(running, fenced).start()
+        time.sleep(0.3)
+        running[0] = False
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual([], fenced)
+
+    def test_stuck_touch_fences_once(self):
+        stuck = threading.Event()
+        touches = []
+
+        def touch(path):
+            touches.append(path)
+            stuck.wait()
+        ha_plugin.touch_heartbeat_file = touch
+
+        running = [True]
+        fenced = []
+        start = time.time()
+        hb = self._heartbeat(running, fenced)
+        hb.start()
+        time.sleep(1)
+        running[0] = False
+        stuck.set()
+
+        self.assertEqual(1, len(fenced))
+        # 3 attempts of interval + timeout
+        self.assertTrue(fenced[0] - start >= 0.45)
+        # no write is piled up on the stuck storage
+        self.assertEqual(1, len(touches))
+        self.assertTrue(hb.failure > 3)
+
+    def test_failed_touch_recovers(self):
+        results = [OSError('EIO'), OSError('EIO'), None, OSError('EIO'), OSError('EIO'), None]
+
+        def touch(path):
+            r = results.pop(0) if results else None
+            if r:
+                raise r
+        ha_plugin.touch_heartbeat_file = touch
+
+        running = [True]
+        fenced = []
+        hb = self._heartbeat(running, fenced)
+        hb.start()
+        time.sleep(0.6)
+        running[0] = False
+        self.assertEqual([], fenced)
+        self.assertEqual(0, hb.failure)
+
+    def test_call_timeout(self):
+        stuck = threading.Event()
+        self.assertRaises(ha_plugin.HeartbeatTimeout, self.workers.call, 0.05, stuck.wait)
+        # another call is not blocked by the stuck one
+        self.assertEqual(3, self.workers.call(1, lambda: 3))
+        stuck.set()
+
+if __name__ == "__main__":
+    unittest.main()
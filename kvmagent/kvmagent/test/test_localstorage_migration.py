@@ -0,0 +1,73 @@
+'''
+
+@author: frank
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from kvmagent.plugins import localstorage
+
+class FakeReport(object):
+    def __init__(self):
+        self.percents = []
+
+    def progress_report(self, percent, flag):
+        self.percents.append(percent)
+
+class TestLocalStorageMigration(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.path = os.path.join(self.src, 'vol.qcow2')
+        with open(self.path, 'w') as fd:
+            fd.write(os.urandom(3 * localstorage.MIGRATE_CHUNK_SIZE + 17))
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+
+    def _sender(self):
+        sender = localstorage.RemoteFileSender('127.0.0.1', 22, 'root', 'password')
+        # the remote host is the local one, so a file is sent to itself
+        sender.ssh_args = ['/bin/bash', '-c']
+        return sender
+
+    def test_progress(self):
+        report = FakeReport()
+        progress = localstorage.MigrationProgress(report, 10, 90, 100)
+        for i in range(4):
+            progress.add(25)
+        progress.add(0)
+        self.assertEqual([30, 50, 70, 90], report.percents)
+
+    def test_md5sum_file(self):
+        with open(self.path) as fd:
+            md5 = hashlib.md5(fd.read()).hexdigest()
+        report = FakeReport()
+        progress = localstorage.MigrationProgress(report, 0, 10, os.path.getsize(self.path) * 2)
+        self.assertEqual(md5, localstorage.md5sum_file(self.path, progress))
+        # the second time comes from the cache
+        self.assertEqual(md5, localstorage.md5sum_file(self.path, progress))
+        self.assertEqual(10, report.percents[-1])
+
+        with open(self.path, 'a') as fd:
+            fd.write('x')
+        self.assertNotEqual(md5, localstorage.md5sum_file(self.path))
+
+    def test_send(self):
+        md5 = localstorage.md5sum_file(self.path, use_cache=False)
+        mtime = os.path.getmtime(self.path)
+        sender = self._sender()
+        try:
+            self.assertEqual(md5, sender.send(self.path))
+            self.assertEqual(md5, localstorage.md5sum_file(self.path, use_cache=False))
+            self.assertEqual(int(mtime), os.path.getmtime(self.path))
+            self.assertFalse(os.path.exists(self.path + '.migrating'))
+            self.assertEqual({self.path: (os.path.getsize(self.path), int(mtime))}, sender.stat_remote_files([self.path, self.path + '.none']))
+            self.assertRaises(Exception, sender.send, self.path + '.none')
+        finally:
+            sender.close()
+        self.assertFalse(os.path.exists(sender.password_file))
+
+if __name__ == "__main__":
+    unittest.main()
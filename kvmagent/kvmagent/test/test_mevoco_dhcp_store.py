@@ -0,0 +1,65 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from kvmagent.plugins import mevoco
+
+class TestDhcpEntryStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dhcp, self.dns, self.option = [os.path.join(self.folder, n) for n in ('hosts.dhcp', 'hosts.dns', 'hosts.option')]
+        with open(self.option, 'w') as fd:
+            fd.write('tag:fa163e000002,option:router,10.0.0.1\n\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _read(self, path):
+        with open(path) as fd:
+            return fd.read().splitlines()
+
+    def test_erase_and_add(self):
+        store = mevoco.DhcpEntryStore(self.dhcp, self.dns, self.option)
+        store.erase('fa:16:3e:00:00:01', '10.0.0.10')
+        store.dhcp.add('fa:16:3e:00:00:01,set:fa163e000001,10.0.0.10,vm1,infinite')
+        store.option.add('tag:fa163e000001,option:netmask,255.255.255.0')
+        store.dns.add('10.0.0.10 vm1')
+        store.flush()
+        self.assertEqual(['tag:fa163e000002,option:router,10.0.0.1', 'tag:fa163e000001,option:netmask,255.255.255.0'],
+                         self._read(self.option))
+
+        # the ip is taken by another nic now
+        store.erase('fa:16:3e:00:00:03', '10.0.0.10')
+        store.dhcp.add('fa:16:3e:00:00:03,set:fa163e000003,10.0.0.10,infinite')
+        store.flush()
+        self.assertEqual(['fa:16:3e:00:00:03,set:fa163e000003,10.0.0.10,infinite'], self._read(self.dhcp))
+        self.assertEqual([], self._read(self.dns))
+
+    def test_reload_changed_file(self):
+        store = mevoco.DhcpEntryStore(self.dhcp, self.dns, self.option)
+        with open(self.option, 'a') as fd:
+            fd.write('tag:fa163e000004,option:router,10.0.0.1\n')
+        store.load_if_changed()
+        store.option.remove('fa163e000002')
+        store.flush()
+        self.assertEqual(['tag:fa163e000004,option:router,10.0.0.1'], self._read(self.option))
+
+class TestDnsmasqReloader(unittest.TestCase):
+    def test_coalesce(self):
+        calls = []
+        reloader = mevoco.DnsmasqReloader(lambda n, c: calls.append(('restart', n)), lambda n, c: calls.append(('refresh', n)))
+        threads = [threading.Thread(target=reloader.reload, args=('ns1', 'conf', i == 3)) for i in range(8)]
+        for t in threads:
+            t.start()
+        reloader.reload_all([('ns2', 'conf', False), ('ns3', 'conf', False)])
+        for t in threads:
+            t.join()
+        self.assertEqual([('refresh', 'ns2'), ('refresh', 'ns3'), ('restart', 'ns1')], sorted(calls))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+'''
+
+@author: frank
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from kvmagent.plugins import shared_block_plugin
+from zstacklib.utils.report import MigrationProgress
+
+BLOCK_SIZE = 64 * 1024
+
+class FakeReport(object):
+    def __init__(self):
+        self.percents = []
+
+    def progress_report(self, percent, flag):
+        self.percents.append(percent)
+
+class TestVolumeCopier(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.workdir, 'src')
+        self.dst = os.path.join(self.workdir, 'dst')
+        self.data = os.urandom(BLOCK_SIZE) + '\0' * BLOCK_SIZE * 8 + os.urandom(BLOCK_SIZE) + os.urandom(100)
+        with open(self.src, 'w') as fd:
+            fd.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_copy(self):
+        report = FakeReport()
+        progress = MigrationProgress(report, 10, 90, len(self.data) * 2)
+        copier = shared_block_plugin.VolumeCopier(self.src, self.dst, progress, BLOCK_SIZE)
+
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), copier.copy())
+        with open(self.dst) as fd:
+            self.assertEqual(self.data, fd.read())
+        # zero blocks are holes in a file
+        self.assertTrue(os.stat(self.dst).st_blocks * 512 < len(self.data))
+
+        copier.verify()
+        self.assertEqual(90, report.percents[-1])
+
+    def test_larger_destination(self):
+        with open(self.dst, 'w') as fd:
+            fd.write('x' * len(self.data) * 2)
+        copier = shared_block_plugin.VolumeCopier(self.src, self.dst, block_size=BLOCK_SIZE)
+        copier.copy()
+        copier.verify()
+
+    def test_verify_corrupted(self):
+        copier = shared_block_plugin.VolumeCopier(self.src, self.dst, block_size=BLOCK_SIZE)
+        copier.copy()
+        with open(self.dst, 'r+') as fd:
+            fd.seek(BLOCK_SIZE * 3)
+            fd.write('x')
+        self.assertRaises(Exception, copier.verify)
+
+if __name__ == "__main__":
+    unittest.main()
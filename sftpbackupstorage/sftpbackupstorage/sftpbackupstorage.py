@@ -3,9 +3,12 @@
 @author: frank
 '''
 from zstacklib.utils import http
+from zstacklib.utils import thread
 from zstacklib.utils import jsonobject
 from zstacklib.utils import shell
 from zstacklib.utils import daemon
+from zstacklib.utils import imagecatalog
+from zstacklib.utils import checksum
 from zstacklib.utils.bash import *
 import functools
 import urlparse
@@ -318,79 +321,49 @@ class SftpBackupStorageAgent(object):
             rsp.exist = False
         return jsonobject.dumps(rsp)
 
+    def _get_catalog(self, bs_path):
+        bs_sftp_info_file = bs_path + '/' + self.SFTP_METADATA_FILE
+        catalog = self.catalogs.get(bs_sftp_info_file)
+        if catalog is None:
+            catalog = self.catalogs[bs_sftp_info_file] = imagecatalog.ImageCatalog(imagecatalog.FileStore(bs_sftp_info_file))
+        return catalog
+
     @replyerror
     def dump_image_metadata_to_file(self, req):
-        def _write_info_to_metadata_file(fd):
-            strip_list_content = content[1:-1]
-            data_list = strip_list_content.split('},')
-            for item in data_list:
-                if item.endswith("}") is not True:
-                    item = item + "}"
-                    fd.write(item + '\n')
-
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        bs_sftp_info_file = cmd.backupStoragePath + '/' + self.SFTP_METADATA_FILE
-        content = cmd.imageMetaData
-        dump_all_metadata = cmd.dumpAllMetaData
-        if content is not None:
-            if '[' == content[0] and ']' == content[-1]:
-                if dump_all_metadata is True:
-                    with open(bs_sftp_info_file, 'w') as fd:
-                        _write_info_to_metadata_file(fd)
-                else:
-                    with open(bs_sftp_info_file, 'a') as fd:
-                        _write_info_to_metadata_file(fd)
-            else:
-                #one image info
-                if dump_all_metadata is True:
-                    with open(bs_sftp_info_file, 'w') as fd:
-                        fd.write(content + '\n')
-                else:
-                    with open(bs_sftp_info_file, 'a') as fd:
-                        fd.write(content + '\n')
+        catalog = self._get_catalog(cmd.backupStoragePath)
+        images = imagecatalog.parse_images(cmd.imageMetaData or '')
+        if cmd.dumpAllMetaData is True:
+            catalog.replace(images)
+        else:
+            catalog.put(images)
 
         rsp = DumpImageMetaDataToFileResponse()
         return jsonobject.dumps(rsp)
 
-    @in_bash
     @replyerror
     def delete_image_metadata_from_file(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        image_uuid = cmd.imageUuid
-        bs_sftp_info_file = cmd.backupStoragePath + '/' + self.SFTP_METADATA_FILE
-        ret, output = bash_ro("sed -i.bak '/%s/d' %s" % (image_uuid, bs_sftp_info_file))
+        self._get_catalog(cmd.backupStoragePath).delete(cmd.imageUuid)
         rsp = DeleteImageMetaDataResponse()
-        rsp.ret = ret
+        rsp.ret = 0
         return jsonobject.dumps(rsp)
 
-    @in_bash
     @replyerror
     def get_images_metadata(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        valid_images_info = ""
-        bs_sftp_info_file = cmd.backupStoragePath + '/' + self.SFTP_METADATA_FILE
-        image_uuid_list = []
-        with open(bs_sftp_info_file) as fd:
-            images_info = fd.read()
-            for image_info in images_info.split('\n'):
-                if image_info != '':
-                    image_json = jsonobject.loads(image_info)
-                    # todo support multiple bs
-                    image_uuid = image_json['uuid']
-                    image_install_path = image_json["backupStorageRefs"][0]["installPath"]
-                    if image_uuid in image_uuid_list:
-                        logger.debug("duplicate uuid %s, ignore" % image_json["uuid"])
-                        continue
-                    image_uuid_list.append(image_uuid)
-                    ret = bash_r("ls %s" % image_install_path)
-                    if ret == 0 :
-                        logger.info("Check image %s install path %s successfully!" % (image_uuid, image_install_path))
-                        valid_images_info = image_info + '\n' + valid_images_info
-                    else:
-                        logger.warn("Image %s install path %s is invalid!" % (image_uuid, image_install_path))
+        catalog = self._get_catalog(cmd.backupStoragePath)
+        valid_images_info = []
+        for image_info in catalog.export(newest_first=True):
+            image_install_path = imagecatalog.get_install_path(image_info)
+            if os.path.exists(image_install_path):
+                valid_images_info.append(image_info + '\n')
+            else:
+                logger.warn("Image install path %s is invalid! %s" % (image_install_path, image_info))
+        catalog.compact()
 
         rsp = GetImageMetaDataResponse()
-        rsp.imagesMetaData = valid_images_info
+        rsp.imagesMetaData = ''.join(valid_images_info)
         return jsonobject.dumps(rsp)
 
     @in_bash
@@ -427,13 +400,7 @@ class SftpBackupStorageAgent(object):
         url = urlparse.urlparse(cmd.url)
         if cmd.urlScheme in [self.URL_HTTP, self.URL_HTTPS, self.URL_FTP]:
             try:
-                image_name = linux.shellquote(image_name)
-                cmd.url = linux.shellquote(cmd.url)
-                ret = use_wget(cmd.url, image_name, path, timeout)
-                if ret != 0:
-                    rsp.success = False
-                    rsp.error = 'http/https/ftp download failed, [wget -O %s %s] returns value %s' % (image_name, cmd.url, ret)
-                    return jsonobject.dumps(rsp)
+                use_wget(cmd.url, image_name, path, timeout)
             except linux.LinuxError as e:
                 traceback.format_exc()
                 rsp.success = False
@@ -458,7 +425,8 @@ class SftpBackupStorageAgent(object):
             if not os.path.isfile(src_path):
                 raise Exception('cannot find the file[%s]' % src_path)
             logger.debug("src_path is: %s" % src_path)
-            shell.call('yes | cp %s %s' % (src_path, linux.shellquote(install_path) ))
+            # copied in process to compute the md5 on the way
+            checksum.copy_file(src_path, install_path)
 
 
 
@@ -469,7 +437,8 @@ class SftpBackupStorageAgent(object):
         except Exception as e:
             image_format = "raw"
         size = os.path.getsize(install_path)
-        md5sum = 'not calculated'
+        # remembered while downloading or copying, only an image got by sftp is read again
+        md5sum = checksum.md5sum(install_path)
         logger.debug('successfully downloaded %s to %s' % (cmd.url, install_path))
         (total, avail) = self.get_capacity()
         rsp.md5Sum = md5sum
@@ -517,7 +486,7 @@ class SftpBackupStorageAgent(object):
         '''
         self.http_server.register_sync_uri(self.CONNECT_PATH, self.connect)
         self.http_server.register_sync_uri(self.ECHO_PATH, self.echo)
-        self.http_server.register_async_uri(self.DOWNLOAD_IMAGE_PATH, self.download_image)
+        self.http_server.register_async_uri(self.DOWNLOAD_IMAGE_PATH, self.download_image, lane=thread.BULK_LANE)
         self.http_server.register_async_uri(self.DELETE_IMAGE_PATH, self.delete_image)
         self.http_server.register_async_uri(self.GET_SSHKEY_PATH, self.get_sshkey)
         self.http_server.register_async_uri(self.WRITE_IMAGE_METADATA, self.write_image_metadata)
@@ -526,11 +495,12 @@ class SftpBackupStorageAgent(object):
         self.http_server.register_async_uri(self.DUMP_IMAGE_METADATA_TO_FILE, self.dump_image_metadata_to_file)
         self.http_server.register_async_uri(self.DELETE_IMAGES_METADATA, self.delete_image_metadata_from_file)
         self.http_server.register_async_uri(self.GET_IMAGES_METADATA, self.get_images_metadata)
-        self.http_server.register_async_uri(self.PING_PATH, self.ping)
+        self.http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
         self.http_server.register_async_uri(self.GET_IMAGE_SIZE, self.get_image_size)
         self.http_server.register_async_uri(self.GET_LOCAL_FILE_SIZE, self.get_local_file_size)
         self.storage_path = None
         self.uuid = None
+        self.catalogs = {}
 
 class SftpBackupStorageDaemon(daemon.Daemon):
     def __init__(self, pidfile):
@@ -6,6 +6,7 @@
 from zstacklib.utils import plugin
 from zstacklib.utils import log
 from zstacklib.utils import http
+from zstacklib.utils import thread
 from zstacklib.utils import jsonobject
 from zstacklib.utils import shell
 from zstacklib.utils import daemon
@@ -94,7 +95,7 @@ class VirtualRouter(object):
         self.plugin_rgty.start_plugins()
 
         self.http_server.register_async_uri(self.INIT_PATH, self.init)
-        self.http_server.register_async_uri(self.PING_PATH, self.ping)
+        self.http_server.register_async_uri(self.PING_PATH, self.ping, lane=thread.URGENT_LANE)
 
         if in_thread:
             self.http_server.start_in_thread()
@@ -0,0 +1,65 @@
+'''
+benchmark of reading and rewriting a security group ruleset with 1k vnics
+and 20k rules, using a generated iptables-save output. Nothing is applied
+to the kernel. Run: python -m zstacklib.test.bench_iptables
+
+@author: frank
+'''
+import time
+import collections
+from zstacklib.utils import iptables
+
+VNIC_NUM = 1000
+RULES_PER_VNIC = 20
+
+def make_iptables_save(vnic_num=VNIC_NUM, rules_per_vnic=RULES_PER_VNIC):
+    declares = [':INPUT ACCEPT [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]', ':sg-default - [0:0]']
+    rules = ['-A FORWARD -m physdev --physdev-is-bridged -j sg-default',
+             '-A sg-default -m state --state RELATED,ESTABLISHED -j ACCEPT']
+    for i in range(vnic_num):
+        vnic = 'vnic%s.0' % i
+        declares.append(':%s-in - [0:0]' % vnic)
+        declares.append(':%s-out - [0:0]' % vnic)
+        rules.append('-A sg-default -m physdev --physdev-out %s --physdev-is-bridged -j %s-in' % (vnic, vnic))
+        rules.append('-A sg-default -m physdev --physdev-in %s --physdev-is-bridged -j %s-out' % (vnic, vnic))
+        for j in range(rules_per_vnic / 2):
+            rules.append('-A %s-in -s 10.%s.%s.0/24 -p tcp -m tcp --dport %s -m state --state NEW -j RETURN' %
+                         (vnic, i % 256, j, 1000 + j))
+            rules.append('-A %s-out -d 10.%s.%s.0/24 -p tcp -m tcp --dport %s -m state --state NEW -j RETURN' %
+                         (vnic, i % 256, j, 1000 + j))
+    rules.append('-A sg-default -j ACCEPT')
+    return '\n'.join(['*filter'] + declares + rules + ['COMMIT', ''])
+
+def _measure(name, func, count):
+    start = time.time()
+    for i in range(count):
+        func()
+    print '%-48s %10.3f ms/op' % (name, (time.time() - start) * 1000 / count)
+
+def parse(txt):
+    ipt = iptables.IPTables()
+    ipt._from_iptables_save(txt)
+    return ipt
+
+def full_rewrite(txt):
+    ipt = iptables.IPTables()
+    ipt._from_iptables_save(txt)
+    ipt.delete_chain('vnic7.0-in')
+    ipt.add_rule('-A vnic7.0-in -s 10.0.0.0/8 -j RETURN')
+    return str(ipt)
+
+def incremental_rewrite(txt):
+    snapshot = iptables.ChainSnapshot('filter', lambda n: n == 'sg-default' or n.startswith('vnic')).load(txt)
+    chains = collections.OrderedDict()
+    chains['vnic7.0-in'] = ['-A vnic7.0-in -s 10.0.0.0/8 -j RETURN']
+    return snapshot.fingerprint, chains
+
+def main():
+    txt = make_iptables_save()
+    print 'ruleset: %s vnics, %s lines' % (VNIC_NUM, len(txt.split('\n')))
+    _measure('parse only', lambda: parse(txt), 1)
+    _measure('full parse + rewrite of the filter table', lambda: full_rewrite(txt), 1)
+    _measure('chain snapshot + one chain --noflush payload', lambda: incremental_rewrite(txt), 10)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+'''
+micro benchmark of jsonobject.loads/dumps with payloads shaped like the
+ones agents receive. Run: python -m zstacklib.test.bench_jsonobject
+
+@author: frank
+'''
+import time
+import uuid
+import simplejson
+from zstacklib.utils import jsonobject
+
+def _start_vm_cmd(nics=10, volumes=20):
+    return {
+        'vmInstanceUuid': uuid.uuid4().hex,
+        'vmName': 'vm',
+        'memory': 8589934592,
+        'cpuNum': 8,
+        'bootDev': ['hd'],
+        'rootVolume': {'installPath': '/zstack/root.qcow2', 'deviceId': 0, 'useVirtio': True},
+        'dataVolumes': [{'installPath': '/zstack/data-%s.qcow2' % i, 'deviceId': i + 1, 'volumeUuid': uuid.uuid4().hex,
+                         'useVirtio': True, 'cacheMode': 'none'} for i in range(volumes)],
+        'nics': [{'mac': 'fa:16:3e:00:00:%02x' % i, 'bridgeName': 'br_eth0_%s' % i, 'uuid': uuid.uuid4().hex,
+                  'deviceId': i, 'useVirtio': True} for i in range(nics)],
+        'addons': {'channel': {'socketPath': '/var/lib/libvirt/qemu/vm', 'targetName': 'org.qemu.guest_agent.0'}},
+    }
+
+def _security_group_cmd(nics=200, rules=20):
+    return {
+        'ruleTOs': [{'vmNicUuid': uuid.uuid4().hex, 'vmNicInternalName': 'vnic%s.0' % i, 'actionCode': 'applyRule',
+                     'rules': [{'protocol': 'TCP', 'type': 'Ingress', 'startPort': j, 'endPort': j,
+                                'allowedCidr': '10.0.%s.0/24' % j, 'securityGroupUuid': uuid.uuid4().hex}
+                               for j in range(rules)]} for i in range(nics)]
+    }
+
+def _vm_sync_rsp(vms=500):
+    return {'states': dict([(uuid.uuid4().hex, 'Running') for i in range(vms)]), 'success': True}
+
+def _measure(name, func, count):
+    start = time.time()
+    for i in range(count):
+        func()
+    cost = time.time() - start
+    print '%-32s %8d loops %10.3f ms/op' % (name, count, cost * 1000 / count)
+
+def main():
+    print 'simplejson C accelerated: %s' % jsonobject.is_accelerated()
+    payloads = [
+        ('StartVmCmd', simplejson.dumps(_start_vm_cmd()), 2000),
+        ('ApplySecurityGroupRuleCmd', simplejson.dumps(_security_group_cmd()), 20),
+        ('VmSyncResponse', simplejson.dumps(_vm_sync_rsp()), 500),
+    ]
+
+    for name, jstr, count in payloads:
+        obj = jsonobject.loads(jstr)
+        _measure('%s loads' % name, lambda: jsonobject.loads(jstr), count)
+        _measure('%s dumps' % name, lambda: jsonobject.dumps(obj), count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+
+@author: frank
+'''
+import json
+import unittest
+from zstacklib.utils import bash
+
+class TestBash(unittest.TestCase):
+    def tearDown(self):
+        bash.enable_profiler(False)
+        bash.reset_profiler()
+
+    def test_eval(self):
+        name = 'x'
+        self.assertEqual('echo x', bash.bash_eval('echo {{name}}'))
+        self.assertEqual('echo y', bash.bash_eval('echo {{name}}', ctx={'name': 'y'}))
+        self.assertEqual('echo {', bash.bash_eval('echo {', ctx={}))
+        self.assertRaises(Exception, bash.bash_eval, 'echo {{nothing}}', {})
+        # a symbol rendered to another template
+        self.assertEqual('echo z', bash.bash_eval('echo {{outer}}', ctx={'outer': '{{inner}}', 'inner': 'z'}))
+
+    def test_template_cache(self):
+        bash._templates.clear()
+        for i in range(10):
+            bash.bash_eval('echo {{i}}', ctx={'i': i})
+        # rendered commands are not cached
+        self.assertEqual(['echo {{i}}'], bash._templates.keys())
+
+    def test_ctx(self):
+        self.assertEqual('a\n', bash.bash_o('echo {{v}}', ctx={'v': 'a'}))
+        self.assertEqual(3, bash.bash_r('exit {{v}}', ctx={'v': 3}))
+        self.assertEqual((0, 'b\n'), bash.bash_ro('echo {{v}}', ctx={'v': 'b'}))
+        self.assertEqual('c\n', bash.bash_errorout('echo {{v}}', ctx={'v': 'c'}))
+
+    def test_profiler(self):
+        bash.enable_profiler()
+        v = 'a'
+        for i in range(3):
+            bash.bash_o('echo {{v}}')
+        bash.bash_r('true', ctx={})
+
+        profile = bash.get_profile()
+        frequent = profile['mostFrequent'][0]
+        self.assertTrue(frequent['site'].startswith(__file__.rstrip('c')))
+        self.assertEqual(3, frequent['count'])
+        self.assertEqual(3, frequent['stackWalks'])
+        self.assertEqual(2, len(profile['slowest']))
+        self.assertEqual(0, profile['mostFrequent'][1]['stackWalks'])
+
+        bash.enable_profiler(False)
+        bash.bash_r('true')
+        self.assertEqual(4, sum(s['count'] for s in bash.get_profile()['slowest']))
+
+    def test_in_bash_debug_info(self):
+        infos = []
+        orig_debug = bash.logger.debug
+        bash.logger.debug = lambda msg: infos.append(msg)
+
+        @bash.in_bash
+        def f():
+            bash.bash_r('echo {{v}}', ctx={'v': 'hello'})
+            return bash._debug_info.stack[-1]
+
+        try:
+            logged = f()
+        finally:
+            bash.logger.debug = orig_debug
+
+        self.assertEqual('echo hello', logged[0]['cmd'])
+        self.assertEqual([], bash._debug_info.stack)
+        self.assertIn(json.dumps(logged), infos[-1])
+
+class TestBashProgress(unittest.TestCase):
+    def test_parsers(self):
+        self.assertEqual((None, 45.0), bash.parse_pv_progress('45\n'))
+        self.assertIsNone(bash.parse_pv_progress('pv: No such file or directory'))
+        self.assertEqual((4096, None), bash.parse_pv_bytes_progress('4096'))
+        self.assertEqual(((51200 + 20) * 1024, 45.0),
+                         bash.parse_wget_progress(' 51200K .......... .......... 45% 1.23M 2s'))
+        self.assertEqual((1234567, 45.0), bash.parse_wget_progress(' 45% [=====>      ] 1,234,567   1.2M/s  eta 2s'))
+        self.assertEqual((None, 45.0), bash.parse_wget_progress('cd.iso   45%[=====>      ] 123.45M  10.2MB/s  eta 10s'))
+        self.assertIsNone(bash.parse_wget_progress('Saving to: cd.iso'))
+        self.assertEqual((1234567, 45.0), bash.parse_rsync_progress('      1,234,567  45%   12.34MB/s    0:00:12'))
+        self.assertIsNone(bash.parse_rsync_progress('sending incremental file list'))
+        self.assertEqual((None, 45.67), bash.parse_qemu_img_progress('    (45.67/100%)'))
+        self.assertEqual((None, 45.0), bash.parse_percent_progress('Image copy: 45% complete...'))
+
+    def test_progress(self):
+        p = bash.CommandProgress(total=1000)
+        self.assertTrue(p.update(None, 50.0))
+        self.assertEqual(500, p.bytes)
+        self.assertFalse(p.update(None, 50.0))
+        self.assertTrue(p.update(800, None))
+        self.assertEqual(80.0, p.percent)
+
+    def test_run(self):
+        updates = []
+        script = "printf '10\\n' >&2; echo out; printf '50\\n' >&2; echo oops >&2; printf '100\\n' >&2"
+        r, o, e = bash.bash_progress(script, 'pv', lambda p: updates.append((p.percent, p.bytes)), total=200)
+        self.assertEqual((0, 'out\n', None), (r, o, e))
+        self.assertEqual([(10.0, 20), (50.0, 100), (100.0, 200)], updates)
+
+        r, o, e = bash.bash_progress(script + '; exit 2', 'pv')
+        self.assertEqual((2, 'oops\n'), (r, e))
+        self.assertRaises(bash.BashError, bash.bash_progress, 'exit 1', 'pv', errorout=True)
+
+    def test_stdout_with_carriage_return(self):
+        updates = []
+        script = "echo file; printf '  1,000  10%%  1MB/s  0:00:01\\r  5,000  50%%  1MB/s  0:00:01\\r'"
+        r, o, e = bash.bash_progress('{{s}}', 'rsync', lambda p: updates.append(p.bytes), progress_stream='stdout',
+                                     ctx={'s': script})
+        self.assertEqual((0, 'file\n'), (r, o))
+        self.assertEqual([1000, 5000], updates)
+
+if __name__ == "__main__":
+    unittest.main()
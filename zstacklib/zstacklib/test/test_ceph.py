@@ -0,0 +1,89 @@
+'''
+
+@author: frank
+'''
+import json
+import threading
+import time
+import unittest
+from zstacklib.utils import ceph
+
+class FakeCeph(object):
+    def __init__(self):
+        self.epoch = 10
+        self.pools = {'pool1': 3, 'pool2': 2}
+        self.calls = []
+        self.delay = 0
+
+    def call(self, cmd):
+        self.calls.append(cmd)
+        time.sleep(self.delay)
+        if cmd == 'ceph df -f json':
+            pools = [{'name': n, 'stats': {'max_avail': 100, 'bytes_used': 10}} for n in sorted(self.pools)]
+            return json.dumps({'stats': {'total_bytes': 1000, 'total_avail_bytes': 900}, 'pools': pools})
+        if cmd == 'ceph osd stat -f json':
+            return json.dumps({'epoch': self.epoch, 'num_osds': 3})
+        if cmd == 'ceph osd dump -f json':
+            return json.dumps({'epoch': self.epoch, 'pools': [{'pool_name': n, 'size': s} for n, s in self.pools.items()]})
+        raise Exception('unexpected command %s' % cmd)
+
+    def count(self, cmd):
+        return len([c for c in self.calls if c == cmd])
+
+class TestCapacityService(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeCeph()
+        self.service = ceph.CapacityService(self.fake.call, max_staleness=0.2, refresh_interval=0)
+
+    def test_read(self):
+        capacity = self.service.get()
+        self.assertEqual((1000, 900), (capacity.total, capacity.available))
+        self.assertEqual([('pool1', 100, 3, 10), ('pool2', 100, 2, 10)],
+                         [(p.name, p.available, p.replicated_size, p.used) for p in capacity.pools])
+
+    def test_staleness_and_force(self):
+        self.service.get()
+        self.service.get()
+        self.assertEqual(1, self.fake.count('ceph df -f json'))
+        self.service.get(force=True)
+        self.assertEqual(2, self.fake.count('ceph df -f json'))
+        time.sleep(0.25)
+        self.service.get()
+        self.assertEqual(3, self.fake.count('ceph df -f json'))
+
+    def test_pool_size_by_epoch(self):
+        self.service.get()
+        self.fake.pools['pool1'] = 2
+        self.assertEqual(3, self.service.get(force=True).pools[0].replicated_size)
+        self.assertEqual(1, self.fake.count('ceph osd dump -f json'))
+
+        self.fake.epoch += 1
+        self.assertEqual(2, self.service.get(force=True).pools[0].replicated_size)
+        self.fake.pools['pool3'] = 3
+        self.assertEqual(3, self.service.get(force=True).pools[2].replicated_size)
+        self.assertEqual(3, self.fake.count('ceph osd dump -f json'))
+
+    def test_single_flight(self):
+        self.fake.delay = 0.1
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.service.get())) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, self.fake.count('ceph df -f json'))
+        self.assertEqual(1, len(set(id(r) for r in results)))
+
+    def test_background_refresh(self):
+        service = ceph.CapacityService(self.fake.call, max_staleness=10, refresh_interval=0.05, idle_timeout=0.2)
+        service.get()
+        time.sleep(0.5)
+        # refreshed until idle for idle_timeout
+        refreshed = self.fake.count('ceph df -f json')
+        self.assertTrue(refreshed > 2)
+        self.assertIsNone(service.refresher)
+        time.sleep(0.1)
+        self.assertEqual(refreshed, self.fake.count('ceph df -f json'))
+
+if __name__ == "__main__":
+    unittest.main()
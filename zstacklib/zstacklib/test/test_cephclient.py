@@ -0,0 +1,78 @@
+'''
+
+@author: frank
+'''
+import json
+import unittest
+from zstacklib.utils import cephclient
+
+class TestFakeCluster(unittest.TestCase):
+    def setUp(self):
+        self.cluster = cephclient.FakeCluster()
+        self.cluster.create_pool('pool')
+        self.cluster.create_image('pool/image', 1 << 30)
+
+    def test_spec(self):
+        self.assertEqual(('pool', 'image', 'sp'), cephclient.parse_spec('pool/image@sp'))
+        self.assertEqual(('rbd', 'image', None), cephclient.parse_spec('image'))
+
+    def test_image(self):
+        self.assertEqual(1 << 30, json.loads(self.cluster.image_info('pool/image'))['size'])
+        self.assertTrue(self.cluster.image_exists('pool/image'))
+        self.assertFalse(self.cluster.image_exists('pool/nothing'))
+        self.assertFalse(self.cluster.image_exists('nothing/image'))
+        self.assertRaises(cephclient.CephNotFound, self.cluster.image_info, 'pool/nothing')
+
+    def test_snapshots_and_children(self):
+        self.cluster.snap_create('pool/image@sp')
+        self.assertEqual(['sp'], [s['name'] for s in json.loads(self.cluster.snap_list('pool/image'))])
+        self.cluster.snap_protect('pool/image@sp')
+        self.cluster.clone('pool/image@sp', 'pool/child')
+        self.assertEqual(['pool/child'], self.cluster.image_children('pool/image@sp'))
+
+        self.assertRaises(cephclient.CephError, self.cluster.snap_unprotect, 'pool/image@sp')
+        self.assertRaises(cephclient.CephError, self.cluster.snap_remove, 'pool/image@sp')
+        self.assertRaises(cephclient.CephError, self.cluster.image_remove, 'pool/image')
+
+        self.cluster.image_remove('pool/child')
+        self.assertEqual([], self.cluster.image_children('pool/image@sp'))
+        self.cluster.snap_unprotect('pool/image@sp')
+        self.cluster.snap_purge('pool/image')
+        self.cluster.image_remove('pool/image')
+        self.assertFalse(self.cluster.image_exists('pool/image'))
+
+    def test_objects_and_status(self):
+        self.cluster.object_put('pool', 'hb', 'zstack\n')
+        self.cluster.object_remove('pool', 'hb')
+        self.assertRaises(cephclient.CephNotFound, self.cluster.object_remove, 'pool', 'hb')
+
+        status = json.loads(self.cluster.mon_command('status'))
+        self.assertEqual('127.0.0.1:6789/0', status['monmap']['mons'][0]['addr'])
+        self.assertEqual(self.cluster.fsid, json.loads(self.cluster.mon_command('mon_status'))['monmap']['fsid'])
+
+class TestClient(unittest.TestCase):
+    def tearDown(self):
+        cephclient.set_client(None)
+
+    def test_fallback_to_cli(self):
+        orig = cephclient.rados
+        cephclient.rados = None
+        try:
+            self.assertIsInstance(cephclient.get_client(), cephclient.CliClient)
+        finally:
+            cephclient.rados = orig
+
+    def test_set_client(self):
+        cluster = cephclient.FakeCluster()
+        cephclient.set_client(cluster)
+        self.assertIs(cluster, cephclient.get_client())
+
+    def test_cli_errors(self):
+        cli = cephclient.CliClient()
+        self.assertEqual('x\n', cli._call('echo x'))
+        self.assertRaises(cephclient.CephNotFound, cli._call, 'ls /nothing/at/all')
+        self.assertRaises(cephclient.CephTimeout, cli._call, 'sleep 3', 1)
+        self.assertRaises(cephclient.CephError, cli._call, 'false')
+
+if __name__ == "__main__":
+    unittest.main()
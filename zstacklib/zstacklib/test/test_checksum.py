@@ -0,0 +1,91 @@
+'''
+
+@author: frank
+'''
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from zstacklib.utils import checksum
+
+CONTENT = ''.join(chr(i % 251) for i in xrange(300000 + 17))
+
+class TestChecksum(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'image')
+        with open(self.path, 'wb') as fd:
+            fd.write(CONTENT)
+        self.orig_buffer_size = checksum.READ_BUFFER_SIZE
+        checksum.READ_BUFFER_SIZE = 64 * 1024
+
+    def tearDown(self):
+        checksum.READ_BUFFER_SIZE = self.orig_buffer_size
+        checksum.forget(self.path)
+        shutil.rmtree(self.workdir)
+
+    def test_file_digest(self):
+        md5 = hashlib.md5(CONTENT).hexdigest()
+        read = []
+        self.assertEqual(md5, checksum.md5sum(self.path, read.append))
+        self.assertEqual(len(CONTENT), sum(read))
+        self.assertTrue(len(read) > 1)
+        self.assertEqual(hashlib.sha1(CONTENT).hexdigest(), checksum.file_digest(self.path, 'sha1'))
+
+        # remembered until the file changes
+        os.chmod(self.path, 0444)
+        self.assertEqual(md5, checksum.get_cached(self.path))
+        os.chmod(self.path, 0644)
+        with open(self.path, 'ab') as fd:
+            fd.write('x')
+        self.assertIsNone(checksum.get_cached(self.path))
+        self.assertEqual(hashlib.md5(CONTENT + 'x').hexdigest(), checksum.md5sum(self.path))
+
+    def test_digesting_writer(self):
+        dst = os.path.join(self.workdir, 'copy')
+        with open(dst, 'wb') as fd:
+            sink = checksum.DigestingWriter(fd)
+            sink.update_from(self.path, 1000)
+            sink.seek(1000)
+            sink.write(CONTENT[1000:])
+        self.assertEqual(hashlib.md5(CONTENT).hexdigest(), sink.hexdigest())
+
+        checksum.forget(self.path)
+        self.assertEqual(hashlib.md5(CONTENT).hexdigest(), checksum.copy_file(self.path, dst))
+        with open(dst, 'rb') as fd:
+            self.assertEqual(CONTENT, fd.read())
+        self.assertEqual(sink.hexdigest(), checksum.get_cached(dst))
+        self.assertEqual(sink.hexdigest(), checksum.get_cached(self.path))
+        checksum.forget(dst)
+
+    def test_tree_digest(self):
+        chunk = 64 * 1024
+        digests = [hashlib.md5(CONTENT[i:i + chunk]).digest() for i in range(0, len(CONTENT), chunk)]
+        read = []
+        self.assertEqual(hashlib.md5(''.join(digests)).hexdigest(),
+                         checksum.tree_digest(self.path, chunk_size=chunk, parallelism=3, progress=read.append))
+        self.assertEqual(len(CONTENT), sum(read))
+        # does not take the plain md5 of the file
+        self.assertEqual(hashlib.md5(CONTENT).hexdigest(), checksum.md5sum(self.path))
+
+        empty = os.path.join(self.workdir, 'empty')
+        open(empty, 'w').close()
+        self.assertEqual(hashlib.md5('').hexdigest(), checksum.tree_digest(empty, use_cache=False))
+
+    def test_folder_digest(self):
+        src = os.path.join(self.workdir, 'src')
+        dst = os.path.join(self.workdir, 'dst')
+        os.makedirs(os.path.join(src, 'sub'))
+        shutil.copy(self.path, os.path.join(src, 'a'))
+        shutil.copy(self.path, os.path.join(src, 'sub', 'b'))
+        shutil.copytree(src, dst)
+        self.assertEqual(checksum.folder_digest(src), checksum.folder_digest(dst))
+
+        with open(os.path.join(dst, 'sub', 'b'), 'r+b') as fd:
+            fd.write('x')
+        self.assertNotEqual(checksum.folder_digest(src), checksum.folder_digest(dst))
+
+if __name__ == "__main__":
+    unittest.main()
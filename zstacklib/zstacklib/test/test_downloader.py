@@ -0,0 +1,242 @@
+'''
+
+@author: frank
+'''
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import hashlib
+import unittest
+import BaseHTTPServer
+import SocketServer
+from zstacklib.utils import checksum
+from zstacklib.utils import downloader
+
+CONTENT = ''.join(chr(i % 251) for i in xrange(1024 * 1024 + 123))
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ranges = True
+    ignore_ranges = False
+    etag = '"v1"'
+    last_modified = None
+    if_ranges = []
+    drop_once = set()
+    requests = []
+    lock = threading.Lock()
+
+    def _record(self, item):
+        with _Handler.lock:
+            _Handler.requests.append(item)
+
+    def do_HEAD(self):
+        self._record(('HEAD', None))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        if _Handler.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', _Handler.etag)
+            if _Handler.last_modified:
+                self.send_header('Last-Modified', _Handler.last_modified)
+        self.end_headers()
+
+    def do_GET(self):
+        r = self.headers.getheader('Range')
+        if r:
+            _Handler.if_ranges.append(self.headers.getheader('If-Range'))
+        if not _Handler.ranges or _Handler.ignore_ranges or not r:
+            self._record(('GET', None))
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(CONTENT)))
+            self.end_headers()
+            self.wfile.write(CONTENT)
+            return
+
+        start, end = [int(x) for x in r.split('=')[1].split('-')]
+        self._record(('GET', start))
+        body = CONTENT[start:end + 1]
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(CONTENT)))
+        self.end_headers()
+        if start in _Handler.drop_once:
+            _Handler.drop_once.discard(start)
+            self.wfile.write(body[:100])
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestDownloader(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = _Server(('127.0.0.1', 0), _Handler)
+        cls.url = 'http://127.0.0.1:%s/image.qcow2' % cls.server.server_address[1]
+        t = threading.Thread(target=cls.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        _Handler.ranges = True
+        _Handler.ignore_ranges = False
+        _Handler.etag = '"v1"'
+        _Handler.last_modified = None
+        _Handler.if_ranges = []
+        _Handler.drop_once = set()
+        _Handler.requests = []
+        self.workdir = tempfile.mkdtemp()
+        self.orig_retry_interval = downloader.RETRY_INTERVAL
+        downloader.RETRY_INTERVAL = 0
+
+    def tearDown(self):
+        downloader.RETRY_INTERVAL = self.orig_retry_interval
+        shutil.rmtree(self.workdir)
+
+    def _gets(self):
+        return sorted([r[1] for r in _Handler.requests if r[0] == 'GET'])
+
+    def _heads(self):
+        return len([r for r in _Handler.requests if r[0] == 'HEAD'])
+
+    def test_parallel_ranges_in_order(self):
+        dst = os.path.join(self.workdir, 'image')
+        reports = []
+        downloader.download_to_file(self.url, dst, progress=lambda d, t: reports.append((d, t)))
+        self.assertEqual([0], self._gets())
+        _Handler.requests = []
+
+        # small segments to get many parallel requests
+        d = downloader.Downloader(self.url, segment_size=64 * 1024, parallelism=4)
+        sink = tempfile.TemporaryFile()
+        self.assertEqual(len(CONTENT), d.download(sink))
+
+        sink.seek(0)
+        self.assertEqual(CONTENT, sink.read())
+        with open(dst) as fd:
+            self.assertEqual(CONTENT, fd.read())
+        self.assertFalse(os.path.exists(dst + downloader.PART_SUFFIX))
+        self.assertFalse(os.path.exists(dst + downloader.META_SUFFIX))
+        self.assertEqual((len(CONTENT), len(CONTENT)), reports[-1])
+        self.assertEqual(1, self._heads())
+        self.assertEqual(range(0, len(CONTENT), 64 * 1024), self._gets())
+
+    def test_sniffed_segment_is_reused(self):
+        d = downloader.Downloader(self.url, segment_size=256 * 1024)
+        self.assertEqual(CONTENT[:0x9007], d.sniff(0x9007))
+        self.assertEqual(CONTENT[:0x9007], d.sniff(0x9007))
+        sink = tempfile.TemporaryFile()
+        d.download(sink)
+        sink.seek(0)
+        self.assertEqual(CONTENT, sink.read())
+        self.assertEqual([0, 262144, 524288, 786432, 1048576], self._gets())
+        self.assertEqual(1, self._heads())
+
+    def test_resume(self):
+        dst = os.path.join(self.workdir, 'image')
+        remote = downloader.head(self.url)
+        with open(dst + downloader.PART_SUFFIX, 'w') as fd:
+            fd.write(CONTENT[:300000])
+        downloader._write_meta(dst + downloader.META_SUFFIX, remote)
+        _Handler.requests = []
+
+        downloader.download_to_file(self.url, dst)
+        with open(dst) as fd:
+            self.assertEqual(CONTENT, fd.read())
+        self.assertEqual(300000, self._gets()[0])
+        # the resumed part is in the md5 computed while downloading
+        self.assertEqual(hashlib.md5(CONTENT).hexdigest(), checksum.get_cached(dst))
+
+    def test_no_resume_if_changed(self):
+        dst = os.path.join(self.workdir, 'image')
+        with open(dst + downloader.PART_SUFFIX, 'w') as fd:
+            fd.write('x' * 300000)
+        with open(dst + downloader.META_SUFFIX, 'w') as fd:
+            fd.write('{"etag": "old"}')
+
+        downloader.download_to_file(self.url, dst)
+        with open(dst) as fd:
+            self.assertEqual(CONTENT, fd.read())
+        self.assertEqual(0, self._gets()[0])
+
+    def test_segment_retry(self):
+        _Handler.drop_once = set([128 * 1024])
+        d = downloader.Downloader(self.url, segment_size=128 * 1024)
+        sink = tempfile.TemporaryFile()
+        d.download(sink)
+        sink.seek(0)
+        self.assertEqual(CONTENT, sink.read())
+        # the retry continues from the bytes received
+        self.assertIn(128 * 1024 + 100, self._gets())
+
+    def test_stream_without_ranges(self):
+        _Handler.ranges = False
+        d = downloader.Downloader(self.url)
+        self.assertFalse(d.ranged)
+        self.assertEqual(CONTENT[:16], d.sniff(16))
+        sink = tempfile.TemporaryFile()
+        d.download(sink)
+        sink.seek(0)
+        self.assertEqual(CONTENT, sink.read())
+        self.assertEqual([None], self._gets())
+        self.assertRaises(downloader.DownloadError, d.download, sink, 100)
+
+    def test_weak_etag_not_in_if_range(self):
+        d = downloader.Downloader(self.url, segment_size=256 * 1024)
+        d.download(tempfile.TemporaryFile())
+        self.assertEqual(set(['"v1"']), set(_Handler.if_ranges))
+
+        _Handler.if_ranges = []
+        _Handler.etag = 'W/"v1"'
+        _Handler.last_modified = 'Tue, 01 Sep 2026 08:00:00 GMT'
+        d = downloader.Downloader(self.url, segment_size=256 * 1024)
+        d.download(tempfile.TemporaryFile())
+        self.assertEqual(set(['Tue, 01 Sep 2026 08:00:00 GMT']), set(_Handler.if_ranges))
+
+        _Handler.if_ranges = []
+        _Handler.last_modified = None
+        d = downloader.Downloader(self.url, segment_size=256 * 1024)
+        d.download(tempfile.TemporaryFile())
+        self.assertEqual(set([None]), set(_Handler.if_ranges))
+
+    def test_stream_if_ranges_ignored(self):
+        _Handler.ignore_ranges = True
+        d = downloader.Downloader(self.url, segment_size=256 * 1024)
+        self.assertTrue(d.ranged)
+        sink = tempfile.TemporaryFile()
+        self.assertEqual(len(CONTENT), d.download(sink))
+        sink.seek(0)
+        self.assertEqual(CONTENT, sink.read())
+
+        d = downloader.Downloader(self.url, segment_size=256 * 1024)
+        self.assertEqual(CONTENT[:16], d.sniff(16))
+        self.assertFalse(d.ranged)
+        sink = tempfile.TemporaryFile()
+        d.download(sink)
+        sink.seek(0)
+        self.assertEqual(CONTENT, sink.read())
+
+    def test_sink_error_stops_workers(self):
+        class _Sink(object):
+            def write(self, data):
+                raise IOError('broken pipe')
+
+        d = downloader.Downloader(self.url, segment_size=16 * 1024, parallelism=2)
+        self.assertRaises(IOError, d.download, _Sink())
+        self.assertTrue(len(self._gets()) <= 2 * 2 + 2)
+
+    def test_bad_url(self):
+        self.assertRaises(downloader.DownloadError, downloader.head, 'http://127.0.0.1:1/image.qcow2')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+'''
+
+@author: frank
+'''
+import unittest
+import threading
+import BaseHTTPServer
+import SocketServer
+from zstacklib.utils import http
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    clients = set()
+
+    def do_POST(self):
+        _Handler.clients.add(self.client_address)
+        length = int(self.headers.getheader('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestHttpConnectionPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = _Server(('127.0.0.1', 0), _Handler)
+        cls.port = cls.server.server_address[1]
+        t = threading.Thread(target=cls.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def test_keep_alive_and_stats(self):
+        http.configure_connection_pool(maxsize=1)
+        uri = 'http://127.0.0.1:%s/callback' % self.port
+        for i in range(5):
+            self.assertEqual('{"i": %s}' % i, http.json_post(uri, '{"i": %s}' % i, fail_soon=True))
+
+        self.assertEqual(1, len(_Handler.clients))
+        stats = http.get_destination_stats()['127.0.0.1:%s' % self.port]
+        self.assertEqual(5, stats['requests'])
+        self.assertEqual(0, stats['errors'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+'''
+
+@author: frank
+'''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from zstacklib.utils import cephclient
+from zstacklib.utils import imagecatalog
+
+def image(uuid, install_path=None):
+    return json.dumps({'uuid': uuid, 'name': 'image-%s' % uuid,
+                       'backupStorageRefs': [{'installPath': install_path or '/bs/%s.qcow2' % uuid}]})
+
+class TestImageCatalog(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'bs_sftp_info.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _catalog(self, compact_min_records=imagecatalog.COMPACT_MIN_RECORDS):
+        return imagecatalog.ImageCatalog(imagecatalog.FileStore(self.path), compact_min_records)
+
+    def _export(self):
+        with open(self.path) as fd:
+            return [json.loads(l)['uuid'] for l in fd.read().splitlines()]
+
+    def test_parse_images(self):
+        self.assertEqual([], imagecatalog.parse_images(''))
+        lines = imagecatalog.parse_images('[%s,%s]' % (image('a'), image('b')))
+        self.assertEqual(['a', 'b'], [json.loads(l)['uuid'] for l in lines])
+        self.assertEqual('/bs/a.qcow2', imagecatalog.get_install_path(lines[0]))
+        self.assertEqual(1, len(imagecatalog.parse_images(image('c'))))
+
+    def test_put_delete_get(self):
+        catalog = self._catalog()
+        self.assertFalse(catalog.exists())
+        catalog.put([image('a')])
+        # the export is written by the first put
+        self.assertTrue(catalog.exists())
+        catalog.put([image('b'), image('c')])
+        catalog.delete('b')
+        catalog.delete('nothing')
+        catalog.put([image('a', '/bs/new.qcow2')])
+
+        self.assertEqual('/bs/new.qcow2', imagecatalog.get_install_path(catalog.get('a')))
+        self.assertIsNone(catalog.get('b'))
+        self.assertEqual(['a', 'c'], [json.loads(l)['uuid'] for l in catalog.export(newest_first=True)])
+
+        # the changes are in the log until compacted
+        self.assertEqual(['a'], self._export())
+        reloaded = self._catalog()
+        self.assertEqual(['c', 'a'], [json.loads(l)['uuid'] for l in reloaded.export()])
+
+        reloaded.compact()
+        self.assertEqual(['c', 'a'], self._export())
+        self.assertFalse(os.path.exists(self.path + '.log'))
+
+    def test_compact_when_log_grows(self):
+        catalog = self._catalog(compact_min_records=10)
+        for i in range(30):
+            catalog.put([image('i%d' % i)])
+            catalog.delete('i%d' % i)
+        self.assertTrue(catalog.log_records <= 10)
+        self.assertEqual(0, len(self._catalog()))
+
+    def test_replace(self):
+        catalog = self._catalog()
+        catalog.put([image('a'), image('b')])
+        catalog.replace([image('c')])
+        self.assertEqual(['c'], self._export())
+        self.assertEqual(['c'], [json.loads(l)['uuid'] for l in self._catalog().export()])
+
+    def test_changed_by_another_writer(self):
+        catalog = self._catalog()
+        catalog.put([image('a')])
+        self._catalog().put([image('b')])
+        self.assertIsNotNone(catalog.get('b'))
+
+    def test_torn_log(self):
+        catalog = self._catalog()
+        catalog.put([image('a')])
+        catalog.put([image('b')])
+        # crashed in the middle of an append
+        with open(self.path + '.log', 'a') as fd:
+            fd.write(image('c')[:20])
+
+        catalog = self._catalog()
+        self.assertEqual(2, len(catalog))
+        catalog.put([image('d')])
+        self.assertEqual(['a', 'b', 'd'], [json.loads(l)['uuid'] for l in self._catalog().export()])
+
+    def test_crash_before_log_removed(self):
+        catalog = self._catalog()
+        catalog.put([image('a')])
+        catalog.put([image('b')])
+        catalog.delete('a')
+        with open(self.path + '.log') as fd:
+            log = fd.read()
+        catalog.compact()
+        # the log replayed again on the compacted export
+        with open(self.path + '.log', 'w') as fd:
+            fd.write(log)
+        self.assertEqual(['b'], [json.loads(l)['uuid'] for l in self._catalog().export()])
+
+    def test_rados_store(self):
+        cluster = cephclient.FakeCluster()
+        cluster.create_pool('bak-t-x')
+        store = imagecatalog.RadosStore('bak-t-x', 'bs_ceph_info.json', cluster)
+        catalog = imagecatalog.ImageCatalog(store)
+        self.assertFalse(catalog.exists())
+
+        catalog.put([image('a')])
+        catalog.put([image('b')])
+        catalog.delete('a')
+        self.assertEqual(image('a') + '\n', cluster.object_get('bak-t-x', 'bs_ceph_info.json'))
+        # another agent sees the log
+        other = imagecatalog.ImageCatalog(imagecatalog.RadosStore('bak-t-x', 'bs_ceph_info.json', cluster))
+        self.assertEqual(['b'], [json.loads(l)['uuid'] for l in other.export()])
+
+        other.compact()
+        self.assertEqual(image('b') + '\n', cluster.object_get('bak-t-x', 'bs_ceph_info.json'))
+        self.assertRaises(cephclient.CephNotFound, cluster.object_stat, 'bak-t-x', 'bs_ceph_info.json.log')
+        self.assertIsNone(catalog.get('a'))
+
+    def test_interleaved_agents(self):
+        cluster = cephclient.FakeCluster()
+        cluster.create_pool('bak-t-x')
+        a = imagecatalog.ImageCatalog(imagecatalog.RadosStore('bak-t-x', 'bs_ceph_info.json', cluster))
+        b = imagecatalog.ImageCatalog(imagecatalog.RadosStore('bak-t-x', 'bs_ceph_info.json', cluster))
+        a.put([image('a0')])
+
+        # b appends between the load and the append of a
+        a._load()
+        b.put([image('b1')])
+        a._append([image('a1')])
+        self.assertIsNotNone(a.get('b1'))
+        a.compact()
+        self.assertEqual(['a0', 'b1', 'a1'], [json.loads(l)['uuid'] for l in
+                                              cluster.object_get('bak-t-x', 'bs_ceph_info.json').splitlines()])
+
+        # b appends while a writes the export, its log stays
+        write_export = a.store.write_export
+        def write_and_put(lines):
+            write_export(lines)
+            b.put([image('b2')])
+        a.store.write_export = write_and_put
+        a.put([image('a2')])
+        a._compact()
+        del a.store.write_export
+        self.assertIsNotNone(a.get('b2'))
+        a.compact()
+        self.assertEqual(['a0', 'b1', 'a1', 'a2', 'b2'], [json.loads(l)['uuid'] for l in
+                                                          cluster.object_get('bak-t-x', 'bs_ceph_info.json').splitlines()])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+'''
+
+@author: frank
+'''
+import unittest
+from zstacklib.utils import iptables
+
+SAVE = '''# Generated by iptables-save
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:sg-default - [0:0]
+:vnic1.0-in - [0:0]
+:vnic1.0-out - [0:0]
+-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT
+-A FORWARD -m physdev --physdev-is-bridged -j sg-default
+-A sg-default -m physdev --physdev-out vnic1.0 --physdev-is-bridged -j vnic1.0-in
+-A sg-default -j ACCEPT
+-A vnic1.0-in -p tcp -m tcp --dport 80 -m state --state NEW -j RETURN
+-A vnic1.0-in -j REJECT --reject-with icmp-host-prohibited
+COMMIT
+'''
+
+class TestChainSnapshot(unittest.TestCase):
+    def _load(self, txt):
+        return iptables.ChainSnapshot('filter', lambda n: n == 'sg-default' or n.startswith('vnic')).load(txt)
+
+    def test_load(self):
+        snapshot = self._load(SAVE)
+        self.assertEqual(['sg-default', 'vnic1.0-in', 'vnic1.0-out'], snapshot.chains.keys())
+        self.assertEqual(2, len(snapshot.chains['vnic1.0-in']))
+        self.assertEqual([], snapshot.chains['vnic1.0-out'])
+        self.assertEqual(['-A FORWARD -m physdev --physdev-is-bridged -j sg-default'], snapshot.references)
+
+    def test_fingerprint(self):
+        fp = self._load(SAVE).fingerprint
+        self.assertEqual(fp, self._load(SAVE.replace('--dport 22', '--dport 23')).fingerprint)
+        self.assertNotEqual(fp, self._load(SAVE.replace('--dport 80', '--dport 81')).fingerprint)
+        self.assertNotEqual(fp, self._load(SAVE.replace('-A FORWARD -m physdev', '-A FORWARD -m foo')).fingerprint)
+
+if __name__ == "__main__":
+    unittest.main()
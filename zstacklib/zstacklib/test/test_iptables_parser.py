@@ -0,0 +1,81 @@
+'''
+
+@author: frank
+'''
+import unittest
+import mock
+from zstacklib.utils import iptables
+
+SAVE = '''# Generated by iptables-save
+*nat
+:PREROUTING ACCEPT [10:600]
+:POSTROUTING ACCEPT [0:0]
+-A POSTROUTING -s 10.0.0.0/24 -j MASQUERADE
+COMMIT
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:vm-1-vnc - [0:0]
+:vm-2-vnc - [0:0]
+-A INPUT -p tcp -m tcp --dport 5900 -j vm-1-vnc
+-A INPUT -p tcp -m tcp --dport 5901 -j vm-2-vnc
+-A vm-1-vnc -d 192.168.0.0/24 -j ACCEPT
+-A vm-1-vnc ! -d 192.168.0.0/24 -j REJECT --reject-with icmp-host-prohibited
+-A vm-2-vnc -d 192.168.0.0/24 -j ACCEPT
+COMMIT
+'''
+
+class TestIPTablesParser(unittest.TestCase):
+    def _load(self):
+        ipt = iptables.IPTables()
+        ipt._from_iptables_save(SAVE)
+        return ipt
+
+    def test_parse(self):
+        ipt = self._load()
+        self.assertEqual(':PREROUTING ACCEPT [10:600]', ipt.get_chain('PREROUTING', 'nat').counter_str)
+        self.assertEqual(2, len(ipt.get_chain('vm-1-vnc').children))
+        self.assertEqual(['*nat', '*filter'], [t.identity for t in ipt.children])
+        self.assertEqual(SAVE.split('\n', 1)[1].strip(), str(ipt).strip())
+
+    def test_unknown_line(self):
+        ipt = iptables.IPTables()
+        self.assertRaises(iptables.IPTablesError, ipt._from_iptables_save, '*filter\nfoo bar\nCOMMIT\n')
+
+    def test_search_by_identity(self):
+        ipt = self._load()
+        rule = '-A vm-2-vnc -d 192.168.0.0/24 -j ACCEPT'
+        self.assertEqual(rule, ipt.search_by_identity(rule).identity)
+        self.assertEqual(1, len(ipt.search_all_by_identity(rule)))
+        self.assertIsNone(ipt.search_by_identity('-A vm-3-vnc -j ACCEPT'))
+        self.assertEqual('*nat', ipt.search_by_identity('*nat').identity)
+
+        ipt.add_rule('-A vm-2-vnc -j REJECT')
+        self.assertTrue(ipt.search_by_identity('-A vm-2-vnc -j REJECT'))
+        ipt.delete_chain('vm-2-vnc')
+        self.assertIsNone(ipt.search_by_identity(rule))
+
+    def test_restore_modified_chains(self):
+        ipt = self._load()
+        self.assertFalse(ipt.get_chain('vm-1-vnc').modified)
+
+        for r in ipt.get_chain('INPUT').children[:]:
+            if ipt.is_target_in_rule(r.identity, 'vm-2-vnc'):
+                r.delete()
+        ipt.delete_chain('vm-2-vnc')
+        ipt.add_rule('-A vm-3-vnc -j ACCEPT')
+
+        with mock.patch.object(iptables, 'restore_chains_noflush') as restore:
+            ipt.iptable_restore_modified_chains()
+            chains, deleted, table_name = restore.call_args[0]
+            self.assertEqual(['INPUT', 'vm-3-vnc'], chains.keys())
+            self.assertEqual(['-A INPUT -p tcp -m tcp --dport 5900 -j vm-1-vnc'], chains['INPUT'])
+            self.assertEqual(['vm-2-vnc'], deleted)
+            self.assertEqual('filter', table_name)
+
+            restore.reset_mock()
+            ipt.iptable_restore_modified_chains()
+            self.assertFalse(restore.called)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,7 @@ import unittest
 import types
 import inspect
 from zstacklib.utils import jsonobject
+import simplejson
 
 class A(object):
     def __init__(self):
@@ -42,6 +43,18 @@ class Test(unittest.TestCase):
         print jb.xxxxx
         print jb.lst
 
+    def test_nested_objects_in_list(self):
+        jstr = '{"ruleTOs": [{"vmNicUuid": "nic1", "rules": [{"port": 22, "allowed": true}]}], "empty": {}}'
+        obj = jsonobject.loads(jstr)
+        self.assertTrue(isinstance(obj.ruleTOs[0], jsonobject.JsonObject))
+        self.assertEqual('nic1', obj.ruleTOs[0].vmNicUuid)
+        self.assertEqual(22, obj.ruleTOs[0].rules[0].port)
+        self.assertTrue(obj.ruleTOs[0].rules[0].allowed)
+        self.assertTrue(isinstance(obj.empty, jsonobject.JsonObject))
+        self.assertIsNone(obj.notExisting)
+        self.assertEqual('nic1', obj.ruleTOs[0].vmNicUuid_)
+        self.assertEqual(simplejson.loads(jstr), simplejson.loads(jsonobject.dumps(obj)))
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,140 @@
+'''
+
+@author: frank
+'''
+import json
+import unittest
+from zstacklib.utils import bash
+from zstacklib.utils import lvm
+
+VG = 'a1b2c3d4e5f6a7b8c9d0e1f2a3b4c5d6'
+
+class FakeLvm(object):
+    def __init__(self, json_report=True):
+        self.json_report = json_report
+        self.lvs = {}
+        self.cmds = []
+
+    def add(self, name, size, active=False, tags=()):
+        self.lvs[name] = dict(size=size, active=active, tags=list(tags))
+
+    def _report(self, target):
+        names = self.lvs.keys() if target == VG else [target.split('/')[-1]]
+        rows = []
+        for name in sorted(names):
+            lv = self.lvs[name]
+            rows.append(dict(lv_name=name, vg_name=VG, lv_uuid='uuid-' + name, lv_size=str(lv['size']),
+                             lv_active='active' if lv['active'] else '', lv_tags=','.join(lv['tags'])))
+        if self.json_report:
+            return json.dumps({'report': [{'lv': rows}]})
+        return ''.join('  %s\n' % '|'.join(r[f] for f in lvm.LVS_FIELDS.split(',')) for r in rows)
+
+    def bash_roe(self, cmd, errorout=False, ret_code=0, pipe_fail=False, ctx=None):
+        self.cmds.append(cmd)
+        args = cmd.split()
+        if args[0] == 'lvs':
+            if '--reportformat' in args and not self.json_report:
+                return 3, '', "lvs: unrecognized option '--reportformat'"
+            target = args[-1]
+            if target != VG and target.split('/')[-1] not in self.lvs:
+                return 5, '', 'Failed to find logical volume'
+            return 0, self._report(target), ''
+        if args[0] == 'lvchange':
+            for path in args[2:]:
+                self.lvs[path.split('/')[-1]]['active'] = args[1] != '-an'
+            return 0, '', ''
+        raise Exception('unexpected command %s' % cmd)
+
+    def lvs_calls(self):
+        return len([c for c in self.cmds if c.startswith('lvs')])
+
+def _path(name):
+    return '/dev/%s/%s' % (VG, name)
+
+class TestLvInventory(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeLvm()
+        self.orig_bash_roe = bash.bash_roe
+        bash.bash_roe = self.fake.bash_roe
+        lvm.inventory = lvm.LvInventory()
+
+    def tearDown(self):
+        bash.bash_roe = self.orig_bash_roe
+        lvm.inventory = lvm.LvInventory()
+
+    def test_lookups_share_one_lvs(self):
+        self.fake.add('root', 1 << 30, active=True, tags=['zs::sharedblock::volume'])
+        self.fake.add('data', 2 << 30)
+
+        self.assertTrue(lvm.lv_exists(_path('root')))
+        self.assertTrue(lvm.lv_is_active(_path('root')))
+        self.assertFalse(lvm.lv_is_active(_path('data')))
+        self.assertEqual(str(2 << 30), lvm.get_lv_size('%s/data' % VG))
+        self.assertEqual('uuid-root', lvm.lv_uuid(_path('root')))
+        self.assertTrue(lvm.has_lv_tag(_path('root'), 'zs::sharedblock::volume'))
+        self.assertFalse(lvm.has_lv_tag(_path('data'), 'zs::sharedblock::volume'))
+        self.assertEqual([_path('root')], lvm.list_local_active_lvs(VG))
+        self.assertEqual(1, self.fake.lvs_calls())
+
+    def test_miss_reloads_once(self):
+        self.fake.add('root', 1 << 30)
+        self.assertTrue(lvm.lv_exists(_path('root')))
+        # created by another host
+        self.fake.add('new', 1 << 30)
+        self.assertTrue(lvm.lv_exists(_path('new')))
+        self.assertFalse(lvm.lv_exists(_path('nothing')))
+        self.assertEqual(3, self.fake.lvs_calls())
+        self.assertEqual('', lvm.lv_uuid(_path('nothing')))
+        self.assertRaises(Exception, lvm.get_lv_size, _path('nothing'))
+
+    def test_ttl(self):
+        lvm.inventory = lvm.LvInventory(ttl=0)
+        self.fake.add('root', 1 << 30)
+        lvm.get_lv_size(_path('root'))
+        self.fake.lvs['root']['size'] = 3 << 30
+        self.assertEqual(str(3 << 30), lvm.get_lv_size(_path('root')))
+
+    def test_invalidated_by_lvchange(self):
+        self.fake.add('root', 1 << 30)
+        lvm.active_lv(_path('root'), shared=True)
+        self.assertTrue(lvm.lv_is_active(_path('root')))
+        lvm.deactive_lv(_path('root'))
+        self.assertFalse(lvm.lv_is_active(_path('root')))
+        # an lvs started before the change is not kept
+        inventory = lvm.inventory
+        orig_lvs = inventory._lvs
+
+        def changed_while_loading(target):
+            lvs = orig_lvs(target)
+            inventory.invalidate(_path('root'))
+            return lvs
+        inventory._lvs = changed_while_loading
+        inventory.invalidate()
+        inventory.get(_path('root'))
+        self.assertEqual({}, inventory.vgs)
+
+    def test_batch(self):
+        names = ['v%d' % i for i in range(10)]
+        for name in names:
+            self.fake.add(name, 1 << 30)
+        paths = [_path(n) for n in names]
+
+        lvm.active_lvs(paths, shared=True)
+        self.assertEqual(paths, [c for c in self.fake.cmds if c.startswith('lvchange')][0].split()[2:])
+        self.assertEqual(sorted(paths), lvm.list_local_active_lvs(VG))
+
+        self.fake.cmds = []
+        lvm.deactive_lvs(paths[:5] + [_path('nothing')])
+        self.assertEqual(['lvchange -an %s' % ' '.join(paths[:5])], [c for c in self.fake.cmds if c.startswith('lvchange')])
+        self.assertEqual(sorted(paths[5:]), lvm.list_local_active_lvs(VG))
+        self.assertEqual(2, self.fake.lvs_calls())
+
+    def test_plain_report(self):
+        self.fake.json_report = False
+        self.fake.add('root', 1 << 30, active=True, tags=['a', 'b'])
+        self.assertTrue(lvm.has_lv_tag(_path('root'), 'b'))
+        self.assertFalse(lvm.inventory.json_report)
+        self.assertTrue(lvm.lv_is_active(_path('root')))
+
+if __name__ == "__main__":
+    unittest.main()
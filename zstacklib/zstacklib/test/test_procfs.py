@@ -0,0 +1,78 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from zstacklib.utils import linux
+from zstacklib.utils import procfs
+
+VM_UUID = '8b1f4e3c5a2d4e6f9a0b1c2d3e4f5a6b'
+
+class TestProcfs(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _proc(self, pid, args, comm='x'):
+        os.makedirs(os.path.join(self.workdir, pid))
+        with open(os.path.join(self.workdir, pid, 'cmdline'), 'w') as fd:
+            fd.write('\0'.join(args) + '\0' if args else '')
+        with open(os.path.join(self.workdir, pid, 'stat'), 'w') as fd:
+            fd.write('%s (%s) S %s\n' % (pid, comm, ' '.join(['0'] * 18 + ['500'])))
+
+    def test_table(self):
+        self._proc('100', ['/usr/libexec/qemu-kvm', '-name', 'guest=%s,debug-threads=on' % VM_UUID])
+        self._proc('101', ['/usr/bin/qemu-system-x86_64', '-name', 'ZStack Management Node VM'])
+        self._proc('102', ['/usr/sbin/dnsmasq', '--conf-file=/var/lib/zstack/dnsmasq/br_eth0_100/dnsmasq.conf'],
+                   comm='dnsmasq (x)')
+        self._proc('103', [])
+        os.makedirs(os.path.join(self.workdir, 'self'))
+
+        table = procfs.scan(self.workdir)
+        self.assertEqual(['100', '101', '102'], sorted(p.pid for p in table.processes))
+        self.assertEqual({VM_UUID: ['100']}, table.get_qemu_vm_pids())
+        self.assertEqual(sorted([VM_UUID, 'ZStack Management Node VM']), sorted(table.get_qemu_vm_names()))
+        self.assertEqual(['102'], [p.pid for p in table.find_by_exe('dnsmasq')])
+        self.assertEqual(['101'], [p.pid for p in table.find_by_token('-name') if 'system' in p.exe])
+        self.assertEqual(['100'], [p.pid for p in table.find('qemu', VM_UUID)])
+
+        dnsmasq = table.get(102)
+        self.assertTrue(dnsmasq.has_words('dnsmasq', 'br_eth0_100'))
+        self.assertFalse(dnsmasq.has_words('br_eth0'))
+        self.assertEqual('dnsmasq (x)', dnsmasq.comm)
+        self.assertEqual(500.0 / procfs.CLOCK_TICKS, dnsmasq.start_time)
+
+    def test_cache(self):
+        self._proc('100', ['sleep', '1'])
+        cache = procfs.ProcessTableCache(ttl=10, proc_dir=self.workdir)
+        table = cache.get()
+        self._proc('101', ['sleep', '2'])
+        self.assertIs(table, cache.get())
+        self.assertEqual(['100', '101'], sorted(cache.get(force=True).by_pid.keys()))
+
+    def test_live_process(self):
+        marker = 'procfs-test-%s' % time.time()
+        # sleep rejects extra arguments, python ignores them
+        p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)', marker], close_fds=True)
+        try:
+            # not in the cached table yet
+            procfs.get_process_table(force=True)
+            self.assertEqual(str(p.pid), linux.find_process_by_cmdline(['time.sleep', marker]))
+            self.assertEqual(p.pid, linux.get_pid_by_process_param(marker))
+            self.assertTrue(0 <= linux.get_process_up_time_in_second(p.pid) < 30)
+        finally:
+            p.kill()
+            p.wait()
+
+        self.assertIsNone(linux.find_process_by_cmdline(['time.sleep', marker]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+'''
+
+@author: frank
+'''
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+from zstacklib.utils import linux
+from zstacklib.utils import qcow2
+
+def make_qcow2(path, virtual_size, backing_file=None, backing_format=None, version=3, cluster_bits=16):
+    header_length = 104 if version == 3 else 72
+    exts = ''
+    if backing_format:
+        data = backing_format + '\0' * ((8 - len(backing_format) % 8) % 8)
+        exts += struct.pack('>II', qcow2.EXT_BACKING_FORMAT, len(backing_format)) + data
+    exts += struct.pack('>II', qcow2.EXT_END, 0)
+
+    backing_offset = header_length + len(exts) if backing_file else 0
+    header = 'QFI\xfb' + struct.pack('>IQIIQ', version, backing_offset, len(backing_file or ''), cluster_bits, virtual_size)
+    header += '\0' * (72 - len(header))
+    if version == 3:
+        header += '\0' * 28 + struct.pack('>I', header_length)
+
+    with open(path, 'w') as fd:
+        fd.write(header + exts + (backing_file or ''))
+        fd.write('\0' * (1 << cluster_bits) * 3)
+
+class TestQcow2(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        qcow2.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def test_read_header(self):
+        make_qcow2(self._path('base.qcow2'), 10 << 30, version=2, cluster_bits=12)
+        make_qcow2(self._path('top.qcow2'), 20 << 30, 'base.qcow2', 'qcow2')
+
+        info = qcow2.get_info(self._path('base.qcow2'))
+        self.assertEqual(('qcow2', 2, 10 << 30, 4096, None), (info.format, info.version, info.virtual_size, info.cluster_size, info.backing_file))
+
+        info = qcow2.get_info(self._path('top.qcow2'))
+        self.assertEqual(('qcow2', 3, 20 << 30, 65536), (info.format, info.version, info.virtual_size, info.cluster_size))
+        self.assertEqual(('base.qcow2', 'qcow2'), (info.backing_file, info.backing_format))
+        self.assertEqual(self._path('base.qcow2'), info.get_backing_path())
+
+    def test_raw_and_other_formats(self):
+        with open(self._path('raw'), 'w') as fd:
+            fd.write('x' * 12345)
+        with open(self._path('vmdk'), 'w') as fd:
+            fd.write('KDMV' + '\0' * 1000)
+
+        info = qcow2.get_info(self._path('raw'))
+        self.assertEqual(('raw', 12345), (info.format, info.virtual_size))
+        self.assertIsNone(qcow2.get_info(self._path('vmdk')))
+        self.assertIsNone(qcow2.get_info(self._path('nothing')))
+
+    def test_chain(self):
+        make_qcow2(self._path('a.qcow2'), 1 << 30)
+        make_qcow2(self._path('b.qcow2'), 1 << 30, self._path('a.qcow2'))
+        make_qcow2(self._path('c.qcow2'), 1 << 30, 'b.qcow2')
+        make_qcow2(self._path('d.qcow2'), 1 << 30, 'missing.qcow2')
+
+        chain = [self._path('c.qcow2'), self._path('b.qcow2'), self._path('a.qcow2')]
+        self.assertEqual(chain, qcow2.get_chain(self._path('c.qcow2')))
+        self.assertEqual(chain, linux.qcow2_get_file_chain(self._path('c.qcow2')))
+        self.assertEqual(sum(os.path.getsize(p) for p in chain), linux.get_qcow2_file_chain_size(self._path('c.qcow2')))
+        self.assertIsNone(qcow2.get_chain(self._path('d.qcow2')))
+
+        make_qcow2(self._path('a.qcow2'), 1 << 30, 'c.qcow2')
+        self.assertRaises(Exception, qcow2.get_chain, self._path('c.qcow2'))
+
+    def test_cache(self):
+        path = self._path('a.qcow2')
+        make_qcow2(path, 1 << 30)
+        info = qcow2.get_info(path)
+        self.assertIs(info, qcow2.get_info(path))
+
+        make_qcow2(path, 2 << 30, 'base.qcow2')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 1))
+        self.assertEqual(2 << 30, qcow2.get_info(path).virtual_size)
+        self.assertEqual('base.qcow2', linux.qcow2_get_backing_file(path))
+
+    def test_linux_helpers(self):
+        make_qcow2(self._path('base.qcow2'), 5 << 30)
+        os.makedirs(self._path('vol'))
+        make_qcow2(self._path('vol/root.qcow2'), 8 << 30, self._path('base.qcow2'))
+
+        self.assertEqual(8 << 30, linux.qcow2_virtualsize(self._path('vol/root.qcow2')))
+        self.assertEqual((8 << 30, os.path.getsize(self._path('vol/root.qcow2'))),
+                         linux.qcow2_size_and_actual_size(self._path('vol/root.qcow2')))
+        self.assertEqual('qcow2', linux.get_img_fmt(self._path('base.qcow2')))
+        self.assertEqual('', linux.qcow2_get_backing_file(self._path('base.qcow2')))
+        self.assertEqual(os.path.realpath(self._path('base.qcow2')),
+                         linux.get_qcow2_base_image_recusively(self._path('vol'), self.workdir))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+'''
+
+@author: frank
+'''
+import threading
+import time
+import unittest
+from zstacklib.utils import report
+
+class FakeServer(object):
+    def __init__(self):
+        self.posts = []
+        self.down = False
+        self.down_urls = set()
+        self.lock = threading.Lock()
+
+    def post(self, url, cmd, header):
+        if self.down or url in self.down_urls:
+            raise Exception('connection refused')
+        with self.lock:
+            self.posts.append((url, cmd, header))
+
+    def progresses(self, uuid=None):
+        ret = []
+        for _, cmd, _ in self.posts:
+            if uuid is None or cmd.resourceUuid == uuid:
+                ret.append(cmd.progress)
+        return ret
+
+class TestProgressReporter(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.reporter = report.ProgressReporter(self.server.post, interval=0.05, idle_timeout=0.2)
+        self.orig_reporter = report.reporter
+        self.orig_url = report.Report.url
+        report.reporter = self.reporter
+        report.Report.url = 'http://127.0.0.1:8080/zstack/progress'
+
+    def tearDown(self):
+        report.reporter = self.orig_reporter
+        report.Report.url = self.orig_url
+
+    def _report(self, uuid):
+        r = report.Report({'api': uuid}, [])
+        r.processType = 'LocalStorageMigrateVolume'
+        r.resourceUuid = uuid
+        return r
+
+    def test_coalesce(self):
+        # flushed here instead of by a sender thread racing with the reports
+        self.reporter.sender = threading.current_thread()
+        r = self._report('vol1')
+        r.progress_report("0", "start")
+        for p in range(1, 100):
+            r.progress_report(str(p), "report")
+        r.progress_report("100", "finish")
+        self.assertTrue(self.reporter.flush())
+
+        # the reports are replaced by the finish before being sent
+        self.assertEqual(['0', '100'], self.server.progresses())
+        self.assertEqual({'commandpath': report.PROGRESS_REPORT_PATH}, self.server.posts[0][2])
+
+    def test_latest_value_per_flush(self):
+        self.reporter.sender = threading.current_thread()
+        r = self._report('vol1')
+        for p in range(10):
+            r.progress_report(str(p), "report")
+        self.reporter.flush()
+        r.progress_report("50", "report")
+        r.progress_report("60", "report")
+        self.reporter.flush()
+        self.assertEqual(['9', '60'], self.server.progresses())
+
+    def test_start_and_finish_resent(self):
+        self.server.down = True
+        r = self._report('vol1')
+        r.progress_report("0", "start")
+        r.progress_report("30", "report")
+        time.sleep(0.2)
+        r.progress_report("100", "finish")
+        time.sleep(0.2)
+        self.assertEqual([], self.server.posts)
+
+        self.server.down = False
+        time.sleep(0.2)
+        self.assertEqual(['0', '100'], self.server.progresses())
+
+    def test_unreachable_destination(self):
+        url = report.Report.url
+        down = 'http://127.0.0.2:8080/zstack/progress'
+        self.server.down_urls.add(down)
+        report.Report.url = down
+        self._report('vol2').progress_report("0", "start")
+        report.Report.url = url
+        self._report('vol1').progress_report("0", "start")
+        time.sleep(0.2)
+        # the reports to the other destination are not held back
+        self.assertEqual(['0'], self.server.progresses('vol1'))
+        self.assertEqual([], self.server.progresses('vol2'))
+
+        self.server.down_urls.clear()
+        time.sleep(0.2)
+        self.assertEqual(['0'], self.server.progresses('vol2'))
+
+    def test_sender_exits_when_idle(self):
+        self._report('vol1').progress_report("1", "report")
+        time.sleep(0.1)
+        self.assertIsNotNone(self.reporter.sender)
+        time.sleep(0.4)
+        self.assertIsNone(self.reporter.sender)
+
+        self._report('vol1').progress_report("2", "report")
+        time.sleep(0.1)
+        self.assertEqual(['1', '2'], self.server.progresses())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+'''
+
+@author: frank
+'''
+import os
+import threading
+import unittest
+from zstacklib.utils import bash
+from zstacklib.utils import shell
+from zstacklib.utils import shellpool
+
+class TestShellPool(unittest.TestCase):
+    def test_return_code_stdout_stderr(self):
+        pool = shellpool.BashWorkerPool(1)
+        self.assertEqual((0, 'hello\n', ''), pool.run('echo hello'))
+        self.assertEqual((3, 'out', 'err\n'), pool.run('echo -n out; echo err >&2; exit 3'))
+        self.assertEqual((0, 'a\n\nb\n', ''), pool.run("printf 'a\\n\\nb\\n'"))
+        r, o, e = pool.run('if then')
+        self.assertEqual(2, r)
+        self.assertIn('syntax error', e)
+
+    def test_worker_state_not_shared(self):
+        pool = shellpool.BashWorkerPool(1)
+        pool.run('cd /; X=1; set -e; false')
+        r, o, _ = pool.run('echo $PWD $X; false; echo still')
+        self.assertEqual(0, r)
+        self.assertEqual('%s\nstill\n' % os.getcwd(), o)
+        self.assertEqual((0, '/tmp\n', ''), pool.run('pwd', '/tmp'))
+
+    def test_large_output(self):
+        pool = shellpool.BashWorkerPool(1)
+        r, o, e = pool.run('head -c 1000000 /dev/zero | tr "\\0" a; seq 1 20000 >&2')
+        self.assertEqual(1000000, len(o))
+        self.assertEqual(20000, len(e.split()))
+
+    def test_busy_pool(self):
+        pool = shellpool.BashWorkerPool(1)
+        worker = pool._acquire()
+        self.assertIsNone(pool.run('true'))
+        pool._release(worker)
+        self.assertEqual(0, pool.run('true')[0])
+
+    def test_dead_worker(self):
+        pool = shellpool.BashWorkerPool(1)
+        self.assertRaises(shellpool.WorkerError, pool.run, 'kill -9 $$')
+        self.assertEqual((0, 'ok\n', ''), pool.run('echo ok'))
+
+    def test_background_job_not_pooled(self):
+        self.assertIsNone(shellpool.run('sleep 1 &'))
+        self.assertTrue(shellpool.run('true && echo 2>&1 &>/dev/null'))
+
+    def test_concurrent(self):
+        results = []
+        def run(i):
+            results.append(shell.call('echo %s' % i).strip() == str(i))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(32)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([True] * 32, results)
+
+    def test_bash_roe(self):
+        name = 'world'
+        self.assertEqual((0, 'hello world\n', None), bash.bash_roe('echo hello {{name}}'))
+        self.assertEqual((1, '', None), bash.bash_roe('false | true; exit 1', ret_code=1))
+        self.assertEqual(1, bash.bash_r('false | true', pipe_fail=True))
+        self.assertEqual('x\n', bash.bash_roe('echo {{v}}', ctx={'v': 'x'})[1])
+        self.assertRaises(bash.BashError, bash.bash_errorout, 'exit 2')
+
+    def test_shell_call(self):
+        self.assertEqual('a\n', shell.call('echo a'))
+        self.assertRaises(shell.ShellError, shell.call, 'exit 1')
+        self.assertEqual('', shell.call('exit 1', False))
+
+    def test_command_stats(self):
+        shellpool.reset_command_stats()
+        bash.bash_r('set -o pipefail; true')
+        shell.call('LANG=C /bin/true')
+        stats = shellpool.get_command_stats()
+        self.assertEqual(2, stats['true']['count'])
+        self.assertEqual(2, sum(stats['true']['histogram'].values()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+'''
+
+@author: frank
+'''
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from zstacklib.utils import taskregistry
+
+class _Task(object):
+    def __init__(self, name, completed=False, last_active=None):
+        self.name = name
+        self.completed = completed
+        self.last_active = last_active or time.time()
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @staticmethod
+    def from_dict(d):
+        t = _Task(d['name'])
+        t.__dict__.update(d)
+        return t
+
+def _registry(**kwargs):
+    return taskregistry.TaskRegistry(lambda t: t.completed, lambda t: t.last_active,
+                                     to_dict=_Task.to_dict, from_dict=_Task.from_dict, **kwargs)
+
+class TestTaskRegistry(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_live_tasks_are_not_capped(self):
+        r = _registry(max_finished=10)
+        for i in range(1000):
+            r.add(i, _Task(i))
+        self.assertEqual(1000, r.live_count())
+        self.assertEqual(0, r.get(0).name)
+
+    def test_finished_generation_is_bounded(self):
+        r = _registry(max_finished=10)
+        for i in range(100):
+            r.add(i, _Task(i))
+        for i in range(100):
+            r.get(i).completed = True
+            r.get(i)
+
+        self.assertEqual(0, r.live_count())
+        self.assertEqual(10, r.finished_count())
+        self.assertIsNone(r.get(0))
+        self.assertEqual(99, r.get(99).name)
+
+    def test_ttl(self):
+        r = _registry(live_ttl=0.2, finished_ttl=0.2)
+        r.add('idle', _Task('idle'))
+        r.add('active', _Task('active'))
+        r.add('done', _Task('done', completed=True))
+        self.assertTrue(r.get('done').completed)
+
+        time.sleep(0.15)
+        r.get('active').last_active = time.time()
+        time.sleep(0.15)
+        r.add('new', _Task('new'))
+
+        self.assertIsNone(r.get('idle'))
+        self.assertIsNone(r.get('done'))
+        self.assertEqual('active', r.get('active').name)
+
+    def test_snapshot(self):
+        path = os.path.join(self.workdir, 'sub', 'tasks.json')
+        r = _registry(snapshot_path=path)
+        r.add('a', _Task('a'))
+        r.add('b', _Task('b', completed=True))
+        r.get('b')
+
+        r = _registry(snapshot_path=path)
+        self.assertEqual(1, r.live_count())
+        self.assertEqual(1, r.finished_count())
+        self.assertTrue(r.get('b').completed)
+
+        with open(path, 'w') as fd:
+            fd.write('{')
+        self.assertEqual(0, _registry(snapshot_path=path).live_count())
+
+    def test_lock_of(self):
+        r = _registry()
+        self.assertIs(r.lock_of('a'), r.lock_of('a'))
+        self.assertEqual(taskregistry.LOCK_STRIPES, len(set(r.lock_of(i) for i in range(1000))))
+
+if __name__ == "__main__":
+    unittest.main()
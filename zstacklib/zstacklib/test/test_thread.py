@@ -7,6 +7,8 @@ import time
 import threading
 from ..utils.thread import ThreadFacade
 from ..utils.thread import AsyncThread
+from ..utils.thread import Executor
+from ..utils import thread
 
 
 class TestThreadFacade(unittest.TestCase):
@@ -34,6 +36,117 @@ class TestThreadFacade(unittest.TestCase):
         self.assertEqual("ok", self.async_ok)
         self.assertEqual("world", self.async_value)
 
+class TestExecutor(unittest.TestCase):
+    def test_concurrency_limit_and_urgent_lane(self):
+        executor = Executor()
+        executor.set_concurrency_limit('/storage/job', 2)
+        release = threading.Event()
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0, 'done': 0}
+
+        def job():
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            release.wait(5)
+            with lock:
+                state['running'] -= 1
+                state['done'] += 1
+
+        for i in range(6):
+            executor.submit(job, key='/storage/job')
+
+        pinged = threading.Event()
+        executor.submit(pinged.set, lane=thread.URGENT_LANE)
+        self.assertTrue(pinged.wait(5))
+        self.assertEqual(4, executor.get_metrics()['keys']['/storage/job']['pending'])
+        for i in range(50):
+            if state['running'] == 2:
+                break
+            time.sleep(0.1)
+
+        release.set()
+        for i in range(50):
+            if executor.get_metrics()['lanes'][thread.DEFAULT_LANE]['completed'] == 6:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(6, state['done'])
+        self.assertEqual(2, state['max'])
+        self.assertEqual(6, executor.get_metrics()['lanes'][thread.DEFAULT_LANE]['completed'])
+
+    def test_bulk_lane(self):
+        executor = Executor()
+        executor.add_lane(thread.BULK_LANE, 2)
+        release = threading.Event()
+        for i in range(5):
+            executor.submit(release.wait, (5,), lane=thread.BULK_LANE)
+
+        # long jobs filling their lane do not hold back the other requests
+        started = threading.Event()
+        executor.submit(started.set)
+        self.assertTrue(started.wait(5))
+        for i in range(50):
+            bulk = executor.get_metrics()['lanes'][thread.BULK_LANE]
+            if bulk['active'] == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(2, bulk['workers'])
+        self.assertEqual(3, bulk['queueDepth'])
+        release.set()
+
+    def test_put_while_worker_takes_task(self):
+        lane = thread.ExecutorLane('test', 2)
+        taken = threading.Event()
+        go_on = threading.Event()
+        get = lane.queue.get
+        def get_and_pause(*args, **kwargs):
+            task = get(*args, **kwargs)
+            if not taken.is_set():
+                # the worker has the task but has not counted itself busy yet
+                taken.set()
+                go_on.wait(5)
+            return task
+        lane.queue.get = get_and_pause
+
+        second = threading.Event()
+        state = {}
+        def first():
+            state['waited'] = second.wait(5)
+        done = threading.Event()
+        def finish(task):
+            if task.func == first:
+                done.set()
+
+        lane.put(thread._Task(first, (), {}, None, finish))
+        self.assertTrue(taken.wait(5))
+        lane.put(thread._Task(second.set, (), {}, None, finish))
+        go_on.set()
+        self.assertTrue(done.wait(10))
+        self.assertTrue(state['waited'])
+        self.assertEqual(2, lane.get_metrics()['workers'])
+
+class TestRunParallel(unittest.TestCase):
+    def test_run_parallel(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0, 'done': []}
+        def run(i):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+                state['done'].append(i)
+
+        thread.run_parallel(run, range(8), 3)
+        self.assertEqual(range(8), sorted(state['done']))
+        self.assertEqual(3, state['max'])
+
+        def fail(i):
+            raise ValueError(i)
+        self.assertRaises(ValueError, thread.run_parallel, fail, range(8), 2)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -1,13 +1,17 @@
 import subprocess
 import functools
 import json
+import os
 from jinja2 import Template
 from zstacklib.utils import log
 import inspect
 import time
 import re
+import sys
+import threading
 from progress_report import WatchThread_1
 from zstacklib.utils import linux
+from zstacklib.utils import shellpool
 
 logger = log.get_logger(__name__)
 
@@ -28,12 +32,30 @@ def __collect_locals_on_stack():
     return ctx
 
 
+MAX_CACHED_TEMPLATES = 4096
+
+# raw string -> (unresolved symbols, compiled template)
+_templates = {}
+
+def _get_template(raw_str):
+    t = _templates.get(raw_str)
+    if t is None:
+        unresolved = re.findall('{{(.+?)}}', raw_str)
+        t = (unresolved, Template(raw_str) if unresolved else None)
+        if len(_templates) >= MAX_CACHED_TEMPLATES:
+            _templates.clear()
+        _templates[raw_str] = t
+    return t
+
 def bash_eval(raw_str, ctx=None):
-    if not ctx:
+    if '{{' not in raw_str:
+        return raw_str
+
+    if ctx is None:
         ctx = __collect_locals_on_stack()
 
     while True:
-        unresolved = re.findall('{{(.+?)}}', raw_str)
+        unresolved, tmpt = _get_template(raw_str)
         if not unresolved:
             break
 
@@ -41,27 +63,108 @@ def bash_eval(raw_str, ctx=None):
             if u not in ctx:
                 raise Exception('unresolved symbol {{%s}}' % u)
 
-        tmpt = Template(raw_str)
         raw_str = tmpt.render(ctx)
+        if '{{' not in raw_str:
+            break
 
     return raw_str
 
+class CallSiteStats(object):
+    def __init__(self, site):
+        self.site = site
+        self.count = 0
+        # calls resolving their symbols from the locals on the stack instead of a ctx
+        self.stack_walks = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def to_dict(self):
+        return {
+            'site': self.site,
+            'count': self.count,
+            'stackWalks': self.stack_walks,
+            'totalTime': self.total_time,
+            'avgTime': self.total_time / self.count if self.count else 0,
+            'maxTime': self.max_time
+        }
+
+MAX_PROFILED_CALL_SITES = 4096
+
+_profiler_enabled = False
+_call_sites = {}
+_call_sites_lock = threading.Lock()
+
+def enable_profiler(enabled=True):
+    '''records the count and the cost of bash_xxx() calls per call site'''
+    global _profiler_enabled
+    _profiler_enabled = enabled
+
+def reset_profiler():
+    with _call_sites_lock:
+        _call_sites.clear()
+
+def _get_call_site():
+    frame = sys._getframe(2)
+    while frame and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if not frame:
+        return 'unknown'
+    return '%s:%s' % (frame.f_code.co_filename, frame.f_lineno)
+
+def _profile(site, start_time, stack_walk):
+    cost = (time.time() - start_time) * 1000
+    with _call_sites_lock:
+        s = _call_sites.get(site)
+        if s is None:
+            if len(_call_sites) >= MAX_PROFILED_CALL_SITES:
+                return
+            s = _call_sites[site] = CallSiteStats(site)
+        s.count += 1
+        s.total_time += cost
+        s.max_time = max(s.max_time, cost)
+        if stack_walk:
+            s.stack_walks += 1
+
+# @return: the top call sites by total time in milliseconds and by count
+def get_profile(top=20):
+    with _call_sites_lock:
+        stats = [s.to_dict() for s in _call_sites.values()]
+
+    return {
+        'slowest': sorted(stats, key=lambda s: s['totalTime'], reverse=True)[:top],
+        'mostFrequent': sorted(stats, key=lambda s: s['count'], reverse=True)[:top]
+    }
+
+# commands run inside @in_bash functions of this thread are logged by them
+_debug_info = threading.local()
+
 # @return: return code, stdout, stderr
-def bash_roe(cmd, errorout=False, ret_code = 0, pipe_fail=False):
-    ctx = __collect_locals_on_stack()
+# ctx: symbols of the command, the locals on the stack are used if not given
+def bash_roe(cmd, errorout=False, ret_code = 0, pipe_fail=False, ctx=None):
+    site = _get_call_site() if _profiler_enabled else None
+    stack_walk = ctx is None and '{{' in cmd
 
+    start_time = time.time()
     cmd = bash_eval(cmd, ctx)
-    p = subprocess.Popen('/bin/bash', stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
     if pipe_fail:
         cmd = 'set -o pipefail; %s' % cmd
-    o, e = p.communicate(cmd)
-    r = p.returncode
 
-    __BASH_DEBUG_INFO__ = ctx.get('__BASH_DEBUG_INFO__')
-    if __BASH_DEBUG_INFO__ is not None:
-        __BASH_DEBUG_INFO__.append({
+    ret = shellpool.run(cmd)
+    if ret:
+        r, o, e = ret
+    else:
+        p = subprocess.Popen('/bin/bash', stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        o, e = p.communicate(cmd)
+        r = p.returncode
+    shellpool.record(cmd, start_time)
+    if site:
+        _profile(site, start_time, stack_walk)
+
+    infos = getattr(_debug_info, 'stack', None)
+    if infos:
+        infos[-1].append({
             'cmd': cmd,
-            'return_code': p.returncode,
+            'return_code': r,
             'stdout': o,
             'stderr': e
         })
@@ -74,23 +177,23 @@ def bash_roe(cmd, errorout=False, ret_code = 0, pipe_fail=False):
     return r, o, e
 
 # @return: return code, stdout
-def bash_ro(cmd, pipe_fail=False):
-    ret, o, _ = bash_roe(cmd, pipe_fail=pipe_fail)
+def bash_ro(cmd, pipe_fail=False, ctx=None):
+    ret, o, _ = bash_roe(cmd, pipe_fail=pipe_fail, ctx=ctx)
     return ret, o
 
 # @return: stdout
-def bash_o(cmd, pipe_fail=False):
-    _, o, _ = bash_roe(cmd, pipe_fail=pipe_fail)
+def bash_o(cmd, pipe_fail=False, ctx=None):
+    _, o, _ = bash_roe(cmd, pipe_fail=pipe_fail, ctx=ctx)
     return o
 
 # @return: return code
-def bash_r(cmd, pipe_fail=False):
-    ret, _, _ = bash_roe(cmd, pipe_fail=pipe_fail)
+def bash_r(cmd, pipe_fail=False, ctx=None):
+    ret, _, _ = bash_roe(cmd, pipe_fail=pipe_fail, ctx=ctx)
     return ret
 
 # @return: stdout
-def bash_errorout(cmd, code=0, pipe_fail=False):
-    _, o, _ = bash_roe(cmd, errorout=True, ret_code=code, pipe_fail=pipe_fail)
+def bash_errorout(cmd, code=0, pipe_fail=False, ctx=None):
+    _, o, _ = bash_roe(cmd, errorout=True, ret_code=code, pipe_fail=pipe_fail, ctx=ctx)
     return o
 
 def bash_progress_1(cmd, func, errorout=True):
@@ -106,19 +209,190 @@ def bash_progress_1(cmd, func, errorout=True):
     finally:
         watch_thread.stop()
 
+# progress lines of the tools are ended by \r or \n
+_PROGRESS_LINE_END = re.compile('[\r\n]')
+_PERCENT = re.compile(r'(\d+(?:\.\d+)?)%')
+_WGET_DOTS = re.compile(r'^\s*(\d+)K ([. ]+)\s+(\d+)%')
+_WGET_BAR = re.compile(r'(\d+)%\s*\[[^\]]*\]\s+([\d,]+)\s')
+_RSYNC = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s')
+_QEMU_IMG = re.compile(r'^\s*\((\d+(?:\.\d+)?)/100%\)')
+
+# bytes kept of the output which is not progress
+PROGRESS_OUTPUT_LIMIT = 64 * 1024
+
+# the parsers return (bytes done or None, percent or None), or None if the line is not progress
+
+def parse_pv_progress(line):
+    '''pv -n'''
+    line = line.strip()
+    if line.isdigit():
+        return None, float(line)
+
+def parse_pv_bytes_progress(line):
+    '''pv -n -b'''
+    line = line.strip()
+    if line.isdigit():
+        return long(line), None
+
+def parse_wget_progress(line):
+    m = _WGET_DOTS.match(line)
+    if m:
+        return (long(m.group(1)) + m.group(2).count('.')) * 1024, float(m.group(3))
+    m = _WGET_BAR.search(line)
+    if m:
+        return long(m.group(2).replace(',', '')), float(m.group(1))
+    m = _PERCENT.search(line)
+    if m and '[' in line:
+        return None, float(m.group(1))
+
+def parse_rsync_progress(line):
+    '''rsync --progress'''
+    m = _RSYNC.match(line)
+    if m:
+        return long(m.group(1).replace(',', '')), float(m.group(2))
+
+def parse_qemu_img_progress(line):
+    '''qemu-img -p'''
+    m = _QEMU_IMG.match(line)
+    if m:
+        return None, float(m.group(1))
+
+def parse_percent_progress(line):
+    '''the last percent of the line, e.g. rbd'''
+    m = _PERCENT.findall(line)
+    if m:
+        return None, float(m[-1])
+
+PROGRESS_PARSERS = {
+    'pv': parse_pv_progress,
+    'pv-bytes': parse_pv_bytes_progress,
+    'wget': parse_wget_progress,
+    'rsync': parse_rsync_progress,
+    'qemu-img': parse_qemu_img_progress,
+    'percent': parse_percent_progress
+}
+
+class CommandProgress(object):
+    def __init__(self, total=None):
+        self.total = total
+        self.bytes = 0
+        self.percent = None
+        self.start_time = time.time()
+        self.update_time = self.start_time
+
+    def update(self, done, percent):
+        if done is None and percent is not None and self.total:
+            done = long(self.total * percent / 100)
+        if percent is None and done is not None and self.total:
+            percent = min(100.0, float(done) * 100 / self.total)
+
+        changed = (done is not None and done != self.bytes) or percent != self.percent
+        if done is not None:
+            self.bytes = done
+        self.percent = percent
+        self.update_time = time.time()
+        return changed
+
+    @property
+    def throughput(self):
+        '''bytes per second'''
+        elapsed = self.update_time - self.start_time
+        return self.bytes / elapsed if elapsed > 0 else 0
+
+def _read_progress(fd, parse, progress, callback):
+    kept = []
+    kept_size = [0]
+
+    def handle(line):
+        parsed = parse(line) if line.strip() else None
+        if parsed is None:
+            if line and kept_size[0] < PROGRESS_OUTPUT_LIMIT:
+                kept.append(line + '\n')
+                kept_size[0] += len(line) + 1
+            return
+
+        if progress.update(*parsed) and callback:
+            try:
+                callback(progress)
+            except Exception:
+                logger.warn(linux.get_exception_stacktrace())
+
+    buf = ''
+    while True:
+        data = os.read(fd.fileno(), 4096)
+        if not data:
+            break
+        lines = _PROGRESS_LINE_END.split(buf + data)
+        buf = lines.pop()
+        for line in lines:
+            handle(line)
+    handle(buf)
+    return ''.join(kept)
+
+# @return: return code, stdout, stderr
+# parser: a name in PROGRESS_PARSERS or a function, applied to each line of progress_stream
+# callback: called with the CommandProgress when it changes, in the thread reading the output
+def bash_progress(cmd, parser, callback=None, total=None, progress_stream='stderr', errorout=False, ret_code=0,
+                  pipe_fail=False, ctx=None):
+    cmd = bash_eval(cmd, ctx)
+    if pipe_fail:
+        cmd = 'set -o pipefail; %s' % cmd
+    logger.debug(cmd)
+
+    parse = PROGRESS_PARSERS[parser] if isinstance(parser, basestring) else parser
+    progress = CommandProgress(total)
+
+    start_time = time.time()
+    p = subprocess.Popen(['/bin/bash', '-c', cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    if progress_stream == 'stdout':
+        progress_fd, other_fd = p.stdout, p.stderr
+    else:
+        progress_fd, other_fd = p.stderr, p.stdout
+
+    other = []
+    reader = threading.Thread(target=lambda: other.append(other_fd.read()))
+    reader.daemon = True
+    reader.start()
+    text = _read_progress(progress_fd, parse, progress, callback)
+    reader.join()
+    r = p.wait()
+    shellpool.record(cmd, start_time)
+
+    if progress_stream == 'stdout':
+        o, e = text, other[0]
+    else:
+        o, e = other[0], text
+
+    infos = getattr(_debug_info, 'stack', None)
+    if infos:
+        infos[-1].append({
+            'cmd': cmd,
+            'return_code': r,
+            'stdout': o,
+            'stderr': e
+        })
+
+    if r != ret_code and errorout:
+        raise BashError('failed to execute bash[%s], return code: %s, stdout: %s, stderr: %s' % (cmd, r, o, e))
+    if r == ret_code:
+        e = None
+
+    return r, o, e
 
 def in_bash(func):
     @functools.wraps(func)
     def wrap(*args, **kwargs):
-        __BASH_DEBUG_INFO__ = []
+        if not hasattr(_debug_info, 'stack'):
+            _debug_info.stack = []
+        infos = []
+        _debug_info.stack.append(infos)
 
         start_time = time.time()
         try:
             return func(*args, **kwargs)
         finally:
+            _debug_info.stack.pop()
             end_time = time.time()
-            logger.debug('BASH COMMAND DETAILS IN %s [cost %s ms]: %s' % (func.__name__, (end_time - start_time) * 1000, json.dumps(__BASH_DEBUG_INFO__)))
-            del __BASH_DEBUG_INFO__
+            logger.debug('BASH COMMAND DETAILS IN %s [cost %s ms]: %s' % (func.__name__, (end_time - start_time) * 1000, json.dumps(infos)))
 
     return wrap
-
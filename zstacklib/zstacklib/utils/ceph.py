@@ -0,0 +1,173 @@
+'''
+capacity of the ceph cluster shared by the ceph agents.
+
+`ceph df` is read at most once per max_staleness by all the requests of an agent, a
+background thread refreshes it while the agent keeps asking. The replicated size of the
+pools is reread only when the osdmap epoch changes, and concurrent refreshes share the
+one in flight.
+
+@author: frank
+'''
+import threading
+import time
+from zstacklib.utils import jsonobject
+from zstacklib.utils import log
+from zstacklib.utils import shell
+
+logger = log.get_logger(__name__)
+
+CAPACITY_MAX_STALENESS = 30
+CAPACITY_REFRESH_INTERVAL = 10
+# the background refresh stops when no one asked for the capacity for so long
+CAPACITY_IDLE_TIMEOUT = 300
+
+class PoolCapacity(object):
+    def __init__(self, name, available, replicated_size, used):
+        self.name = name
+        self.available = available
+        self.replicated_size = replicated_size
+        self.used = used
+
+class Capacity(object):
+    def __init__(self, total, available, pools, read_time):
+        self.total = total
+        self.available = available
+        self.pools = pools  # type: list[PoolCapacity]
+        self.read_time = read_time
+
+class _Flight(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def _parse_df(o):
+    df = jsonobject.loads(o)
+
+    if df.stats.total_bytes__ is not None:
+        total = long(df.stats.total_bytes_)
+    elif df.stats.total_space__ is not None:
+        total = long(df.stats.total_space__) * 1024
+    else:
+        raise Exception('unknown ceph df output: %s' % o)
+
+    if df.stats.total_avail_bytes__ is not None:
+        avail = long(df.stats.total_avail_bytes_)
+    elif df.stats.total_avail__ is not None:
+        avail = long(df.stats.total_avail_) * 1024
+    else:
+        raise Exception('unknown ceph df output: %s' % o)
+
+    return total, avail, df.pools or []
+
+def _parse_osdmap_epoch(o):
+    stat = jsonobject.loads(o)
+    # luminous and later put the osdmap fields at the top level, jewel nests them once or twice
+    while stat is not None and stat.epoch__ is None:
+        stat = stat.osdmap__
+    return stat.epoch_ if stat is not None else None
+
+class CapacityService(object):
+    def __init__(self, call=shell.call, max_staleness=CAPACITY_MAX_STALENESS,
+                 refresh_interval=CAPACITY_REFRESH_INTERVAL, idle_timeout=CAPACITY_IDLE_TIMEOUT):
+        self.call = call
+        self.max_staleness = max_staleness
+        self.refresh_interval = refresh_interval
+        self.idle_timeout = idle_timeout
+
+        self.capacity = None  # type: Capacity
+        self.osdmap_epoch = None
+        self.pool_sizes = {}
+        self.last_asked = 0
+        self.refresher = None
+        self.flight = None  # type: _Flight
+        self.lock = threading.Lock()
+
+    def _read_pool_sizes(self, names):
+        sizes = {}
+        for pool in jsonobject.loads(self.call('ceph osd dump -f json')).pools or []:
+            sizes[pool.pool_name_] = pool.size_
+
+        for name in names:
+            if sizes.get(name) is None:
+                sizes[name] = jsonobject.loads(self.call('ceph osd pool get %s size -f json' % name)).size
+        return sizes
+
+    def _read(self):
+        read_time = time.time()
+        total, avail, pools = _parse_df(self.call('ceph df -f json'))
+        names = [pool.name for pool in pools]
+
+        epoch = _parse_osdmap_epoch(self.call('ceph osd stat -f json'))
+        if epoch is None or epoch != self.osdmap_epoch or any(n not in self.pool_sizes for n in names):
+            logger.debug('osdmap epoch changed from %s to %s, reread the size of pools' % (self.osdmap_epoch, epoch))
+            self.pool_sizes = self._read_pool_sizes(names)
+            self.osdmap_epoch = epoch
+
+        pool_capacities = [PoolCapacity(pool.name, pool.stats.max_avail_, self.pool_sizes[pool.name],
+                                        pool.stats.bytes_used_) for pool in pools]
+        return Capacity(total, avail, pool_capacities, read_time)
+
+    def refresh(self, not_before=None):
+        '''
+        reads the capacity, or waits for the read in flight if it started after not_before
+        '''
+        while True:
+            with self.lock:
+                flight = self.flight
+                leader = flight is None
+                if leader:
+                    flight = self.flight = _Flight()
+            if leader or not_before is None or flight.start_time >= not_before:
+                break
+            flight.done.wait()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._read()
+            with self.lock:
+                self.capacity = flight.result
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flight = None
+            flight.done.set()
+
+    def _refresh_in_background(self):
+        while time.time() - self.last_asked <= self.idle_timeout:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warn('failed to refresh the ceph capacity: %s' % e)
+
+        with self.lock:
+            self.refresher = None
+
+    def get(self, force=False):
+        '''
+        the capacity read within max_staleness seconds, force reads one after this call
+        '''
+        now = time.time()
+        with self.lock:
+            self.last_asked = now
+            capacity = self.capacity
+            if self.refresher is None and self.refresh_interval:
+                self.refresher = threading.Thread(target=self._refresh_in_background, name='ceph-capacity-refresher')
+                self.refresher.daemon = True
+                self.refresher.start()
+
+        if not force and capacity and now - capacity.read_time <= self.max_staleness:
+            return capacity
+        return self.refresh(now if force else None)
+
+capacity = CapacityService()
@@ -0,0 +1,531 @@
+'''
+the rbd, rados and ceph operations of the ceph agents.
+
+RadosClient keeps one connection to the cluster per agent and runs the operations
+through the python rados/rbd bindings. CliClient forks the rbd, rados and ceph commands
+and is used when the bindings are not installed or cannot connect. FakeCluster keeps a
+cluster in memory for tests and benchmarks. The operations answering json return the
+text the commands print, so callers parse them the same way whichever client runs them.
+
+Images and snapshots are named pool/image[@snap] as on the rbd command line.
+
+@author: frank
+'''
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from zstacklib.utils import log
+from zstacklib.utils import shell
+
+try:
+    import rados
+    import rbd
+except ImportError:
+    rados = None
+    rbd = None
+
+logger = log.get_logger(__name__)
+
+CEPH_CONF = '/etc/ceph/ceph.conf'
+CONNECT_TIMEOUT = 30
+OP_TIMEOUT = 60
+# how long to use the cli after librados failed to connect before trying again
+RECONNECT_INTERVAL = 300
+
+class CephError(Exception):
+    pass
+
+class CephNotFound(CephError):
+    pass
+
+class CephTimeout(CephError):
+    pass
+
+def parse_spec(spec):
+    '''pool/image[@snap] to (pool, image, snap), the pool is rbd if omitted'''
+    image, _, snap = spec.partition('@')
+    pool, _, name = image.rpartition('/')
+    return pool or 'rbd', name, snap or None
+
+class CliClient(object):
+    name = 'cli'
+
+    def _call(self, cmd, timeout=None):
+        if timeout:
+            cmd = 'timeout %d %s' % (timeout, cmd)
+        c = shell.ShellCmd(cmd, pooled=True)
+        c(False)
+        if c.return_code == 0:
+            return c.stdout
+
+        err = '%s failed, return code: %s, stdout: %s, stderr: %s' % (cmd, c.return_code, c.stdout, c.stderr)
+        if timeout and c.return_code == 124:
+            raise CephTimeout(err)
+        if 'No such file or directory' in c.stderr:
+            raise CephNotFound(err)
+        raise CephError(err)
+
+    def mon_command(self, prefix):
+        return self._call('ceph %s -f json' % prefix)
+
+    def image_info(self, spec):
+        return self._call('rbd --format json info %s' % spec)
+
+    def image_exists(self, spec):
+        try:
+            self.image_info(spec)
+            return True
+        except CephNotFound:
+            return False
+
+    def image_children(self, spec):
+        return [l.strip() for l in self._call('rbd children %s' % spec).splitlines() if l.strip()]
+
+    def image_remove(self, spec):
+        self._call('rbd rm %s' % spec)
+
+    def snap_list(self, spec):
+        return self._call('rbd --format json snap ls %s' % spec)
+
+    def snap_create(self, spec):
+        self._call('rbd snap create %s' % spec)
+
+    def snap_remove(self, spec):
+        self._call('rbd snap rm %s' % spec)
+
+    def snap_protect(self, spec):
+        self._call('rbd snap protect %s' % spec)
+
+    def snap_unprotect(self, spec):
+        self._call('rbd snap unprotect %s' % spec)
+
+    def snap_rollback(self, spec):
+        self._call('rbd snap rollback %s' % spec)
+
+    def snap_purge(self, spec):
+        self._call('rbd snap purge %s' % spec)
+
+    def object_put(self, pool, name, data, timeout=None):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            self._call("rados -p '%s' put '%s' %s" % (pool, name, path), timeout)
+        finally:
+            os.remove(path)
+
+    def object_get(self, pool, name):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self._call("rados -p '%s' get '%s' %s" % (pool, name, path))
+            with open(path) as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+    def object_append(self, pool, name, data):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            self._call("rados -p '%s' append '%s' %s" % (pool, name, path))
+        finally:
+            os.remove(path)
+
+    def object_stat(self, pool, name):
+        '''(size, mtime)'''
+        # pool/name mtime 2018-01-01 10:00:00.000000, size 123
+        o = self._call("rados -p '%s' stat '%s'" % (pool, name))
+        mtime, _, size = o.strip().partition(' mtime ')[2].rpartition(', size ')
+        return long(size), mtime
+
+    def object_remove(self, pool, name):
+        self._call("rados -p '%s' rm '%s'" % (pool, name))
+
+def _rados_errors(f):
+    @functools.wraps(f)
+    def inner(self, *args, **kwargs):
+        try:
+            return f(self, *args, **kwargs)
+        except (rados.ObjectNotFound, rbd.ImageNotFound) as e:
+            # the pool may be gone, reopen it next time
+            self.ioctxs.clear()
+            raise CephNotFound('%s%s: %s' % (f.__name__, args, e))
+        except rados.TimedOut as e:
+            raise CephTimeout('%s%s: %s' % (f.__name__, args, e))
+        except (rados.Error, rbd.Error) as e:
+            raise CephError('%s%s: %s' % (f.__name__, args, e))
+    return inner
+
+class RadosClient(object):
+    name = 'rados'
+
+    def __init__(self, conffile=CEPH_CONF, connect_timeout=CONNECT_TIMEOUT, op_timeout=OP_TIMEOUT):
+        self.cluster = rados.Rados(conffile=conffile)
+        self.cluster.conf_set('rados_osd_op_timeout', str(op_timeout))
+        self.cluster.conf_set('rados_mon_op_timeout', str(op_timeout))
+        self.cluster.connect(timeout=connect_timeout)
+        self.ioctxs = {}
+        self.lock = threading.Lock()
+
+    def _ioctx(self, pool):
+        with self.lock:
+            ioctx = self.ioctxs.get(pool)
+            if ioctx is None:
+                ioctx = self.ioctxs[pool] = self.cluster.open_ioctx(pool)
+            return ioctx
+
+    def _open(self, spec, read_only=False):
+        pool, name, snap = parse_spec(spec)
+        return rbd.Image(self._ioctx(pool), name, snapshot=snap, read_only=read_only)
+
+    def _with_image(self, spec, func, read_only=False):
+        image = self._open(spec, read_only=read_only)
+        try:
+            return func(image)
+        finally:
+            image.close()
+
+    @_rados_errors
+    def mon_command(self, prefix):
+        ret, out, err = self.cluster.mon_command(json.dumps({'prefix': prefix, 'format': 'json'}), '')
+        if ret != 0:
+            raise CephError('ceph %s failed, return code: %s, %s' % (prefix, ret, err))
+        return out
+
+    @_rados_errors
+    def image_info(self, spec):
+        def info(image):
+            st = image.stat()
+            d = {'name': parse_spec(spec)[1], 'size': st['size'], 'objects': st['num_objs'], 'order': st['order'],
+                 'object_size': st['obj_size'], 'block_name_prefix': st['block_name_prefix'],
+                 'format': 1 if image.old_format() else 2}
+            try:
+                pool, name, snap = image.parent_info()
+                d['parent'] = {'pool': pool, 'image': name, 'snapshot': snap}
+            except rbd.ImageNotFound:
+                pass
+            return json.dumps(d)
+        return self._with_image(spec, info, read_only=True)
+
+    @_rados_errors
+    def image_exists(self, spec):
+        try:
+            self._with_image(spec, lambda image: None, read_only=True)
+            return True
+        except (rados.ObjectNotFound, rbd.ImageNotFound):
+            return False
+
+    @_rados_errors
+    def image_children(self, spec):
+        return ['%s/%s' % c for c in self._with_image(spec, lambda image: image.list_children(), read_only=True)]
+
+    @_rados_errors
+    def image_remove(self, spec):
+        pool, name, _ = parse_spec(spec)
+        rbd.RBD().remove(self._ioctx(pool), name)
+
+    @_rados_errors
+    def snap_list(self, spec):
+        snaps = self._with_image(spec, lambda image: list(image.list_snaps()), read_only=True)
+        return json.dumps([{'id': s['id'], 'name': s['name'], 'size': s['size']} for s in snaps])
+
+    def _snap(self, spec, op):
+        snap = parse_spec(spec)[2]
+        image = self._open(spec.partition('@')[0])
+        try:
+            getattr(image, op)(snap)
+        finally:
+            image.close()
+
+    @_rados_errors
+    def snap_create(self, spec):
+        self._snap(spec, 'create_snap')
+
+    @_rados_errors
+    def snap_remove(self, spec):
+        self._snap(spec, 'remove_snap')
+
+    @_rados_errors
+    def snap_protect(self, spec):
+        self._snap(spec, 'protect_snap')
+
+    @_rados_errors
+    def snap_unprotect(self, spec):
+        self._snap(spec, 'unprotect_snap')
+
+    @_rados_errors
+    def snap_rollback(self, spec):
+        self._snap(spec, 'rollback_to_snap')
+
+    @_rados_errors
+    def snap_purge(self, spec):
+        def purge(image):
+            for s in list(image.list_snaps()):
+                image.remove_snap(s['name'])
+        self._with_image(spec, purge)
+
+    @_rados_errors
+    def object_put(self, pool, name, data, timeout=None):
+        # bounded by the rados_osd_op_timeout of the connection
+        self._ioctx(pool).write_full(name, data)
+
+    @_rados_errors
+    def object_get(self, pool, name):
+        ioctx = self._ioctx(pool)
+        size, _ = ioctx.stat(name)
+        return ioctx.read(name, size) if size else ''
+
+    @_rados_errors
+    def object_append(self, pool, name, data):
+        self._ioctx(pool).append(name, data)
+
+    @_rados_errors
+    def object_stat(self, pool, name):
+        size, mtime = self._ioctx(pool).stat(name)
+        return size, time.mktime(mtime)
+
+    @_rados_errors
+    def object_remove(self, pool, name):
+        self._ioctx(pool).remove_object(name)
+
+class _FakeImage(object):
+    def __init__(self, size, parent=None):
+        self.size = size
+        self.parent = parent
+        self.snaps = []  # [{'id', 'name', 'size', 'protected'}]
+        self.children = {}  # snap name -> set of pool/image
+
+    def get_snap(self, name):
+        for s in self.snaps:
+            if s['name'] == name:
+                return s
+        raise CephNotFound('snapshot %s not found' % name)
+
+class FakeCluster(object):
+    '''
+    a cluster in memory with the operations of the clients, op_latency seconds are spent
+    on each operation
+    '''
+    name = 'fake'
+
+    def __init__(self, fsid='8c7b5ad0-9b2c-4c2e-a1f7-3f6a0e7b1c2d', mons=('127.0.0.1:6789/0',), op_latency=0):
+        self.fsid = fsid
+        self.mons = list(mons)
+        self.op_latency = op_latency
+        self.pools = {}
+        self.snap_id = 0
+        self.object_version = 0
+        self.lock = threading.RLock()
+
+    def _op(self):
+        if self.op_latency:
+            time.sleep(self.op_latency)
+
+    def create_pool(self, pool):
+        with self.lock:
+            self.pools.setdefault(pool, {'images': {}, 'objects': {}})
+
+    def _pool(self, pool):
+        p = self.pools.get(pool)
+        if p is None:
+            raise CephNotFound('pool %s not found' % pool)
+        return p
+
+    def _image(self, spec):
+        pool, name, _ = parse_spec(spec)
+        image = self._pool(pool)['images'].get(name)
+        if image is None:
+            raise CephNotFound('image %s not found' % spec)
+        return image
+
+    def create_image(self, spec, size):
+        with self.lock:
+            pool, name, _ = parse_spec(spec)
+            self._pool(pool)['images'][name] = _FakeImage(size)
+
+    def clone(self, snap_spec, spec):
+        with self.lock:
+            parent = self._image(snap_spec)
+            snap = parent.get_snap(parse_spec(snap_spec)[2])
+            if not snap['protected']:
+                raise CephError('snapshot %s is not protected' % snap_spec)
+            pool, name, _ = parse_spec(spec)
+            self._pool(pool)['images'][name] = _FakeImage(snap['size'], parse_spec(snap_spec))
+            parent.children.setdefault(snap['name'], set()).add('%s/%s' % (pool, name))
+
+    def mon_command(self, prefix):
+        self._op()
+        monmap = {'fsid': self.fsid, 'mons': [{'rank': i, 'name': 'mon%d' % i, 'addr': a} for i, a in enumerate(self.mons)]}
+        if prefix == 'status':
+            return json.dumps({'fsid': self.fsid, 'health': {'status': 'HEALTH_OK'}, 'monmap': monmap})
+        if prefix == 'mon_status':
+            return json.dumps({'name': 'mon0', 'state': 'leader', 'monmap': monmap})
+        raise CephError('unsupported command %s' % prefix)
+
+    def image_info(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            snap = parse_spec(spec)[2]
+            d = {'name': parse_spec(spec)[1], 'size': image.get_snap(snap)['size'] if snap else image.size, 'format': 2}
+            if image.parent:
+                d['parent'] = {'pool': image.parent[0], 'image': image.parent[1], 'snapshot': image.parent[2]}
+            return json.dumps(d)
+
+    def image_exists(self, spec):
+        try:
+            self.image_info(spec)
+            return True
+        except CephNotFound:
+            return False
+
+    def image_children(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            snap = image.get_snap(parse_spec(spec)[2])
+            return sorted(image.children.get(snap['name'], []))
+
+    def image_remove(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            if image.snaps:
+                raise CephError('image %s has snapshots' % spec)
+            pool, name, _ = parse_spec(spec)
+            del self._pool(pool)['images'][name]
+            if image.parent:
+                parent = self._image('%s/%s' % image.parent[:2])
+                parent.children.get(image.parent[2], set()).discard('%s/%s' % (pool, name))
+
+    def snap_list(self, spec):
+        self._op()
+        with self.lock:
+            return json.dumps([{'id': s['id'], 'name': s['name'], 'size': s['size']} for s in self._image(spec).snaps])
+
+    def snap_create(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            name = parse_spec(spec)[2]
+            if any(s['name'] == name for s in image.snaps):
+                raise CephError('snapshot %s exists' % spec)
+            self.snap_id += 1
+            image.snaps.append({'id': self.snap_id, 'name': name, 'size': image.size, 'protected': False})
+
+    def snap_remove(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            snap = image.get_snap(parse_spec(spec)[2])
+            if snap['protected']:
+                raise CephError('snapshot %s is protected' % spec)
+            image.snaps.remove(snap)
+
+    def snap_protect(self, spec):
+        self._op()
+        with self.lock:
+            snap = self._image(spec).get_snap(parse_spec(spec)[2])
+            if snap['protected']:
+                raise CephError('snapshot %s is already protected' % spec)
+            snap['protected'] = True
+
+    def snap_unprotect(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            snap = image.get_snap(parse_spec(spec)[2])
+            if image.children.get(snap['name']):
+                raise CephError('snapshot %s has children' % spec)
+            snap['protected'] = False
+
+    def snap_rollback(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            image.size = image.get_snap(parse_spec(spec)[2])['size']
+
+    def snap_purge(self, spec):
+        self._op()
+        with self.lock:
+            image = self._image(spec)
+            if any(s['protected'] for s in image.snaps):
+                raise CephError('image %s has protected snapshots' % spec)
+            image.snaps = []
+
+    def _object(self, pool, name):
+        o = self._pool(pool)['objects'].get(name)
+        if o is None:
+            raise CephNotFound('object %s/%s not found' % (pool, name))
+        return o
+
+    def _write_object(self, pool, name, data):
+        # the version stands for the mtime, which may not change between two writes
+        self.object_version += 1
+        self._pool(pool)['objects'][name] = (data, self.object_version)
+
+    def object_put(self, pool, name, data, timeout=None):
+        self._op()
+        with self.lock:
+            self._write_object(pool, name, data)
+
+    def object_get(self, pool, name):
+        self._op()
+        with self.lock:
+            return self._object(pool, name)[0]
+
+    def object_append(self, pool, name, data):
+        self._op()
+        with self.lock:
+            o = self._pool(pool)['objects'].get(name)
+            self._write_object(pool, name, (o[0] if o else '') + data)
+
+    def object_stat(self, pool, name):
+        self._op()
+        with self.lock:
+            data, version = self._object(pool, name)
+            return len(data), version
+
+    def object_remove(self, pool, name):
+        self._op()
+        with self.lock:
+            self._object(pool, name)
+            del self._pool(pool)['objects'][name]
+
+_client = None
+_client_time = None
+_client_lock = threading.Lock()
+
+def _connect():
+    if rados is None or rbd is None:
+        return CliClient()
+
+    try:
+        return RadosClient()
+    except Exception as e:
+        logger.warn('cannot connect to the ceph cluster by librados, use the ceph cli instead: %s' % e)
+        return CliClient()
+
+def get_client():
+    '''
+    the client of this agent, a RadosClient if the bindings are installed and connect
+    '''
+    global _client, _client_time
+    with _client_lock:
+        retry = rados is not None and isinstance(_client, CliClient) and time.time() - _client_time > RECONNECT_INTERVAL
+        if _client is None or retry:
+            _client = _connect()
+            _client_time = time.time()
+            logger.debug('ceph operations are run by the %s client' % _client.name)
+        return _client
+
+def set_client(client):
+    '''uses client, e.g. a FakeCluster, for the operations of this agent'''
+    global _client
+    with _client_lock:
+        _client = client
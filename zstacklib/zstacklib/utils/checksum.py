@@ -0,0 +1,211 @@
+'''
+checksums of image files.
+
+a digest computed while a file is written, by wrapping the sink of a download or a copy
+in DigestingWriter, costs no read of its own. It is remembered for the path with the
+inode, mtime and size of the file, so asking for the checksum later reads nothing as
+long as the file is not changed. Other files are read with a large reused buffer.
+
+tree digests hash fixed size chunks of a memory-mapped file in worker threads and then
+the chunk digests, they are only comparable with tree digests of the same chunk size.
+
+@author: frank
+'''
+import collections
+import hashlib
+import mmap
+import os
+import os.path
+import threading
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+TREE_CHUNK_SIZE = 64 * 1024 * 1024
+TREE_PARALLELISM = 4
+MAX_CACHED_DIGESTS = 4096
+
+# (path, algorithm) -> ((inode, mtime, size), hex digest)
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+def get_file_key(path):
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime, st.st_size
+
+def get_cached(path, algorithm='md5', key=None):
+    '''the remembered digest if the file is not changed since, otherwise None'''
+    key = key or get_file_key(path)
+    with _cache_lock:
+        c = _cache.get((path, algorithm))
+    if c and c[0] == key:
+        return c[1]
+    return None
+
+def remember(path, digest, algorithm='md5', key=None):
+    '''key is the one of the file before it was read, the digest is dropped if the file changed meanwhile'''
+    current = get_file_key(path)
+    if key and key != current:
+        logger.debug('%s changed while computing its %s, not cached' % (path, algorithm))
+        return
+
+    with _cache_lock:
+        _cache.pop((path, algorithm), None)
+        _cache[(path, algorithm)] = (current, digest)
+        while len(_cache) > MAX_CACHED_DIGESTS:
+            _cache.popitem(last=False)
+
+def forget(path):
+    with _cache_lock:
+        for k in [k for k in _cache if k[0] == path]:
+            del _cache[k]
+
+class DigestingWriter(object):
+    '''a file object computing the digest of the data written through it'''
+    def __init__(self, fd, algorithm='md5'):
+        self.fd = fd
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+
+    def update_from(self, path, length):
+        '''adds the first length bytes of path, what was written before a download is resumed'''
+        for data in _read_blocks(path, length):
+            self.hash.update(data)
+
+    def write(self, data):
+        self.fd.write(data)
+        self.hash.update(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+def _read_blocks(path, length=None):
+    '''buffers of the file, valid until the next one is taken'''
+    buf = bytearray(READ_BUFFER_SIZE)
+    left = length
+    with open(path, 'rb', 0) as fd:
+        while left is None or left > 0:
+            n = fd.readinto(buf)
+            if not n:
+                break
+            if left is not None:
+                n = min(n, left)
+                left -= n
+            yield buffer(buf, 0, n)
+
+def file_digest(path, algorithm='md5', progress=None, use_cache=True):
+    '''
+    @param progress: called with the number of bytes read each time
+    '''
+    key = get_file_key(path)
+    digest = get_cached(path, algorithm, key) if use_cache else None
+    if digest:
+        if progress:
+            progress(key[2])
+        return digest
+
+    h = hashlib.new(algorithm)
+    for data in _read_blocks(path):
+        h.update(data)
+        if progress:
+            progress(len(data))
+
+    digest = h.hexdigest()
+    remember(path, digest, algorithm, key)
+    return digest
+
+def md5sum(path, progress=None, use_cache=True):
+    return file_digest(path, 'md5', progress, use_cache)
+
+def copy_file(src, dst, algorithm='md5'):
+    '''copies src to dst and remembers the digest of both, the data is read once'''
+    key = get_file_key(src)
+    with open(dst, 'wb') as fd:
+        sink = DigestingWriter(fd, algorithm)
+        for data in _read_blocks(src):
+            sink.write(data)
+
+    digest = sink.hexdigest()
+    remember(src, digest, algorithm, key)
+    remember(dst, digest, algorithm)
+    return digest
+
+def _chunk_digests(path, algorithm, chunk_size, parallelism, progress):
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size == 0:
+            return []
+        m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    offsets = range(0, size, chunk_size)
+    digests = [None] * len(offsets)
+    todo = iter(enumerate(offsets))
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    i, offset = next(todo)
+                except StopIteration:
+                    return
+
+            try:
+                # hashlib releases the GIL on large buffers, the chunks are hashed in parallel
+                digests[i] = hashlib.new(algorithm, buffer(m, offset, chunk_size)).digest()
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+
+            if progress:
+                with lock:
+                    progress(min(chunk_size, size - offset))
+
+    try:
+        workers = [threading.Thread(target=work) for _ in range(min(parallelism, len(offsets)))]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
+    finally:
+        m.close()
+
+    if errors:
+        raise errors[0]
+    return digests
+
+def tree_digest(path, algorithm='md5', chunk_size=TREE_CHUNK_SIZE, parallelism=TREE_PARALLELISM, progress=None,
+                use_cache=True):
+    '''the digest of the digests of every chunk_size bytes of the file'''
+    name = '%s-tree-%d' % (algorithm, chunk_size)
+    key = get_file_key(path)
+    digest = get_cached(path, name, key) if use_cache else None
+    if digest:
+        if progress:
+            progress(key[2])
+        return digest
+
+    digests = _chunk_digests(path, algorithm, chunk_size, parallelism, progress)
+    digest = hashlib.new(algorithm, ''.join(digests)).hexdigest()
+    remember(path, digest, name, key)
+    return digest
+
+def folder_digest(path, algorithm='md5', chunk_size=TREE_CHUNK_SIZE, parallelism=TREE_PARALLELISM):
+    '''the digest of the sorted tree digests of the regular files under path, the names are not part of it'''
+    digests = []
+    for root, _, files in os.walk(path):
+        for f in files:
+            p = os.path.join(root, f)
+            if os.path.isfile(p) and not os.path.islink(p):
+                digests.append(tree_digest(p, algorithm, chunk_size, parallelism))
+
+    return hashlib.new(algorithm, '\n'.join(sorted(digests))).hexdigest()
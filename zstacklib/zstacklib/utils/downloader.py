@@ -0,0 +1,371 @@
+'''
+parallel http range downloader. A single HEAD request finds the size and the range support
+of a url, segments of the file are then fetched by workers and written in order into a sink,
+a sink is anything having write(): a file, the stdin of a pipe or an image importer.
+Urls not supporting ranges (and ftp urls) are read in one stream into the same sink.
+
+@author: frank
+'''
+import json
+import os
+import os.path
+import ssl
+import threading
+import time
+import urllib2
+import urlparse
+from zstacklib.utils import checksum
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+PARALLELISM = 4
+READ_BLOCK_SIZE = 256 * 1024
+RETRY_TIMES = 3
+RETRY_INTERVAL = 1
+SOCKET_TIMEOUT = 60
+PART_SUFFIX = '.download'
+META_SUFFIX = '.download.meta'
+
+class DownloadError(Exception):
+    '''download error'''
+
+class DownloadTimeout(DownloadError):
+    '''download timeout'''
+
+class _HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+def _open(url, headers=None, method_head=False, cert_check=False):
+    req = (_HeadRequest if method_head else urllib2.Request)(url, headers=headers or {})
+    if not cert_check and url.startswith('https://') and hasattr(ssl, '_create_unverified_context'):
+        return urllib2.urlopen(req, timeout=SOCKET_TIMEOUT, context=ssl._create_unverified_context())
+    return urllib2.urlopen(req, timeout=SOCKET_TIMEOUT)
+
+class RemoteFile(object):
+    def __init__(self, url, size=None, accept_ranges=False, etag=None, last_modified=None):
+        # the url after redirections, segments are fetched from it directly
+        self.url = url
+        self.size = size
+        self.accept_ranges = accept_ranges
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def validator(self):
+        # a weak etag is not allowed in If-Range
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def to_dict(self):
+        return {'url': self.url, 'size': self.size, 'etag': self.etag, 'lastModified': self.last_modified}
+
+def head(url, cert_check=False):
+    '''
+    the size and the range support of url. An ftp url has no HEAD, it is opened
+    and closed at once, so is a http url whose server refuses HEAD
+    '''
+    http_url = urlparse.urlparse(url).scheme in ('http', 'https')
+    try:
+        try:
+            rsp = _open(url, method_head=http_url, cert_check=cert_check)
+        except urllib2.HTTPError as e:
+            if not http_url or e.code not in (403, 405, 501):
+                raise
+            rsp = _open(url, cert_check=cert_check)
+    except (urllib2.URLError, IOError, ValueError) as e:
+        raise DownloadError('failed to get the information of %s, %s' % (url, e))
+
+    try:
+        info = rsp.info()
+        length = (info.getheader('Content-Length') or '').strip()
+        size = long(length) if length.isdigit() else None
+        accept_ranges = http_url and 'bytes' in (info.getheader('Accept-Ranges') or '').lower()
+        return RemoteFile(rsp.geturl(), size, accept_ranges, info.getheader('ETag'), info.getheader('Last-Modified'))
+    finally:
+        rsp.close()
+
+class _RetryableError(Exception):
+    pass
+
+class _RangesIgnored(DownloadError):
+    pass
+
+class _Segments(object):
+    '''
+    segments handed out to workers in order and collected back in order, a worker
+    can't run ahead of the writer more than window segments, which bounds the memory
+    '''
+    def __init__(self, segments, window):
+        self.segments = segments
+        self.window = window
+        self.results = {}
+        self.next = 0
+        self.written = 0
+        self.error = None
+        self.cond = threading.Condition()
+
+    def take(self):
+        with self.cond:
+            while self.next - self.written >= self.window and not self.error:
+                self.cond.wait()
+            if self.error or self.next >= len(self.segments):
+                return None, None
+            i = self.next
+            self.next += 1
+            return i, self.segments[i]
+
+    def put(self, i, data):
+        with self.cond:
+            self.results[i] = data
+            self.cond.notify_all()
+
+    def fail(self, e):
+        with self.cond:
+            if not self.error:
+                self.error = e
+            self.cond.notify_all()
+
+    def get(self, i):
+        with self.cond:
+            while i not in self.results and not self.error:
+                self.cond.wait()
+            if self.error:
+                raise self.error
+            self.written = i + 1
+            self.cond.notify_all()
+            return self.results.pop(i)
+
+class Downloader(object):
+    def __init__(self, url, remote=None, parallelism=PARALLELISM, segment_size=SEGMENT_SIZE, cert_check=False, timeout=0):
+        self.url = url
+        self.cert_check = cert_check
+        self.remote = remote or head(url, cert_check)
+        self.parallelism = parallelism
+        self.segment_size = segment_size
+        self.timeout = timeout
+        self.deadline = time.time() + timeout if timeout else None
+        self.downloaded = 0
+        # the first bytes of the file, fetched by sniff() and not downloaded again
+        self._header = None
+        # the response being read when the url is downloaded in one stream
+        self._stream = None
+        # the server answered a range request with the whole file
+        self._ranges_ignored = False
+
+    @property
+    def ranged(self):
+        return bool(self.remote.accept_ranges and self.remote.size) and not self._ranges_ignored
+
+    def _check_deadline(self):
+        if self.deadline and time.time() > self.deadline:
+            raise DownloadTimeout('downloading %s timeout after %s seconds' % (self.url, self.timeout))
+
+    def _open_stream(self):
+        try:
+            return _open(self.remote.url, cert_check=self.cert_check)
+        except (urllib2.URLError, IOError, ValueError) as e:
+            raise DownloadError('failed to download %s, %s' % (self.url, e))
+
+    def sniff(self, length):
+        '''the first length bytes of the file, it's shorter if the file is'''
+        if self._header is None and self.ranged:
+            try:
+                self._header = self._fetch(0, min(max(length, self.segment_size), self.remote.size))
+            except _RangesIgnored as e:
+                self._fall_back_to_stream(e)
+
+        if self._header is None:
+            self._stream = self._open_stream()
+            chunks = []
+            got = 0
+            while got < length:
+                data = self._stream.read(length - got)
+                if not data:
+                    break
+                chunks.append(data)
+                got += len(data)
+            self._header = ''.join(chunks)
+        return self._header[:length]
+
+    def _fall_back_to_stream(self, e):
+        logger.warn('%s, download it in one stream' % e)
+        self._ranges_ignored = True
+        self._header = None
+
+    def _fetch(self, start, end):
+        headers = {}
+        if self.remote.validator:
+            # the server sends the whole file instead if it has been changed
+            headers['If-Range'] = self.remote.validator
+
+        chunks = []
+        pos = start
+        retry = 0
+        while pos < end:
+            self._check_deadline()
+            try:
+                headers['Range'] = 'bytes=%d-%d' % (pos, end - 1)
+                rsp = _open(self.remote.url, headers, cert_check=self.cert_check)
+                try:
+                    if rsp.getcode() == 200:
+                        raise _RangesIgnored('%s ignored the range request or has been changed' % self.url)
+                    if rsp.getcode() != 206:
+                        raise DownloadError('unexpected status code of the range request to %s: %s' %
+                                            (self.url, rsp.getcode()))
+                    while pos < end:
+                        self._check_deadline()
+                        data = rsp.read(min(READ_BLOCK_SIZE, end - pos))
+                        if not data:
+                            raise _RetryableError('connection closed at byte %d' % pos)
+                        chunks.append(data)
+                        pos += len(data)
+                finally:
+                    rsp.close()
+            except DownloadError:
+                raise
+            except (_RetryableError, urllib2.URLError, IOError) as e:
+                retry += 1
+                if retry > RETRY_TIMES:
+                    raise DownloadError('failed to download bytes %d-%d of %s after %s retries, %s' %
+                                        (start, end - 1, self.url, RETRY_TIMES, e))
+                logger.warn('failed to download bytes %d-%d of %s, retry %s, %s' % (pos, end - 1, self.url, retry, e))
+                time.sleep(RETRY_INTERVAL)
+
+        return ''.join(chunks)
+
+    def _write(self, sink, data, progress):
+        sink.write(data)
+        self.downloaded += len(data)
+        if progress:
+            progress(self.downloaded, self.remote.size)
+
+    def _download_ranges(self, sink, offset, progress):
+        size = self.remote.size
+        bounds = [(s, min(s + self.segment_size, size)) for s in xrange(offset, size, self.segment_size)]
+        if offset == 0 and self._header is not None and bounds and len(self._header) == bounds[0][1]:
+            # the first segment has been sniffed
+            first, bounds = self._header, bounds[1:]
+            self._write(sink, first, progress)
+            self._header = None
+
+        segments = _Segments(bounds, self.parallelism * 2)
+
+        def work():
+            while True:
+                i, bound = segments.take()
+                if i is None:
+                    return
+                start, end = bound
+                try:
+                    segments.put(i, self._fetch(start, end))
+                except Exception as e:
+                    segments.fail(e)
+                    return
+
+        workers = []
+        for _ in range(min(self.parallelism, len(bounds))):
+            t = threading.Thread(target=work)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+
+        try:
+            for i in xrange(len(bounds)):
+                self._write(sink, segments.get(i), progress)
+        except Exception as e:
+            segments.fail(e)
+            raise
+        finally:
+            for t in workers:
+                t.join()
+
+    def _download_stream(self, sink, progress):
+        rsp = self._stream or self._open_stream()
+        self._stream = None
+        try:
+            if self._header:
+                self._write(sink, self._header, progress)
+                self._header = None
+
+            while True:
+                self._check_deadline()
+                try:
+                    data = rsp.read(READ_BLOCK_SIZE)
+                except IOError as e:
+                    raise DownloadError('failed to download %s, %s' % (self.url, e))
+                if not data:
+                    break
+                self._write(sink, data, progress)
+        finally:
+            rsp.close()
+
+        if self.remote.size is not None and self.downloaded != self.remote.size:
+            raise DownloadError('%s is incomplete, %s of %s bytes downloaded' % (self.url, self.downloaded, self.remote.size))
+
+    def download(self, sink, offset=0, progress=None):
+        '''
+        writes the file from offset into sink in order, calls progress(downloaded, total)
+        after each write. Returns the bytes of the file in the sink
+        '''
+        if offset and not self.ranged:
+            raise DownloadError('%s does not support ranges, cannot download it from byte %s' % (self.url, offset))
+
+        self.downloaded = offset
+        if self.ranged:
+            try:
+                self._download_ranges(sink, offset, progress)
+            except _RangesIgnored as e:
+                # nothing is in the sink yet, the whole file can be taken instead
+                if self.downloaded:
+                    raise
+                self._fall_back_to_stream(e)
+                self._download_stream(sink, progress)
+        else:
+            self._download_stream(sink, progress)
+        return self.downloaded
+
+def _read_meta(path):
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return None
+
+def _write_meta(path, remote):
+    with open(path, 'w') as fd:
+        json.dump(remote.to_dict(), fd)
+
+def download_to_file(url, dst, progress=None, timeout=0, cert_check=False, parallelism=PARALLELISM, resume=True):
+    '''
+    downloads url to dst through dst.download, a download interrupted is resumed from
+    the end of dst.download if the file is not changed by its ETag or Last-Modified.
+    The md5 of dst is remembered by checksum
+    '''
+    d = Downloader(url, parallelism=parallelism, cert_check=cert_check, timeout=timeout)
+    part = dst + PART_SUFFIX
+    meta = dst + META_SUFFIX
+
+    offset = 0
+    if resume and d.ranged and d.remote.validator and os.path.exists(part) and _read_meta(meta) == d.remote.to_dict():
+        offset = min(os.path.getsize(part), d.remote.size)
+        logger.debug('resume downloading %s from byte %s' % (url, offset))
+    else:
+        _write_meta(meta, d.remote)
+
+    with open(part, 'r+b' if offset else 'wb') as fd:
+        # the md5 is computed while downloading, only a resumed part is read again
+        sink = checksum.DigestingWriter(fd)
+        if offset:
+            sink.update_from(part, offset)
+        fd.seek(offset)
+        fd.truncate()
+        d.download(sink, offset, progress)
+
+    os.rename(part, dst)
+    os.remove(meta)
+    checksum.remember(dst, sink.hexdigest())
+    return d.remote
@@ -8,6 +8,8 @@ import types
 
 import cherrypy
 import thread
+import threading
+import time
 import logging
 import logging.handlers
 
@@ -38,7 +40,10 @@ class RawUri(object):
 
 class AsyncUri(SyncUri):
     def __init__(self):
+        super(AsyncUri, self).__init__()
         self.callback_uri = None
+        self.lane = thread.DEFAULT_LANE
+        self.concurrency = None
 
 class Request(object):
     def __init__(self):
@@ -103,8 +108,11 @@ class AsyncUirHandler(SyncUriHandler):
     def __init__(self, uri_obj):
         super(AsyncUirHandler, self).__init__(uri_obj)
     
-    @thread.AsyncThread
     def _run_index(self, task_uuid, request):
+        thread.get_executor().submit(self._do_run_index, (task_uuid, request), lane=self.uri_obj.lane,
+                                     key=self.uri_obj.uri if self.uri_obj.concurrency else None)
+
+    def _do_run_index(self, task_uuid, request):
         callback_uri = self._get_callback_uri(request)
         headers = {TASK_UUID : task_uuid}
         try:
@@ -165,14 +173,22 @@ class HttpServer(object):
         self.port = port
         self.mapper = None
     
-    def register_async_uri(self, uri, func, callback_uri=None):
+    # lane: executor lane the request runs in, use thread.URGENT_LANE for
+    #       cheap requests like ping which must not queue behind storage jobs,
+    #       thread.BULK_LANE for long running jobs like image downloads and merges
+    # concurrency: max number of requests of this uri running at the same time
+    def register_async_uri(self, uri, func, callback_uri=None, lane=thread.DEFAULT_LANE, concurrency=None):
         async_uri_obj = AsyncUri()
         async_uri_obj.callback_uri = callback_uri
         if async_uri_obj.callback_uri is None:
             async_uri_obj.callback_uri = self.async_callback_uri
         async_uri_obj.uri = uri
         async_uri_obj.func = func
+        async_uri_obj.lane = lane
+        async_uri_obj.concurrency = concurrency
         async_uri_obj.controller = AsyncUirHandler(async_uri_obj)
+        if concurrency:
+            thread.get_executor().set_concurrency_limit(uri, concurrency)
         
         self.async_uri_handlers[uri] = async_uri_obj
     
@@ -270,27 +286,135 @@ class HttpServer(object):
     def stop(self):
         cherrypy.engine.exit()
 
-def json_post(uri, body=None, headers={}, method='POST', fail_soon=False):
+# keep-alive connection pool shared by all callbacks of the agent process
+HTTP_POOL_NUM_POOLS = 16
+HTTP_POOL_MAXSIZE = 8
+# when all connections to a destination are busy, wait for a free one
+# instead of opening more sockets to the management node
+HTTP_POOL_BLOCK = True
+HTTP_POOL_TIMEOUT = 120.0
+
+class DestinationStats(object):
+    def __init__(self, destination):
+        self.destination = destination
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_error = None
+
+    def record(self, latency, error=None):
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if error is not None:
+            self.errors += 1
+            self.last_error = str(error)
+
+    def to_dict(self):
+        avg = self.total_latency / self.requests if self.requests else 0.0
+        return {
+            'destination': self.destination,
+            'requests': self.requests,
+            'errors': self.errors,
+            'avgLatency': avg,
+            'maxLatency': self.max_latency,
+            'lastError': self.last_error
+        }
+
+class HttpConnectionPool(object):
+    def __init__(self, num_pools=HTTP_POOL_NUM_POOLS, maxsize=HTTP_POOL_MAXSIZE, block=HTTP_POOL_BLOCK,
+                 pool_timeout=HTTP_POOL_TIMEOUT):
+        self.pool_timeout = pool_timeout
+        self.manager = urllib3.PoolManager(num_pools=num_pools, maxsize=maxsize, block=block, timeout=120.0,
+                                           retries=urllib3.util.retry.Retry(15))
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    @staticmethod
+    def _get_destination(uri):
+        u = urllib3.util.parse_url(uri)
+        port = u.port if u.port else (443 if u.scheme == 'https' else 80)
+        return '%s:%s' % (u.host, port)
+
+    def _record(self, destination, latency, error=None):
+        with self.stats_lock:
+            s = self.stats.get(destination)
+            if not s:
+                s = self.stats[destination] = DestinationStats(destination)
+            s.record(latency, error)
+
+    def urlopen(self, method, uri, headers, body=None, timeout=None, retries=None):
+        '''timeout and retries override the ones of the pool when not None'''
+        destination = self._get_destination(uri)
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        if retries is not None:
+            kwargs['retries'] = retries
+
+        start = time.time()
+        try:
+            rsp = self.manager.urlopen(method, uri, headers=headers, body=body, pool_timeout=self.pool_timeout, **kwargs)
+            content = rsp.data
+        except Exception as e:
+            self._record(destination, time.time() - start, e)
+            raise
+
+        err = 'HTTP status %s' % rsp.status if rsp.status >= 400 else None
+        self._record(destination, time.time() - start, err)
+        return content
+
+    def get_stats(self):
+        with self.stats_lock:
+            return dict([(k, v.to_dict()) for k, v in self.stats.items()])
+
+    def clear(self):
+        self.manager.clear()
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+def get_connection_pool():
+    global _connection_pool
+    if _connection_pool:
+        return _connection_pool
+
+    with _connection_pool_lock:
+        if not _connection_pool:
+            _connection_pool = HttpConnectionPool()
+        return _connection_pool
+
+def configure_connection_pool(num_pools=HTTP_POOL_NUM_POOLS, maxsize=HTTP_POOL_MAXSIZE, block=HTTP_POOL_BLOCK,
+                              pool_timeout=HTTP_POOL_TIMEOUT):
+    global _connection_pool
+    with _connection_pool_lock:
+        old = _connection_pool
+        _connection_pool = HttpConnectionPool(num_pools, maxsize, block, pool_timeout)
+
+    if old:
+        old.clear()
+    return _connection_pool
+
+def get_destination_stats():
+    return get_connection_pool().get_stats()
+
+def json_post(uri, body=None, headers={}, method='POST', fail_soon=False, timeout=None, retries=None):
     ret = []
     def post(_):
         try:
-            pool = urllib3.PoolManager(timeout=120.0, retries=urllib3.util.retry.Retry(15))
-            header = {'Content-Type': 'application/json', 'Connection': 'close'}
+            header = {'Content-Type': 'application/json'}
             for k in headers.keys():
                 header[k] = headers[k]
 
             if body is not None:
                 assert isinstance(body, types.StringType)
                 header['Content-Length'] = str(len(body))
-                content = pool.urlopen(method, uri, headers=header, body=str(body)).data
-
-                #(resp, content) = http_obj.request(uri, 'POST', body='%s' % body, headers=header)
+                content = get_connection_pool().urlopen(method, uri, header, str(body), timeout, retries)
             else:
                 header['Content-Length'] = '0'
-                #(resp, content) = http_obj.request(uri, 'POST', headers=header)
-                content = pool.urlopen(method, uri, headers=header).data
+                content = get_connection_pool().urlopen(method, uri, header, timeout=timeout, retries=retries)
 
-            pool.clear()
             ret.append(content)
             return True
         except Exception as e:
@@ -309,11 +433,11 @@ def json_post(uri, body=None, headers={}, method='POST', fail_soon=False):
     return ret[0]
 
 
-def json_dump_post(uri, body=None, headers={}, fail_soon=False):
+def json_dump_post(uri, body=None, headers={}, fail_soon=False, timeout=None, retries=None):
     content = None
     if body is not None:
         content = jsonobject.dumps(body)
-    return json_post(uri, content, headers, fail_soon=fail_soon)
+    return json_post(uri, content, headers, fail_soon=fail_soon, timeout=timeout, retries=retries)
 
 def json_dump_get(uri, body=None, headers={}, fail_soon=False):
     content = None
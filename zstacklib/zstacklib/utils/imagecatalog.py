@@ -0,0 +1,275 @@
+'''
+the image metadata of a backup storage.
+
+the images are kept in an export of one json line per image, the file the management
+node reads back, and the changes made since in a log next to it. adding or deleting an
+image appends one line to the log and updates the index in memory, the log is folded
+into the export when it gets longer than the images. the export is replaced atomically
+and replaying the log on it again is harmless, so a crash at any point loses at most the
+line being appended.
+
+@author: frank
+'''
+import collections
+import errno
+import json
+import os
+import os.path
+import threading
+from zstacklib.utils import cephclient
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+# the log is compacted when it has more records than this and than the images
+COMPACT_MIN_RECORDS = 1000
+DELETED = '__deleted__'
+
+def parse_images(content):
+    '''a json array of images or one image to a json line per image'''
+    content = content.strip()
+    if not content:
+        return []
+
+    images = json.loads(content, object_pairs_hook=collections.OrderedDict)
+    if not isinstance(images, list):
+        images = [images]
+    return [json.dumps(image) for image in images]
+
+def get_install_path(line):
+    # todo support multiple bs
+    return json.loads(line)["backupStorageRefs"][0]["installPath"]
+
+class FileStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.log_path = path + '.log'
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as fd:
+                return fd.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            # the size first like the stat of the objects
+            return st.st_size, st.st_ino, st.st_mtime
+        except OSError:
+            return None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def version(self):
+        return self._stat(self.path), self._stat(self.log_path)
+
+    def read_export(self):
+        return self._read(self.path)
+
+    def read_log(self):
+        return self._read(self.log_path)
+
+    def append_log(self, data):
+        with open(self.log_path, 'a') as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def write_export(self, lines):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            for line in lines:
+                fd.write(line + '\n')
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp, self.path)
+
+    def remove_log(self):
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+class RadosStore(object):
+    def __init__(self, pool, name, client=None):
+        self.pool = pool
+        self.name = name
+        self.log_name = name + '.log'
+        self.client = client
+
+    def _client(self):
+        return self.client or cephclient.get_client()
+
+    def _stat(self, name):
+        try:
+            return self._client().object_stat(self.pool, name)
+        except cephclient.CephNotFound:
+            return None
+
+    def _read(self, name):
+        try:
+            return self._client().object_get(self.pool, name)
+        except cephclient.CephNotFound:
+            return None
+
+    def exists(self):
+        return self._stat(self.name) is not None
+
+    def version(self):
+        return self._stat(self.name), self._stat(self.log_name)
+
+    def read_export(self):
+        return self._read(self.name)
+
+    def read_log(self):
+        return self._read(self.log_name)
+
+    def append_log(self, data):
+        self._client().object_append(self.pool, self.log_name, data)
+
+    def write_export(self, lines):
+        # write_full replaces the object at once
+        self._client().object_put(self.pool, self.name, ''.join(line + '\n' for line in lines))
+
+    def remove_log(self):
+        try:
+            self._client().object_remove(self.pool, self.log_name)
+        except cephclient.CephNotFound:
+            pass
+
+def _log_size(version):
+    return version[1][0] if version[1] else 0
+
+class ImageCatalog(object):
+    def __init__(self, store, compact_min_records=COMPACT_MIN_RECORDS):
+        self.store = store
+        self.compact_min_records = compact_min_records
+        self.images = collections.OrderedDict()  # uuid -> json line
+        self.log_records = 0
+        self.log_torn = False
+        self.loaded_version = None
+        self.lock = threading.RLock()
+
+    def _apply(self, line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            logger.warn('skip the broken image metadata: %s' % line)
+            return
+
+        if DELETED in record:
+            self.images.pop(record[DELETED], None)
+        else:
+            self.images.pop(record['uuid'], None)
+            self.images[record['uuid']] = line
+
+    def _load(self):
+        version = self.store.version()
+        if version == self.loaded_version:
+            return
+
+        self.images = collections.OrderedDict()
+        for line in (self.store.read_export() or '').splitlines():
+            if line.strip():
+                self._apply(line)
+
+        content = self.store.read_log() or ''
+        records = [line for line in content.splitlines() if line.strip()]
+        for line in records:
+            self._apply(line)
+        self.log_records = len(records)
+        # the last append was cut off, the next one starts a new line
+        self.log_torn = bool(content) and not content.endswith('\n')
+        self.loaded_version = version
+
+    def _append(self, lines):
+        data = ''.join(line + '\n' for line in lines)
+        if self.log_torn:
+            data = '\n' + data
+        before = self.store.version()
+        self.store.append_log(data)
+        after = self.store.version()
+
+        if before == self.loaded_version and after[0] == before[0] and \
+                _log_size(after) == _log_size(before) + len(data):
+            self.log_torn = False
+            self.log_records += len(lines)
+            for line in lines:
+                self._apply(line)
+            self.loaded_version = after
+        else:
+            # another agent wrote the catalog around the append, replay all of it including our lines
+            self.loaded_version = None
+            self._load()
+
+        # the export is what tells the management node there is metadata, write it at first
+        if self.loaded_version[0] is None or self.log_records > max(self.compact_min_records, len(self.images)):
+            self._compact()
+
+    def _compact(self):
+        folded = self.loaded_version
+        self.store.write_export(self.images.values())
+        # the log is removed only if it is still what was folded in, records appended by
+        # another agent meanwhile stay to be replayed on the new export
+        if self.store.version()[1] == folded[1]:
+            self.store.remove_log()
+            self.log_records = 0
+            self.log_torn = False
+        # the catalog may have been changed by others after the export was written, read
+        # it again next time instead of taking a version of records not seen
+        self.loaded_version = None
+
+    def exists(self):
+        return self.store.exists()
+
+    def get(self, uuid):
+        with self.lock:
+            self._load()
+            return self.images.get(uuid)
+
+    def put(self, lines):
+        if not lines:
+            return
+        with self.lock:
+            self._load()
+            self._append(lines)
+
+    def delete(self, uuid):
+        with self.lock:
+            self._load()
+            if uuid in self.images:
+                self._append([json.dumps({DELETED: uuid})])
+
+    def replace(self, lines):
+        with self.lock:
+            self.images = collections.OrderedDict()
+            for line in lines:
+                self._apply(line)
+            self.store.write_export(self.images.values())
+            self.store.remove_log()
+            self.log_records = 0
+            self.log_torn = False
+            self.loaded_version = None
+
+    def compact(self):
+        with self.lock:
+            self._load()
+            if self.log_records:
+                self._compact()
+
+    def export(self, newest_first=False):
+        '''the json lines of the images'''
+        with self.lock:
+            self._load()
+            lines = self.images.values()
+        return reversed(lines) if newest_first else iter(lines)
+
+    def __len__(self):
+        with self.lock:
+            self._load()
+            return len(self.images)
@@ -3,39 +3,137 @@
 @author: frank
 '''
 import os
+import collections
+import hashlib
 from zstacklib.utils import shell
 from zstacklib.utils import linux
 from zstacklib.utils import log
 from zstacklib.utils import ordered_set
-from pyparsing import *
 
 logger = log.get_logger(__name__)
 
 class IPTablesError(Exception):
     '''iptables error'''
     
+class _NodeList(list):
+    '''
+    children of a node. Appending and removing keep the name/identity indexes
+    of the owner up to date, other changes make the owner rebuild them on the
+    next lookup. Any change marks the owner as modified.
+    '''
+    def __init__(self, owner, iterable=()):
+        super(_NodeList, self).__init__(iterable)
+        self.owner = owner
+
+    def _changed(self):
+        self.owner.modified = True
+        self.owner._index = None
+
+    def append(self, node):
+        super(_NodeList, self).append(node)
+        self.owner.modified = True
+        index = self.owner._index
+        if index is not None:
+            index[0].setdefault(node.name, []).append(node)
+            index[1].setdefault(node.identity, []).append(node)
+
+    def remove(self, node):
+        super(_NodeList, self).remove(node)
+        self.owner.modified = True
+        index = self.owner._index
+        if index is not None:
+            try:
+                index[0][node.name].remove(node)
+                index[1][node.identity].remove(node)
+            except (KeyError, ValueError):
+                self.owner._index = None
+
+    def extend(self, nodes):
+        super(_NodeList, self).extend(nodes)
+        self._changed()
+
+    def insert(self, pos, node):
+        super(_NodeList, self).insert(pos, node)
+        self._changed()
+
+    def pop(self, *args):
+        ret = super(_NodeList, self).pop(*args)
+        self._changed()
+        return ret
+
+    def sort(self, *args, **kwargs):
+        super(_NodeList, self).sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super(_NodeList, self).reverse()
+        self._changed()
+
+    def __setitem__(self, key, value):
+        super(_NodeList, self).__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super(_NodeList, self).__delitem__(key)
+        self._changed()
+
+    def __setslice__(self, i, j, seq):
+        super(_NodeList, self).__setslice__(i, j, seq)
+        self._changed()
+
+    def __delslice__(self, i, j):
+        super(_NodeList, self).__delslice__(i, j)
+        self._changed()
+
+    def __iadd__(self, nodes):
+        self.extend(nodes)
+        return self
+
 class Node(object):
+    # name and identity of a node must not change after it's added to a parent,
+    # the parent indexes its children by them
     def __init__(self):
         self.name = None
         self.identity = None
         self.parent = None
-        self.children = []
-    
+        self._index = None
+        self._children = _NodeList(self)
+        self.modified = False
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, lst):
+        self._children = _NodeList(self, lst)
+        self.modified = True
+        self._index = None
+
+    def _get_index(self):
+        if self._index is None:
+            by_name = {}
+            by_identity = {}
+            for c in self._children:
+                by_name.setdefault(c.name, []).append(c)
+                by_identity.setdefault(c.identity, []).append(c)
+            self._index = (by_name, by_identity)
+        return self._index
+
     def add_child(self, node):
         self.children.append(node)
         node.parent = self
     
     def get_child_by_name(self, name):
-        for c in self.children:
-            if c.name == name:
-                return c
-        return None
+        lst = self._get_index()[0].get(name)
+        return lst[0] if lst else None
     
     def get_child_by_identity(self, identity):
-        for c in self.children:
-            if c.identity == identity:
-                return c
-        return None
+        lst = self._get_index()[1].get(identity)
+        return lst[0] if lst else None
+
+    def get_children_by_identity(self, identity):
+        return list(self._get_index()[1].get(identity, []))
     
     def insert_child_before(self, n1, n2):
         pos = self.children.index(n1)
@@ -164,12 +262,12 @@ class IPTableChain(Node):
         self.children = []
     
     def __str__(self):
-        if not self.children:
-            return ''
+        return '\n'.join(self.render_rules(self.children))
 
-        rules = []
-        for r in self.children:
-            rules.append(r)
+    @staticmethod
+    def render_rules(rules):
+        if not rules:
+            return []
 
         def sort(r1, r2):
             return r1.order - r2.order
@@ -179,7 +277,7 @@ class IPTableChain(Node):
         for r in rules:
             lst.add(str(r))
 
-        return '\n'.join(lst)
+        return list(lst)
 
 class IPTableRule(Node):
     def __init__(self):
@@ -198,7 +296,6 @@ class IPTables(Node):
 
     def __init__(self):
         super(IPTables, self).__init__()
-        self._parser = None
         self._current_table = None
         self._filter_table = None
         self._nat_table = None
@@ -241,11 +338,10 @@ class IPTables(Node):
         else:
             assert 0, 'unknown table name: %s' % table_name
         
-    def _parse_table_action(self, tokens):
-        table_name = tokens[1]
-        self._create_table_if_not_exists(table_name)
+    def _parse_table(self, line):
+        self._create_table_if_not_exists(line[1:].split()[0])
     
-    def _parse_commit_action(self, tokens):
+    def _parse_commit(self, line):
         self._current_table = None
     
     def _create_chain_if_not_exists(self, chain_name, counter_str=None):
@@ -261,12 +357,10 @@ class IPTables(Node):
             self._current_table.add_child(chain)
         return chain
         
-    def _parse_counter_action(self, tokens):
-        chain_name = tokens[1]
-        prefix = ':%s' % chain_name
-        lst = [prefix]
-        lst.extend(tokens[2:])
-        counter_str = ' '.join(lst)
+    def _parse_counter(self, line):
+        # ':chain policy [packets:bytes]'
+        chain_name, _, rest = line[1:].partition(' ')
+        counter_str = ' '.join([':%s' % chain_name, rest])
         self._create_chain_if_not_exists(chain_name, counter_str)
     
     def _add_rule(self, chain_name, rule_identity, order=0):
@@ -279,31 +373,23 @@ class IPTables(Node):
         rule.order = order
         chain.add_child(rule)
         
-    def _parse_rule_action(self, tokens):
-        chain_name = tokens[1]
-        self._add_rule(chain_name, ' '.join(tokens))
-    
-    def _construct_pyparsing(self):
-        if self._parser:
-            return
-        
-        table = Literal('*') + Word(alphas)
-        table.setParseAction(self._parse_table_action)
-        
-        chain_name = Word(printables + '.-_+=%$#')
-        
-        counter = Literal(':') + chain_name + restOfLine
-        counter.setParseAction(self._parse_counter_action)
-        
-        comment = Literal('#') + restOfLine
-        
-        rule = Literal('-A') + chain_name + restOfLine
-        rule.setParseAction(self._parse_rule_action)
-        
-        commit = Literal('COMMIT')
-        commit.setParseAction(self._parse_commit_action)
-        
-        self._parser = table | counter | comment | rule | commit
+    def _parse_rule(self, line):
+        # '-A chain ...'
+        self._add_rule(line.split(None, 2)[1], line)
+
+    def _parse_line(self, line):
+        if line.startswith('-A'):
+            self._parse_rule(line)
+        elif line.startswith(':'):
+            self._parse_counter(line)
+        elif line.startswith('*'):
+            self._parse_table(line)
+        elif line.startswith('#'):
+            pass
+        elif line.startswith('COMMIT'):
+            self._parse_commit(line)
+        else:
+            raise IPTablesError('unknown line in iptables-save output: %s' % line)
         
     @staticmethod
     def find_target_in_rule(rule):
@@ -384,13 +470,22 @@ class IPTables(Node):
         
     def _from_iptables_save(self, txt):
         self._reset()
-        self._construct_pyparsing()
         for l in txt.split('\n'):
             l = l.strip('\n').strip('\r').strip('\t').strip()
             if not l:
                 continue
             
-            self._parser.parseString(l)
+            self._parse_line(l)
+
+        self._mark_unmodified()
+
+    def _mark_unmodified(self):
+        self.modified = False
+        for table in self.children:
+            table.modified = False
+            table.saved_chain_names = set([c.name for c in table.children])
+            for chain in table.children:
+                chain.modified = False
     
     def iptables_save(self):
         out = shell.call('/sbin/iptables-save')
@@ -435,10 +530,10 @@ class IPTables(Node):
             
         
         def _clean_rule_having_stale_target_chain():
-            alive_chain_names = []
+            alive_chain_names = set()
             for t in self.children:
                 for c in t.children:
-                    alive_chain_names.append(c.name)
+                    alive_chain_names.add(c.name)
 
             def walker(rule, data):
                 if not isinstance(rule, IPTableRule):
@@ -518,15 +613,8 @@ class IPTables(Node):
         if sort_nat_func:
             self._sort_chain_in_nat_table(sort_nat_func)
 
-        def make_reject_rule_last(r1, r2):
-            if self.is_target_in_rule(r1, 'REJECT'):
-                return 1
-            if self.is_target_in_rule(r2, 'REJECT'):
-                return -1
-            return 0
-
         for c in self._filter_table.children:
-            c.children = sorted(c.children, make_reject_rule_last)
+            c.children = sorted(c.children, self._make_reject_rule_last)
 
         content = str(self)
         if marshall_func:
@@ -534,6 +622,44 @@ class IPTables(Node):
 
         return content
 
+    @staticmethod
+    def _make_reject_rule_last(r1, r2):
+        if IPTables.is_target_in_rule(r1, 'REJECT'):
+            return 1
+        if IPTables.is_target_in_rule(r2, 'REJECT'):
+            return -1
+        return 0
+
+    def iptable_restore_modified_chains(self, table_name=FILTER_TABLE_NAME):
+        '''
+        apply only the chains added, changed or deleted in the table since the
+        rules were loaded, with one 'iptables-restore --noflush'. Unlike
+        iptable_restore(), rules jumping to deleted chains and empty chains
+        are not cleaned up, the caller has to remove them.
+        '''
+        table = self.get_table(table_name)
+        if not table:
+            return
+
+        saved_chain_names = getattr(table, 'saved_chain_names', set())
+        chains = collections.OrderedDict()
+        for c in table.children:
+            if not c.modified and c.name in saved_chain_names:
+                continue
+
+            rules = c.children
+            if table_name == self.FILTER_TABLE_NAME:
+                rules = sorted(rules, self._make_reject_rule_last)
+            chains[c.name] = IPTableChain.render_rules(rules)
+
+        current_chain_names = set([c.name for c in table.children])
+        deleted_chain_names = [n for n in saved_chain_names if n not in current_chain_names]
+        if not chains and not deleted_chain_names:
+            return
+
+        restore_chains_noflush(chains, deleted_chain_names, table_name)
+        self._mark_unmodified()
+
     def iptable_restore(self, marshall_func=None, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
         content = self._to_iptables_string(marshall_func, sort_nat_func, sort_filter_func, sort_mangle_func)
         f = linux.write_to_temp_file(content)
@@ -549,6 +675,8 @@ iptable rules:
             raise IPTablesError(err)
         finally:
             os.remove(f)
+
+        self._mark_unmodified()
             
     @staticmethod
     def from_iptables_save():
@@ -558,16 +686,44 @@ iptable rules:
     
     def _normalize_rule(self, rule):
         return ' '.join(rule.strip().split())
+
+    def _get_chains_of_rule(self, identity):
+        # a rule identity is '-A chain ...', only the chains of that name can contain it
+        tokens = identity.split(None, 2)
+        if len(tokens) < 2 or tokens[0] != '-A':
+            return None
+        return [c for c in [t.get_child_by_name(tokens[1]) for t in self.children] if c]
+
+    def search_all_by_identity(self, identity):
+        chains = self._get_chains_of_rule(identity)
+        if chains is None:
+            return super(IPTables, self).search_all_by_identity(identity)
+
+        ret = []
+        for c in chains:
+            ret.extend(c.get_children_by_identity(identity))
+        return ret
+
+    def search_by_identity(self, identity):
+        chains = self._get_chains_of_rule(identity)
+        if chains is None:
+            return super(IPTables, self).search_by_identity(identity)
+
+        for c in chains:
+            r = c.get_child_by_identity(identity)
+            if r:
+                return r
+        return None
     
     def add_rule(self, rule, table_name=FILTER_TABLE_NAME, order=0):
         if table_name not in [self.FILTER_TABLE_NAME, self.NAT_TABLE_NAME, self.MANGLE_TABLE_NAME]:
             raise IPTablesError('unknown table name[%s]' % table_name)
         
         self._create_table_if_not_exists(table_name)
-        chain_name = Word(printables + '-_+=%$#')
-        rule_p = Literal('-A') + chain_name + restOfLine
-        res = rule_p.parseString(rule)
-        self._add_rule(res[1], rule, order)
+        tokens = rule.split(None, 2)
+        if len(tokens) < 2 or tokens[0] != '-A':
+            raise IPTablesError('invalid rule[%s]' % rule)
+        self._add_rule(tokens[1], rule, order)
     
     def remove_rule(self, rule_str):
         rule_str = self._normalize_rule(rule_str)
@@ -590,6 +746,89 @@ iptable rules:
 def from_iptables_save():
     return IPTables.from_iptables_save()
 
+BUILTIN_CHAIN_NAMES = ['INPUT', 'FORWARD', 'OUTPUT', 'PREROUTING', 'POSTROUTING']
+
+class ChainSnapshot(object):
+    '''
+    rules of the chains accepted by chain_filter and the rules of other chains
+    jumping into them, read from 'iptables-save -t table' line by line without
+    building the tree of the whole ruleset.
+    '''
+    def __init__(self, table_name, chain_filter):
+        self.table_name = table_name
+        self.chain_filter = chain_filter
+        # chain name -> rules
+        self.chains = collections.OrderedDict()
+        # rules of other chains whose targets are the selected chains
+        self.references = []
+        self.fingerprint = None
+
+    def load(self, txt=None):
+        if txt is None:
+            txt = shell.call('/sbin/iptables-save -t %s' % self.table_name)
+
+        chains = collections.OrderedDict()
+        references = []
+        for l in txt.split('\n'):
+            l = l.strip()
+            if l.startswith(':'):
+                name = l[1:].split(' ', 1)[0]
+                if self.chain_filter(name):
+                    chains.setdefault(name, [])
+            elif l.startswith('-A '):
+                name = l.split(' ', 2)[1]
+                if self.chain_filter(name):
+                    chains.setdefault(name, []).append(l)
+                else:
+                    target = IPTables.find_target_in_rule(l)
+                    if target and self.chain_filter(target):
+                        references.append(l)
+
+        self.chains = chains
+        self.references = references
+        md5 = hashlib.md5()
+        for name, rules in chains.items():
+            md5.update(':%s\n' % name)
+            md5.update('\n'.join(rules))
+        md5.update('\n'.join(references))
+        self.fingerprint = md5.hexdigest()
+        return self
+
+def restore_chains_noflush(chains, deleted_chains=(), table_name=IPTables.FILTER_TABLE_NAME):
+    '''
+    replace the rules of the chains in 'chains'(name -> rules)
+    and delete 'deleted_chains' in one 'iptables-restore --noflush'
+    transaction, other chains of the table are left untouched.
+    '''
+    lst = ['*%s' % table_name]
+    # in noflush mode, a declared user chain is created or flushed
+    lst.extend([':%s - [0:0]' % name for name in chains.keys() if name not in BUILTIN_CHAIN_NAMES])
+    # while declaring a builtin chain doesn't flush it
+    lst.extend(['-F %s' % name for name in chains.keys() if name in BUILTIN_CHAIN_NAMES])
+    for rules in chains.values():
+        lst.extend(rules)
+    for name in deleted_chains:
+        lst.append('-F %s' % name)
+    for name in deleted_chains:
+        lst.append('-X %s' % name)
+    lst.append('COMMIT')
+    lst.append('')
+    content = '\n'.join(lst)
+
+    f = linux.write_to_temp_file(content)
+    try:
+        shell.call('/sbin/iptables-restore --noflush < %s' % f)
+    except Exception as e:
+        err = '''Failed to apply iptables rules:
+shell error description:
+%s
+iptable rules:
+%s
+''' % (str(e), content)
+        raise IPTablesError(err)
+    finally:
+        os.remove(f)
+
 def insert_single_rule_to_filter_table(rule):
     insert_rule = rule.replace('-A', '-I')
     shell.call("/sbin/iptables-save | grep -- '{0}' > /dev/null || iptables {1}".format(rule, insert_rule))
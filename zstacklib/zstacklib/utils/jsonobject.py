@@ -105,18 +105,24 @@ def _parse_dict(d):
             raise NoneSupportedTypeError("Cannot parse object: %s, type: %s, dict dump: %s" % (val, type(val), d))
         
     return dobj
-            
+
+def _object_hook(d):
+    # called by the (C accelerated) simplejson scanner for every json object,
+    # inner objects first. The decoded dict becomes the attribute dict of the
+    # JsonObject directly, nothing is copied or walked again
+    obj = JsonObject.__new__(JsonObject)
+    obj.__dict__ = d
+    return obj
+
 def loads(jstr):
     try:
-        root = simplejson.loads(jstr)
+        root = simplejson.loads(jstr, object_hook=_object_hook)
     except Exception as e:
         raise  NoneSupportedTypeError("Cannot compile string: %s to a jsonobject" % jstr)
-    if isinstance(root, types.DictType):
-        return _parse_dict(root)
-    if isinstance(root, types.ListType):
-        return _parse_list(root)
-    else:
-        return root
+    return root
+
+def is_accelerated():
+    return bool(simplejson._import_c_make_encoder())
 
 def _new_json_object():
     return JsonObject()
@@ -133,9 +139,24 @@ def _is_unsupported_type(obj):
 def _is_primitive_types(obj):
     return isinstance(obj, (types.BooleanType, types.LongType, types.IntType, types.FloatType, types.StringType, types.UnicodeType))
 
+# the types json can carry as they are, checked by exact type first as the
+# isinstance() chains below are expensive for big payloads
+_PRIMITIVE_TYPES = frozenset([types.BooleanType, types.LongType, types.IntType, types.FloatType, types.StringType,
+                              types.UnicodeType])
+
 def _dump_list(lst):
     nlst = []
     for val in lst:
+        t = type(val)
+        if t in _PRIMITIVE_TYPES or t is types.DictType:
+            nlst.append(val)
+            continue
+        if t is types.ListType:
+            nlst.append(_dump_list(val))
+            continue
+        if val is None:
+            continue
+
         if _is_unsupported_type(val):
             raise NoneSupportedTypeError('Cannot dump val: %s, type: %s, list dump: %s' % (val, type(val), lst))
         
@@ -146,8 +167,6 @@ def _dump_list(lst):
         elif isinstance(val, types.ListType):        
             tlst = _dump_list(val)
             nlst.append(tlst)
-        elif isinstance(val, types.NoneType):
-            pass
         else:
             nmap = _dump(val)
             nlst.append(nmap)
@@ -165,7 +184,17 @@ def _dump(obj):
     #items = inspect.getmembers(obj)
     for key, val in items:
         if key.startswith('_'): continue
-        
+
+        t = type(val)
+        if t in _PRIMITIVE_TYPES or t is types.DictType:
+            ret[key] = val
+            continue
+        if t is types.ListType:
+            ret[key] = _dump_list(val)
+            continue
+        if val is None:
+            continue
+
         if _is_unsupported_type(obj):
             raise NoneSupportedTypeError('cannot dump %s, type:%s, object dict: %s' % (val, type(val), obj.__dict__))
         
@@ -176,8 +205,6 @@ def _dump(obj):
         elif isinstance(val, types.ListType):
             nlst = _dump_list(val)
             ret[key] = nlst
-        elif isinstance(val, types.NoneType):
-            pass
         else:
             nmap = _dump(val)
             ret[key] = nmap
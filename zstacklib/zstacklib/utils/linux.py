@@ -18,7 +18,11 @@ import re
 import platform
 
 from zstacklib.utils import shell
+from zstacklib.utils import downloader
+from zstacklib.utils import qcow2
 from zstacklib.utils import log
+from zstacklib.utils import procfs
+from zstacklib.utils import checksum
 
 
 logger = log.get_logger(__name__)
@@ -296,83 +300,33 @@ def shellquote(s):
     return "'" + s.replace("'", "'\\''") + "'"
 
 def wget(url, workdir, rename=None, timeout=0, interval=1, callback=None, callback_data=None, cert_check=False):
-    def get_percentage(filesize, dst):
-        try:
-            curr_size = os.path.getsize(dst)
-            p = round(float(curr_size)/float(filesize) * 100, 2)
-            return p
-        except Exception as e:
-            logger.debug('%s may have not been ready, %s' % (dst, str(e)))
-            return None
+    dst_file = os.path.join(workdir, rename or os.path.basename(url))
+    last_report = [0]
 
-    def get_file_size(url):
-        output = shell.call('curl --head %s' % url)
-        for l in output.split('\n'):
-            if 'Content-Length' in l:
-                filesize = l.split(':')[1].strip()
-                return True, long(filesize)
-        return False, 0
-
-    cmdlst = ['wget']
-    dst_file = os.path.join(workdir, os.path.basename(url))
-    src_file = os.path.join(workdir, os.path.basename(url))
-    if os.path.exists(src_file):
-        os.remove(src_file)
-
-    if not cert_check:
-        cmdlst.append('--no-check-certificate')
-    cmdlst.append(url)
-    if rename:
-        cmdlst.append('-O %s' % rename)
-        dst_file = os.path.join(workdir, rename)
-    cmdlst.append('2>/dev/null')
-
-    cmd = ' '.join(cmdlst)
-
-    is_support_file_size, filesize = get_file_size(url)
-    if is_support_file_size:
-        process = subprocess.Popen(cmd, shell=True, executable='/bin/sh', cwd=workdir, close_fds=True)
-        is_timeout = False
-        count = 0
-        logger.debug('start to download %s, total size: %s' % (url, filesize))
+    def progress(downloaded, total):
+        if not callback or not total:
+            return
+        now = time.time()
+        if now - last_report[0] < interval and downloaded < total:
+            return
+        last_report[0] = now
         try:
-            while process.poll() is None:
-                time.sleep(interval)
-                count += interval
-                if timeout > 0 and count > timeout:
-                    process.kill()
-                    is_timeout = True
-                    break
-
-                if callback:
-                    p = get_percentage(filesize, dst_file)
-                    if p:
-                        try:
-                            callback(p, callback_data)
-                        except Exception:
-                            pass
-
-            if is_timeout:
-                raise LinuxError('wget %s timeout after %s seconds' % (url, timeout))
+            callback(round(float(downloaded) / float(total) * 100, 2), callback_data)
+        except Exception:
+            pass
 
-            return process.returncode
-        except Exception as e:
-            logger.warn(get_exception_stacktrace())
-            if process.poll() is None:
-                process.kill()
-            raise LinuxError('unhandled exception happened when downloading %s, %s' % (url, str(e)))
-    else:
-        shell.call(cmd, workdir=workdir)
+    logger.debug('start to download %s to %s' % (url, dst_file))
+    try:
+        downloader.download_to_file(url, dst_file, progress=progress, timeout=timeout, cert_check=cert_check)
         return 0
+    except downloader.DownloadTimeout:
+        raise LinuxError('wget %s timeout after %s seconds' % (url, timeout))
+    except Exception as e:
+        logger.warn(get_exception_stacktrace())
+        raise LinuxError('unhandled exception happened when downloading %s, %s' % (url, str(e)))
 
 def md5sum(file_path):
-    return 'md5sum is not calculated due to time cost'
-
-    #cmd = shell.ShellCmd('md5sum %s' % file_path)
-    #cmd()
-    #output = cmd.stdout
-    #sum5 = output.split(' ')[0]
-    #return sum5.strip()
+    return checksum.md5sum(file_path)
 
 def mkdir(path, mode):
     if os.path.isdir(path):
@@ -532,6 +486,10 @@ def sftp_get(hostname, sshkey, filename, download_to, timeout=0, interval=1, cal
             os.remove(batch_file_path)
 
 def qcow2_size_and_actual_size(file_path):
+    info = qcow2.get_info(file_path)
+    if info:
+        return info.virtual_size, os.path.getsize(file_path)
+
     cmd = shell.ShellCmd('''set -o pipefail; qemu-img info %s |  awk '{if (/^virtual size:/) {vs=substr($4,2)}; if (/^disk size:/) {ds=$3} } END{print vs?vs:"null", ds?ds:"null"}' ''' % file_path)
     cmd(False)
     if cmd.return_code != 0:
@@ -572,6 +530,10 @@ def get_img_file_fmt(src):
     return fmt
 
 def get_img_fmt(src):
+    info = qcow2.get_info(src)
+    if info:
+        return info.format
+
     fmt = shell.call("set -o pipefail; /usr/bin/qemu-img info %s | grep -w '^file format' | awk '{print $3}'" % src)
     fmt = fmt.strip(' \t\r\n')
     if fmt != 'raw' and fmt != 'qcow2':
@@ -662,12 +624,18 @@ def qcow2_convert_to_raw(src, dst):
 def qcow2_rebase(backing_file, target):
     fmt = get_img_fmt(backing_file)
     shell.call('/usr/bin/qemu-img rebase -F %s -f qcow2 -b %s %s' % (fmt, backing_file, target))
+    qcow2.invalidate(target)
 
 def qcow2_rebase_no_check(backing_file, target):
     fmt = get_img_fmt(backing_file)
     shell.call('/usr/bin/qemu-img rebase -F %s -u -f qcow2 -b %s %s' % (fmt, backing_file, target))
+    qcow2.invalidate(target)
 
 def qcow2_virtualsize(file_path):
+    info = qcow2.get_info(file_path)
+    if info:
+        return info.virtual_size
+
     file_path = shellquote(file_path)
     cmd = shell.ShellCmd("set -o pipefail; qemu-img info %s | grep -w 'virtual size' | awk -F '(' '{print $2}' | awk '{print $1}'" % file_path)
     cmd(False)
@@ -682,24 +650,17 @@ def qcow2_get_backing_file(path):
         out = shell.call("qemu-img info %s | grep 'backing file:' | cut -d ':' -f 2" % path)
         return out.strip(' \t\r\n')
 
-    with open(path, 'r') as resp:
-        magic = resp.read(4)
-        if magic != 'QFI\xfb':
-            return ""
-
-        # read backing file info from header
-        resp.seek(8)
-        backing_file_info = resp.read(12)
-        backing_file_offset = struct.unpack('>Q', backing_file_info[:8])[0]
-        if backing_file_offset == 0:
-            return ""
-
-        backing_file_size = struct.unpack('>L', backing_file_info[8:])[0]
-        resp.seek(backing_file_offset)
-        return resp.read(backing_file_size)
+    info = qcow2.get_info(path)
+    if not info or not info.backing_file:
+        return ""
+    return info.backing_file
 
 # Get derived file and all its backing files
 def qcow2_get_file_chain(path):
+    chain = qcow2.get_chain(path)
+    if chain:
+        return chain
+
     out = shell.call("qemu-img info --backing-chain %s | grep 'image:' | awk '{print $2}'" % path)
     return out.splitlines()
 
@@ -717,9 +678,15 @@ def get_qcow2_base_backing_file_recusively(path):
 def get_qcow2_base_image_recusively(vol_install_dir, image_cache_dir):
     real_vol_dir = os.path.realpath(vol_install_dir)
     real_cache_dir = os.path.realpath(image_cache_dir)
-    backing_files = shell.call(
-        "set -o pipefail; find %s -type f -name '*.qcow2' -exec qemu-img info {} \;| grep 'backing file:' | awk '{print $3}'"
-        % real_vol_dir).splitlines()
+    backing_files = []
+    for root, _, files in os.walk(real_vol_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            if not f.endswith('.qcow2') or os.path.islink(path):
+                continue
+            info = qcow2.get_info(path)
+            if info and info.backing_file:
+                backing_files.append(info.backing_file)
 
     base_image = set()
     for backing_file in backing_files:
@@ -954,29 +921,10 @@ def wait_callback_success(callback, callback_data=None, timeout=60,
     return False
 
 def get_process_up_time_in_second(pid):
-    output = shell.call('ps -p %s -o etime=' % pid)
-    output = output.strip()
-    if '-' in output:
-        day, output = output.split('-')
-        day = int(day)
-    else:
-        day = 0
-
-    time_pair = output.split(':')
-    if len(time_pair) == 3:
-        hour = int(time_pair[0])
-        minute = int(time_pair[1])
-        second = int(time_pair[2])
-    elif len(time_pair) == 2:
-        hour = 0
-        minute = int(time_pair[0])
-        second = int(time_pair[1])
-    else:
-        hour = 0
-        minute = 0
-        second = int(time_pair[0])
-
-    return day * 24 * 3600 + hour * 3600 + minute * 60 + second
+    p = procfs.get_process_table().get(pid) or procfs.get_process_table(force=True).get(pid)
+    if not p:
+        raise LinuxError('cannot find the process[pid:%s]' % pid)
+    return int(p.get_up_time())
 
 
 def get_cpu_num():
@@ -1012,19 +960,20 @@ def full_path(path):
         return os.path.abspath(path)
 
 def get_pid_by_process_param(param):
-    cmd = shell.ShellCmd('''set -o pipefail; ps -aux | grep "[%s]%s" | sed 's/\s\s*/ /g' | cut -f 2 -d " "''' % (param[0], param[1:]))
-    output = cmd(False)
-    if cmd.return_code != 0:
+    pids = procfs.find_pids(param)
+    if not pids:
         return None
-    output = output.strip(" \t\n\r")
-    return int(output)
+    return int(pids[0])
 
 def get_pid_by_process_name(name):
-    cmd = shell.ShellCmd('ps -ae | grep -w %s' % name)
-    output = cmd(False)
-    if cmd.return_code != 0:
-        return None
-    return output.split()[0]
+    for table in (procfs.get_process_table(), procfs.get_process_table(force=True)):
+        for p in table.processes:
+            try:
+                if p.comm == name[:15] and process_exists(p.pid):
+                    return p.pid
+            except IOError:
+                continue
+    return None
 
 def get_nic_name_by_mac(mac):
     names = get_nic_names_by_mac(mac)
@@ -1136,26 +1085,8 @@ def create_vlan_bridge(bridgename, ethname, vlan, ip=None, netmask=None):
     create_bridge(bridgename, vlan_dev_name, move_route)
 
 def find_process_by_cmdline(cmdlines):
-    pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
-    for pid in pids:
-        try:
-            with open(os.path.join('/proc', pid, 'cmdline'), 'r') as fd:
-                cmdline = fd.read()
-
-            is_find = True
-            for c in cmdlines:
-                if c not in cmdline:
-                    is_find = False
-                    break
-
-            if not is_find:
-                continue
-
-            return pid
-        except IOError:
-            continue
-
-    return None
+    pids = procfs.find_pids(*cmdlines)
+    return pids[0] if pids else None
 
 def error_if_path_missing(path):
     if not os.path.exists(path):
@@ -1391,9 +1322,7 @@ def kill_process(pid, timeout=5):
     os.kill(int(pid), 15)
 
     def check(_):
-        cmd = shell.ShellCmd('ps %s > /dev/null' % pid)
-        cmd(False)
-        return cmd.return_code != 0
+        return not process_exists(pid)
 
     if wait_callback_success(check, None, timeout):
         return
@@ -1,6 +1,9 @@
+import contextlib
 import functools
+import json
 import random
 import os.path
+import threading
 import time
 
 from zstacklib.utils import shell
@@ -14,6 +17,9 @@ LVM_CONFIG_PATH = "/etc/lvm"
 SANLOCK_CONFIG_FILE_PATH = "/etc/sanlock/sanlock.conf"
 LVM_CONFIG_BACKUP_PATH = "/etc/lvm/zstack-backup"
 SUPER_BLOCK_BACKUP = "superblock.bak"
+# other hosts sharing a vg create, remove and resize its lvs, this process doesn't see that
+LV_INVENTORY_TTL = 3
+LVS_FIELDS = "lv_name,vg_name,lv_uuid,lv_size,lv_active,lv_tags"
 
 
 class LvmlockdLockType(object):
@@ -391,22 +397,161 @@ def add_vg_tag(vgUuid, tag):
     cmd(is_exception=True)
 
 
+class LvInfo(object):
+    def __init__(self, vg_name, lv_name, uuid, size, active, tags):
+        self.vg_name = vg_name
+        self.lv_name = lv_name
+        self.path = "/dev/%s/%s" % (vg_name, lv_name)
+        self.uuid = uuid
+        self.size = size
+        self.active = active
+        self.tags = tags
+
+
+def _split_lv_path(path):
+    # type: (str) -> (str, str)
+    names = os.path.normpath(path.strip()).split("/")
+    if len(names) == 4 and names[0] == "" and names[1] == "dev":
+        names = names[2:]
+    if len(names) == 2 and names[0] and names[1]:
+        return names[0], names[1]
+    return None, None
+
+
+def _new_lv_info(lv_name, vg_name, uuid, size, active, tags):
+    return LvInfo(vg_name, lv_name, uuid, long(size.strip().strip("B") or 0),
+                  "active" in active.split(), set(t for t in tags.split(",") if t))
+
+
+def _parse_lvs_json(output):
+    lvs = []
+    for report in json.loads(output)["report"]:
+        for lv in report.get("lv", []):
+            lvs.append(_new_lv_info(*[lv[f] for f in LVS_FIELDS.split(",")]))
+    return lvs
+
+
+def _parse_lvs_plain(output):
+    lvs = []
+    for line in output.splitlines():
+        if line.strip() != "":
+            lvs.append(_new_lv_info(*line.strip().split("|", 5)))
+    return lvs
+
+
+class LvInventory(object):
+    '''
+    the lvs of a vg loaded by one lvs call and indexed by path. A vg is reloaded after
+    the lvm commands of this module change it, after ttl and once on a miss, as the
+    other hosts sharing the vg create and remove lvs
+    '''
+    def __init__(self, ttl=LV_INVENTORY_TTL):
+        self.ttl = ttl
+        self.json_report = True
+        self.vgs = {}  # vg name -> (load time, {path: LvInfo})
+        self.generations = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    def _lvs(self, target):
+        # the lvs of target, a vg or an lv; None if lvs failed
+        if self.json_report:
+            r, o, e = bash.bash_roe("lvs --nolocking --noheadings --units b --nosuffix --reportformat json -o %s %s" %
+                                    (LVS_FIELDS, target))
+            if r == 0:
+                try:
+                    return _parse_lvs_json(o)
+                except (ValueError, KeyError, TypeError):
+                    pass
+            elif "reportformat" not in e:
+                return None
+            logger.debug("lvs does not support json report, use separated columns instead")
+            self.json_report = False
+
+        r, o, e = bash.bash_roe("lvs --nolocking --noheadings --units b --nosuffix --separator '|' -o %s %s" %
+                                (LVS_FIELDS, target))
+        if r != 0:
+            return None
+        return _parse_lvs_plain(o)
+
+    def _load(self, vg, force=False):
+        with self.lock:
+            loaded = self.vgs.get(vg)
+            if loaded and not force and time.time() - loaded[0] < self.ttl:
+                return loaded[1], False
+            generation = (self.epoch, self.generations.get(vg, 0))
+
+        load_time = time.time()
+        lvs = self._lvs(vg)
+        if lvs is None:
+            return {}, True
+
+        indexed = dict((lv.path, lv) for lv in lvs)
+        with self.lock:
+            # not to keep a snapshot taken while an lvm command was changing the vg
+            if generation == (self.epoch, self.generations.get(vg, 0)):
+                self.vgs[vg] = (load_time, indexed)
+        return indexed, True
+
+    def get(self, path):
+        # type: (str) -> LvInfo
+        vg, lv = _split_lv_path(path)
+        if vg is None:
+            lvs = self._lvs(path)
+            return lvs[0] if lvs else None
+
+        path = "/dev/%s/%s" % (vg, lv)
+        lvs, fresh = self._load(vg)
+        if path not in lvs and not fresh:
+            lvs, _ = self._load(vg, force=True)
+        return lvs.get(path)
+
+    def list(self, vg):
+        # type: (str) -> list[LvInfo]
+        return self._load(vg)[0].values()
+
+    def invalidate(self, path=None):
+        # invalidates the vg of path, or all vgs if path is None or not like /dev/vg/lv
+        vg = _split_lv_path(path)[0] if path else None
+        with self.lock:
+            if vg is None:
+                self.epoch += 1
+                self.vgs.clear()
+            else:
+                self.generations[vg] = self.generations.get(vg, 0) + 1
+                self.vgs.pop(vg, None)
+
+
+inventory = LvInventory()
+
+
+@contextlib.contextmanager
+def _changing(*paths):
+    try:
+        yield
+    finally:
+        for path in paths:
+            inventory.invalidate(path)
+
+
 def has_lv_tag(path, tag):
     if tag == "":
         logger.debug("check tag is empty, return false")
         return False
-    o = shell.call("lvs -Stags={%s} %s --nolocking --noheadings --readonly 2>/dev/null | wc -l" % (tag, path))
-    return o.strip() == '1'
+    lv = inventory.get(path)
+    return lv is not None and tag in lv.tags
 
 
 def clean_lv_tag(path, tag):
     if has_lv_tag(path, tag):
-        shell.run('lvchange --deltag %s %s' % (tag, path))
+        with _changing(path):
+            shell.run('lvchange --deltag %s %s' % (tag, path))
 
 
 def add_lv_tag(path, tag):
     if not has_lv_tag(path, tag):
-        shell.run('lvchange --addtag %s %s' % (tag, path))
+        with _changing(path):
+            shell.run('lvchange --addtag %s %s' % (tag, path))
 
 
 def get_meta_lv_path(path):
@@ -417,7 +562,8 @@ def delete_image(path, tag):
     def activate_and_remove(f):
         active_lv(f, shared=False)
         backing = linux.qcow2_get_backing_file(f)
-        shell.check_run("lvremove -y -Stags={%s} %s" % (tag, f))
+        with _changing(f):
+            shell.check_run("lvremove -y -Stags={%s} %s" % (tag, f))
         return f
 
     fpath = path
@@ -444,8 +590,9 @@ def create_lv_from_absolute_path(path, size, tag="zs::sharedblock::volume"):
     vgName = path.split("/")[2]
     lvName = path.split("/")[3]
 
-    bash.bash_errorout("lvcreate -an --addtag %s --size %sb --name %s %s" %
-                         (tag, calcLvReservedSize(size), lvName, vgName))
+    with _changing(path):
+        bash.bash_errorout("lvcreate -an --addtag %s --size %sb --name %s %s" %
+                           (tag, calcLvReservedSize(size), lvName, vgName))
     if not lv_exists(path):
         raise Exception("can not find lv %s after create", path)
 
@@ -459,14 +606,16 @@ def dd_zero(path):
 
 
 def get_lv_size(path):
-    cmd = shell.ShellCmd("lvs --nolocking --readonly --noheading -osize --units b %s" % path)
-    cmd(is_exception=True)
-    return cmd.stdout.strip().strip("B")
+    lv = inventory.get(path)
+    if lv is None:
+        raise Exception("can not find lv %s" % path)
+    return str(lv.size)
 
 
 def resize_lv(path, size):
     cmd = shell.ShellCmd("lvresize --size %sb %s" % (calcLvReservedSize(size), path))
-    cmd(is_exception=True)
+    with _changing(path):
+        cmd(is_exception=True)
 
 
 @bash.in_bash
@@ -476,11 +625,27 @@ def active_lv(path, shared=False):
     if shared:
         flag = "-asy"
 
-    bash.bash_errorout("lvchange %s %s" % (flag, path))
+    with _changing(path):
+        bash.bash_errorout("lvchange %s %s" % (flag, path))
     if lv_is_active(path) is False:
         raise Exception("active lv %s with %s failed" % (path, flag))
 
 
+@bash.in_bash
+@linux.retry(times=10, sleep_time=random.uniform(0.1, 3))
+def active_lvs(paths, shared=False):
+    # activates all the paths by one lvchange
+    if len(paths) == 0:
+        return
+    flag = "-asy" if shared else "-ay"
+
+    with _changing(*paths):
+        r, o, e = bash.bash_roe("lvchange %s %s" % (flag, " ".join(paths)))
+    inactive = [p for p in paths if not lv_is_active(p)]
+    if len(inactive) != 0:
+        raise Exception("active lvs %s with %s failed, stdout: %s, stderr: %s" % (inactive, flag, o, e))
+
+
 @bash.in_bash
 @linux.retry(times=3, sleep_time=random.uniform(0.1, 3))
 def deactive_lv(path, raise_exception=True):
@@ -488,33 +653,51 @@ def deactive_lv(path, raise_exception=True):
         return
     if not lv_is_active(path):
         return
-    if raise_exception:
-        bash.bash_errorout("lvchange -an %s" % path)
-    else:
-        bash.bash_r("lvchange -an %s" % path)
+    with _changing(path):
+        if raise_exception:
+            bash.bash_errorout("lvchange -an %s" % path)
+        else:
+            bash.bash_r("lvchange -an %s" % path)
     if lv_is_active(path):
         raise RetryException("lv %s is still active after lvchange -an" % path)
 
 
+@bash.in_bash
+@linux.retry(times=3, sleep_time=random.uniform(0.1, 3))
+def deactive_lvs(paths, raise_exception=True):
+    # deactivates all the active ones of paths by one lvchange
+    paths = [p for p in paths if lv_is_active(p)]
+    if len(paths) == 0:
+        return
+
+    with _changing(*paths):
+        r, o, e = bash.bash_roe("lvchange -an %s" % " ".join(paths))
+    if r != 0 and raise_exception:
+        raise Exception("deactive lvs %s failed, stdout: %s, stderr: %s" % (paths, o, e))
+    active = [p for p in paths if lv_is_active(p)]
+    if len(active) != 0:
+        raise RetryException("lvs %s are still active after lvchange -an" % active)
+
+
 @bash.in_bash
 def delete_lv(path, raise_exception=True):
     logger.debug("deleting lv %s" % path)
     # remove meta-lv if any
     if lv_exists(get_meta_lv_path(path)):
-        shell.run("lvremove -y %s" % get_meta_lv_path(path))
+        with _changing(path):
+            shell.run("lvremove -y %s" % get_meta_lv_path(path))
     if not lv_exists(path):
         return
-    if raise_exception:
-        o = bash.bash_errorout("lvremove -y %s" % path)
-    else:
-        o = bash.bash_o("lvremove -y %s" % path)
+    with _changing(path):
+        if raise_exception:
+            o = bash.bash_errorout("lvremove -y %s" % path)
+        else:
+            o = bash.bash_o("lvremove -y %s" % path)
     return o
 
 
-@bash.in_bash
 def lv_exists(path):
-    r = bash.bash_r("lvs --nolocking --readonly %s" % path)
-    return r == 0
+    return inventory.get(path) is not None
 
 
 @bash.in_bash
@@ -525,21 +708,21 @@ def vg_exists(vgUuid):
 
 
 def lv_uuid(path):
-    cmd = shell.ShellCmd("lvs --nolocking --readonly --noheadings %s -ouuid" % path)
-    cmd(is_exception=False)
-    return cmd.stdout.strip()
+    lv = inventory.get(path)
+    return lv.uuid if lv else ""
 
 
 def lv_is_active(path):
-    # NOTE(weiw): use readonly to get active may return 'unknown'
-    r = bash.bash_r("lvs --nolocking --noheadings %s -oactive | grep -w active" % path)
-    return r == 0
+    # NOTE(weiw): use readonly to get active may return 'unknown', the inventory doesn't
+    lv = inventory.get(path)
+    return lv is not None and lv.active
 
 
 @bash.in_bash
 def lv_rename(old_abs_path, new_abs_path, overwrite=False):
     if not lv_exists(new_abs_path):
-        return bash.bash_roe("lvrename %s %s" % (old_abs_path, new_abs_path))
+        with _changing(old_abs_path, new_abs_path):
+            return bash.bash_roe("lvrename %s %s" % (old_abs_path, new_abs_path))
 
     if overwrite is False:
         raise Exception("lv with name %s is already exists, can not rename lv %s to it" %
@@ -553,7 +736,8 @@ def lv_rename(old_abs_path, new_abs_path, overwrite=False):
 
     r, o, e = lv_rename(old_abs_path, new_abs_path)
     if r != 0:
-        bash.bash_errorout("lvrename %s %s" % (tmp_path, new_abs_path))
+        with _changing(new_abs_path):
+            bash.bash_errorout("lvrename %s %s" % (tmp_path, new_abs_path))
         raise Exception("rename lv %s to tmp name %s failed: stdout: %s, stderr: %s" %
                         (old_abs_path, new_abs_path, o, e))
 
@@ -561,13 +745,7 @@ def lv_rename(old_abs_path, new_abs_path, overwrite=False):
 
 
 def list_local_active_lvs(vgUuid):
-    cmd = shell.ShellCmd("lvs --nolocking %s --noheadings -opath -Slv_active=active" % vgUuid)
-    cmd(is_exception=False)
-    result = []
-    for i in cmd.stdout.strip().split("\n"):
-        if i != "":
-            result.append(i)
-    return result
+    return sorted(lv.path for lv in inventory.list(vgUuid) if lv.active)
 
 
 def check_gl_lock(raise_exception=False):
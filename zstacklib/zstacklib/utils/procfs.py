@@ -0,0 +1,197 @@
+'''
+the process table read from /proc without forking ps.
+
+a snapshot is shared by the callers for PROCESS_TABLE_TTL seconds, callers which must
+not miss a process just started or exited scan again with force.
+
+@author: frank
+'''
+import errno
+import os
+import os.path
+import re
+import signal
+import threading
+import time
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+PROCESS_TABLE_TTL = 1
+
+ZSTACK_UUID_PATTERN = re.compile('[0-9a-f]{8}[0-9a-f]{4}[1-5][0-9a-f]{3}[89ab][0-9a-f]{3}[0-9a-f]{12}')
+# qemu-kvm and qemu-system-<arch>, not the tools like qemu-img and qemu-nbd
+QEMU_EXECUTABLES = ('qemu-kvm', 'qemu-system-')
+
+CLOCK_TICKS = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+
+def _read(path):
+    with open(path) as fd:
+        return fd.read()
+
+def get_up_time(proc_dir='/proc'):
+    return float(_read(os.path.join(proc_dir, 'uptime')).split()[0])
+
+class Process(object):
+    def __init__(self, pid, args, proc_dir='/proc'):
+        self.pid = pid
+        self.args = args
+        self.proc_dir = proc_dir
+        self.exe = os.path.basename(args[0]) if args else ''
+        self.cmdline = ' '.join(args)
+        self._stat = None
+
+    def _get_stat(self):
+        if self._stat is None:
+            stat = _read(os.path.join(self.proc_dir, self.pid, 'stat'))
+            # the comm in parentheses may contain spaces and parentheses
+            left, right = stat.index('('), stat.rindex(')')
+            self._stat = [stat[left + 1:right]] + stat[right + 2:].split()
+        return self._stat
+
+    @property
+    def comm(self):
+        return self._get_stat()[0]
+
+    @property
+    def start_time(self):
+        '''seconds after boot'''
+        # the 22nd field, the 20th after pid and comm
+        return float(self._get_stat()[20]) / CLOCK_TICKS
+
+    def get_up_time(self):
+        return get_up_time(self.proc_dir) - self.start_time
+
+    def is_qemu(self):
+        return self.exe == QEMU_EXECUTABLES[0] or self.exe.startswith(QEMU_EXECUTABLES[1])
+
+    def has_words(self, *words):
+        '''words of the cmdline like grep -w'''
+        for w in words:
+            if not re.search(r'(?<!\w)%s(?!\w)' % re.escape(w), self.cmdline):
+                return False
+        return True
+
+    def __repr__(self):
+        return '<Process %s %s>' % (self.pid, self.cmdline)
+
+def get_qemu_vm_name(args):
+    '''the name of -name guest=<name>,debug-threads=on or -name <name>'''
+    if '-name' not in args[:-1]:
+        return None
+
+    name = args[args.index('-name') + 1].split(',')[0]
+    if name.startswith('guest='):
+        name = name[len('guest='):]
+    return name
+
+def get_qemu_vm_uuid(args):
+    '''the uuid only if it is the name of the vm, uuids elsewhere in the args are volumes or images'''
+    name = get_qemu_vm_name(args)
+    if name and len(name) == 32 and ZSTACK_UUID_PATTERN.match(name):
+        return name
+    return None
+
+class ProcessTable(object):
+    def __init__(self, processes, read_time):
+        self.read_time = read_time
+        self.processes = processes  # type: list[Process]
+        self.by_pid = {}
+        self.by_exe = {}
+        self.by_token = {}
+        for p in processes:
+            self.by_pid[p.pid] = p
+            self.by_exe.setdefault(p.exe, []).append(p)
+            for token in set(p.args):
+                self.by_token.setdefault(token, []).append(p)
+
+    def get(self, pid):
+        return self.by_pid.get(str(pid))
+
+    def find_by_exe(self, exe):
+        return self.by_exe.get(exe, [])
+
+    def find_by_token(self, token):
+        '''processes having the exact argument'''
+        return self.by_token.get(token, [])
+
+    def find(self, *substrings):
+        '''processes having all substrings in the cmdline'''
+        return [p for p in self.processes if all(s in p.cmdline for s in substrings)]
+
+    def get_qemu_processes(self):
+        return [p for p in self.processes if p.is_qemu()]
+
+    def get_qemu_vm_pids(self):
+        '''vm uuid -> pids of its qemu processes'''
+        vm_pids = {}
+        for p in self.get_qemu_processes():
+            uuid = get_qemu_vm_uuid(p.args)
+            if uuid:
+                vm_pids.setdefault(uuid, []).append(p.pid)
+        return vm_pids
+
+    def get_qemu_vm_names(self):
+        names = [get_qemu_vm_name(p.args) for p in self.get_qemu_processes()]
+        return [n for n in names if n is not None]
+
+def scan(proc_dir='/proc'):
+    read_time = time.time()
+    processes = []
+    for pid in os.listdir(proc_dir):
+        if not pid.isdigit():
+            continue
+        try:
+            cmdline = _read(os.path.join(proc_dir, pid, 'cmdline'))
+        except IOError:
+            continue
+
+        # kernel threads have no cmdline
+        if cmdline:
+            processes.append(Process(pid, cmdline.rstrip('\0').split('\0'), proc_dir))
+    return ProcessTable(processes, read_time)
+
+class ProcessTableCache(object):
+    def __init__(self, ttl=PROCESS_TABLE_TTL, proc_dir='/proc'):
+        self.ttl = ttl
+        self.proc_dir = proc_dir
+        self.table = None  # type: ProcessTable
+        self.lock = threading.Lock()
+
+    def get(self, force=False):
+        '''a table read within ttl seconds, force reads one after this call'''
+        now = time.time()
+        with self.lock:
+            table = self.table
+        if not force and table and now - table.read_time <= self.ttl:
+            return table
+
+        table = scan(self.proc_dir)
+        with self.lock:
+            if self.table is None or self.table.read_time < table.read_time:
+                self.table = table
+        return table
+
+cache = ProcessTableCache()
+
+def get_process_table(force=False):
+    return cache.get(force)
+
+def find_pids(*substrings):
+    '''
+    pids of the live processes having all substrings in the cmdline, /proc is scanned
+    again if none is found in the cached table
+    '''
+    table = get_process_table()
+    pids = [p.pid for p in table.find(*substrings) if os.path.exists(os.path.join(cache.proc_dir, p.pid))]
+    if not pids:
+        pids = [p.pid for p in get_process_table(force=True).find(*substrings)]
+    return pids
+
+def kill_processes(processes, sig=signal.SIGKILL):
+    for p in processes:
+        try:
+            os.kill(int(p.pid), sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
@@ -0,0 +1,153 @@
+'''
+reads the format, virtual size, cluster size and backing file of local images from their
+headers instead of running qemu-img info. The metadata of regular files is cached by
+(device, inode, mtime, size), block devices are read each time as writes don't change their
+mtime. Callers fall back to qemu-img on None, e.g. for rbd paths or formats other than qcow2
+and raw.
+
+@author: frank
+'''
+import os
+import os.path
+import stat
+import struct
+import threading
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+QCOW2_MAGIC = 'QFI\xfb'
+# magics of the formats qemu-img tells apart from raw
+OTHER_MAGICS = ('KDMV', '# Disk DescriptorFile', 'conectix', 'vhdxfile', 'LUKS\xba\xbe', 'QED\x00', 'QEVM', 'WithoutFreeSpace')
+VDI_MAGIC = '\x7f\x10\xda\xbe'
+HEADER_LENGTH = 4096
+EXT_END = 0
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+MAX_CACHED_IMAGES = 16384
+
+class ImageInfo(object):
+    def __init__(self, path, format, virtual_size, cluster_size=None, backing_file=None, backing_format=None, version=None):
+        self.path = path
+        self.format = format
+        self.virtual_size = virtual_size
+        self.cluster_size = cluster_size
+        # as written in the header, a relative name is relative to the directory of path
+        self.backing_file = backing_file
+        self.backing_format = backing_format
+        self.version = version
+
+    def get_backing_path(self):
+        if not self.backing_file:
+            return None
+        if os.path.isabs(self.backing_file):
+            return self.backing_file
+        return os.path.join(os.path.dirname(self.path), self.backing_file)
+
+def _parse_qcow2(path, fd, header):
+    if len(header) < 72:
+        return None
+
+    version, backing_offset, backing_size, cluster_bits, virtual_size = struct.unpack('>IQIIQ', header[4:32])
+    if version not in (2, 3) or not 9 <= cluster_bits <= 21:
+        return None
+
+    backing_file = None
+    if backing_offset:
+        if backing_offset + backing_size <= len(header):
+            backing_file = header[backing_offset:backing_offset + backing_size]
+        else:
+            fd.seek(backing_offset)
+            backing_file = fd.read(backing_size)
+
+    backing_format = None
+    ext_offset = 72
+    if version == 3 and len(header) >= 104:
+        ext_offset = struct.unpack('>I', header[100:104])[0]
+    # header extensions are between the header and the backing file name
+    ext_end = backing_offset if backing_offset else 1 << cluster_bits
+    while ext_offset + 8 <= min(ext_end, len(header)):
+        ext_type, ext_len = struct.unpack('>II', header[ext_offset:ext_offset + 8])
+        if ext_type == EXT_END:
+            break
+        if ext_type == EXT_BACKING_FORMAT:
+            backing_format = header[ext_offset + 8:ext_offset + 8 + ext_len]
+        ext_offset += 8 + (ext_len + 7) / 8 * 8
+
+    return ImageInfo(path, 'qcow2', virtual_size, 1 << cluster_bits, backing_file, backing_format, version)
+
+def read_info(path):
+    '''
+    the metadata of a local qcow2 or raw image from its header, no cache.
+    Returns None if the image is not a local file or in other formats
+    '''
+    try:
+        with open(path, 'rb') as fd:
+            header = fd.read(HEADER_LENGTH)
+            if header[:4] == QCOW2_MAGIC:
+                return _parse_qcow2(path, fd, header)
+
+            if any(header.startswith(m) for m in OTHER_MAGICS) or header[0x40:0x44] == VDI_MAGIC:
+                return None
+            fd.seek(0, os.SEEK_END)
+            # a vpc image has its footer at the end
+            size = fd.tell()
+            if size >= 512:
+                fd.seek(size - 512)
+                if fd.read(8) == 'conectix':
+                    return None
+            return ImageInfo(path, 'raw', size)
+    except (IOError, OSError) as e:
+        logger.debug('cannot read the header of %s, %s' % (path, e))
+        return None
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def get_info(path):
+    '''read_info() cached by (device, inode, mtime, size) of regular files'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if not stat.S_ISREG(st.st_mode):
+        return read_info(path)
+
+    key = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+    with _cache_lock:
+        cached = _cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    info = read_info(path)
+    if info:
+        with _cache_lock:
+            if len(_cache) >= MAX_CACHED_IMAGES:
+                _cache.clear()
+            _cache[path] = (key, info)
+    return info
+
+def invalidate(path):
+    with _cache_lock:
+        _cache.pop(path, None)
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+def get_chain(path):
+    '''
+    path and its backing files from the top, None if a member of the chain is not a
+    local qcow2 or raw image
+    '''
+    chain = []
+    while path:
+        if path in chain:
+            raise Exception('backing file loop found in the chain of %s: %s' % (chain[0], chain))
+        info = get_info(path)
+        if not info:
+            return None
+        chain.append(path)
+        path = info.get_backing_path()
+    return chain
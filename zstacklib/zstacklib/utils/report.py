@@ -1,10 +1,21 @@
+import threading
+import time
+
 from zstacklib.utils import http
 from zstacklib.utils import log
-from zstacklib.utils import thread
 from zstacklib.utils import linux
 
 logger = log.get_logger(__name__)
 
+PROGRESS_FLUSH_INTERVAL = 1
+# a report is not worth blocking the reports to other destinations
+PROGRESS_POST_TIMEOUT = 5
+# start and finish are resent for so long before given up
+PROGRESS_EVENT_RETRY_TIMEOUT = 300
+# the sender thread exits when nothing was reported for so long
+PROGRESS_SENDER_IDLE_TIMEOUT = 60
+PROGRESS_REPORT_PATH = "/progress/report"
+
 class ProgressReportCmd(object):
     def __init__(self):
         self.progress = None
@@ -12,6 +23,124 @@ class ProgressReportCmd(object):
         self.resourceUuid = None
         self.serverUuid = None
 
+class _ProgressItem(object):
+    def __init__(self, url, cmd, header, guaranteed):
+        self.url = url
+        self.cmd = cmd
+        self.header = header
+        self.guaranteed = guaranteed
+        self.queued_time = time.time()
+
+def _post(url, cmd, header):
+    http.json_dump_post(url, cmd, header, fail_soon=True, timeout=PROGRESS_POST_TIMEOUT, retries=False)
+
+class ProgressReporter(object):
+    '''
+    sends the progress of all resources from one thread over the pooled connections.
+
+    only the latest report of a resource waiting to be sent is kept, start and finish
+    are never coalesced and are resent until delivered. A destination failing is skipped
+    until the next flush, the reports to other destinations are still sent
+    '''
+    def __init__(self, post=_post, interval=PROGRESS_FLUSH_INTERVAL, retry_timeout=PROGRESS_EVENT_RETRY_TIMEOUT,
+                 idle_timeout=PROGRESS_SENDER_IDLE_TIMEOUT):
+        self.post = post
+        self.interval = interval
+        self.retry_timeout = retry_timeout
+        self.idle_timeout = idle_timeout
+
+        self.pending = {}  # key -> list[_ProgressItem]
+        self.order = []
+        self.sender = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+
+    def submit(self, key, url, cmd, header, flag):
+        guaranteed = flag in ("start", "finish")
+        item = _ProgressItem(url, cmd, header, guaranteed)
+        with self.lock:
+            items = self.pending.get(key)
+            if items is None:
+                items = self.pending[key] = []
+                self.order.append(key)
+
+            # a report not sent yet is replaced by the newer one or by the finish
+            if items and not items[-1].guaranteed and flag != "start":
+                items.pop()
+            items.append(item)
+
+            if self.sender is None:
+                self.sender = threading.Thread(target=self._send_in_background, name='progress-reporter')
+                self.sender.daemon = True
+                self.sender.start()
+
+        if guaranteed:
+            self.wakeup.set()
+
+    def _take(self):
+        with self.lock:
+            taken = [(key, self.pending.pop(key)) for key in self.order]
+            self.order = []
+            return taken
+
+    def _requeue(self, key, items):
+        now = time.time()
+        items = [i for i in items if i.guaranteed]
+        for i in items:
+            if now - i.queued_time > self.retry_timeout:
+                logger.warn("give up reporting progress[%s] of %s[%s]" %
+                            (i.cmd.progress, i.cmd.processType, i.cmd.resourceUuid))
+        items = [i for i in items if now - i.queued_time <= self.retry_timeout]
+        if not items:
+            return
+
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                self.pending[key] = items
+                self.order.append(key)
+            else:
+                self.pending[key] = items + pending
+
+    def flush(self):
+        '''
+        sends what is pending, returns False if some of it has to be resent
+        '''
+        failed_urls = set()
+        for key, items in self._take():
+            for pos, i in enumerate(items):
+                if i.url in failed_urls:
+                    self._requeue(key, items[pos:])
+                    break
+
+                try:
+                    self.post(i.url, i.cmd, i.header)
+                except Exception as e:
+                    logger.warn("report progress to %s failed: %s" % (i.url, e))
+                    failed_urls.add(i.url)
+                    self._requeue(key, items[pos:])
+                    break
+        return not failed_urls
+
+    def _send_in_background(self):
+        last_sent = time.time()
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                if self.pending:
+                    last_sent = time.time()
+                self.flush()
+            except Exception:
+                logger.warn(linux.get_exception_stacktrace())
+
+            with self.lock:
+                if not self.pending and time.time() - last_sent > self.idle_timeout:
+                    self.sender = None
+                    return
+
+reporter = ProgressReporter()
+
 def get_scale(stage=None):
     if not stage:
         return 0, 100
@@ -42,18 +171,17 @@ class Report(object):
         try:
             self.progress = percent
             header = {
-                "start": "/progress/report",
-                "finish": "/progress/report",
-                "report": "/progress/report"
+                "start": PROGRESS_REPORT_PATH,
+                "finish": PROGRESS_REPORT_PATH,
+                "report": PROGRESS_REPORT_PATH
             }
-            self.header = {'commandpath': header.get(flag, "/progress/report")}
-            self.report()
+            self.header = {'commandpath': header.get(flag, PROGRESS_REPORT_PATH)}
+            self.report(flag)
         except Exception as e:
             logger.warn(linux.get_exception_stacktrace())
             logger.warn("report progress failed: %s" % e.message)
 
-    @thread.AsyncThread
-    def report(self):
+    def report(self, flag="report"):
         if not self.url:
             raise Exception('No url specified')
 
@@ -65,5 +193,32 @@ class Report(object):
         cmd.threadContextMap = self.ctxMap
         cmd.threadContextStack = self.ctxStack
         logger.debug("url: %s, progress: %s, header: %s", Report.url, cmd.progress, self.header)
-        http.json_dump_post(Report.url, cmd, self.header)
+        key = (self.processType, self.resourceUuid, id(self.ctxMap))
+        reporter.submit(key, Report.url, cmd, self.header, flag)
+
+
+class MigrationProgress(object):
+    '''
+    bytes handled by a migration step, reported when the percent between start and end changes
+    '''
+    def __init__(self, report, start, end, total):
+        self.report = report
+        self.start = start
+        self.end = end
+        self.total = total
+        self.done = 0
+        self.percent = None
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.done += size
+            if self.total > 0:
+                percent = int(round(float(self.done) / float(self.total) * (self.end - self.start) + self.start))
+            else:
+                percent = self.end
+            if percent == self.percent:
+                return
+            self.percent = percent
 
+        self.report.progress_report(percent, "report")
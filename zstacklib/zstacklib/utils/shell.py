@@ -3,7 +3,9 @@
 @author: frank
 '''
 import subprocess
+import time
 from zstacklib.utils import log
+from zstacklib.utils import shellpool
 
 logcmd = True
 
@@ -17,25 +19,34 @@ class ShellCmd(object):
     classdocs
     '''
     
-    def __init__(self, cmd, workdir=None, pipe=True):
+    def __init__(self, cmd, workdir=None, pipe=True, pooled=False):
         '''
         Constructor
+
+        a pooled command runs in a bash worker of shellpool if one is free, the
+        process is only started when the command is called and no worker runs it
         '''
         self.cmd = cmd
-        if pipe:
-            self.process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                                            stderr=subprocess.PIPE, close_fds=True, executable='/bin/bash', cwd=workdir)
-        else:
-            self.process = subprocess.Popen(cmd, shell=True, close_fds=True, executable='/bin/bash', cwd=workdir)
+        self.workdir = workdir
+        self.process = None
+        if not pooled:
+            self._start_process(pipe)
             
         self.stdout = None
         self.stderr = None
         self.return_code = None
 
+    def _start_process(self, pipe=True):
+        if pipe:
+            self.process = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                                            stderr=subprocess.PIPE, close_fds=True, executable='/bin/bash', cwd=self.workdir)
+        else:
+            self.process = subprocess.Popen(self.cmd, shell=True, close_fds=True, executable='/bin/bash', cwd=self.workdir)
+
     def raise_error(self):
         err = []
         err.append('failed to execute shell command: %s' % self.cmd)
-        err.append('return code: %s' % self.process.returncode)
+        err.append('return code: %s' % self.return_code)
         err.append('stdout: %s' % self.stdout)
         err.append('stderr: %s' % self.stderr)
         raise ShellError('\n'.join(err))
@@ -43,17 +54,29 @@ class ShellCmd(object):
     def __call__(self, is_exception=True):
         if logcmd:
             logger.debug(self.cmd)
-            
-        (self.stdout, self.stderr) = self.process.communicate()
-        if is_exception and self.process.returncode != 0:
+
+        start_time = time.time()
+        ret = None
+        if not self.process:
+            ret = shellpool.run(self.cmd, self.workdir)
+
+        if ret:
+            self.return_code, self.stdout, self.stderr = ret
+        else:
+            if not self.process:
+                self._start_process()
+            (self.stdout, self.stderr) = self.process.communicate()
+            self.return_code = self.process.returncode
+
+        shellpool.record(self.cmd, start_time)
+        if is_exception and self.return_code != 0:
             self.raise_error()
 
-        self.return_code = self.process.returncode
         return self.stdout
 
 def call(cmd, exception=True, workdir=None):
     # type: (str, bool, bool) -> str
-    return ShellCmd(cmd, workdir)(exception)
+    return ShellCmd(cmd, workdir, pooled=True)(exception)
 
 def run(cmd, workdir=None):
     s = ShellCmd(cmd, workdir, False)
@@ -0,0 +1,264 @@
+'''
+long-lived bash workers running the commands of bash.bash_roe() and shell.call(),
+a command then costs a fork of a small bash instead of a fork of the agent.
+
+@author: frank
+'''
+import errno
+import fcntl
+import os
+import os.path
+import re
+import select
+import subprocess
+import threading
+import time
+import uuid
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+POOL_SIZE = 8
+enabled = True
+
+# frames are '<token>\0<workdir>\0<command>\0'. A command runs in a subshell so 'exit',
+# 'cd' or 'set' in it don't change the worker, its stdout and stderr end with
+# '\0<token><return code in 3 digits>\n'
+_WORKER_SCRIPT = r'''
+while IFS= read -r -d '' __zs_token && IFS= read -r -d '' __zs_cwd && IFS= read -r -d '' __zs_cmd; do
+    if [ -n "$__zs_cwd" ]; then
+        (cd "$__zs_cwd" && eval "$__zs_cmd") </dev/null
+    else
+        (eval "$__zs_cmd") </dev/null
+    fi
+    __zs_rc=$?
+    printf '\0%s%03d\n' "$__zs_token" $__zs_rc >&2
+    printf '\0%s%03d\n' "$__zs_token" $__zs_rc
+done
+'''
+
+# a background job started by a command would keep the worker's stdout, and
+# write into the output of later commands
+_BACKGROUND_JOB = re.compile(r'(?<![&>|<])&(?![&>])')
+
+class WorkerError(Exception):
+    '''bash worker error'''
+
+class _Stream(object):
+    def __init__(self, fd, marker):
+        self.fd = fd
+        self.marker = marker
+        self.frame_len = len(marker) + 4
+        self.chunks = []
+        self.size = 0
+        self.tail = ''
+        self.end = None
+        self.done = False
+
+    def feed(self, chunk):
+        if self.end is None:
+            window = self.tail + chunk
+            pos = window.find(self.marker)
+            if pos >= 0:
+                self.end = self.size - len(self.tail) + pos
+            else:
+                self.tail = window[-(len(self.marker) - 1):]
+
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if self.end is not None and self.size >= self.end + self.frame_len:
+            self.done = True
+
+    def result(self):
+        data = ''.join(self.chunks)
+        rc = int(data[self.end + len(self.marker):self.end + len(self.marker) + 3])
+        return data[:self.end], rc
+
+class BashWorker(object):
+    def __init__(self):
+        self.process = subprocess.Popen(['/bin/bash', '-c', _WORKER_SCRIPT], stdout=subprocess.PIPE,
+                                        stdin=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        # commands forked later by the agent must not hold the pipes of the worker
+        for f in (self.process.stdin, self.process.stdout, self.process.stderr):
+            flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def run(self, cmd, workdir=None):
+        token = uuid.uuid4().hex
+        marker = '\0%s' % token
+        try:
+            self.process.stdin.write('%s\0%s\0%s\0' % (token, workdir or '', cmd))
+            self.process.stdin.flush()
+        except IOError as e:
+            raise WorkerError('failed to send command to bash worker[pid:%s], %s' % (self.process.pid, e))
+
+        streams = {}
+        for f in (self.process.stdout, self.process.stderr):
+            streams[f.fileno()] = _Stream(f.fileno(), marker)
+
+        pending = streams.keys()
+        while pending:
+            try:
+                readable, _, _ = select.select(pending, [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise WorkerError('bash worker[pid:%s] exited when running %s' % (self.process.pid, cmd))
+
+                s = streams[fd]
+                s.feed(chunk)
+                if s.done:
+                    pending.remove(fd)
+
+        o, r = streams[self.process.stdout.fileno()].result()
+        e, _ = streams[self.process.stderr.fileno()].result()
+        return r, o, e
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except Exception:
+            logger.warn('failed to stop bash worker[pid:%s]' % self.process.pid)
+
+class BashWorkerPool(object):
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._idle = []
+        self._count = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # workers are not shared with a forked child
+                self._pid = os.getpid()
+                self._idle = []
+                self._count = 0
+
+            if self._idle:
+                return self._idle.pop()
+            if self._count >= self.size:
+                return None
+            self._count += 1
+
+        try:
+            return BashWorker()
+        except Exception as e:
+            with self._lock:
+                self._count -= 1
+            logger.warn('failed to start a bash worker, %s' % e)
+            return None
+
+    def _release(self, worker, broken=False):
+        with self._lock:
+            if not broken and self._pid == os.getpid() and worker.process.poll() is None:
+                self._idle.append(worker)
+                return
+            self._count -= 1
+
+        worker.close()
+
+    def prestart(self, num=None):
+        workers = [w for w in [self._acquire() for _ in range(num or self.size)] if w]
+        for w in workers:
+            self._release(w)
+
+    # @return: return code, stdout, stderr; or None if no worker can run the command now
+    def run(self, cmd, workdir=None):
+        worker = self._acquire()
+        if not worker:
+            return None
+
+        try:
+            ret = worker.run(cmd, workdir)
+        except:
+            # the output of the command may be half read
+            self._release(worker, broken=True)
+            raise
+
+        self._release(worker)
+        return ret
+
+_pool = BashWorkerPool()
+
+def get_pool():
+    return _pool
+
+# @return: return code, stdout, stderr; or None if the command has to be run in a new bash
+def run(cmd, workdir=None):
+    if not enabled or '\0' in cmd or _BACKGROUND_JOB.search(cmd):
+        return None
+    if workdir and not os.path.isdir(workdir):
+        return None
+
+    return _pool.run(cmd, workdir)
+
+class CommandStats(object):
+    # upper bounds of the histogram buckets in milliseconds, the last bucket counts the slower
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def record(self, cost):
+        self.count += 1
+        self.total_time += cost
+        self.max_time = max(self.max_time, cost)
+        for i, b in enumerate(self.BUCKETS):
+            if cost <= b:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def to_dict(self):
+        buckets = ['<=%sms' % b for b in self.BUCKETS] + ['>%sms' % self.BUCKETS[-1]]
+        return {
+            'count': self.count,
+            'avgTime': self.total_time / self.count if self.count else 0,
+            'maxTime': self.max_time,
+            'histogram': dict(zip(buckets, self.histogram))
+        }
+
+MAX_STATS_COMMANDS = 512
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _command_name(cmd):
+    for w in cmd.replace(';', ' ').split():
+        if w in ('set', '-o', 'pipefail', 'sudo', 'nohup', 'exec') or '=' in w:
+            continue
+        return os.path.basename(w)
+    return ''
+
+def record(cmd, start_time):
+    cost = (time.time() - start_time) * 1000
+    name = _command_name(cmd)
+    with _stats_lock:
+        s = _stats.get(name)
+        if s is None:
+            if len(_stats) >= MAX_STATS_COMMANDS:
+                name = 'others'
+                s = _stats.setdefault(name, CommandStats())
+            else:
+                s = _stats[name] = CommandStats()
+        s.record(cost)
+
+# @return: command name -> count, average and max time in milliseconds, histogram
+def get_command_stats():
+    with _stats_lock:
+        return dict([(k, v.to_dict()) for k, v in _stats.items()])
+
+def reset_command_stats():
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,177 @@
+'''
+registry of long running tasks (e.g. image uploads) polled by their ids.
+
+Running tasks live in the live generation and are only dropped when idle longer than
+live_ttl, a heap of expiry times finds them without scanning. Finished tasks move to
+the finished generation, kept in finishing order and bounded by max_finished and
+finished_ttl. The registry can be snapshotted to a file and loaded after a restart.
+
+@author: frank
+'''
+import heapq
+import json
+import os
+import os.path
+import threading
+import time
+from collections import OrderedDict
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+LIVE_TTL = 24 * 3600
+FINISHED_TTL = 3600
+MAX_FINISHED_TASKS = 1000
+LOCK_STRIPES = 32
+
+class TaskRegistry(object):
+    def __init__(self, is_finished, last_active, live_ttl=LIVE_TTL, finished_ttl=FINISHED_TTL,
+                 max_finished=MAX_FINISHED_TASKS, snapshot_path=None, to_dict=None, from_dict=None):
+        '''
+        is_finished(task) and last_active(task) tell the state and the last activity time of
+        a task in seconds; to_dict(task) and from_dict(dict) are required by a snapshot_path,
+        a task loaded from a snapshot is the one from_dict() returns
+        '''
+        self.is_finished = is_finished
+        self.last_active = last_active
+        self.live_ttl = live_ttl
+        self.finished_ttl = finished_ttl
+        self.max_finished = max_finished
+        self.snapshot_path = snapshot_path
+        self.to_dict = to_dict
+        self.from_dict = from_dict
+
+        self._live = {}
+        # key -> (task, finish time), oldest first
+        self._finished = OrderedDict()
+        # (expiry time, key) of live tasks, an entry is rechecked when popped as tasks keep active
+        self._expiry = []
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._stripes = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+        if self.snapshot_path:
+            self.load()
+
+    def lock_of(self, key):
+        '''the lock serializing the work on a task, tasks share LOCK_STRIPES locks'''
+        return self._stripes[hash(key) % LOCK_STRIPES]
+
+    def _finish(self, key, now):
+        task = self._live.pop(key)
+        self._finished.pop(key, None)
+        self._finished[key] = (task, now)
+
+    def _expunge(self, now):
+        changed = False
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            task = self._live.get(key)
+            if task is None:
+                continue
+
+            if self.is_finished(task):
+                self._finish(key, now)
+                changed = True
+                continue
+
+            expiry = self.last_active(task) + self.live_ttl
+            if expiry > now:
+                heapq.heappush(self._expiry, (expiry, key))
+            else:
+                logger.warn('drop task[%s] idle for more than %s seconds' % (key, self.live_ttl))
+                del self._live[key]
+                changed = True
+
+        while self._finished:
+            key, (_, finish_time) = next(self._finished.iteritems())
+            if len(self._finished) <= self.max_finished and finish_time + self.finished_ttl > now:
+                break
+            del self._finished[key]
+            changed = True
+
+        return changed
+
+    def add(self, key, task):
+        now = time.time()
+        with self._lock:
+            self._finished.pop(key, None)
+            if key not in self._live:
+                heapq.heappush(self._expiry, (now + self.live_ttl, key))
+            self._live[key] = task
+            self._expunge(now)
+        self.save()
+
+    def get(self, key):
+        now = time.time()
+        changed = False
+        with self._lock:
+            task = self._live.get(key)
+            if task is not None:
+                if self.is_finished(task):
+                    self._finish(key, now)
+                    changed = True
+            else:
+                task, _ = self._finished.get(key, (None, None))
+            changed = self._expunge(now) or changed
+
+        if changed:
+            self.save()
+        return task
+
+    def remove(self, key):
+        with self._lock:
+            task = self._live.pop(key, None)
+            if task is None:
+                task, _ = self._finished.pop(key, (None, None))
+        self.save()
+        return task
+
+    def live_count(self):
+        with self._lock:
+            return len(self._live)
+
+    def finished_count(self):
+        with self._lock:
+            return len(self._finished)
+
+    def save(self):
+        if not self.snapshot_path:
+            return
+
+        with self._save_lock:
+            with self._lock:
+                snapshot = {
+                    'live': [(k, self.to_dict(t)) for k, t in self._live.items()],
+                    'finished': [(k, self.to_dict(t), f) for k, (t, f) in self._finished.items()]
+                }
+
+            try:
+                d = os.path.dirname(self.snapshot_path)
+                if d and not os.path.isdir(d):
+                    os.makedirs(d, 0755)
+                tmp = self.snapshot_path + '.tmp'
+                with open(tmp, 'w') as fd:
+                    json.dump(snapshot, fd)
+                os.rename(tmp, self.snapshot_path)
+            except (IOError, OSError) as e:
+                logger.warn('failed to save the task snapshot %s, %s' % (self.snapshot_path, e))
+
+    def load(self):
+        try:
+            with open(self.snapshot_path) as fd:
+                snapshot = json.load(fd)
+        except IOError:
+            return
+        except ValueError as e:
+            logger.warn('ignore the broken task snapshot %s, %s' % (self.snapshot_path, e))
+            return
+
+        now = time.time()
+        with self._lock:
+            for key, d, finish_time in snapshot.get('finished', []):
+                self._finished[key] = (self.from_dict(d), finish_time)
+            for key, d in snapshot.get('live', []):
+                self._live[key] = self.from_dict(d)
+                heapq.heappush(self._expiry, (now + self.live_ttl, key))
+            self._expunge(now)
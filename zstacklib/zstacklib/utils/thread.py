@@ -4,6 +4,9 @@
 '''
 
 import threading
+import Queue
+import collections
+import time
 import inspect
 import pprint
 import traceback
@@ -70,4 +73,236 @@ class PeriodicTimer(object):
         self.thread.cancel()
         
 def timer(interval, function, args=[], kwargs={}, stop_on_exception=True):
-    return PeriodicTimer(interval, function, args, kwargs, stop_on_exception)
\ No newline at end of file
+    return PeriodicTimer(interval, function, args, kwargs, stop_on_exception)
+
+
+DEFAULT_LANE = 'default'
+# short, latency sensitive requests(ping, echo...) which must never wait
+# behind long running storage jobs
+URGENT_LANE = 'urgent'
+# long running data jobs(image download/upload, volume migration, snapshot merge...),
+# kept apart so they cannot take all the workers of the default lane
+BULK_LANE = 'bulk'
+DEFAULT_LANE_WORKERS = 64
+URGENT_LANE_WORKERS = 4
+BULK_LANE_WORKERS = 16
+
+class _Task(object):
+    def __init__(self, func, args, kwargs, key, done):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.done = done
+        self.submit_time = time.time()
+
+class ExecutorLane(object):
+    def __init__(self, name, max_workers, idle_timeout=60):
+        self.name = name
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = 0
+        self.idle_workers = 0
+        # queued tasks no worker has taken yet, a worker leaving queue.get() with a task is
+        # still counted idle until it takes the lock, the queue size can't tell that
+        self.unclaimed = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+
+    def put(self, task):
+        with self.lock:
+            self.queue.put(task)
+            self.unclaimed += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.unclaimed)
+            if self.idle_workers < self.unclaimed and self.workers < self.max_workers:
+                self.workers += 1
+                self.idle_workers += 1
+                t = threading.Thread(target=self._work, name='%s-lane-worker' % self.name)
+                t.daemon = True
+                t.start()
+
+    def _work(self):
+        while True:
+            try:
+                task = self.queue.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                with self.lock:
+                    if not self.unclaimed:
+                        self.workers -= 1
+                        self.idle_workers -= 1
+                        return
+                continue
+
+            with self.lock:
+                self.unclaimed -= 1
+                self.idle_workers -= 1
+                self.active += 1
+                self.total_wait_time += time.time() - task.submit_time
+
+            ok = True
+            try:
+                task.func(*task.args, **task.kwargs)
+            except Exception as e:
+                ok = False
+                content = traceback.format_exc()
+                err = '%s\n%s\nargs:%s' % (str(e), content, pprint.pformat([task.args, task.kwargs]))
+                logger.warn(err)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.idle_workers += 1
+                    if ok:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                task.done(task)
+
+    def get_metrics(self):
+        with self.lock:
+            processed = self.completed + self.failed
+            return {
+                'maxWorkers': self.max_workers,
+                'workers': self.workers,
+                'active': self.active,
+                'queueDepth': self.unclaimed,
+                'maxQueueDepth': self.max_queue_depth,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avgWaitTime': self.total_wait_time / processed if processed else 0.0
+            }
+
+class Executor(object):
+    '''
+    bounded thread pool replacing thread-per-request for async jobs.
+    Tasks are dispatched to named lanes, each lane has its own workers so
+    that a busy lane never delays another one. A task submitted with a key
+    is held back when the concurrency limit of that key is reached.
+    '''
+
+    def __init__(self):
+        self.lanes = {}
+        self.limits = {}
+        self.running = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.add_lane(DEFAULT_LANE, DEFAULT_LANE_WORKERS)
+        self.add_lane(URGENT_LANE, URGENT_LANE_WORKERS)
+        self.add_lane(BULK_LANE, BULK_LANE_WORKERS)
+
+    def add_lane(self, name, max_workers, idle_timeout=60):
+        with self.lock:
+            lane = self.lanes.get(name)
+            if lane:
+                lane.max_workers = max_workers
+            else:
+                lane = self.lanes[name] = ExecutorLane(name, max_workers, idle_timeout)
+            return lane
+
+    def set_concurrency_limit(self, key, limit):
+        with self.lock:
+            if limit:
+                self.limits[key] = limit
+            else:
+                self.limits.pop(key, None)
+
+        self._dispatch_pending(key)
+
+    def _task_done(self, task):
+        if task.key is None:
+            return
+
+        with self.lock:
+            self.running[task.key] -= 1
+            if not self.running[task.key] and not self.pending.get(task.key):
+                del self.running[task.key]
+                self.pending.pop(task.key, None)
+                return
+        self._dispatch_pending(task.key)
+
+    def _dispatch_pending(self, key):
+        ready = []
+        with self.lock:
+            pending = self.pending.get(key)
+            limit = self.limits.get(key)
+            while pending and (not limit or self.running.get(key, 0) < limit):
+                self.running[key] = self.running.get(key, 0) + 1
+                ready.append(pending.popleft())
+
+        for lane, task in ready:
+            lane.put(task)
+
+    def submit(self, func, args=(), kwargs={}, lane=DEFAULT_LANE, key=None):
+        l = self.lanes.get(lane)
+        if not l:
+            raise Exception('no executor lane[%s], available lanes are %s' % (lane, self.lanes.keys()))
+
+        task = _Task(func, args, kwargs, key, self._task_done)
+        if key is None:
+            l.put(task)
+            return
+
+        with self.lock:
+            limit = self.limits.get(key)
+            if limit and self.running.get(key, 0) >= limit:
+                self.pending.setdefault(key, collections.deque()).append((l, task))
+                return
+            self.running[key] = self.running.get(key, 0) + 1
+        l.put(task)
+
+    def get_metrics(self):
+        ret = {'lanes': dict([(name, lane.get_metrics()) for name, lane in self.lanes.items()])}
+        with self.lock:
+            ret['keys'] = dict([(k, {'running': self.running.get(k, 0), 'pending': len(self.pending.get(k, [])),
+                                     'limit': self.limits.get(k)})
+                                for k in set(self.running.keys() + self.pending.keys())])
+        return ret
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    if _executor:
+        return _executor
+
+    with _executor_lock:
+        if not _executor:
+            _executor = Executor()
+        return _executor
+
+# run func(item) for each item with at most 'parallelism' threads and wait for all of them,
+# no new item is started after a failure and the first exception is raised
+def run_parallel(func, items, parallelism):
+    items = list(items)
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+
+    errors = []
+    def worker():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                func(item)
+            except Exception as e:
+                logger.warn('%s\n%s' % (str(e), traceback.format_exc()))
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker, name=func.__name__) for _ in range(min(max(parallelism, 1), len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]